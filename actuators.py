@@ -0,0 +1,268 @@
+"""
+액추에이터(전등, 히터, 펌프)의 상태가 바뀐 순간만 기록하는 상태 변화 로그(actuator_events 테이블) 모듈.
+
+예전에는 measurements의 모든 줄에 'ON'/'OFF' 문자열 네 개를 같이 저장했지만, 액추에이터 상태는 하루에 몇 번만 바뀜.
+이제 SmartFarmDevice가 GPIO에 쓸 때마다 (스마트팜, 액추에이터, 시각, 새 상태) 한 줄을 이어 붙이고(append-only),
+어느 시각의 상태나 기간 동안 켜져 있던 시간은 이 로그에서 계산함.
+
+actuator_events 테이블 한 줄의 구조
+- device_id : 스마트팜 이름
+- actuator : ACTUATORS 중 하나 ("led_first", "led_second", "heater", "pump")
+- timestamp_ms : 상태가 바뀐 시각 (epoch 밀리초)
+- state : 새 상태 (1 켜짐, 0 꺼짐)
+
+계산은 한 액추에이터의 로그를 (시각 int64, 상태 int8) NumPy 배열(ActuatorTimeline)로 읽어 searchsorted와 누적합으로 함.
+- 시각 T의 상태 : T 이하인 마지막 변화의 상태
+- [a, b) 동안 켜져 있던 시간 : F(b) - F(a) (F(t)는 처음부터 t까지 켜져 있던 시간의 누적값)
+첫 기록보다 앞선 시각은 상태를 모르므로 꺼져 있던 것으로 셈.
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+ACTUATORS = ("led_first", "led_second", "heater", "pump")
+# measurements 테이블과 페이지들이 쓰던 상태 열 이름 ("heater" -> "heater_state")
+STATE_FIELDS = {f"{actuator}_state": actuator for actuator in ACTUATORS}
+
+CREATE_ACTUATOR_EVENTS_QUERY = """CREATE TABLE IF NOT EXISTS actuator_events(
+                device_id TEXT NOT NULL,
+                actuator TEXT NOT NULL,
+                timestamp_ms INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                PRIMARY KEY (device_id, actuator, timestamp_ms));"""
+
+INSERT_ACTUATOR_EVENT_QUERY = (
+    "INSERT OR REPLACE INTO actuator_events (device_id, actuator, timestamp_ms, state) VALUES (?, ?, ?, ?);"
+)
+
+HOUR_MS = 3600 * 1000
+
+# 히터의 소비전력(W, 환경변수 SMARTFARM_HEATER_WATTS). 켜져 있던 시간에 곱해 전력량(kWh)을 계산함.
+# 히터마다 소비전력이 달라 기본값을 두지 않으므로, 주지 않으면(0) 전력량은 계산하지 않고 켜져 있던 시간(on_hours)만 반환함
+HEATER_POWER_WATTS = float(os.environ.get("SMARTFARM_HEATER_WATTS", "0"))
+
+
+def ensure_actuator_events_table(con):
+    with con:
+        con.execute(CREATE_ACTUATOR_EVENTS_QUERY)
+
+
+def transitions_query(source, device_expr, timestamp_expr, condition="1"):
+    """
+    상태 열이 있는 예전 measurements 같은 테이블 source에서, 상태가 바뀐 줄들만 골라 actuator_events에 넣는 SQL 문들을 만듬.
+    - device_expr : 스마트팜 이름 SQL 식 (열 이름 혹은 '?')
+    - timestamp_expr : epoch 밀리초 SQL 식
+    - condition : source에서 읽을 줄들의 조건 (나눠서 옮길 때). 인자는 device_expr의 것 다음에 줌
+    각 스마트팜에서 condition 안의 첫 줄은 actuator_events에 이미 있는 그 앞의 마지막 상태와 비교하므로,
+    오래된 줄부터 나눠 옮겨도 같은 상태가 두 번 기록되지 않음
+    """
+    queries = []
+    for actuator in ACTUATORS:
+        column = f"{actuator}_state"
+        queries.append(
+            "INSERT OR REPLACE INTO actuator_events (device_id, actuator, timestamp_ms, state) "
+            f"SELECT device_id, '{actuator}', timestamp_ms, state FROM ("
+            "SELECT device_id, timestamp_ms, state, lag(state) OVER (PARTITION BY device_id ORDER BY timestamp_ms) AS previous FROM ("
+            f"SELECT {device_expr} AS device_id, {timestamp_expr} AS timestamp_ms, ({column} = 'ON') AS state "
+            f"FROM {source} WHERE {column} IS NOT NULL AND ({condition}))) AS t "
+            "WHERE previous != state OR (previous IS NULL AND state IS NOT ("
+            f"SELECT e.state FROM actuator_events AS e WHERE e.device_id = t.device_id AND e.actuator = '{actuator}' "
+            "AND e.timestamp_ms < t.timestamp_ms ORDER BY e.timestamp_ms DESC LIMIT 1));"
+        )
+    return queries
+
+
+class ActuatorTimeline:
+    """
+    액추에이터 하나의 상태 변화들을 담은 배열.
+    - times(int64[]) : 상태가 바뀐 시각들 (epoch 밀리초, 오름차순)
+    - states(int8[]) : 바뀐 상태들 (1, 0)
+    """
+
+    def __init__(self, times, states):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.states = np.asarray(states, dtype=np.int8)
+        # cumulative[i] : 첫 변화부터 times[i]까지 켜져 있던 시간(밀리초)
+        self.cumulative = np.zeros(len(self.times), dtype=np.int64)
+        if len(self.times) > 1:
+            np.cumsum(self.states[:-1].astype(np.int64) * np.diff(self.times), out=self.cumulative[1:])
+
+    def __len__(self):
+        return len(self.times)
+
+    def state_at(self, when_ms):
+        """시각(들)의 상태를 반환함 (1, 0, 첫 기록보다 앞서면 -1)"""
+        when_ms = np.asarray(when_ms, dtype=np.int64)
+        if len(self.times) == 0:
+            return np.full(when_ms.shape, -1, dtype=np.int8)
+        index = np.searchsorted(self.times, when_ms, side="right") - 1
+        return np.where(index >= 0, self.states[np.maximum(index, 0)], -1).astype(np.int8)
+
+    def on_ms_until(self, when_ms):
+        """첫 기록부터 시각(들)까지 켜져 있던 시간(밀리초) F(t)"""
+        when_ms = np.asarray(when_ms, dtype=np.int64)
+        if len(self.times) == 0:
+            return np.zeros(when_ms.shape, dtype=np.int64)
+        index = np.searchsorted(self.times, when_ms, side="right") - 1
+        safe = np.maximum(index, 0)
+        value = self.cumulative[safe] + self.states[safe].astype(np.int64) * (when_ms - self.times[safe])
+        return np.where(index >= 0, value, 0)
+
+    def on_ms_between(self, start_ms, end_ms):
+        """[start, end) 구간(들) 동안 켜져 있던 시간(밀리초)"""
+        return self.on_ms_until(end_ms) - self.on_ms_until(start_ms)
+
+    def duty_cycle(self, start_ms, end_ms):
+        """
+        [start, end) 구간(들) 동안 켜져 있던 비율 (0~1)
+
+        1초부터 4초까지, 6초부터 계속 켜져 있던 액추에이터 (첫 기록 앞의 0~1초는 꺼져 있던 것으로 셈)
+        >>> timeline = ActuatorTimeline([1000, 4000, 6000], [1, 0, 1])
+        >>> timeline.duty_cycle([0, 0, 2000], [8000, 2000, 10000]).tolist()
+        [0.625, 0.5, 0.75]
+        """
+        start_ms = np.asarray(start_ms, dtype=np.int64)
+        end_ms = np.asarray(end_ms, dtype=np.int64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.on_ms_between(start_ms, end_ms) / (end_ms - start_ms)
+
+
+def day_boundaries(start, end):
+    """start(datetime)가 속한 날의 자정부터 end(datetime) 다음 자정까지의 자정 시각들 (epoch 밀리초 int64 배열)"""
+    day = datetime.combine(start.date(), datetime.min.time())
+    boundaries = []
+    while True:
+        boundaries.append(int(day.timestamp() * 1000))
+        if day > end:
+            break
+        # 서머타임이 있어도 자정이 되도록 날짜로 더함
+        day = datetime.combine(day.date() + timedelta(days=1), datetime.min.time())
+    return np.array(boundaries, dtype=np.int64)
+
+
+class ActuatorLog:
+    """
+    스마트팜들의 액추에이터 상태 변화를 기록하고 읽는 객체.
+    - db_path(str) : datas.db 경로 (읽을 때 씀)
+    - writer(ingest.MeasurementWriter) : 기록할 변화를 넘길 저장기. 측정값과 같은 writer 스레드가 모아서 저장함
+    """
+
+    def __init__(self, db_path, writer):
+        self.db_path = db_path
+        self.writer = writer
+        self._lock = threading.Lock()
+        # (스마트팜, 액추에이터) -> 마지막으로 기록한 상태. 같은 상태를 다시 쓰는 것은 기록하지 않음
+        self._last_state = {}
+
+        # 지표들
+        self.recorded_count = 0
+
+    def load_last_states(self, device_id):
+        """datas.db에 기록된 그 스마트팜의 액추에이터마다 마지막 상태를 불러옴 (서버가 켜질 때 한번)"""
+        con = sqlite3.connect(self.db_path)
+        try:
+            rows = con.execute(
+                "SELECT actuator, state FROM actuator_events AS e WHERE device_id = ? AND timestamp_ms = "
+                "(SELECT max(timestamp_ms) FROM actuator_events WHERE device_id = e.device_id AND actuator = e.actuator);",
+                (device_id,),
+            ).fetchall()
+        finally:
+            con.close()
+        with self._lock:
+            for actuator, state in rows:
+                self._last_state[(device_id, actuator)] = state
+
+    def record(self, device_id, actuator, state, timestamp_ms=None):
+        """
+        액추에이터의 새 상태를 기록함. 마지막으로 기록한 상태와 같으면 기록하지 않음.
+        SmartFarmDevice.add_actuator_listener()에 partial(log.record, device_id)로 등록해 씀
+        """
+        state = 1 if state else 0
+        key = (device_id, actuator)
+        with self._lock:
+            if self._last_state.get(key) == state:
+                return False
+            self._last_state[key] = state
+            self.recorded_count += 1
+        if timestamp_ms is None:
+            timestamp_ms = int(datetime.now().timestamp() * 1000)
+        self.writer.submit_actuator_event((device_id, actuator, timestamp_ms, state))
+        return True
+
+    def timeline(self, device_id, actuator, start_ms=None, end_ms=None) -> ActuatorTimeline:
+        """
+        [start, end] 기간의 상태 변화들을 ActuatorTimeline으로 읽음.
+        start 이전의 마지막 변화도 함께 읽어 start 시각의 상태를 알 수 있게 함. None이면 제한 없음
+        """
+        conditions = ["device_id = ?", "actuator = ?"]
+        params = [device_id, actuator]
+        if start_ms is not None:
+            conditions.append(
+                "timestamp_ms >= coalesce((SELECT max(timestamp_ms) FROM actuator_events "
+                "WHERE device_id = ? AND actuator = ? AND timestamp_ms <= ?), ?)"
+            )
+            params += [device_id, actuator, start_ms, start_ms]
+        if end_ms is not None:
+            conditions.append("timestamp_ms <= ?")
+            params.append(end_ms)
+        con = sqlite3.connect(self.db_path)
+        try:
+            rows = con.execute(
+                f"SELECT timestamp_ms, state FROM actuator_events WHERE {' AND '.join(conditions)} ORDER BY timestamp_ms;",
+                params,
+            ).fetchall()
+        finally:
+            con.close()
+        if not rows:
+            return ActuatorTimeline([], [])
+        times, states = zip(*rows)
+        return ActuatorTimeline(times, states)
+
+    def states_at(self, device_id, timestamps_ms) -> dict:
+        """시각들에서의 모든 액추에이터 상태 -> {"led_first_state": int8[], ...} (1, 0, 모르면 -1)"""
+        timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+        if len(timestamps_ms) == 0:
+            return {field: np.zeros(0, dtype=np.int8) for field in STATE_FIELDS}
+        start_ms, end_ms = int(timestamps_ms.min()), int(timestamps_ms.max())
+        return {
+            field: self.timeline(device_id, actuator, start_ms, end_ms).state_at(timestamps_ms)
+            for field, actuator in STATE_FIELDS.items()
+        }
+
+    def duty_cycle(self, device_id, actuator, start, end, bucket=None) -> list:
+        """
+        기간 동안 켜져 있던 시간과 비율을 구간별로 계산함.
+        - start, end(datetime) : 기간
+        - bucket(str) : None이면 기간 전체 하나, "1h"면 한 시간마다, "1d"면 하루(자정~자정)마다
+        -> return [{"start": datetime, "end": datetime, "on_hours": float, "duty_cycle": float}, ...]
+        """
+        start_ms = int(start.timestamp() * 1000)
+        end_ms = int(end.timestamp() * 1000)
+        if bucket is None:
+            edges = np.array([start_ms, end_ms], dtype=np.int64)
+        elif bucket == "1h":
+            first = int(start.replace(minute=0, second=0, microsecond=0).timestamp() * 1000)
+            edges = np.arange(first, end_ms + HOUR_MS, HOUR_MS, dtype=np.int64)
+        elif bucket == "1d":
+            edges = day_boundaries(start, end)
+        else:
+            raise ValueError(f"구간 {bucket}는 허용되지 않습니다! (None, '1h', '1d')")
+        # 구간 경계를 기간 안으로 자름 (첫 구간과 마지막 구간은 기간에 걸친 부분만 셈)
+        edges = np.unique(np.clip(edges, start_ms, end_ms))
+        timeline = self.timeline(device_id, actuator, start_ms, end_ms)
+        lower, upper = edges[:-1], edges[1:]
+        on_ms = timeline.on_ms_between(lower, upper)
+        duty = timeline.duty_cycle(lower, upper)
+        return [
+            {
+                "start": datetime.fromtimestamp(a / 1000),
+                "end": datetime.fromtimestamp(b / 1000),
+                "on_hours": round(on / HOUR_MS, 4),
+                "duty_cycle": round(float(d), 4),
+            }
+            for a, b, on, d in zip(lower.tolist(), upper.tolist(), on_ms.tolist(), duty.tolist())
+        ]
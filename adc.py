@@ -0,0 +1,140 @@
+"""
+MCP3008 ADC를 한 번의 SPI 트랜잭션으로 여러 번 변환(oversampling)해 읽고, 보정표로 값을 환산하는 모듈.
+
+수위센서를 한 번만 읽으면 잡음 때문에 그래프가 들쭉날쭉하기 때문에
+- BurstADCReader : 채널마다 samples번의 변환 명령(3바이트씩)을 미리 만들어 둔 한 덩어리로 xfer2 한 번에 보내고,
+  받은 bytes를 NumPy로 한꺼번에 10비트 코드로 풀어 채널별로 중앙값(median)이나 절사평균(trimmed mean)으로 줄임.
+  여러 채널을 같은 덩어리에 섞어 보내므로 다른 채널을 읽느라 트랜잭션이 늘어나지 않음
+- CalibrationTable : 실측한 (ADC 코드, 값) 점들을 선형 보간해 ADC 코드 0~1023 각각의 값을 미리 계산해 둔 1024칸짜리 표.
+  읽을 때는 표를 찾아보기만 함
+"""
+
+import numpy as np
+
+import metrics
+
+VREF = 3.3  # MCP3008 기준 전압(V)
+ADC_CODES = 1024  # 10비트
+# spidev가 한 트랜잭션에 보낼 수 있는 기본 최대 크기(bytes)
+SPI_MAX_TRANSFER = 4096
+
+REDUCE_METHODS = ("median", "trimmed_mean")
+
+SPI_READ_SECONDS = metrics.histogram("smartfarm_spi_read_seconds", "ADC burst 한 번의 SPI 트랜잭션에 걸린 시간")
+
+
+def code_to_volts(code):
+    return VREF * code / ADC_CODES
+
+
+def volts_to_code(volts):
+    return volts / VREF * ADC_CODES
+
+
+def build_burst(channels, samples):
+    """channels를 차례로 samples번 변환시키는 single-ended 명령들을 한 list로 만듬 (변환 한 번에 3바이트)"""
+    frame = []
+    for channel in channels:
+        if not 0 <= channel <= 7:
+            raise ValueError(f"MCP3008에는 {channel}번 채널이 없습니다! (0~7)")
+        frame.extend([1, (8 + channel) << 4, 0])
+    return frame * samples
+
+
+def decode_burst(response, n_channels, samples):
+    """xfer2의 응답을 (samples, n_channels) 모양의 uint16 ADC 코드 배열로 풀어냄"""
+    raw = np.frombuffer(bytes(response), dtype=np.uint8).reshape(samples, n_channels, 3)
+    return ((raw[:, :, 1].astype(np.uint16) & 0x03) << 8) | raw[:, :, 2]
+
+
+def reduce_codes(codes, method="median", trim=0.2):
+    """
+    (samples, channels) 코드 배열을 채널별 값 하나씩으로 줄임 -> float64[channels]
+    - method : "median"(중앙값) 혹은 "trimmed_mean"(양 끝 trim 비율씩 버린 평균)
+    """
+    if method == "median":
+        return np.median(codes, axis=0)
+    elif method == "trimmed_mean":
+        samples = codes.shape[0]
+        cut = int(samples * trim)
+        ordered = np.sort(codes, axis=0)
+        return ordered[cut : samples - cut].mean(axis=0)
+    raise ValueError(f"알 수 없는 방법 {method}입니다! ({REDUCE_METHODS} 중 하나)")
+
+
+class BurstADCReader:
+    """
+    여러 채널을 oversampling해서 한 번의 SPI 트랜잭션으로 읽는 객체.
+    - spi : 열려 있는 spidev.SpiDev (혹은 같은 인터페이스의 가상 장치)
+    - channels(list[int]) : 읽을 MCP3008 채널들
+    - samples(int) : 채널마다 변환할 횟수
+    - method(str) : reduce_codes()의 방법
+    - trim(float) : trimmed_mean에서 양 끝에서 버릴 비율
+    """
+
+    def __init__(self, spi, channels, samples=32, method="median", trim=0.2):
+        if method not in REDUCE_METHODS:
+            raise ValueError(f"알 수 없는 방법 {method}입니다! ({REDUCE_METHODS} 중 하나)")
+        self.spi = spi
+        self.channels = list(channels)
+        self.samples = samples
+        self.method = method
+        self.trim = trim
+        self._burst = build_burst(self.channels, samples)
+        if len(self._burst) > SPI_MAX_TRANSFER:
+            raise ValueError(
+                f"한 번에 보낼 SPI 데이터({len(self._burst)} bytes)가 {SPI_MAX_TRANSFER} bytes보다 큽니다! samples를 줄여주세요"
+            )
+
+        # 지표들
+        self.read_count = 0
+        self.last_spread = {}  # 채널별 마지막 읽기의 (최대 코드 - 최소 코드). 잡음 크기를 볼 때 씀
+
+    def read_codes(self):
+        """burst 한 번을 보내 (samples, channels) 코드 배열을 반환함"""
+        # xfer2는 넘긴 list를 응답으로 덮어쓰는 구현도 있어 복사본을 넘김
+        with SPI_READ_SECONDS.time():
+            response = self.spi.xfer2(list(self._burst))
+        self.read_count += 1
+        return decode_burst(response, len(self.channels), self.samples)
+
+    def read(self):
+        """burst 한 번을 보내 {채널: 줄인 ADC 코드(float)} dict를 반환함"""
+        codes = self.read_codes()
+        reduced = reduce_codes(codes, self.method, self.trim)
+        spread = codes.max(axis=0) - codes.min(axis=0)
+        self.last_spread = dict(zip(self.channels, spread.tolist()))
+        return dict(zip(self.channels, reduced.tolist()))
+
+
+class CalibrationTable:
+    """
+    ADC 코드 -> 물리값(예: 수위 cm) 1024칸 보정표.
+    - points(list[(code, value)]) : 실측한 점들. 점들 사이는 선형 보간하고, 양 끝 밖은 가장 가까운 점의 값을 씀
+    """
+
+    def __init__(self, points):
+        if len(points) < 2:
+            raise ValueError("보정표를 만들려면 실측한 점이 두 개 이상 필요합니다!")
+        points = sorted(points)
+        codes = np.array([code for code, _ in points], dtype=np.float64)
+        values = np.array([value for _, value in points], dtype=np.float64)
+        self.points = points
+        self.table = np.interp(np.arange(ADC_CODES), codes, values)
+
+    @classmethod
+    def from_volts(cls, points):
+        """(전압 V, 값) 점들로 보정표를 만듬"""
+        return cls([(volts_to_code(volts), value) for volts, value in points])
+
+    def lookup(self, code):
+        """
+        ADC 코드(소수여도 됨 - 중앙값이나 평균이므로)를 보정표로 환산함.
+        소수 코드는 양 옆 두 칸 사이를 선형 보간함
+        """
+        code = min(max(float(code), 0.0), ADC_CODES - 1)
+        low = int(code)
+        if low == ADC_CODES - 1:
+            return float(self.table[low])
+        fraction = code - low
+        return float(self.table[low] + (self.table[low + 1] - self.table[low]) * fraction)
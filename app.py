@@ -1,15 +1,57 @@
-from flask import Flask, request, render_template, redirect, jsonify
-from flask_socketio import SocketIO, emit
-from hardware import SmartFarmDevice, DEFAULT_MIN_TEMP, DEFAULT_OFF_TIME, DEFAULT_ON_TIME
-from datetime import datetime
-from time import strftime
 import time
-from PIL import Image
+
+# 프로세스가 켜진 시각 - import에 걸린 시간까지 켜는 시간에 넣기 위해 가장 먼저 잼
+_PROCESS_STARTED = time.monotonic()
+
+from flask import Flask, request, render_template, redirect, jsonify, Response
+from flask_socketio import SocketIO, join_room
+from hardware import SmartFarmDevice, GPIO
+from datetime import datetime, timedelta
 import numpy as np
-import RPi.GPIO as GPIO
-import base64
-from functools import wraps
+from contextlib import contextmanager
+from functools import partial, wraps
+import os
+from ingest import connect_database, ensure_measurements_table
+from storage import STORAGE_BACKEND, open_storage
+from migrate import MeasurementMigration
+import history
+from scheduler import AcquisitionScheduler
+from control import ControlEngine
+from streaming import FrameBroadcaster, BOUNDARY
+from ringbuffer import SampleRingBuffer, ms_to_timestamp, decode_states, timestamp_to_ms
+from archive import ImageArchive
+from telemetry import TelemetryPublisher
+from fleet import FleetDevice, load_fleet_config
+from settings import SettingsStore
+from retention import ARCHIVE_DIR, RetentionManager, iter_archived_rows
+from actuators import ACTUATORS, HEATER_POWER_WATTS, ActuatorLog
+from rules import RuleEngine, alert_room, load_rules, query_alerts
+from growth import GROWTH_INTERVAL, GrowthAnalyzer, ensure_growth_table, growth_query
+import itertools
 import sqlite3
+import log
+import metrics
+
+# 측정원별 주기(초). 가상 하드웨어(SMARTFARM_BACKEND=sim)로 부하 테스트할 때는 환경변수로 줄여서 빠르게 돌릴 수 있음
+# - MEASURE_INTERVAL : 측정값을 datas.db에 저장하는 주기
+# - DHT_INTERVAL : 온습도센서를 읽고 텔레메트리 'environment' 채널로 발행하는 주기
+# - WATER_LEVEL_INTERVAL : 수위센서를 읽고 텔레메트리 'water_level' 채널로 발행하는 주기
+# - IMAGE_INTERVAL : /streaming/mjpeg를 보는 사람이 있을 때 카메라로 사진을 찍는 주기
+# - IMAGE_ARCHIVE_INTERVAL : 카메라 사진을 사진 보관소(./captured_images/)에 저장하는 주기
+MEASURE_INTERVAL = float(os.environ.get("SMARTFARM_MEASURE_INTERVAL", 30))
+DHT_INTERVAL = float(os.environ.get("SMARTFARM_DHT_INTERVAL", 10))
+WATER_LEVEL_INTERVAL = float(os.environ.get("SMARTFARM_WATER_LEVEL_INTERVAL", 1))
+IMAGE_INTERVAL = float(os.environ.get("SMARTFARM_IMAGE_INTERVAL", 6))
+IMAGE_ARCHIVE_INTERVAL = float(os.environ.get("SMARTFARM_IMAGE_ARCHIVE_INTERVAL", 30))
+
+# 메모리 링 버퍼에 들고 있을 최근 측정값 개수 (30초 주기면 하루치)
+RECENT_SAMPLE_CAPACITY = 2880
+
+# 전원이 켜진 뒤 제어 엔진(히터, 전등 조절)이 돌기 시작할 때까지 걸려도 되는 시간(초). 넘으면 어느 단계가 오래 걸렸는지 출력함
+STARTUP_BUDGET_SECONDS = float(os.environ.get("SMARTFARM_STARTUP_BUDGET", 10))
+STARTUP_PHASE_SECONDS = metrics.gauge("smartfarm_startup_phase_seconds", "서버를 켤 때 단계마다 걸린 시간", ["phase"])
+
+LOG = log.get_logger("app")
 
 app = Flask(__name__)
 socketio = SocketIO(app)
@@ -19,98 +61,229 @@ authenticated = False
 
 class FlaskAppWrapper:
     def __init__(self, app):
-        ## self.datas의 구조
-        # 개별 data의 구조는 {"timestamp" : "2023.08.08 07:11:09"와 같은 형태의 문자열, "temperature":float, "humidity":float, "water_level" : float
-        # "led_first_state" : str ('ON'/'OFF'), "led_second_state" : str ('ON'/'OFF'), "heater_state" : str ('ON'/'OFF'), "pump_state" : str ('ON'/'OFF')}
-        # self.datas는 위 개별 data들'을 시간순서대로 모아둔 list임
-        self.con_data = sqlite3.connect("./datas.db")  # DATA 저장용
-        self.con_setting = sqlite3.connect("./settings.db")  # SETTING 저장용
-        self.cur_data = self.con_data.cursor()
-        self.cur_setting = self.con_setting.cursor()
-
-        # 데이터 저장용 테이블 있는지 확인
-        self.cur_data.execute(
-            "SELECT count(name) FROM sqlite_master WHERE type='table' AND name = 'measurements';"
-        )
-        count_data_table = self.cur_data.fetchone()[0]
-        if count_data_table == 0:
-            print("[app.__init__] : datas.db에 measurements 테이블이 존재하지 않습니다!")
-            self.cur_data.execute(
-                """CREATE table measurements(
-								timestamp TEXT PRIMARY KEY,
-								temperature REAL,
-								humidity REAL,
-								water_level REAL,
-								led_first_state TEXT,
-								led_second_state TEXT,
-								heater_state TEXT,
-								pump_state TEXT);"""
-            )
-            self.con_data.commit()  # 수정사항 반영
-        else :
-            print("[app.__init__]: datas.db에 measurements 테이블이 존재합니다.")
+        ## datas.db의 measurements 테이블 한 줄의 구조
+        # device_id(스마트팜 이름), timestamp_ms(epoch 밀리초 정수), temperature, humidity, water_level (float)
+        # 액추에이터 상태는 바뀔 때만 actuator_events 테이블에 따로 기록함 (actuators.py)
+        self.app = app
+        # 전원이 나갔다 켜졌을 때 히터 제어가 최대한 빨리 돌아오도록, 켜는 순서는
+        # 스마트팜(GPIO) -> 제어 엔진 -> 링 버퍼 -> 스케줄러 -> 웹페이지 순서이며 단계마다 걸린 시간을 잼
+        self.startup_phases = {"imports": time.monotonic() - _PROCESS_STARTED}
+
+        with self.startup_phase("config"):
+            # 함께 돌릴 스마트팜들 (fleet.json). 첫번째 스마트팜이 기본 스마트팜이며 예전 데이터와 설정을 이어받음
+            self.fleet_config = load_fleet_config()
+            device_ids = [config.device_id for config in self.fleet_config]
+            self.default_device_id = device_ids[0]
+
+            self.con_data = connect_database("./datas.db")  # DATA 저장용 (WAL 모드)
+            # datas.db의 형식 버전(schema_version)을 확인함. 이 서버보다 새 형식이면 SchemaVersionError로 멈추고,
+            # 예전 형식이면 새 테이블로 바꿔 단 뒤 예전 측정값은 서버가 도는 동안 조금씩 옮김 (migrate.py)
+            migration_pending = ensure_measurements_table(self.con_data, self.default_device_id)
+            # 사진으로 계산한 생장 값 테이블 (카메라가 없어도 /api/growth가 빈 결과를 돌려주도록 항상 만듬)
+            ensure_growth_table(self.con_data)
+            self.settings = SettingsStore("./settings.db")  # SETTING 저장용 (스마트팜마다 한 줄)
+            self.settings.ensure(device_ids)
+
+            # raw 측정값 저장소 (SMARTFARM_STORAGE - datas.db 혹은 memory-mapped segment 파일, storage.py)와
+            # 모든 스마트팜의 측정값(segment 저장소면 집계만)을 모아서 저장하는 write-behind 저장기 하나 - 측정 루프는 디스크 I/O를 기다리지 않음
+            self.storage = open_storage(STORAGE_BACKEND, "./datas.db", max_delay=MEASURE_INTERVAL)
+            self.measurement_writer = self.storage.writer
+            # 액추에이터 상태가 바뀐 순간만 기록하는 상태 변화 로그 (기록은 위 저장기가 측정값과 함께 함)
+            self.actuator_log = ActuatorLog("./datas.db", self.measurement_writer)
+
+            # 경보 규칙들 (rules.json. 없으면 기본 규칙) - 잘못된 규칙이 있으면 RuleConfigError로 멈춤
+            self.rules = load_rules(device_ids=device_ids)
+
+            # 구독한 사용자에게만 바뀐 값만 보내는 텔레메트리 발행기 (스마트팜마다 채널을 등록함)
+            self.telemetry = TelemetryPublisher(socketio)
+
+        with self.startup_phase("devices"):
+            # 스마트팜들을 켬 (GPIO를 설정하고 저장된 설정값대로 전등과 히터를 맞춤)
+            self.devices = {}
+            for config in self.fleet_config:
+                self.devices[config.device_id] = self.start_device(config)
+
+        with self.startup_phase("control"):
+            # 새 측정값, 설정값 변경, 전등 전환 시각에만 깨어나 모든 스마트팜의 히터와 전등을 조절하는 제어 엔진 하나
+            self.control_engine = ControlEngine([device.smartfarm for device in self.devices.values()])
+            self.control_engine.start()
+        self.startup_phases["control_ready"] = time.monotonic() - _PROCESS_STARTED
+
+        with self.startup_phase("ring_buffers"):
+            # 페이지들이 읽을 최근 측정값 (스케줄러가 새 측정값을 넣기 전에 채워야 순서가 맞음)
+            for device_id, device in self.devices.items():
+                timestamps, values = self.storage.latest(device_id, RECENT_SAMPLE_CAPACITY)
+                device.recent_samples.warm(
+                    timestamps,
+                    values,
+                    state_lookup=partial(self.actuator_log.states_at, device_id),
+                    source=self.storage.backend,
+                    device_id=device_id,
+                )
 
-        # 설정 저장용 테이블 있는지 확인
-        self.cur_setting.execute(
-            "SELECT count(name) FROM sqlite_master WHERE type='table' AND name='settings';"
+        with self.startup_phase("scheduler"):
+            # 측정값이 들어올 때마다 경보 규칙들을 검사하는 규칙 엔진 (측정 루프는 큐에 넣기만 함. 스케줄러보다 먼저 켬)
+            self.rule_engine = RuleEngine(self.rules, "./datas.db", socketio)
+            self.rule_engine.start()
+
+            # 측정원마다 자기 주기로 모든 스마트팜을 차례로 측정하고 측정이 끝나자마자 결과를 발행하는 스케줄러 하나
+            # (스마트팜을 늘려도 스케줄러 작업 수는 그대로임)
+            # - dht : 온습도센서 (DHT11은 자주 읽으면 실패가 잦아 DHT_INTERVAL마다)
+            # - water_level : SPI 수위센서 (읽는 비용이 작아 WATER_LEVEL_INTERVAL마다)
+            # - record : 현재 상태를 MEASURE_INTERVAL마다 datas.db에 저장
+            # - camera_archive : 카메라가 달린 스마트팜이 있으면 IMAGE_ARCHIVE_INTERVAL마다 사진 보관소에 사진을 저장
+            # - growth : 카메라가 달린 스마트팜이 있으면 GROWTH_INTERVAL마다 새로 저장된 사진들의 생장 분석 작업을 분석 프로세스에 넘김
+            self.scheduler = AcquisitionScheduler(spawn=socketio.start_background_task, sleep=socketio.sleep)
+            self.scheduler.add_source("dht", self.measure_environment, DHT_INTERVAL, jitter_budget=1.0)
+            self.scheduler.add_source("water_level", self.measure_water_levels, WATER_LEVEL_INTERVAL, jitter_budget=0.2)
+            self.scheduler.add_source("record", self.record_measurement, MEASURE_INTERVAL, jitter_budget=1.0)
+            if any(device.image_archive is not None for device in self.devices.values()):
+                self.scheduler.add_source("camera_archive", self.archive_image, IMAGE_ARCHIVE_INTERVAL, jitter_budget=2.0)
+            # 사진 보관소의 사진으로 초록 비율, 잎 넓이, 변화량을 계산하는 생장 분석기 (계산은 다른 프로세스에서 함, growth.py)
+            self.growth_analyzer = None
+            archives = {device_id: device.image_archive.root for device_id, device in self.devices.items() if device.image_archive}
+            if archives:
+                self.growth_analyzer = GrowthAnalyzer("./datas.db", archives)
+                self.growth_analyzer.start()
+                self.scheduler.add_source("growth", self.growth_analyzer.poll, GROWTH_INTERVAL, jitter_budget=5.0)
+            self.scheduler.start()
+
+            # 오래된 raw 측정값을 달마다 압축 열 파일로 옮기고 datas.db의 빈 공간을 조금씩 돌려주는 정리 스레드
+            self.retention = RetentionManager("./datas.db", ARCHIVE_DIR, segment_log=self.storage.segment_log)
+            self.retention.start()
+
+            # 예전 형식의 측정값을 조금씩 새 형식으로 옮기는 스레드 (옮길 것이 있을 때만)
+            self.migration = None
+            if migration_pending:
+                self.migration = MeasurementMigration("./datas.db")
+                self.migration.start()
+
+        with self.startup_phase("routes"):
+            # 라우팅
+            self.setup_route()
+            self.setup_socketio_events()
+            # '/metrics'를 읽을 때마다 각 객체의 get_stats()에서 모아오는 지표들 (측정 루프에서는 따로 기록하지 않음)
+            metrics.REGISTRY.add_collector(self.collect_metrics)
+
+        self.report_startup()
+
+    @contextmanager
+    def startup_phase(self, name):
+        """켜는 단계 하나가 걸린 시간을 self.startup_phases와 smartfarm_startup_phase_seconds 지표에 기록함"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.startup_phases[name] = elapsed
+            STARTUP_PHASE_SECONDS.labels(name).set(elapsed)
+
+    def report_startup(self):
+        """켜는 데 걸린 시간을 한 줄로 출력하고, STARTUP_BUDGET_SECONDS를 넘었으면 어느 단계가 오래 걸렸는지 알려줌"""
+        total = time.monotonic() - _PROCESS_STARTED
+        self.startup_phases["total"] = total
+        STARTUP_PHASE_SECONDS.labels("imports").set(self.startup_phases["imports"])
+        STARTUP_PHASE_SECONDS.labels("total").set(total)
+        LOG.info(
+            "startup", "서버를 켰습니다.", **{name: round(seconds, 2) for name, seconds in self.startup_phases.items()}
         )
-        count_setting_table = self.cur_setting.fetchone()[0]
-        if count_setting_table == 0:  # 만약 설정 저장용 테이블 없으면 만들고 기본값 넣음
-            print("[app.__init__]: settings.db에 settings 테이블이 존재하지 않습니다!")
-            self.cur_setting.execute(
-                """CREATE table settings(
-                                        ref_temperature REAL,
-				        ref_turn_on_time TEXT,
-				        ref_turn_off_time TEXT);"""
+        if self.startup_phases["control_ready"] > STARTUP_BUDGET_SECONDS:
+            slowest = max(
+                ("imports", "config", "devices", "control"), key=lambda name: self.startup_phases[name]
+            )
+            LOG.warning(
+                "startup_slow",
+                "제어 엔진이 켜지기까지 목표보다 오래 걸렸습니다!",
+                control_ready=round(self.startup_phases["control_ready"], 2),
+                budget=STARTUP_BUDGET_SECONDS,
+                slowest=slowest,
             )
-            self.con_setting.commit()  # 수정사항 반영
-            default_min_temp_str = DEFAULT_MIN_TEMP
-            default_on_time_str = DEFAULT_ON_TIME.strftime("%H:%M")
-            default_off_time_str = DEFAULT_OFF_TIME.strftime("%H:%M")
-            query = f"""INSERT INTO settings(
-                        ref_temperature,
-                        ref_turn_on_time,
-                        ref_turn_off_time)
-                    VALUES(
-                        {default_min_temp_str},
-                        '{default_on_time_str}',
-                        '{default_off_time_str}');
-                 """
-            self.cur_setting.execute(query)
-            self.con_setting.commit()  # 수정사항 반영
-        else :
-            print("[app.__init__]: settings.db에 settings 테이블이 존재합니다.")
-
-        # 저장된 설정값들 불러오기
-        # -> (ref_temperature, ref_turn_on_time, ref_turn_off_time) 이렇게 받아옴
-        self.reference_status = list(self.cur_setting.execute(
-            "SELECT * FROM settings;"
-        ).fetchone())
-        ref_temp = self.reference_status[0]
-        # 켤시각과 끌 시각은 datetime.time형으로 전달해야하기 때문에 문자열에서 datetime.time 형으로 변환함
-        ref_turn_on_time = datetime.strptime(self.reference_status[1], "%H:%M").time()
-        ref_turn_off_time = datetime.strptime(self.reference_status[2], "%H:%M").time()
-        print("[app.__init__] 설정된 초기값들")
-        print(f"    - 설정 최소 온도 : {ref_temp}")
-        print(f"    - 설정된 켜는 시각 : {ref_turn_on_time}")
-        print(f"    - 설정된 끄는 시각 : {ref_turn_off_time}")
-
-        self.app = app
-        self.smartfarm = SmartFarmDevice(ref_temp, ref_turn_on_time, ref_turn_off_time)
-
-        # 라우팅
-        self.setup_route()
 
-        # background thread 시작함
-        background_emit_measurement_thread = socketio.start_background_task(
-            self.measure_and_emit_periodically
+    def start_device(self, config):
+        """
+        설정(fleet.DeviceConfig)에 맞게 스마트팜 한 대를 켜고, 그 스마트팜에 딸린 링 버퍼, 카메라 방송, 사진 보관소,
+        텔레메트리 채널을 만들어 FleetDevice로 묶어 반환함
+        """
+        device_id = config.device_id
+        # 저장된 설정값들 불러오기 -> [ref_temperature, ref_turn_on_time, ref_turn_off_time]
+        reference_status = self.settings.load(device_id)
+        ref_temp = reference_status[0]
+        # 켤시각과 끌 시각은 datetime.time형으로 전달해야하기 때문에 문자열에서 datetime.time 형으로 변환함
+        ref_turn_on_time = datetime.strptime(reference_status[1], "%H:%M").time()
+        ref_turn_off_time = datetime.strptime(reference_status[2], "%H:%M").time()
+        LOG.info(
+            "start_device", "스마트팜을 켭니다.", device=device_id, min_temp=ref_temp, on_time=ref_turn_on_time, off_time=ref_turn_off_time
         )
-        # background_streaming_thread = socketio.start_background_task(self.update_image_periodically)
 
-        # CLEANUP : 스마트팜이 스스로 상태를 계속 조절하는 스레드와 그 스레드용 함수는 app.py가 아니라 hardware.py에 있어야 하고, 스마트팜의 __init__함수에서 스레드가 시작되는게 마땅함!
-        background_adjust_thread = socketio.start_background_task(
-            self.adjust_periodically
+        smartfarm = SmartFarmDevice(
+            ref_temp,
+            ref_turn_on_time,
+            ref_turn_off_time,
+            pins=config.pins,
+            device_id=device_id,
+            camera_enabled=config.camera,
+            water_level_calibration=config.water_level_calibration,
+        )
+        # 이제부터 출력 핀에 쓸 때마다 상태가 바뀌었으면 상태 변화 로그에 남기고,
+        # 켜면서 맞춘 지금 상태도 (서버가 꺼져 있던 사이에 바뀌었을 수 있으므로) 한번 기록함
+        self.actuator_log.load_last_states(device_id)
+        smartfarm.add_actuator_listener(partial(self.actuator_log.record, device_id))
+        for actuator in ACTUATORS:
+            self.actuator_log.record(device_id, actuator, getattr(smartfarm, f"get_{actuator}_state")() == GPIO.HIGH)
+
+        # 최근 측정값들을 메모리에 들고 있는 링 버퍼 - /stats, /control은 sqlite 대신 여기서 읽음
+        # (datas.db에서 채우는 것은 제어 엔진을 켠 뒤에 함)
+        recent_samples = SampleRingBuffer(RECENT_SAMPLE_CAPACITY)
+
+        frame_broadcaster = None
+        image_archive = None
+        if smartfarm.camera_enabled:
+            # 카메라 화면을 보는 사람이 있을 때만 사진을 찍어 모든 viewer에게 MJPEG로 나눠주는 캡처 스레드
+            frame_broadcaster = FrameBroadcaster(smartfarm.get_image, IMAGE_INTERVAL)
+            # 사진을 날짜별 segment 파일에 모아 저장하고 시각으로 찾을 수 있게 하는 사진 보관소 (저장은 스레드 풀에서 함)
+            image_archive = ImageArchive(os.path.join("./captured_images", device_id))
+
+        # 텔레메트리 채널
+        # - environment : 온습도 측정마다 (그래프에 점을 찍어야 하므로 바뀐 값이 없어도 시각은 보냄)
+        # - water_level : 수위 측정마다 (바뀌었을 때만)
+        self.telemetry.add_channel(
+            device_id,
+            "environment",
+            ("temperature", "humidity", "water_level", "led_first_state", "led_second_state", "heater_state", "pump_state"),
+            send_empty=True,
         )
+        self.telemetry.add_channel(device_id, "water_level", ("water_level",))
+
+        return FleetDevice(config, smartfarm, reference_status, recent_samples, frame_broadcaster, image_archive)
+
+    def request_device(self):
+        """
+        요청의 device 인자(쿼리 혹은 form)로 고른 스마트팜(FleetDevice)을 반환함. 주어지지 않으면 기본 스마트팜, 없는 이름이면 None
+        """
+        device_id = request.values.get("device") or self.default_device_id
+        return self.devices.get(device_id)
+
+    def unknown_device_response(self):
+        device_id = request.values.get("device")
+        LOG.warning("unknown_device", "존재하지 않는 스마트팜이 요청되었습니다!", device=device_id)
+        return jsonify({"error": f"스마트팜 {device_id}가 없습니다! ({', '.join(self.devices)} 중 하나)"}), 404
+
+    def for_each_device(self, func):
+        """모든 스마트팜에 대해 func(device)를 부름. 한 대에서 오류가 나도 나머지 스마트팜은 계속함"""
+        for device in self.devices.values():
+            try:
+                func(device)
+            except Exception as e:
+                # 고장난 스마트팜 한 대가 측정 주기마다 로그를 남기지 않도록 1분에 한 줄만 남김
+                LOG.error(
+                    "device_failed",
+                    "스마트팜에서 오류가 발생했습니다!",
+                    key=(device.device_id, func.__name__),
+                    every=60,
+                    device=device.device_id,
+                    task=func.__name__,
+                    error=e,
+                )
 
     def convert_state(self, i):
         """
@@ -140,88 +313,214 @@ class FlaskAppWrapper:
         self.app.add_url_rule("/control/set_temp", "set_temp", self.set_temp, methods=["POST"])
         self.app.add_url_rule("/control/set_time_period","set_time_period",self.set_time_period,methods=["POST"])
         self.app.add_url_rule("/streaming", "streaming", self.streaming, methods=["GET"])
-
-    def measure_and_emit_periodically(self):
-        """
-        30초에 한번씩 주기적으로 스마트팜의 측정값들을 갱신하고 얻은 측정값들을 'give_data'란 이벤트 이름으로 emit하는 스레드용 함수
-        """
-        con_data = sqlite3.connect("./datas.db", check_same_thread = False)  # 다른 스레드에서 쓰기 위한 Data 저장용 DB connection을 하나 더 만듬.. 그냥 self.con_data 객체 쓰면 오류나더라고
-        cur_data = con_data.cursor()
-        while True:
-            print("[app.measure_and_emit_periodically() 실행됨]")
-            start_time = time.time()
-
-            # 스마트팜 측정 후 데이터 얻음
-            self.smartfarm.measure_temp_and_humidity()
-            self.smartfarm.measure_water_level()
-            temperature = self.smartfarm.get_temperature()
-            humidity = self.smartfarm.get_humidity()
-            water_level = self.smartfarm.get_water_level()
-            led_first_state = self.smartfarm.get_led_first_state()
-            led_second_state = self.smartfarm.get_led_second_state()
-            heater_state = self.smartfarm.get_heater_state()
-            pump_state = self.smartfarm.get_pump_state()
-
-            # emit 및 저장을 위해 데이터를 가공
-            now = datetime.now()
-            now_str = now.strftime("%Y.%m.%d %H:%M:%S")
-            name = [
-                "recent_timestamp",
-                "humidity",
-                "temperature",
-                "water_level",
-                "led_first_state",
-                "led_second_state",
-                "heater_state",
-                "pump_state",
+        self.app.add_url_rule("/streaming/mjpeg", "streaming_mjpeg", self.streaming_mjpeg, methods=["GET"])
+        self.app.add_url_rule("/api/measurements", "api_measurements", self.api_measurements, methods=["GET"])
+        self.app.add_url_rule("/api/images", "api_images", self.api_images, methods=["GET"])
+        self.app.add_url_rule("/api/sensors", "api_sensors", self.api_sensors, methods=["GET"])
+        self.app.add_url_rule("/api/actuators/state", "api_actuator_state", self.api_actuator_state, methods=["GET"])
+        self.app.add_url_rule("/api/actuators/duty_cycle", "api_duty_cycle", self.api_duty_cycle, methods=["GET"])
+        self.app.add_url_rule("/api/alerts", "api_alerts", self.api_alerts, methods=["GET"])
+        self.app.add_url_rule("/api/growth", "api_growth", self.api_growth, methods=["GET"])
+        self.app.add_url_rule("/metrics", "metrics", self.metrics, methods=["GET"])
+
+    def setup_socketio_events(self):
+        """
+        socket.io 이벤트들에 대해 핸들러 함수들을 등록하는 셋업 함수
+        - telemetry_subscribe : {"device": 장치, "channels": [채널들], "encoding": "json"/"binary"} -> 채널 방에 들어가고 keyframe을 받음
+        - telemetry_unsubscribe : {"device": 장치, "channels": [채널들]} -> 채널 방에서 나옴
+        - telemetry_resync : 구독한 채널들의 keyframe을 다시 받음
+        - alerts_subscribe : {"device": 장치} -> 그 스마트팜의 경보 방에 들어가고 지금 풀리지 않은 경보들을 'alert' 이벤트로 받음
+        """
+        socketio.on_event("telemetry_subscribe", self.on_telemetry_subscribe)
+        socketio.on_event("telemetry_unsubscribe", self.on_telemetry_unsubscribe)
+        socketio.on_event("telemetry_resync", self.on_telemetry_resync)
+        socketio.on_event("alerts_subscribe", self.on_alerts_subscribe)
+        socketio.on_event("disconnect", self.on_disconnect)
+
+    def on_telemetry_subscribe(self, msg):
+        if authenticated != True:
+            return {"error": "로그인이 필요합니다!"}
+        msg = msg or {}
+        try:
+            self.telemetry.subscribe(
+                request.sid, msg.get("device", self.default_device_id), msg.get("channels", ["environment"]), msg.get("encoding", "json")
+            )
+        except ValueError as e:
+            LOG.warning("bad_subscribe", "잘못된 구독 요청입니다.", error=e)
+            return {"error": str(e)}
+        return {"ok": True}
+
+    def on_telemetry_unsubscribe(self, msg):
+        msg = msg or {}
+        self.telemetry.unsubscribe(request.sid, msg.get("device"), msg.get("channels"))
+
+    def on_telemetry_resync(self, _msg=None):
+        self.telemetry.resync(request.sid)
+
+    def on_alerts_subscribe(self, msg):
+        if authenticated != True:
+            return {"error": "로그인이 필요합니다!"}
+        device_id = (msg or {}).get("device", self.default_device_id)
+        if device_id not in self.devices:
+            return {"error": f"스마트팜 {device_id}가 없습니다!"}
+        join_room(alert_room(device_id))
+        for alert in self.rule_engine.active_alerts(device_id):
+            socketio.emit("alert", dict(alert, state="firing"), to=request.sid)
+        return {"ok": True}
+
+    def on_disconnect(self, *args):
+        self.telemetry.disconnect(request.sid)
+
+    def collect_metrics(self):
+        """metrics.MetricsRegistry의 수집 함수 - 저장 큐, 텔레메트리 구독자, 사진 보관소, 생장 분석, 온습도센서 상태를 내보냄"""
+        writer = self.measurement_writer.get_stats()
+        yield "smartfarm_ingest_queue_depth", "gauge", "저장을 기다리는 측정값 줄 수", [({}, writer["queue_depth"])]
+        yield "smartfarm_ingest_dropped_total", "counter", "저장 큐가 가득 차 버린 측정값 줄 수", [({}, writer["dropped"])]
+        yield "smartfarm_ingest_failed_total", "counter", "저장에 실패한 측정값 줄 수", [({}, writer["failed"])]
+        yield "smartfarm_ingest_retried_total", "counter", "datas.db가 잠겨 다시 저장한 배치 수", [({}, writer["retried"])]
+        yield "smartfarm_actuator_events_total", "counter", "기록한 액추에이터 상태 변화 수", [({}, self.actuator_log.recorded_count)]
+        rules = self.rule_engine.get_stats()
+        yield "smartfarm_rule_queue_depth", "gauge", "규칙 검사를 기다리는 측정값 수", [({}, rules["queue_depth"])]
+        yield "smartfarm_rule_dropped_total", "counter", "규칙 검사 큐가 가득 차 버린 측정값 수", [({}, rules["dropped"])]
+        firing = {}
+        for alert in rules["firing"]:
+            key = (alert["device"], alert["severity"])
+            firing[key] = firing.get(key, 0) + 1
+        yield "smartfarm_alerts_firing", "gauge", "풀리지 않은 경보 수", [
+            ({"device": device_id, "severity": severity}, count) for (device_id, severity), count in firing.items()
+        ]
+        retention = self.retention.get_stats()
+        yield "smartfarm_db_bytes", "gauge", "datas.db 파일 크기", [({}, retention["db_bytes"])]
+        yield "smartfarm_db_freelist_pages", "gauge", "datas.db의 아직 돌려주지 않은 빈 페이지 수", [({}, retention["freelist_pages"])]
+        yield "smartfarm_measurement_archive_bytes", "gauge", "측정값 열 파일들의 크기 합", [({}, retention["archive_bytes"])]
+        if self.storage.segment_log is not None:
+            segments = self.storage.get_stats()
+            yield "smartfarm_segment_files", "gauge", "raw 측정값 segment 파일 수", [({}, segments["segments"])]
+            yield "smartfarm_segment_bytes", "gauge", "raw 측정값 segment 파일들의 크기 합 (미리 잡아둔 크기)", [({}, segments["bytes"])]
+            yield "smartfarm_segment_records_total", "counter", "segment 파일에 이어 쓴 측정값 수", [({}, segments["appended"])]
+        if self.migration is not None:
+            migration = self.migration.get_stats()
+            yield "smartfarm_migration_copied_rows", "gauge", "새 형식으로 옮긴 예전 측정값 줄 수", [({}, migration["copied"])]
+        subscribers = self.telemetry.get_stats()["subscribers"]
+        yield "smartfarm_telemetry_subscribers", "gauge", "텔레메트리 방마다의 구독자 수", [
+            ({"room": room}, count) for room, count in subscribers.items()
+        ]
+        archives = {device_id: device.image_archive.get_stats() for device_id, device in self.devices.items() if device.image_archive}
+        yield "smartfarm_archive_pending", "gauge", "저장을 기다리는 사진 수", [
+            ({"device": device_id}, stats["pending"]) for device_id, stats in archives.items()
+        ]
+        yield "smartfarm_archive_dropped_total", "counter", "저장이 밀려 버린 사진 수", [
+            ({"device": device_id}, stats["dropped"]) for device_id, stats in archives.items()
+        ]
+        if self.growth_analyzer is not None:
+            growth = self.growth_analyzer.get_stats()
+            yield "smartfarm_growth_frames_total", "counter", "생장 분석을 마친 사진 수", [({}, growth["analyzed"])]
+            yield "smartfarm_growth_failed_total", "counter", "디코딩하지 못해 분석하지 못한 사진 수", [({}, growth["failed"])]
+            yield "smartfarm_growth_lag_seconds", "gauge", "마지막으로 분석한 사진이 찍힌 뒤 지난 시간", [
+                ({"device": device_id}, lag) for device_id, lag in growth["lag_seconds"].items()
+            ]
+            yield "smartfarm_growth_green_coverage", "gauge", "마지막으로 분석한 사진의 초록 픽셀 비율", [
+                ({"device": device_id}, latest["green_coverage"]) for device_id, latest in growth["latest"].items()
             ]
-            states = list(
-                map(self.convert_state, [led_first_state, led_second_state, heater_state, pump_state])
+        health = [(device_id, sensor) for device_id, device in self.devices.items() for sensor in device.smartfarm.get_dht_health()]
+        yield "smartfarm_dht_rejected_total", "counter", "합칠 때 벗어난 값(outlier)으로 버려진 DHT 측정 수", [
+            ({"device": device_id, "pin": sensor["pin"]}, sensor["rejected"]) for device_id, sensor in health
+        ]
+        yield "smartfarm_dht_staleness_seconds", "gauge", "DHT 센서가 마지막으로 성공한 뒤 지난 시간", [
+            ({"device": device_id, "pin": sensor["pin"]}, sensor["staleness"]) for device_id, sensor in health
+        ]
+
+    def metrics(self):
+        """
+        '/metrics'로 GET 요청이 들어왔을 때 모든 지표를 Prometheus 텍스트 형식으로 반환하는 함수.
+        Prometheus가 로그인 없이 읽어갈 수 있도록 login_required를 붙이지 않음 (측정 지표만 있고 설정을 바꿀 수는 없음)
+        """
+        return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+    def get_data_dict(self, smartfarm):
+        """
+        스마트팜(SmartFarmDevice)의 현재 측정값과 액추에이터 상태를 dict로 만들어 반환하는 함수
+        """
+        now_str = datetime.now().strftime("%Y.%m.%d %H:%M:%S")
+        name = [
+            "recent_timestamp",
+            "humidity",
+            "temperature",
+            "water_level",
+            "led_first_state",
+            "led_second_state",
+            "heater_state",
+            "pump_state",
+        ]
+        states = list(
+            map(
+                self.convert_state,
+                [
+                    smartfarm.get_led_first_state(),
+                    smartfarm.get_led_second_state(),
+                    smartfarm.get_heater_state(),
+                    smartfarm.get_pump_state(),
+                ],
             )
-            data_dict = dict(
-                zip(name, [now_str, humidity, temperature, water_level] + states)
-            )  # 만든 결과 dict
-
-            con_data = sqlite3.connect("./datas.db", check_same_thread=False)
-            cur_data = con_data.cursor() 
-            cur_data.execute(
-                f"""INSERT INTO measurements
-                    VALUES (
-                        '{now_str}',
-                        {humidity:.1f},
-                        {temperature:.1f},
-                        {water_level:.1f},
-			                  '{self.convert_state(led_first_state)}',
-			                  '{self.convert_state(led_second_state)}',
-                        '{self.convert_state(heater_state)}',
-			                  '{self.convert_state(pump_state)}');
-                """)
-            con_data.commit()
-
-            # 이전 emit으로부터 30초가 흐를때까지 기다림
-            # 참고 : flask-socketio.readthedocs.io/en/latest/api.html#flask_socketio.SocketIO.sleep (비동기 멈춤)
-            end_time = time.time()
-            if 30 - (end_time - start_time) > 0:
-                print(
-                    f"    [app.acquire_and_emit_periodically] : {30 - (end_time - start_time)} 만큼 기다립니다."
-                )
-                socketio.sleep(30 - (end_time - start_time))
+        )
+        values = [smartfarm.get_humidity(), smartfarm.get_temperature(), smartfarm.get_water_level()]
+        return dict(zip(name, [now_str] + values + states))
+
+    def measure_environment(self):
+        """
+        DHT_INTERVAL마다 스케줄러가 부르는 함수. 모든 스마트팜의 온습도를 측정하고 측정이 끝나자마자 발행함
+        """
+        self.for_each_device(self.measure_and_publish_data)
+
+    def measure_and_publish_data(self, device):
+        device.smartfarm.measure_temp_and_humidity()
+        self.publish_data(device)
+
+    def publish_data(self, device):
+        """
+        스마트팜 한 대의 현재 상태를 텔레메트리 '<device_id>/environment' 채널로 발행함
+        (구독자가 있는 방에만, 바뀐 값만 'telemetry' 이벤트로 보냄) -> stats.html에 적힌 자바스크립트에서 그래프에 추가할 것
+        같은 값들을 규칙 엔진에도 넘김
+        """
+        data_dict = self.get_data_dict(device.smartfarm)
+        self.telemetry.publish(device.device_id, "environment", data_dict)
+        self.rule_engine.submit(device.device_id, data_dict)
+
+    def measure_water_levels(self):
+        """
+        WATER_LEVEL_INTERVAL마다 스케줄러가 부르는 함수. 모든 스마트팜의 수위를 측정해 '<device_id>/water_level' 채널로 발행함
+        (그래프에 점을 추가하지 않고 stats.html의 수위 글자만 갱신함)
+        """
+        self.for_each_device(self.measure_and_publish_water_level)
 
-            # 이벤트 이름 'give_data'로 데이터 data_dict를 emit -> stats.html에 적힌 자바스크립트에서 처리해 그래프에 추가할 것
-            with self.app.app_context() as context:
-                socketio.emit(
-                    "give_data", data_dict
-                )  # socketio.emit 함수를 사용할때는 jsonify()를 사용하지 말고 그냥 딕셔너리 형태의 데이터를 주어야 함!
-                # 참고 : https://stackoverflow.com/questions/75004494/typeerror-object-of-type-response-is-not-json-serializable-2
+    def measure_and_publish_water_level(self, device):
+        device.smartfarm.measure_water_level()
+        values = {"water_level": device.smartfarm.get_water_level()}
+        self.telemetry.publish(device.device_id, "water_level", values)
+        self.rule_engine.submit(device.device_id, values)
 
-    def adjust_periodically(self):
+    def record_measurement(self):
         """
-        1초에 한번씩 smartfarm.adjust 함수를 실행시키는 스레드용 함수
+        MEASURE_INTERVAL(기본 30초)마다 스케줄러가 부르는 함수. 모든 스마트팜의 현재 상태를 datas.db에 저장할 줄로 만들어 저장 큐에 넣음
+        (모든 스마트팜의 줄이 같은 저장기에서 한 배치로 저장됨)
         """
-        # CLEANUP : 스마트팜이 스스로 상태를 계속 조절하는 스레드와 그 스레드용 함수는 app.py가 아니라 hardware.py에 있어야 하고, 스마트팜의 __init__함수에서 그 스레드가 시작되는게 마땅함!
-        while True:
-            self.smartfarm.adjust()
-            socketio.sleep(1)
+        self.for_each_device(self.record_device_measurement)
+
+    def record_device_measurement(self, device):
+        data_dict = self.get_data_dict(device.smartfarm)
+        # 열 순서는 ingest.MEASUREMENT_COLUMNS (timestamp_ms, temperature, humidity, water_level, device_id)
+        # 액추에이터 상태는 바뀔 때 이미 actuator_log에 기록했으므로 줄에는 넣지 않음
+        row = (
+            int(time.time() * 1000),
+            round(data_dict["temperature"], 1),
+            round(data_dict["humidity"], 1),
+            round(data_dict["water_level"], 1),
+            device.device_id,
+        )
+        # 페이지들이 바로 읽을 수 있도록 그 스마트팜의 링 버퍼에 (지금 상태와 함께) 넣고, 저장소에 넘김
+        # (sqlite면 저장 큐에 넣기만 하고 실제 저장은 MeasurementWriter의 writer 스레드가 모아서 함. segment면 mmap에 레코드 하나를 복사함)
+        device.recent_samples.append_row(row, data_dict)
+        self.storage.append(row)
 
     def index(self):
         """
@@ -264,42 +563,43 @@ class FlaskAppWrapper:
     @login_required
     def stats(self):
         """
-        '/stats'에 GET 요청이 들어왔을 때 stats.html을 반환하는 view 함수
-        """
-        # 초기 그래프를 그릴 데이터들을 가져옴
-        con_data = sqlite3.connect("./datas.db", check_same_thread=False)
-        cur_data = con_data.cursor()
-        recent_datas = cur_data.execute(
-            "SELECT * FROM measurements ORDER BY timestamp DESC;"
-        ).fetchmany(6)  # 최근 6개 데이터
-        con_data.close()
-
-        recent_datas.reverse()
-        recent_timestamps = [data[0] for data in recent_datas]
-        recent_timestamp = recent_timestamps[-1]
-        initial_humidities = [data[1] for data in recent_datas]
-        initial_temperatures = [data[2] for data in recent_datas]
-        initial_water_levels = [data[3] for data in recent_datas]
-
-        led_first_state = self.convert_state(self.smartfarm.get_led_first_state())
-        led_second_state = self.convert_state(self.smartfarm.get_led_second_state())
-        heater_state = self.convert_state(self.smartfarm.get_heater_state())
-        pump_state = self.convert_state(self.smartfarm.get_pump_state())
-
-
-        print(f"[app.stats (GET)] : 화면에 표시할 데이터들을 출력합니다 : ")
-        print(f"    recent_timestamp :{recent_timestamp}")
-        print(f"    initial_humidities :{initial_humidities}")
-        print(f"    initial_temperatures :{initial_temperatures}")
-        print(f"    initial_water_levels :{initial_water_levels}")
-        print(f"    led_first_state : {led_first_state}")
-        print(f"    led_second_state : {led_second_state}")
-        print(f"    heater_state : {heater_state}")
-        print(f"    pump_state : {pump_state}")
+        '/stats?device='에 GET 요청이 들어왔을 때 stats.html을 반환하는 view 함수
+        - device : 보여줄 스마트팜 이름. 비어있으면 기본 스마트팜
+        """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        smartfarm = device.smartfarm
+        # 초기 그래프를 그릴 최근 6개 데이터를 메모리 링 버퍼에서 가져옴 (sqlite를 열지 않음)
+        timestamps, values, _ = device.recent_samples.latest(6)
+        values = values.astype(np.float64).round(1)
+        recent_timestamps = [ms_to_timestamp(ms) for ms in timestamps.tolist()]
+        recent_timestamp = recent_timestamps[-1] if recent_timestamps else ""
+        initial_temperatures = values[:, 0].tolist()
+        initial_humidities = values[:, 1].tolist()
+        initial_water_levels = values[:, 2].tolist()
+
+        led_first_state = self.convert_state(smartfarm.get_led_first_state())
+        led_second_state = self.convert_state(smartfarm.get_led_second_state())
+        heater_state = self.convert_state(smartfarm.get_heater_state())
+        pump_state = self.convert_state(smartfarm.get_pump_state())
+
+        LOG.debug(
+            "stats",
+            "화면에 표시할 데이터들",
+            device=device.device_id,
+            samples=len(recent_timestamps),
+            led_first_state=led_first_state,
+            led_second_state=led_second_state,
+            heater_state=heater_state,
+            pump_state=pump_state,
+        )
         # 맨 처음 stats.html을 서버에서 보내줄 때 초기 그래프에 표시될 데이터를 같이 주면
         # stats.html 자바스크립트 부분 초기 데이터 템플릿에 들어감
         return render_template(
             "stats.html",
+            device_id = device.device_id,
+            device_ids = list(self.devices),
             recent_timestamps = recent_timestamps,
             recent_timestamp = recent_timestamp,
             initial_temperatures=initial_temperatures,
@@ -314,32 +614,51 @@ class FlaskAppWrapper:
     @login_required
     def control(self):
         """
-        '/control' 로 GET 요청이 들어왔을 때 control.html을 반환하는 view 함수
+        '/control?device=' 로 GET 요청이 들어왔을 때 control.html을 반환하는 view 함수
+        - device : 조절할 스마트팜 이름. 비어있으면 기본 스마트팜
         """
-        # 위쪽의 background_task 함수에서 값을 얻어오고 딕셔너리 안에 넣어서 넘겨줘야함, 변수명 이래 직접써도 될라나모르겄다
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        smartfarm = device.smartfarm
+        # 가장 최근에 기록된 측정값을 메모리 링 버퍼에서 가져옴. 아직 기록된 값이 없으면 스마트팜의 현재 값을 씀
+        timestamps, values, states = device.recent_samples.latest(1)
+        if len(timestamps) == 1:
+            temperature, humidity, water_level = values[0].astype(np.float64).round(1).tolist()
+            state_dict = decode_states(states[0])
+        else:
+            temperature = smartfarm.get_temperature()
+            humidity = smartfarm.get_humidity()
+            water_level = smartfarm.get_water_level()
+            state_dict = {
+                "led_first_state": self.convert_state(smartfarm.get_led_first_state()),
+                "led_second_state": self.convert_state(smartfarm.get_led_second_state()),
+                "heater_state": self.convert_state(smartfarm.get_heater_state()),
+                "pump_state": self.convert_state(smartfarm.get_pump_state()),
+            }
         cur_status = {
-            "cur_temperature": self.smartfarm.get_temperature(),
-            "cur_humidity": self.smartfarm.get_humidity(),
-            "cur_water_level": self.smartfarm.get_water_level(),
-            "cur_first_light_state": self.smartfarm.get_led_first_state(),
-            "cur_second_light_state": self.smartfarm.get_led_second_state(),
-            "cur_heater_state": self.smartfarm.get_heater_state(),
-            "cur_pump_state": self.smartfarm.get_pump_state(),
+            "cur_temperature": temperature,
+            "cur_humidity": humidity,
+            "cur_water_level": water_level,
+            "cur_first_light_state": state_dict["led_first_state"],
+            "cur_second_light_state": state_dict["led_second_state"],
+            "cur_heater_state": state_dict["heater_state"],
+            "cur_pump_state": state_dict["pump_state"],
         }
 
         reference_status = {
-            "ref_temperature" : self.reference_status[0],
-            "ref_turn_on_time" : self.reference_status[1],
-            "ref_turn_off_time" : self.reference_status[2],
+            "ref_temperature" : device.reference_status[0],
+            "ref_turn_on_time" : device.reference_status[1],
+            "ref_turn_off_time" : device.reference_status[2],
         }
-        print(f"cur_status : {cur_status}")
         reference_status = dict()
-        reference_status['ref_temperature'] = self.reference_status[0]
-        reference_status['ref_turn_on_time'] = self.reference_status[1]
-        reference_status['ref_turn_off_time'] = self.reference_status[2]
-        print(f"reference_status : {reference_status}")
+        reference_status['ref_temperature'] = device.reference_status[0]
+        reference_status['ref_turn_on_time'] = device.reference_status[1]
+        reference_status['ref_turn_off_time'] = device.reference_status[2]
+        LOG.debug("control", "제어 페이지 상태", device=device.device_id, **cur_status, **reference_status)
         return render_template(
             "control.html",
+            device_id=device.device_id,
             code=True,
             cur_status=cur_status,
             reference_status = reference_status
@@ -348,108 +667,309 @@ class FlaskAppWrapper:
     @login_required
     def set_temp(self):
         """
-        '/control/set_temp'로 POST 요청이 들어왔을 때 사용자 설정 최저 온도를 request.form의 설정 온도로 갱신하는 함수
+        '/control/set_temp'로 POST 요청이 들어왔을 때 request.form의 device 스마트팜의 사용자 설정 최저 온도를 request.form의 설정 온도로 갱신하는 함수
         """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
         _temp = request.form.get("new_temp_reference")
-        print(f"[app.set_temp()] : _temp : {_temp} (type : {type(_temp)})")
         try:
             temp = float(_temp)
-            self.smartfarm.set_min_temp(temp)
+            device.smartfarm.set_min_temp(temp)
             # CLEANUP : ref보다 setting으로 표현하는게 더 이해하기 쉬운듯. app.py에 사용되는 변수명과 control.html에 쓰이는 변수명들을 모두 바꾸는 것이 어떨까?
-            # UPDATE를 이용해 오직 한개의 레이블만 사용할 것
-            self.reference_status[0] = temp
-            con_setting = sqlite3.connect('./settings.db', check_same_thread = False)
-            cur_setting = con_setting.cursor()
-            cur_setting.execute(
-                f"""UPDATE settings
-                    SET ref_temperature = {temp:.1f}
-                """)
-            con_setting.commit()
-            con_setting.close()
+            device.reference_status[0] = temp
+            self.settings.set_min_temp(device.device_id, temp)
             return redirect(request.referrer)
         
         except ValueError as e:
-            print("[app.set_temp] 허용되지 않은 입력이 존재합니다.")
+            LOG.warning("bad_input", "허용되지 않은 최저 온도 입력입니다.", device=device.device_id, value=_temp)
             return redirect(request.referrer, code="temp_invalid")
 
     @login_required
     def set_time_period(self):
         """
-        '/control/set_time_period'로 POST 요청이 들어왔을 때 사용자 설정 최저 온도를 request.form의 설정 온도로 갱신하는 함수
+        '/control/set_time_period'로 POST 요청이 들어왔을 때 request.form의 device 스마트팜의 불 켜는/끄는 시각을 request.form의 시각으로 갱신하는 함수
         """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        control_url = f"/control?device={device.device_id}"
         on_time_str = request.form["new_turn_on_time_reference"]
         off_time_str = request.form["new_turn_off_time_reference"]
-        print(
-            f"[app.set_time_period] : on_time_str : {on_time_str} ({type(on_time_str)})"
-        )
-        print(
-            f"[app.set_time_period] : off_time_str : {off_time_str} ({type(off_time_str)})"
-        )
 
         if on_time_str == off_time_str:
-            print("[app.time_period] : 입력받은 두 시각이 동일합니다!")
-            return redirect("/control", code="time_same")
+            LOG.warning("bad_input", "입력받은 두 시각이 동일합니다!", device=device.device_id, on_time=on_time_str)
+            return redirect(control_url, code="time_same")
 
         try:
             # smartfarm에는 datetime.datetime 형으로 넘겨줘야해서 형변환 시켜줌
             on_time = datetime.strptime(on_time_str, "%H:%M").time()
             off_time = datetime.strptime(off_time_str, "%H:%M").time()
-            # 다른 스레드에서는 또다른 커넥션 객체를 만들어 작업해주어야함..
-            con_setting = sqlite3.connect('./settings.db', check_same_thread = False)
-            cur_setting = con_setting.cursor()
-            self.smartfarm.set_on_time(on_time)
-            self.smartfarm.set_off_time(off_time)
-            self.reference_status[1] = on_time_str
-            self.reference_status[2] = off_time_str
-            con_setting = sqlite3.connect("./settings.db", check_same_thread=False)
-            cur_setting = con_setting.cursor()
-            cur_setting.execute(
-                f"""
-                UPDATE settings 
-                SET ref_turn_on_time = '{on_time_str}',
-                    ref_turn_off_time = '{off_time_str}';
-                """
-            )
-            con_setting.commit()
-            con_setting.close()
-            return redirect("/control")
+            device.smartfarm.set_on_time(on_time)
+            device.smartfarm.set_off_time(off_time)
+            device.reference_status[1] = on_time_str
+            device.reference_status[2] = off_time_str
+            self.settings.set_time_period(device.device_id, on_time_str, off_time_str)
+            return redirect(control_url)
         except ValueError as e:
-            print("[app.time_period] 허용되지 않은 입력이 존재합니다.")
-            return redirect("/control", code="time_invalid")
+            LOG.warning(
+                "bad_input", "허용되지 않은 시각 입력입니다.", device=device.device_id, on_time=on_time_str, off_time=off_time_str
+            )
+            return redirect(control_url, code="time_invalid")
+
+    @login_required
+    def api_measurements(self):
+        """
+        '/api/measurements?from=&to=&fields=&resolution=&format=' 으로 GET 요청이 들어왔을 때 기간별 측정값을 흘려보내는(streaming) 함수
+        - from, to : 시작/끝 시각 (예: 2023.08.08 07:00:00 혹은 2023-08-08T07:00). 비어있으면 제한 없음
+        - fields : 쉼표로 구분한 열 이름들 (예: temperature,humidity). 비어있으면 온도, 습도, 수위
+        - resolution : 'raw', '1m', '1h', '1d' 혹은 초 단위 숫자. 1m 이상이면 집계 테이블에서 읽음
+        - format : 'json'(기본값) 혹은 'csv'
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜, 'all'이면 모든 스마트팜 (device_id 열이 추가됨)
+        결과는 history 모듈의 generator가 조금씩 만들어 보내기 때문에 기간이 길어도 메모리를 많이 쓰지 않음.
+        raw 해상도는 열 파일로 옮긴 오래된 측정값(retention.py)을 먼저 내보내고 raw 측정값 저장소(storage.py)의 측정값을 이어서 내보냄
+        """
+        output_format = request.args.get("format", "json")
+        fields_str = request.args.get("fields", "")
+        fields = [field.strip() for field in fields_str.split(",") if field.strip()]
+        try:
+            start = history.parse_time(request.args.get("from"))
+            end = history.parse_time(request.args.get("to"))
+            resolution = history.choose_resolution(request.args.get("resolution"))
+            device_id = request.args.get("device") or self.default_device_id
+            if device_id == "all":
+                device_id = None
+            elif device_id not in self.devices:
+                raise history.HistoryQueryError(f"스마트팜 {device_id}가 없습니다! ({', '.join(self.devices)} 중 하나 혹은 'all')")
+            query, params, columns = history.build_query(start, end, fields, resolution, device_id)
+        except history.HistoryQueryError as e:
+            LOG.warning("bad_request", "잘못된 측정값 조회 요청입니다.", error=e)
+            return jsonify({"error": str(e)}), 400
+
+        if resolution == "raw":
+            chunks = itertools.chain(
+                iter_archived_rows(ARCHIVE_DIR, columns, start, end, device_id), self.storage.iter_raw(columns, start, end, device_id)
+            )
+        else:
+            chunks = history.iter_rows("./datas.db", query, params)
+        chunks = history.fill_actuator_states(chunks, columns, self.actuator_log, resolution, device_id)
+        if output_format == "csv":
+            return Response(history.stream_csv(chunks, columns), mimetype="text/csv")
+        elif output_format == "json":
+            return Response(history.stream_json(chunks, columns), mimetype="application/json")
+        else:
+            return jsonify({"error": f"format {output_format}는 허용되지 않습니다! ('json' 혹은 'csv')"}), 400
 
     @login_required
     def streaming(self):
         """
-        '/streaming'으로 GET 요청이 들어왔을 때 streaming.html을 반환하는 view 함수
+        '/streaming?device='으로 GET 요청이 들어왔을 때 streaming.html을 반환하는 view 함수
         """
-        return render_template("streaming.html")
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        return render_template("streaming.html", device_id=device.device_id)
 
-    def update_image_periodically(self):
+    @login_required
+    def streaming_mjpeg(self):
         """
-        6초에 한번씩 스마트팜으로부터 이미지를 얻어 'give_image'란 이벤트 이름으로 이미지를 byte형으로 emit하는 스레드용 함수.
-        30초에 한번씩은 스마트팜에서 얻은 byte형 이미지를 로컬에 측정시각을 파일 이름으로 하여 jpeg로 저장함.
+        '/streaming/mjpeg?device='로 GET 요청이 들어왔을 때 그 스마트팜의 카메라 화면을 MJPEG(multipart/x-mixed-replace)로 계속 보내는 함수.
+        streaming.html의 <img> 태그가 이 주소를 src로 씀. 사진이 오래 안 오면 스트림을 끝내고, 카메라가 없는 스마트팜이면 404
         """
-        last_saved_time = time.time()
-        last_emit_time = time.time()
-        while True:
-            print("[update_image_periodically 실행됨]")
-            current_time = time.time()
-            # 사진을 파일로 저장하는 주기는 30초로하고, 30초 이전에는 저장 없이 스트림에서 byte64로 이미지만 가져옴
-            # CLEANUP : 이미지를 파일로 저장하는 기능은 스마트팜이 아니라 서버에서 구현하는게 맞을듯. 스마트팜의 get_image에 save_to_file을 인자로 주어 그에 맞게 스마트팜에서 이미지를 저장하거나 저장하지 않도록 하는 것이 아니라,
-            #           스마트팜은 단순히 이미지를 찍어 byte로 리턴하고, 저장은 서버의 update_image_periodically 함수에서 하자
-            if current_time - last_saved_time >= 30:
-                byte_image = self.smartfarm.get_image(save_to_file=True)
-                last_saved_time = current_time
-            else:
-                byte_image = self.smartfarm.get_image(save_to_file=False)
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        if device.frame_broadcaster is None:
+            return jsonify({"error": f"{device.device_id}에는 카메라가 없습니다!"}), 404
+        return Response(
+            device.frame_broadcaster.mjpeg_stream(timeout=max(30, IMAGE_INTERVAL * 5)),
+            mimetype=f"multipart/x-mixed-replace; boundary={BOUNDARY}",
+        )
+
+    def archive_image(self):
+        """
+        IMAGE_ARCHIVE_INTERVAL(기본 30초)마다 스케줄러가 부르는 함수. 카메라가 달린 스마트팜의 가장 최근 사진을 그 스마트팜의 사진 보관소에 넘김.
+        썸네일 만들기와 파일 쓰기는 보관소의 스레드 풀에서 하므로 바로 반환함
+        (실시간 화면은 FleetDevice.frame_broadcaster가 /streaming/mjpeg로 따로 보냄)
+        """
+        for device in self.devices.values():
+            if device.image_archive is None:
+                continue
+            frame = device.smartfarm.get_frame()
+            if frame is not None:
+                device.image_archive.submit(frame)
+
+    @login_required
+    def api_images(self):
+        """
+        '/api/images?at=&thumbnail=&device=' 으로 GET 요청이 들어왔을 때 사진 보관소에서 그 시각에 가장 가까운 사진을 jpeg로 반환하는 함수
+        - at : 시각 (예: 2023.08.08 14:00:00 혹은 2023-08-08T14:00). 비어있으면 지금
+        - thumbnail : 1이면 썸네일을 반환함
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜
+        사진 시각은 X-Captured-At 헤더로 알려줌. 그 날 찍은 사진이 없거나 카메라가 없는 스마트팜이면 404
+        """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        if device.image_archive is None:
+            return jsonify({"error": f"{device.device_id}에는 카메라가 없습니다!"}), 404
+        try:
+            at = history.parse_time(request.args.get("at"))
+        except history.HistoryQueryError as e:
+            LOG.warning("bad_request", "잘못된 사진 조회 요청입니다.", error=e)
+            return jsonify({"error": str(e)}), 400
+        when = datetime.now() if at is None else datetime.strptime(at, history.TIMESTAMP_FORMAT)
+        found = device.image_archive.find(when, thumbnail=request.args.get("thumbnail") == "1")
+        if found is None:
+            return jsonify({"error": f"{when.strftime('%Y.%m.%d')}에 저장된 사진이 없습니다!"}), 404
+        captured_at, data = found
+        return Response(data, mimetype="image/jpeg", headers={"X-Captured-At": captured_at.strftime(history.TIMESTAMP_FORMAT)})
+
+    @login_required
+    def api_sensors(self):
+        """
+        '/api/sensors?device=' 으로 GET 요청이 들어왔을 때 온습도센서마다의 건강 상태를 json으로 반환하는 함수
+        (실패율, outlier로 버려진 비율, 합친 값과의 평균 차이, 마지막 성공 후 지난 시간) - 교체할 센서를 고를 때 봄
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜
+        """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        return jsonify({"device": device.device_id, "dht": device.smartfarm.get_dht_health()})
+
+    @login_required
+    def api_actuator_state(self):
+        """
+        '/api/actuators/state?at=&device=' 으로 GET 요청이 들어왔을 때 그 시각의 액추에이터 상태들을 json으로 반환하는 함수
+        - at : 시각 (예: 2023.08.08 03:00:00 혹은 2023-08-08T03:00). 비어있으면 지금
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜
+        상태 변화 기록이 없는 시각의 상태는 null
+        """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        try:
+            at = history.parse_time(request.args.get("at"))
+        except history.HistoryQueryError as e:
+            LOG.warning("bad_request", "잘못된 액추에이터 상태 조회 요청입니다.", error=e)
+            return jsonify({"error": str(e)}), 400
+        when = datetime.now() if at is None else datetime.strptime(at, history.TIMESTAMP_FORMAT)
+        states = self.actuator_log.states_at(device.device_id, [int(when.timestamp() * 1000)])
+        result = {"device": device.device_id, "at": when.strftime(history.TIMESTAMP_FORMAT)}
+        for field, values in states.items():
+            state = int(values[0])
+            result[field] = None if state < 0 else ("ON" if state == 1 else "OFF")
+        return jsonify(result)
+
+    @login_required
+    def api_alerts(self):
+        """
+        '/api/alerts?device=&active=&from=&to=&limit=' 으로 GET 요청이 들어왔을 때 경보들을 최근 것부터 json으로 반환하는 함수
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜, 'all'이면 모든 스마트팜
+        - active : 1이면 풀리지 않은 경보만
+        - from, to : 경보가 시작된 시각의 범위 (예: 2023.08.08 07:00:00). 비어있으면 제한 없음
+        - limit : 최대 개수 (기본 100)
+        started, resolved는 epoch 밀리초이며 풀리지 않은 경보의 resolved는 null
+        """
+        device_id = request.args.get("device") or self.default_device_id
+        if device_id == "all":
+            device_id = None
+        elif device_id not in self.devices:
+            return self.unknown_device_response()
+        try:
+            start = history.parse_time(request.args.get("from"))
+            end = history.parse_time(request.args.get("to"))
+            limit = int(request.args.get("limit", 100))
+        except (history.HistoryQueryError, ValueError) as e:
+            LOG.warning("bad_request", "잘못된 경보 조회 요청입니다.", error=e)
+            return jsonify({"error": str(e)}), 400
+        alerts = query_alerts(
+            "./datas.db",
+            device_id,
+            active=request.args.get("active") == "1",
+            start_ms=None if start is None else timestamp_to_ms(start),
+            end_ms=None if end is None else timestamp_to_ms(end) + 999,
+            limit=limit,
+        )
+        return jsonify({"alerts": alerts})
 
-            # 사진을 보낸 시간이 6초가 안지났으면 6초 될때까지 기다림
-            if (current_time - last_emit_time) < 6:
-                # print(f"  [update_image_periodically] async sleep for {6 - (current_time - last_emit_time) :.3f} seconds")
-                socketio.sleep(6 - (current_time - last_emit_time))
-            last_emit_time = time.time()
+    @login_required
+    def api_growth(self):
+        """
+        '/api/growth?device=&from=&to=&format=' 으로 GET 요청이 들어왔을 때 사진으로 계산한 생장 값들(growth.py)을 시각 순서대로 반환하는 함수
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜, 'all'이면 모든 스마트팜 (device_id 열이 추가됨)
+        - from, to : 시작/끝 시각 (예: 2023.08.08 07:00:00). 비어있으면 제한 없음
+        - format : 'json'(기본값) 혹은 'csv'
+        열은 timestamp, green_coverage, canopy_area, change, brightness (비율은 모두 0~1)
+        """
+        output_format = request.args.get("format", "json")
+        device_id = request.args.get("device") or self.default_device_id
+        if device_id == "all":
+            device_id = None
+        elif device_id not in self.devices:
+            return self.unknown_device_response()
+        try:
+            start = history.parse_time(request.args.get("from"))
+            end = history.parse_time(request.args.get("to"))
+        except history.HistoryQueryError as e:
+            LOG.warning("bad_request", "잘못된 생장 값 조회 요청입니다.", error=e)
+            return jsonify({"error": str(e)}), 400
+        query, params, columns = growth_query(
+            None if start is None else timestamp_to_ms(start), None if end is None else timestamp_to_ms(end) + 999, device_id
+        )
+        if output_format not in ("json", "csv"):
+            return jsonify({"error": f"format {output_format}는 허용되지 않습니다! ('json' 혹은 'csv')"}), 400
+        # 첫 chunk를 응답을 시작하기 전에 읽어, 쿼리 오류가 상태 줄(200)을 보낸 뒤에 나지 않게 함
+        chunks = history.iter_rows("./datas.db", query, params)
+        try:
+            first = next(chunks, [])
+        except sqlite3.Error as e:
+            LOG.error("growth_query_failed", "생장 값을 읽는 중 오류가 발생했습니다!", error=e)
+            return jsonify({"error": "생장 값을 읽을 수 없습니다!"}), 500
+        chunks = itertools.chain([first], chunks)
+        if output_format == "csv":
+            return Response(history.stream_csv(chunks, columns), mimetype="text/csv")
+        return Response(history.stream_json(chunks, columns), mimetype="application/json")
 
-            socketio.emit("give_image", {"byte_image": byte_image})
+    @login_required
+    def api_duty_cycle(self):
+        """
+        '/api/actuators/duty_cycle?actuator=&from=&to=&bucket=&device=' 으로 GET 요청이 들어왔을 때
+        액추에이터가 켜져 있던 시간(on_hours)과 비율(duty_cycle)을 구간별로 json으로 반환하는 함수
+        - actuator : "led_first", "led_second", "heater"(기본값), "pump"
+        - from, to : 기간 (예: 2023.08.08 19:00:00). 비어있으면 from은 하루 전, to는 지금
+        - bucket : 비어있으면 기간 전체 하나, '1h'면 한 시간마다, '1d'면 하루마다
+        - device : 스마트팜 이름. 비어있으면 기본 스마트팜
+        bucket=1d인 히터의 on_hours가 '하루에 히터가 켜져 있던 시간'임.
+        전력량(energy_kwh)은 환경변수 SMARTFARM_HEATER_WATTS(히터 소비전력)를 주었을 때만 함께 반환함 (기본값 없음)
+        """
+        device = self.request_device()
+        if device is None:
+            return self.unknown_device_response()
+        actuator = request.args.get("actuator") or "heater"
+        bucket = request.args.get("bucket") or None
+        try:
+            if actuator not in ACTUATORS:
+                raise history.HistoryQueryError(f"액추에이터 {actuator}가 없습니다! ({', '.join(ACTUATORS)} 중 하나)")
+            if bucket not in (None, "1h", "1d"):
+                raise history.HistoryQueryError(f"구간 {bucket}는 허용되지 않습니다! ('1h' 혹은 '1d')")
+            start = history.parse_time(request.args.get("from"))
+            end = history.parse_time(request.args.get("to"))
+        except history.HistoryQueryError as e:
+            LOG.warning("bad_request", "잘못된 가동 시간 조회 요청입니다.", error=e)
+            return jsonify({"error": str(e)}), 400
+        end = datetime.now() if end is None else datetime.strptime(end, history.TIMESTAMP_FORMAT)
+        start = end - timedelta(days=1) if start is None else datetime.strptime(start, history.TIMESTAMP_FORMAT)
+        if start >= end:
+            return jsonify({"error": "기간의 시작이 끝보다 앞서야 합니다!"}), 400
+
+        buckets = self.actuator_log.duty_cycle(device.device_id, actuator, start, end, bucket)
+        for entry in buckets:
+            if actuator == "heater" and HEATER_POWER_WATTS > 0:
+                entry["energy_kwh"] = round(entry["on_hours"] * HEATER_POWER_WATTS / 1000, 4)
+            entry["start"] = entry["start"].strftime(history.TIMESTAMP_FORMAT)
+            entry["end"] = entry["end"].strftime(history.TIMESTAMP_FORMAT)
+        return jsonify({"device": device.device_id, "actuator": actuator, "buckets": buckets})
 
 
 if __name__ == "__main__":
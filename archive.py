@@ -0,0 +1,326 @@
+"""
+카메라 사진을 날짜별 segment 파일에 이어 붙여 저장하고, 시각으로 바로 찾을 수 있게 하는 사진 보관소.
+
+예전처럼 ./captured_images/에 30초마다 사진 파일을 하나씩 만들면 한 철이면 파일이 수십만 개가 되고,
+특정 시각의 사진을 찾으려면 디렉토리 전체를 훑어야 함. 그래서 하루치 사진을 한 파일에 모아둠.
+- YYYY-MM-DD.seg : 원본 JPEG와 축소된 JPEG(썸네일)를 차례로 이어 붙이기만 하는(append-only) 파일
+- YYYY-MM-DD.idx : 사진마다 (시각 epoch 밀리초, segment에서의 위치, 원본 크기, 썸네일 크기)를 고정 크기로 적은 색인 파일
+색인은 읽을 때 시각 순서로 정렬해 두므로 "지난 화요일 14시 사진"은 색인에서 이진 탐색 후 segment 파일의 한 위치만 읽으면 됨.
+색인 파일에는 쓴 순서대로 쌓이므로 시계가 뒤로 가거나(RTC가 없어 NTP가 고칠 때) 두 저장 스레드의 순서가 바뀌면
+시각 순서가 아닐 수 있지만, 거의 정렬되어 있어 읽을 때 정렬하는 비용은 작음.
+썸네일 만들기와 파일 쓰기, fsync는 스레드 풀에서 하기 때문에 캡처 루프와 스케줄러는 디스크를 기다리지 않음.
+"""
+
+import bisect
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import log
+
+LOG = log.get_logger("archive")
+
+# 색인 한 줄 : 시각(epoch 밀리초), segment에서의 위치, 원본 크기, 썸네일 크기 (썸네일은 원본 바로 뒤에 있음)
+INDEX_RECORD = struct.Struct("<qQII")
+DAY_FORMAT = "%Y-%m-%d"
+# 메모리에 들고 있을 하루치 색인 수 (지금 쓰는 날짜는 빼고). 한 철을 둘러봐도 메모리가 늘어나지 않도록 오래 안 쓴 것부터 버림
+INDEX_CACHE_DAYS = 7
+
+
+def make_thumbnail(jpeg_bytes, size=(160, 160), quality=70):
+    """
+    JPEG bytes를 size 안에 들어가도록 줄인 JPEG bytes를 반환함.
+    PIL의 draft 모드로 처음부터 작게 디코딩하기 때문에 원본 크기로 디코딩하는 것보다 훨씬 빠름
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(jpeg_bytes))
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    image.thumbnail(size)
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def archive_days(root) -> list:
+    """root 사진 보관소에 사진이 있는 날짜들(YYYY-MM-DD)을 순서대로 반환함"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(name[: -len(".idx")] for name in os.listdir(root) if name.endswith(".idx"))
+
+
+def read_index(root, day) -> list:
+    """
+    하루치 색인을 읽기만 해서 (시각, 위치, 원본 크기, 썸네일 크기) list로 시각 순서대로 반환함.
+    다른 프로세스(growth.py의 분석 프로세스)에서 서버가 쓰는 중인 보관소를 읽을 때 씀 - 잘린 마지막 줄은 고치지 않고 무시함
+    """
+    try:
+        with open(os.path.join(root, f"{day}.idx"), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return sorted(INDEX_RECORD.iter_unpack(data[: len(data) - len(data) % INDEX_RECORD.size]), key=_record_time)
+
+
+def _record_time(record):
+    return record[0]
+
+
+def iter_frames(root, start_ms=None, end_ms=None, limit=None):
+    """
+    root 사진 보관소에서 [start_ms, end_ms] (epoch 밀리초) 사이의 원본 사진들을 (시각 epoch 밀리초, JPEG bytes)로
+    시각 순서대로 내보내는 generator. 읽기만 하므로 다른 프로세스에서 써도 됨
+    - limit(int) : 최대 장수. None이면 제한 없음
+    """
+    days = archive_days(root)
+    if start_ms is not None:
+        first_day = datetime.fromtimestamp(start_ms / 1000).strftime(DAY_FORMAT)
+        days = [day for day in days if day >= first_day]
+    if end_ms is not None:
+        last_day = datetime.fromtimestamp(end_ms / 1000).strftime(DAY_FORMAT)
+        days = [day for day in days if day <= last_day]
+    count = 0
+    for day in days:
+        records = read_index(root, day)
+        timestamps = [record[0] for record in records]
+        lo = 0 if start_ms is None else bisect.bisect_left(timestamps, start_ms)
+        hi = len(records) if end_ms is None else bisect.bisect_right(timestamps, end_ms)
+        if lo >= hi:
+            continue
+        with open(os.path.join(root, f"{day}.seg"), "rb") as f:
+            for timestamp_ms, offset, length, _ in records[lo:hi]:
+                if limit is not None and count >= limit:
+                    return
+                f.seek(offset)
+                yield timestamp_ms, f.read(length)
+                count += 1
+
+
+class _DayIndex:
+    """하루치 색인을 시각 순서로 메모리에 들고 있는 객체. 시각 목록은 이진 탐색용으로 따로 들고 있음"""
+
+    def __init__(self, records):
+        self.records = sorted(records, key=_record_time)
+        self.timestamps = [record[0] for record in self.records]
+
+    def insert(self, record):
+        """record를 시각 순서의 제자리에 넣음 (같은 시각이면 뒤에). 보통은 맨 뒤라 append와 같음"""
+        i = bisect.bisect_right(self.timestamps, record[0])
+        self.records.insert(i, record)
+        self.timestamps.insert(i, record[0])
+
+
+class ImageArchive:
+    """
+    날짜별 segment 파일과 색인 파일로 이루어진 사진 보관소.
+    - root(str) : 파일들을 저장할 디렉토리
+    - workers(int) : 썸네일을 만들고 파일에 쓰는 스레드 개수
+    - thumbnail_size(tuple) : 썸네일 최대 크기. None이면 썸네일을 만들지 않음
+    - max_pending(int) : 아직 저장되지 않은 사진이 이보다 많으면(디스크가 느릴 때) 새 사진을 버림
+    - fsync(bool) : 사진을 쓸 때마다 fsync해서 전원이 나가도 색인과 segment가 어긋나지 않게 함
+    """
+
+    def __init__(self, root="./captured_images", workers=2, thumbnail_size=(160, 160), max_pending=8, fsync=True):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.max_pending = max_pending
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ImageArchive")
+        self._lock = threading.Lock()  # segment/색인 파일에 이어 쓰는 것과 색인 캐시를 보호함
+        self._indexes = OrderedDict()  # 날짜 -> _DayIndex (최근에 쓴 순서)
+        self._writing_day = None  # 마지막으로 사진을 넣은 날짜. 캐시에서 버리지 않음
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+        # 지표들
+        self.written_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
+        self.last_write_seconds = 0.0
+
+    def _paths(self, day):
+        return os.path.join(self.root, f"{day}.seg"), os.path.join(self.root, f"{day}.idx")
+
+    def _load_index(self, day):
+        """
+        하루치 색인을 읽어 캐시함. 쓰다가 끊겨 마지막 줄이 잘려 있으면 그 줄은 버림 (self._lock을 잡은 채로 불러야 함).
+        색인 파일이 없는 날짜는 빈 색인을 돌려주고 캐시하지 않음
+        """
+        index = self._indexes.get(day)
+        if index is not None:
+            self._indexes.move_to_end(day)
+            return index
+        _, index_path = self._paths(day)
+        if not os.path.exists(index_path):
+            return _DayIndex([])
+        with open(index_path, "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        if usable != len(data):
+            LOG.warning("truncated_index", "마지막 색인이 잘려 있어 버립니다.", path=index_path)
+            with open(index_path, "r+b") as f:
+                f.truncate(usable)
+        index = _DayIndex(list(INDEX_RECORD.iter_unpack(data[:usable])))
+        self._cache_index(day, index)
+        return index
+
+    def _cache_index(self, day, index):
+        """색인을 캐시에 넣고, 지금 쓰는 날짜를 빼고 INDEX_CACHE_DAYS개를 넘으면 오래 안 쓴 것부터 버림"""
+        self._indexes[day] = index
+        self._indexes.move_to_end(day)
+        for old_day in list(self._indexes):
+            if len(self._indexes) <= INDEX_CACHE_DAYS + (self._writing_day in self._indexes):
+                break
+            if old_day != self._writing_day:
+                del self._indexes[old_day]
+
+    def submit(self, frame):
+        """
+        capture.Frame 한 장을 저장하도록 스레드 풀에 넘김. frame은 저장이 끝나면 release되므로 넘긴 뒤에는 쓰면 안 됨.
+        밀린 사진이 max_pending개보다 많으면 저장하지 않고 버리며 False를 반환함
+        """
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                self.dropped_count += 1
+                frame.release()
+                LOG.warning("dropped", "저장이 밀려 사진을 버립니다!", every=60, dropped=self.dropped_count)
+                return False
+            self._pending += 1
+        self._executor.submit(self._write_frame, frame)
+        return True
+
+    def _write_frame(self, frame):
+        try:
+            with frame:
+                self.add(frame.view(), frame.timestamp)
+        except Exception as e:
+            self.error_count += 1
+            LOG.error("write_failed", "사진을 저장하는 중 오류가 발생했습니다!", every=60, error=e)
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def add(self, jpeg, timestamp):
+        """
+        JPEG 한 장(bytes 혹은 memoryview)을 timestamp(time.time() 형식)의 사진으로 바로 저장함.
+        그 날의 마지막 사진보다 이른 사진(시계가 뒤로 간 경우 등)도 버리지 않고 색인의 제자리에 넣음
+        """
+        start = time.monotonic()
+        thumbnail = b""
+        if self.thumbnail_size is not None:
+            # 썸네일은 파일 잠금 밖에서 만들어 여러 스레드가 동시에 만들 수 있게 함
+            thumbnail = make_thumbnail(bytes(jpeg), self.thumbnail_size)
+        timestamp_ms = int(timestamp * 1000)
+        day = datetime.fromtimestamp(timestamp).strftime(DAY_FORMAT)
+        segment_path, index_path = self._paths(day)
+
+        with self._lock:
+            index = self._load_index(day)
+            if index.timestamps and timestamp_ms < index.timestamps[-1]:
+                LOG.info(
+                    "out_of_order",
+                    "그 날의 마지막 사진보다 이른 사진입니다. 색인의 제자리에 넣습니다.",
+                    every=60,
+                    timestamp_ms=timestamp_ms,
+                    last_ms=index.timestamps[-1],
+                )
+            # segment를 먼저 쓰고 fsync한 뒤에 색인을 씀 - 중간에 전원이 나가도 색인은 완전히 쓰인 사진만 가리킴
+            with open(segment_path, "ab") as f:
+                offset = f.tell()
+                f.write(jpeg)
+                f.write(thumbnail)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            record = (timestamp_ms, offset, len(jpeg), len(thumbnail))
+            with open(index_path, "ab") as f:
+                f.write(INDEX_RECORD.pack(*record))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            index.insert(record)
+            self._writing_day = day
+            if day not in self._indexes:
+                # 첫 사진이라 색인 파일이 막 생긴 날짜
+                self._cache_index(day, index)
+        self.written_count += 1
+        self.last_write_seconds = time.monotonic() - start
+
+    def _read(self, day, record, thumbnail):
+        segment_path, _ = self._paths(day)
+        _, offset, length, thumbnail_length = record
+        if thumbnail:
+            if thumbnail_length == 0:
+                return None
+            offset, length = offset + length, thumbnail_length
+        with open(segment_path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def find(self, when, thumbnail=False, tolerance=None):
+        """
+        when(datetime)에 가장 가까운 사진을 찾아 (사진 시각 datetime, JPEG bytes)로 반환함. 없으면 None
+        - thumbnail(bool) : True면 원본 대신 썸네일을 반환함
+        - tolerance(timedelta) : 가장 가까운 사진이 이보다 멀리 떨어져 있으면 None. None이면 그 날 안에서 가장 가까운 사진
+        """
+        target_ms = int(when.timestamp() * 1000)
+        day = when.strftime(DAY_FORMAT)
+        with self._lock:
+            index = self._load_index(day)
+            i = bisect.bisect_left(index.timestamps, target_ms)
+            candidates = [index.records[j] for j in (i - 1, i) if 0 <= j < len(index.records)]
+        if not candidates:
+            return None
+        record = min(candidates, key=lambda r: abs(r[0] - target_ms))
+        if tolerance is not None and abs(record[0] - target_ms) > tolerance.total_seconds() * 1000:
+            return None
+        data = self._read(day, record, thumbnail)
+        if data is None:
+            return None
+        return datetime.fromtimestamp(record[0] / 1000), data
+
+    def iter_range(self, start, end, thumbnail=False, step=None):
+        """
+        start부터 end(datetime)까지의 사진들을 (사진 시각 datetime, JPEG bytes)로 시각 순서대로 내보내는 generator (타임랩스용).
+        - step(timedelta) : 주어지면 이 간격보다 촘촘한 사진은 건너뜀
+        """
+        start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+        step_ms = 0 if step is None else int(step.total_seconds() * 1000)
+        last_ms = None
+        day = start.date()
+        while day <= end.date():
+            day_str = day.strftime(DAY_FORMAT)
+            with self._lock:
+                index = self._load_index(day_str)
+                lo = bisect.bisect_left(index.timestamps, start_ms)
+                hi = bisect.bisect_right(index.timestamps, end_ms)
+                records = index.records[lo:hi]
+            for record in records:
+                if last_ms is not None and record[0] - last_ms < step_ms:
+                    continue
+                data = self._read(day_str, record, thumbnail)
+                if data is None:
+                    continue
+                last_ms = record[0]
+                yield datetime.fromtimestamp(record[0] / 1000), data
+            day += timedelta(days=1)
+
+    def close(self):
+        """밀린 사진을 모두 저장하고 스레드 풀을 닫음"""
+        self._executor.shutdown(wait=True)
+
+    def get_stats(self) -> dict:
+        return {
+            "written": self.written_count,
+            "dropped": self.dropped_count,
+            "errors": self.error_count,
+            "pending": self._pending,
+            "last_write_seconds": self.last_write_seconds,
+        }
@@ -0,0 +1,493 @@
+"""
+가상 하드웨어(SMARTFARM_BACKEND=sim)로 서버의 성능을 재는 벤치마크 모음.
+
+랙을 늘리기 전에 숫자를 알기 위해 아래 네 가지를 재고, 결과를 JSON으로 남겨 버전끼리 비교할 수 있게 함.
+- ingest : MeasurementWriter로 datas.db에 측정값을 계속 넣을 때의 초당 저장 줄 수
+- dashboard : datas.db에 측정값이 10^3, 10^6, 10^7줄 있을 때 서버가 켜지는 시간과 /stats, /control, /api/measurements 응답 시간
+- fanout : 구독자(socket.io 가상 사용자)가 1~500명일 때 텔레메트리 한 번을 발행해 모두에게 전달하는 시간
+- cycle : 온습도 측정 -> 발행 -> 수위 측정 -> 저장 큐에 넣기까지의 한 주기 시간 (DHT 센서가 느리거나 실패할 때 포함)
+dashboard와 cycle은 서버(app.py)를 통째로 켜야 하므로 경우마다 따로 프로세스를 띄워 잼.
+
+    SMARTFARM_BACKEND=sim python benchmark.py all --output bench.json
+    python benchmark.py all --quick --output bench.json      (작은 크기로 빨리 돌려봄)
+    python benchmark.py dashboard --sizes 1000,1000000,10000000
+    python benchmark.py compare old.json new.json           (10% 넘게 나빠진 항목을 보여주고 있으면 1로 종료)
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("SMARTFARM_BACKEND", "sim")
+os.environ.setdefault("SMARTFARM_SIM_SEED", "2023")
+
+BENCHMARKS = ("ingest", "dashboard", "fanout", "cycle")
+
+DEFAULT_INGEST_ROWS = 200000
+DEFAULT_DASHBOARD_SIZES = (10**3, 10**6, 10**7)
+DEFAULT_FANOUT_CLIENTS = (1, 10, 50, 100, 250, 500)
+DEFAULT_REQUESTS = 50
+DEFAULT_PUBLISHES = 100
+DEFAULT_CYCLES = 5
+
+QUICK = {"rows": 20000, "sizes": (10**3, 10**5), "clients": (1, 10, 100), "requests": 10, "publishes": 20, "cycles": 2}
+
+# cycle 벤치마크의 경우들 - 가상 DHT 센서 설정 (SMARTFARM_SIM_* 환경변수)
+CYCLE_SCENARIOS = {
+    "healthy": {"SMARTFARM_SIM_DHT_FAIL_RATE": "0.0"},
+    "default": {},
+    "slow": {"SMARTFARM_SIM_DHT_LATENCY": "1.5"},
+    "failing": {"SMARTFARM_SIM_DHT_FAIL_RATE": "0.6"},
+    "dead": {"SMARTFARM_SIM_DEAD_PINS": "21,16"},
+}
+
+# compare에서 값이 클수록 좋은 항목 (나머지는 작을수록 좋음)
+HIGHER_IS_BETTER = ("rows_per_second",)
+
+
+def summarize(samples):
+    """걸린 시간(초)들을 밀리초 단위의 평균, 중앙값, p95, p99, 최댓값 dict로 줄임"""
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(percentile(50) * 1000, 3),
+        "p95_ms": round(percentile(95) * 1000, 3),
+        "p99_ms": round(percentile(99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def synthetic_rows(n, device_ids=("farm",), start=datetime(2023, 3, 1), step=timedelta(seconds=1), seed=2023):
+    """
+    ingest.MEASUREMENT_COLUMNS 순서의 가짜 측정값 n줄을 만드는 generator.
+    한 시각에 스마트팜마다 한 줄씩이며, 시각은 step씩 늘어남
+    """
+    rng = random.Random(seed)
+    when = start
+    produced = 0
+    while produced < n:
+        timestamp_ms = int(when.timestamp() * 1000)
+        for device_id in device_ids:
+            if produced >= n:
+                return
+            yield (
+                timestamp_ms,
+                round(20 + rng.gauss(0, 2), 1),
+                round(55 + rng.gauss(0, 5), 1),
+                round(12 + rng.gauss(0, 1), 1),
+                device_id,
+            )
+            produced += 1
+        when += step
+
+
+def populate_database(db_path, n_rows, device_id="farm"):
+    """datas.db에 가짜 측정값 n_rows줄을 한꺼번에 넣고 집계 테이블을 채움. 마지막 측정 시각을 반환함"""
+    from ingest import INSERT_MEASUREMENT_QUERY, connect_database, ensure_measurements_table
+    from rollups import create_rollup_tables
+
+    con = connect_database(db_path)
+    ensure_measurements_table(con, device_id)
+    # 가장 최근 측정이 지금 근처가 되도록 시작 시각을 잡음 (/api/measurements?from=최근 하루 가 의미 있도록)
+    start = datetime.now().replace(microsecond=0) - timedelta(seconds=n_rows)
+    rows = synthetic_rows(n_rows, (device_id,), start=start)
+    chunk = []
+    with con:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == 50000:
+                con.executemany(INSERT_MEASUREMENT_QUERY, chunk)
+                chunk = []
+        if chunk:
+            con.executemany(INSERT_MEASUREMENT_QUERY, chunk)
+    create_rollup_tables(con)
+    con.close()
+    return start + timedelta(seconds=n_rows - 1)
+
+
+def bench_ingest(workdir, rows, batch_size=64):
+    """MeasurementWriter에 rows줄을 최대한 빨리 넣고 모두 저장될 때까지의 처리량을 잼"""
+    from ingest import MeasurementWriter, connect_database, ensure_measurements_table
+
+    db_path = os.path.join(workdir, "ingest.db")
+    con = connect_database(db_path)
+    ensure_measurements_table(con)
+    con.close()
+    # 큐가 가득 차면 버리지 않고 기다리게 해서 저장 속도 자체를 잼
+    writer = MeasurementWriter(db_path, batch_size=batch_size, max_delay=0.05, queue_size=4096, put_timeout=10.0)
+    data = list(synthetic_rows(rows, ("rack1", "rack2")))
+    start = time.perf_counter()
+    for row in data:
+        writer.submit(row)
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    stats = writer.get_stats()
+    writer.close()
+    return {
+        "rows": rows,
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1),
+        "batches": stats["batches"],
+        "dropped": stats["dropped"],
+        "failed": stats["failed"],
+        "mean_flush_ms": round(stats["total_flush_seconds"] / max(stats["batches"], 1) * 1000, 3),
+        "db_bytes": os.path.getsize(db_path),
+    }
+
+
+def bench_fanout(clients_list, publishes, encodings=("json", "binary")):
+    """
+    flask_socketio의 가상 사용자(test_client)들을 한 방에 구독시킨 뒤 TelemetryPublisher.publish() 한 번이
+    모든 사용자에게 전달되기까지의 시간을 잼 (test_client는 emit될 때 바로 받기 때문에 publish()가 끝나면 전달도 끝남)
+    """
+    from flask import Flask, request
+    from flask_socketio import SocketIO
+    from telemetry import FIELDS, TelemetryPublisher
+
+    flask_app = Flask("benchmark")
+    sio = SocketIO(flask_app, async_mode="threading")
+    publisher = TelemetryPublisher(sio)
+    publisher.add_channel("bench", "environment", FIELDS, send_empty=True)
+
+    @sio.on("telemetry_subscribe")
+    def on_subscribe(msg):
+        publisher.subscribe(request.sid, "bench", ["environment"], msg["encoding"])
+
+    rng = random.Random(2023)
+    results = {}
+    for encoding in encodings:
+        results[encoding] = {}
+        for n_clients in clients_list:
+            clients = [sio.test_client(flask_app) for _ in range(n_clients)]
+            for client in clients:
+                client.emit("telemetry_subscribe", {"encoding": encoding})
+                client.get_received()
+            samples = []
+            for _ in range(publishes):
+                values = {
+                    "temperature": 20 + rng.random() * 5,
+                    "humidity": 50 + rng.random() * 10,
+                    "water_level": 12 + rng.random(),
+                    "heater_state": int(rng.random() < 0.5),
+                }
+                start = time.perf_counter()
+                publisher.publish("bench", "environment", values)
+                samples.append(time.perf_counter() - start)
+            delivered = sum(len(client.get_received()) for client in clients)
+            for client in clients:
+                client.disconnect()
+            result = summarize(samples)
+            result["delivered"] = delivered
+            result["expected"] = n_clients * publishes
+            results[encoding][str(n_clients)] = result
+            print(f"[benchmark.fanout] {encoding} {n_clients}명 : p50 {result['p50_ms']}ms, p99 {result['p99_ms']}ms", file=sys.stderr)
+    return results
+
+
+def _dashboard_child(workdir, requests, last_timestamp):
+    """따로 띄운 프로세스에서 서버를 켜고 페이지 응답 시간을 잼 (workdir에 datas.db가 미리 채워져 있어야 함)"""
+    os.chdir(workdir)
+    os.environ.setdefault("SMARTFARM_MEASURE_INTERVAL", "3600")
+    os.environ.setdefault("SMARTFARM_DHT_INTERVAL", "3600")
+    os.environ.setdefault("SMARTFARM_WATER_LEVEL_INTERVAL", "3600")
+    start = time.perf_counter()
+    import app as server
+
+    wrapper = server.FlaskAppWrapper(server.app)
+    startup = time.perf_counter() - start
+    server.authenticated = True
+    client = server.app.test_client()
+
+    last = datetime.strptime(last_timestamp, "%Y.%m.%d %H:%M:%S")
+    day_ago = (last - timedelta(days=1)).strftime("%Y.%m.%d %H:%M:%S")
+    hour_ago = (last - timedelta(hours=1)).strftime("%Y.%m.%d %H:%M:%S")
+    targets = {
+        "/stats": "/stats",
+        "/control": "/control",
+        "/api/measurements raw 1h": f"/api/measurements?from={hour_ago}",
+        "/api/measurements 1m 1d": f"/api/measurements?from={day_ago}&resolution=1m",
+        "/api/measurements 1h all": "/api/measurements?resolution=1h",
+    }
+    results = {"startup_seconds": round(startup, 3)}
+    for name, url in targets.items():
+        for _ in range(3):
+            client.get(url).get_data()
+        samples = []
+        for _ in range(requests):
+            begin = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            samples.append(time.perf_counter() - begin)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} 응답이 {response.status_code}입니다!")
+        results[name] = summarize(samples)
+    wrapper.scheduler.stop()
+    wrapper.control_engine.stop()
+    return results
+
+
+def _cycle_child(workdir, cycles):
+    """따로 띄운 프로세스에서 서버를 켜고 측정 한 주기(온습도 -> 발행 -> 수위 -> 저장 큐)를 cycles번 잼"""
+    os.chdir(workdir)
+    import app as server
+    from hardware import DHT_READ_DEADLINE
+
+    wrapper = server.FlaskAppWrapper(server.app)
+    # 스케줄러가 켜지며 시작한 첫 측정이 끝날 때까지 기다렸다가 직접 부름
+    wrapper.scheduler.stop()
+    time.sleep(DHT_READ_DEADLINE + 1.0)
+    dht_samples, water_samples, record_samples, cycle_samples = [], [], [], []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        wrapper.measure_environment()
+        after_dht = time.perf_counter()
+        wrapper.measure_water_levels()
+        after_water = time.perf_counter()
+        wrapper.record_measurement()
+        end = time.perf_counter()
+        dht_samples.append(after_dht - start)
+        water_samples.append(after_water - after_dht)
+        record_samples.append(end - after_water)
+        cycle_samples.append(end - start)
+    wrapper.control_engine.stop()
+    smartfarm = next(iter(wrapper.devices.values())).smartfarm
+    cycle = summarize(cycle_samples)
+    return {
+        "cycle": cycle,
+        "dht": summarize(dht_samples),
+        "water_level": summarize(water_samples),
+        "record": summarize(record_samples),
+        "measure_interval_seconds": server.MEASURE_INTERVAL,
+        "budget_used_max": round(cycle["max_ms"] / 1000 / server.MEASURE_INTERVAL, 4),
+        "dht_health": smartfarm.get_dht_health(),
+    }
+
+
+def run_child(kind, env, args, verbose=False):
+    """이 파일을 따로 프로세스로 띄워 _child 벤치마크 하나를 돌리고 결과 dict를 받음"""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "_child", kind, "--result", result_path] + args
+        child_env = dict(os.environ, **env)
+        child_env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), child_env.get("PYTHONPATH")]))
+        output = None if verbose else subprocess.DEVNULL
+        subprocess.run(command, env=child_env, stdout=output, stderr=output, check=True)
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def bench_dashboard(workdir, sizes, requests, verbose=False):
+    results = {}
+    for size in sizes:
+        size_dir = os.path.join(workdir, f"dashboard-{size}")
+        os.makedirs(size_dir, exist_ok=True)
+        start = time.perf_counter()
+        last_timestamp = populate_database(os.path.join(size_dir, "datas.db"), size)
+        populate_seconds = time.perf_counter() - start
+        print(f"[benchmark.dashboard] {size}줄을 {populate_seconds:.1f}초만에 채웠습니다.", file=sys.stderr)
+        result = run_child(
+            "dashboard",
+            {},
+            ["--workdir", size_dir, "--requests", str(requests), "--last", last_timestamp.strftime("%Y.%m.%d %H:%M:%S")],
+            verbose,
+        )
+        result["populate_seconds"] = round(populate_seconds, 3)
+        result["db_bytes"] = os.path.getsize(os.path.join(size_dir, "datas.db"))
+        results[str(size)] = result
+        print(f"[benchmark.dashboard] {size}줄 : /stats p50 {result['/stats']['p50_ms']}ms, 서버 켜는 시간 {result['startup_seconds']}초", file=sys.stderr)
+        shutil.rmtree(size_dir, ignore_errors=True)
+    return results
+
+
+def bench_cycle(workdir, cycles, scenarios=tuple(CYCLE_SCENARIOS), verbose=False):
+    results = {}
+    for scenario in scenarios:
+        scenario_dir = os.path.join(workdir, f"cycle-{scenario}")
+        os.makedirs(scenario_dir, exist_ok=True)
+        results[scenario] = run_child(
+            "cycle", CYCLE_SCENARIOS[scenario], ["--workdir", scenario_dir, "--cycles", str(cycles)], verbose
+        )
+        print(f"[benchmark.cycle] {scenario} : 한 주기 최대 {results[scenario]['cycle']['max_ms']}ms", file=sys.stderr)
+    return results
+
+
+def environment_info():
+    """결과를 비교할 때 알아야 할 실행 환경 정보"""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    import numpy as np
+
+    return {
+        "revision": revision,
+        "started_at": datetime.now().strftime("%Y.%m.%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": np.__version__,
+        "backend": os.environ.get("SMARTFARM_BACKEND"),
+        "seed": os.environ.get("SMARTFARM_SIM_SEED"),
+    }
+
+
+def flatten(results, prefix=""):
+    """중첩된 결과 dict를 {"dashboard.1000./stats.p50_ms": 값} 처럼 숫자 값만 있는 평평한 dict로 만듬"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+# 비교할 항목들 (횟수나 크기 같은 나머지 숫자는 비교하지 않음)
+_COMPARED_SUFFIXES = ("_ms", "rows_per_second", "startup_seconds")
+
+
+def compare(old, new, threshold=0.1):
+    """두 결과 파일의 같은 항목을 비교해 threshold 비율 넘게 나빠진 항목들을 (이름, 예전 값, 새 값, 비율) list로 반환함"""
+    old_flat = flatten(old.get("results", {}))
+    new_flat = flatten(new.get("results", {}))
+    regressions = []
+    for name in sorted(old_flat.keys() & new_flat.keys()):
+        if not name.endswith(_COMPARED_SUFFIXES):
+            continue
+        before, after = old_flat[name], new_flat[name]
+        if before == 0:
+            continue
+        ratio = after / before
+        worse = ratio < 1 - threshold if name.endswith(HIGHER_IS_BETTER) else ratio > 1 + threshold
+        if worse:
+            regressions.append((name, before, after, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="스마트팜 서버 벤치마크 (가상 하드웨어)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in BENCHMARKS + ("all",):
+        bench = sub.add_parser(name)
+        bench.add_argument("--output", help="결과 JSON을 저장할 파일. 없으면 표준 출력")
+        bench.add_argument("--workdir", help="DB 파일들을 만들 디렉토리. 없으면 임시 디렉토리를 만들고 끝나면 지움")
+        bench.add_argument("--quick", action="store_true", help="작은 크기로 빨리 돌려봄")
+        bench.add_argument("--verbose", action="store_true", help="따로 띄운 서버 프로세스의 출력을 보여줌")
+        bench.add_argument("--rows", type=int, help=f"ingest에서 넣을 줄 수 (기본 {DEFAULT_INGEST_ROWS})")
+        bench.add_argument("--sizes", help="dashboard에서 datas.db에 채울 줄 수들 (쉼표로 구분)")
+        bench.add_argument("--clients", help="fanout에서 구독자 수들 (쉼표로 구분)")
+        bench.add_argument("--requests", type=int, help="dashboard에서 주소마다 보낼 요청 수")
+        bench.add_argument("--publishes", type=int, help="fanout에서 발행할 횟수")
+        bench.add_argument("--cycles", type=int, help="cycle에서 경우마다 잴 주기 수")
+    compare_parser = sub.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="이 비율 넘게 나빠지면 보고함 (기본 0.1)")
+    child = sub.add_parser("_child")
+    child.add_argument("kind", choices=("dashboard", "cycle"))
+    child.add_argument("--result", required=True)
+    child.add_argument("--workdir", required=True)
+    child.add_argument("--requests", type=int, default=DEFAULT_REQUESTS)
+    child.add_argument("--cycles", type=int, default=DEFAULT_CYCLES)
+    child.add_argument("--last")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold)
+        for name, before, after, ratio in regressions:
+            print(f"{name} : {before} -> {after} ({ratio:.2f}배)")
+        print(f"{len(regressions)}개 항목이 {args.threshold:.0%} 넘게 나빠졌습니다.")
+        return 1 if regressions else 0
+
+    if args.command == "_child":
+        if args.kind == "dashboard":
+            result = _dashboard_child(args.workdir, args.requests, args.last)
+        else:
+            result = _cycle_child(args.workdir, args.cycles)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        # 서버의 백그라운드 스레드들을 기다리지 않고 바로 끝냄
+        sys.stdout.flush()
+        os._exit(0)
+
+    def option(value, quick_key, default):
+        if value is not None:
+            return value
+        return QUICK[quick_key] if args.quick else default
+
+    def int_list(value):
+        return tuple(int(x) for x in value.split(",")) if value else None
+
+    rows = option(args.rows, "rows", DEFAULT_INGEST_ROWS)
+    sizes = option(int_list(args.sizes), "sizes", DEFAULT_DASHBOARD_SIZES)
+    clients = option(int_list(args.clients), "clients", DEFAULT_FANOUT_CLIENTS)
+    requests = option(args.requests, "requests", DEFAULT_REQUESTS)
+    publishes = option(args.publishes, "publishes", DEFAULT_PUBLISHES)
+    cycles = option(args.cycles, "cycles", DEFAULT_CYCLES)
+    selected = BENCHMARKS if args.command == "all" else (args.command,)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="smartfarm-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    report = {"environment": environment_info(), "parameters": {}, "results": {}}
+    try:
+        if "ingest" in selected:
+            report["parameters"]["ingest"] = {"rows": rows}
+            report["results"]["ingest"] = bench_ingest(workdir, rows)
+            print(f"[benchmark.ingest] 초당 {report['results']['ingest']['rows_per_second']}줄", file=sys.stderr)
+        if "dashboard" in selected:
+            report["parameters"]["dashboard"] = {"sizes": list(sizes), "requests": requests}
+            report["results"]["dashboard"] = bench_dashboard(workdir, sizes, requests, args.verbose)
+        if "fanout" in selected:
+            report["parameters"]["fanout"] = {"clients": list(clients), "publishes": publishes}
+            report["results"]["fanout"] = bench_fanout(clients, publishes)
+        if "cycle" in selected:
+            report["parameters"]["cycle"] = {"cycles": cycles, "scenarios": CYCLE_SCENARIOS}
+            report["results"]["cycle"] = bench_cycle(workdir, cycles, verbose=args.verbose)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"[benchmark] 결과를 {args.output}에 저장했습니다.", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
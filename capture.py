@@ -0,0 +1,231 @@
+"""
+카메라 화면을 계속 받아 미리 만들어 둔 버퍼들에 담아두는 연속 캡처 파이프라인.
+
+카메라를 video port에서 MJPEG로 계속 녹화시키고, 카메라가 보내주는 JPEG 한 장 한 장을
+FrameBufferPool에 미리 할당해 둔 고정 크기 bytearray들 중 비어있는 곳에 복사해 넣음.
+- 사진을 쓰는 쪽은 Frame.view()로 복사 없이 memoryview를 받음
+- 파일로 저장할 때는 이미 JPEG로 인코딩된 bytes를 그대로 씀 (PIL로 다시 열어 인코딩하지 않음)
+- 버퍼 개수와 크기가 고정이라 몇 주를 켜둬도 메모리 사용량이 늘지 않음
+버퍼는 참조 횟수(retain/release)로 관리하며, 모든 버퍼가 사용 중이면 새 사진은 버림.
+"""
+
+import os
+import threading
+import time
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+
+
+class FrameBufferPool:
+    """
+    미리 할당해 둔 고정 크기 bytearray 버퍼 묶음.
+    - count(int) : 버퍼 개수
+    - size(int) : 버퍼 하나의 크기(bytes). 이보다 큰 사진은 담을 수 없어 버림
+    """
+
+    def __init__(self, count=4, size=512 * 1024):
+        self.size = size
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self._refs = [0] * count
+        self._free = list(range(count))
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """비어있는 버퍼 번호를 하나 꺼내 반환함 (참조 횟수 1). 비어있는 버퍼가 없으면 None"""
+        with self._lock:
+            if not self._free:
+                return None
+            index = self._free.pop()
+            self._refs[index] = 1
+            return index
+
+    def retain(self, index):
+        with self._lock:
+            self._refs[index] += 1
+
+    def release(self, index):
+        """참조 횟수를 1 줄이고, 0이 되면 버퍼를 다시 비어있는 버퍼로 돌려놓음"""
+        with self._lock:
+            self._refs[index] -= 1
+            if self._refs[index] == 0:
+                self._free.append(index)
+
+    def free_count(self):
+        with self._lock:
+            return len(self._free)
+
+
+class Frame:
+    """
+    FrameBufferPool의 버퍼 하나에 담긴 JPEG 사진 한 장.
+    다 쓴 뒤에는 release()를 불러야 하며, with 문으로 쓰면 끝날 때 자동으로 release됨.
+    """
+
+    __slots__ = ("pool", "index", "length", "seq", "timestamp")
+
+    def __init__(self, pool, index, length, seq, timestamp):
+        self.pool = pool
+        self.index = index
+        self.length = length
+        self.seq = seq  # 몇 번째 사진인지
+        self.timestamp = timestamp  # 사진이 완성된 시각 (time.time())
+
+    def view(self) -> memoryview:
+        """복사 없이 사진 bytes를 가리키는 memoryview를 반환함. release() 뒤에는 쓰면 안 됨"""
+        return memoryview(self.pool.buffers[self.index])[: self.length]
+
+    def tobytes(self) -> bytes:
+        """사진을 bytes로 복사해 반환함 (release 뒤에도 써야 하는 경우에만 사용)"""
+        return bytes(self.view())
+
+    def save(self, path):
+        """이미 인코딩된 JPEG bytes를 디코딩 없이 그대로 파일에 씀"""
+        with open(path, "wb") as f:
+            f.write(self.view())
+
+    def retain(self):
+        self.pool.retain(self.index)
+        return self
+
+    def release(self):
+        self.pool.release(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _PoolOutput:
+    """
+    카메라가 녹화하면서 write()를 부르는 출력 객체. JPEG 시작 표시(0xFFD8)와 끝 표시(0xFFD9)를 기준으로 사진을 나눠 버퍼에 담음
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.index = None
+        self.length = 0
+        self.overflow = False
+
+    def write(self, buf):
+        if buf[:2] == JPEG_START:
+            # 새 사진이 시작되면 이전 사진을 완성시킴
+            self._finish()
+            self.index = self.engine.pool.acquire()
+            self.length = 0
+            self.overflow = False
+            if self.index is None:
+                self.engine.dropped_pool_empty += 1
+        if self.index is not None and not self.overflow:
+            end = self.length + len(buf)
+            if end > self.engine.pool.size:
+                self.overflow = True
+            else:
+                self.engine.pool.buffers[self.index][self.length : end] = buf
+                self.length = end
+        # 사진이 끝났으면 다음 사진이 올 때까지 기다리지 않고 바로 완성시킴
+        if buf[-2:] == JPEG_END:
+            self._finish()
+        return len(buf)
+
+    def _finish(self):
+        if self.index is None:
+            return
+        index, self.index = self.index, None
+        if self.overflow or self.length == 0:
+            if self.overflow:
+                self.engine.dropped_oversize += 1
+            self.engine.pool.release(index)
+            return
+        self.engine._publish(index, self.length)
+
+    def flush(self):
+        self._finish()
+
+
+class CaptureEngine:
+    """
+    카메라를 MJPEG로 계속 녹화시키며 가장 최근 사진을 들고 있는 캡처 엔진.
+    - camera : picamera.PiCamera와 같은 인터페이스를 가진 카메라 (start_recording, stop_recording)
+    - pool(FrameBufferPool) : 사진을 담을 버퍼 묶음. None이면 기본 크기로 만듬
+    - resolution(tuple) : 녹화 해상도
+    - framerate(int) : 초당 사진 수
+    """
+
+    def __init__(self, camera, pool=None, resolution=(600, 600), framerate=5):
+        self.camera = camera
+        self.pool = pool if pool is not None else FrameBufferPool()
+        self.resolution = resolution
+        self.framerate = framerate
+        self._output = _PoolOutput(self)
+        self._condition = threading.Condition()
+        self._latest = None
+        self.running = False
+
+        # 지표들
+        self.frame_count = 0
+        self.dropped_pool_empty = 0
+        self.dropped_oversize = 0
+        self.started_time = None
+
+    def start(self):
+        if self.running:
+            return
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.framerate
+        self.camera.start_recording(self._output, format="mjpeg")
+        self.running = True
+        self.started_time = time.monotonic()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.camera.stop_recording()
+        self.running = False
+
+    def _publish(self, index, length):
+        """다 받은 사진을 가장 최근 사진으로 바꿔 끼우고 기다리던 쪽을 깨움"""
+        with self._condition:
+            self.frame_count += 1
+            frame = Frame(self.pool, index, length, self.frame_count, time.time())
+            previous, self._latest = self._latest, frame
+            self._condition.notify_all()
+        if previous is not None:
+            previous.release()
+
+    def latest(self):
+        """가장 최근 사진을 retain해서 반환함 (다 쓰면 release해야 함). 아직 사진이 없으면 None"""
+        with self._condition:
+            if self._latest is None:
+                return None
+            return self._latest.retain()
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        """seq가 after_seq보다 큰 사진이 나올 때까지 기다렸다가 retain해서 반환함. 시간이 다 되면 None"""
+        with self._condition:
+            ready = self._condition.wait_for(
+                lambda: self._latest is not None and self._latest.seq > after_seq, timeout
+            )
+            if not ready:
+                return None
+            return self._latest.retain()
+
+    def get_stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_time if self.started_time else 0.0
+        return {
+            "frames": self.frame_count,
+            "fps": self.frame_count / elapsed if elapsed > 0 else 0.0,
+            "dropped_pool_empty": self.dropped_pool_empty,
+            "dropped_oversize": self.dropped_oversize,
+            "free_buffers": self.pool.free_count(),
+        }
+
+
+def save_frame(frame, directory, filename):
+    """사진을 directory/filename에 그대로 저장함. directory가 없으면 만듬"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    frame.save(path)
+    return path
@@ -0,0 +1,132 @@
+"""
+스마트팜의 히터와 전등을 조절하는 이벤트 기반 제어 엔진.
+여러 대의 스마트팜(fleet.py)을 스레드 하나로 함께 조절함.
+
+예전에는 1초마다 SmartFarmDevice.adjust()를 불렀지만, 온도는 온습도 측정이 끝날 때만 바뀌고
+전등을 켜고 끄는 시각은 미리 계산할 수 있기 때문에, 제어 엔진은 아래 경우에만 깨어나 조절함.
+- 새 온도 측정값이 들어왔을 때 -> 히터 조절
+- 설정 최저 온도가 바뀌었을 때 -> 히터 조절
+- 켜는/끄는 시각이 바뀌었을 때 -> 전등 조절 후 다음 전등 전환 시각을 다시 계산
+- 미리 계산해 둔 다음 전등 전환 시각이 되었을 때 -> 전등 조절 후 그 다음 전환 시각을 계산
+"""
+
+import threading
+import time
+from datetime import datetime
+from functools import partial
+
+import log
+import metrics
+
+LOG = log.get_logger("control")
+
+# 시스템 시계가 바뀌는 경우(라즈베리파이는 부팅 직후 NTP로 시계를 맞춤)를 대비해 이 시간(초)보다 오래 자지 않음
+MAX_SLEEP_SECONDS = 300.0
+# 타이머가 전환 시각보다 아주 조금 일찍 깨어나 같은 시각을 다시 기다리는 일이 없도록 더 기다리는 시간(초)
+WAKEUP_MARGIN_SECONDS = 0.01
+
+ADJUST_SECONDS = metrics.histogram("smartfarm_adjust_seconds", "스마트팜 한 대의 히터/전등을 조절하는 데 걸린 시간", ["device"])
+ADJUST_ERRORS = metrics.counter("smartfarm_adjust_errors_total", "스마트팜을 조절하다 오류가 난 횟수", ["device"])
+
+
+class ControlEngine:
+    """
+    SmartFarmDevice들에서 오는 알림과 다음 전등 전환 시각에만 깨어나 히터와 전등을 조절하는 제어 엔진.
+    - devices(list[SmartFarmDevice]) : 조절할 스마트팜들 (device_id가 서로 달라야 함)
+    """
+
+    def __init__(self, devices):
+        self.devices = {device.device_id: device for device in devices}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {device_id: set() for device_id in self.devices}
+        self._stopped = False
+        self.next_transition = {device_id: None for device_id in self.devices}
+
+        # 지표들
+        self.wakeup_count = 0
+        self.heater_adjust_count = 0
+        self.light_adjust_count = 0
+        self.last_adjust_seconds = 0.0
+
+        self._adjust_seconds = {device_id: ADJUST_SECONDS.labels(device_id) for device_id in self.devices}
+        self._adjust_errors = {device_id: ADJUST_ERRORS.labels(device_id) for device_id in self.devices}
+        for device_id, device in self.devices.items():
+            device.add_listener(partial(self.notify, device_id=device_id))
+        self._thread = threading.Thread(target=self._run, name="ControlEngine", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def notify(self, reason, device_id=None):
+        """
+        SmartFarmDevice가 측정값이나 설정값이 바뀌었을 때 부르는 함수. 제어 스레드를 바로 깨움
+        - device_id(str) : 알림을 보낸 스마트팜. None이면 모든 스마트팜
+        """
+        with self._lock:
+            targets = self._pending if device_id is None else [device_id]
+            for target in targets:
+                self._pending[target].add(reason)
+        self._wake.set()
+
+    def get_stats(self) -> dict:
+        return {
+            "wakeups": self.wakeup_count,
+            "heater_adjusts": self.heater_adjust_count,
+            "light_adjusts": self.light_adjust_count,
+            "last_adjust_seconds": self.last_adjust_seconds,
+            "next_transition": {
+                device_id: None if transition is None else transition.strftime("%Y.%m.%d %H:%M:%S")
+                for device_id, transition in self.next_transition.items()
+            },
+        }
+
+    def _adjust(self, device_id, reasons):
+        """스마트팜 한 대를 받은 알림(reasons)과 전등 전환 시각에 맞게 조절함"""
+        device = self.devices[device_id]
+        if reasons & {"measurement", "min_temp"}:
+            device.adjust_heater()
+            self.heater_adjust_count += 1
+        # 켜는/끄는 시각이 바뀌었거나 전환 시각이 지났으면 전등을 조절하고 다음 전환 시각을 다시 계산함
+        next_transition = self.next_transition[device_id]
+        transition_due = next_transition is not None and datetime.now() >= next_transition
+        if transition_due or reasons & {"on_time", "off_time"}:
+            device.adjust_lights()
+            self.light_adjust_count += 1
+            self.next_transition[device_id] = device.next_light_transition()
+
+    def _run(self):
+        """제어 스레드용 함수. 알림이 오거나 가장 가까운 전등 전환 시각이 될 때까지 잠들어 있음"""
+        # 처음 시작할 때는 모든 스마트팜의 히터와 전등을 조절함
+        pending = {device_id: {"measurement", "on_time"} for device_id in self.devices}
+        while not self._stopped:
+            start = time.monotonic()
+            for device_id, reasons in pending.items():
+                try:
+                    with self._adjust_seconds[device_id].time():
+                        self._adjust(device_id, reasons)
+                except Exception as e:
+                    self._adjust_errors[device_id].inc()
+                    # 한 대가 고장나도 다른 스마트팜은 계속 조절함
+                    LOG.error(
+                        "adjust_failed", "스마트팜을 조절하는 중 오류가 발생했습니다!", key=device_id, every=60, device=device_id, error=e
+                    )
+            self.last_adjust_seconds = time.monotonic() - start
+
+            transitions = [transition for transition in self.next_transition.values() if transition is not None]
+            if not transitions:
+                timeout = MAX_SLEEP_SECONDS
+            else:
+                timeout = (min(transitions) - datetime.now()).total_seconds() + WAKEUP_MARGIN_SECONDS
+                timeout = min(max(timeout, 0.0), MAX_SLEEP_SECONDS)
+
+            self._wake.wait(timeout)
+            self._wake.clear()
+            self.wakeup_count += 1
+            with self._lock:
+                pending = self._pending
+                self._pending = {device_id: set() for device_id in self.devices}
@@ -0,0 +1,430 @@
+"""
+스마트팜 하드웨어 드라이버 계층.
+
+SmartFarmDevice는 GPIO, DHT 온습도센서, SPI(MCP3008 ADC), 카메라를 직접 import하지 않고
+이 모듈의 load_backend()가 돌려주는 DeviceBackend 객체를 통해 사용함.
+- "rpi" 백엔드 : 실제 라즈베리파이용. RPi.GPIO, Adafruit_DHT, spidev, picamera를 그때그때 import함
+- "sim" 백엔드 : 일반 리눅스 PC에서 돌아가는 가상 하드웨어. 센서 지연시간, 실패율, 시간 배속을 설정할 수 있어
+                 라즈베리파이 없이도 FlaskAppWrapper, 백그라운드 루프, SQLite 경로의 성능을 측정할 수 있음
+
+사용할 백엔드는 환경변수 SMARTFARM_BACKEND (기본값 "rpi")로 고름.
+가상 백엔드의 설정값들은 아래 환경변수로 바꿀 수 있음
+- SMARTFARM_SIM_TIME_SCALE : 가상 센서의 지연시간에 곱해지는 배율 (0.01이면 100배 빠르게)
+- SMARTFARM_SIM_DHT_LATENCY : DHT 센서 한번 읽는 데 걸리는 시간(초)
+- SMARTFARM_SIM_DHT_FAIL_RATE : DHT 센서 한번 읽을 때 실패할 확률 (0~1)
+- SMARTFARM_SIM_DEAD_PINS : 항상 실패하는 DHT 핀 번호들 (예: "21,16")
+"""
+
+import os
+import random
+import threading
+import time as _time
+from datetime import datetime
+from io import BytesIO
+
+DEFAULT_BACKEND = "rpi"
+
+
+class DeviceBackend:
+    """
+    한 종류의 하드웨어 드라이버 묶음.
+    - name(str) : 백엔드 이름 ("rpi"/"sim")
+    - GPIO : RPi.GPIO와 같은 인터페이스를 가진 모듈/객체 (HIGH, LOW, BCM, OUT, setmode, setup, output, cleanup)
+    - DHT : Adafruit_DHT와 같은 인터페이스를 가진 모듈/객체 (DHT11, read_retry)
+    - spi_factory : spidev.SpiDev처럼 호출하면 SPI 장치 객체를 만들어 주는 함수
+    - camera_factory : picamera.PiCamera처럼 호출하면 카메라 객체를 만들어 주는 함수
+    """
+
+    def __init__(self, name, GPIO, DHT, spi_factory, camera_factory):
+        self.name = name
+        self.GPIO = GPIO
+        self.DHT = DHT
+        self.spi_factory = spi_factory
+        self.camera_factory = camera_factory
+        # 가상 백엔드일 때만 SimulatedEnvironment가 들어감
+        self.environment = None
+
+    def register_actuators(self, heater_pins=(), pump_pins=()):
+        """가상 백엔드에 어떤 핀이 히터와 펌프인지 알려줌. 실제 하드웨어에서는 아무것도 안 함"""
+        if self.environment is not None:
+            self.environment.heater_pins.update(heater_pins)
+            self.environment.pump_pins.update(pump_pins)
+
+    def __repr__(self):
+        return f"DeviceBackend({self.name!r})"
+
+
+def _load_rpi_backend():
+    """실제 라즈베리파이 하드웨어용 백엔드를 만듬. 필요한 모듈이 없으면 ImportError가 그대로 올라감"""
+    import RPi.GPIO as GPIO
+
+    # pip install Adafruit_DHT로 DHT 온습도센서 사용 모듈을 설치
+    import Adafruit_DHT
+    import spidev
+
+    def camera_factory():
+        # 카메라는 고장나 있는 경우가 많아 실제로 카메라를 만들 때만 picamera를 import함
+        import picamera
+
+        return picamera.PiCamera()
+
+    return DeviceBackend("rpi", GPIO, Adafruit_DHT, spidev.SpiDev, camera_factory)
+
+
+class SimulatedEnvironment:
+    """
+    가상 스마트팜의 물리 상태(온도, 습도, 수위)를 흉내내는 클래스.
+    히터 핀이 켜져 있으면 온도가 천천히 오르고 꺼져 있으면 바깥 온도로 내려가며,
+    펌프 핀이 켜져 있으면 수위가 조금씩 줄어듬. 시간은 time_scale 배속으로 흐름.
+    """
+
+    def __init__(self, time_scale=1.0, outside_temp=14.0, humidity=55.0, water_level=12.0, seed=None):
+        self.time_scale = time_scale
+        self.outside_temp = outside_temp
+        self.temperature = outside_temp
+        self.humidity = humidity
+        self.water_level = water_level
+        self.heater_pins = set()
+        self.pump_pins = set()
+        self.pin_levels = {}
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_step = _time.monotonic()
+
+    def set_pin(self, pin, level):
+        with self._lock:
+            self._step()
+            self.pin_levels[pin] = level
+
+    def _is_on(self, pins):
+        return any(self.pin_levels.get(pin) for pin in pins)
+
+    def _step(self):
+        """마지막으로 호출된 뒤 흐른 (배속된) 시간만큼 물리 상태를 진행시킴. self._lock을 잡은 상태에서 호출해야 함"""
+        now = _time.monotonic()
+        # 배속이 작을수록(지연이 짧을수록) 가상 시간은 빨리 흐름
+        elapsed = (now - self._last_step) / max(self.time_scale, 1e-6)
+        self._last_step = now
+        if self._is_on(self.heater_pins):
+            self.temperature += 0.002 * elapsed
+        else:
+            self.temperature += (self.outside_temp - self.temperature) * min(1.0, 0.0005 * elapsed)
+        if self._is_on(self.pump_pins):
+            self.water_level = max(0.0, self.water_level - 0.0005 * elapsed)
+        self.humidity = min(95.0, max(20.0, self.humidity + self.random.gauss(0, 0.01) * elapsed ** 0.5))
+
+    def snapshot(self):
+        """현재 (temperature, humidity, water_level)을 반환"""
+        with self._lock:
+            self._step()
+            return self.temperature, self.humidity, self.water_level
+
+
+class SimulatedGPIO:
+    """RPi.GPIO와 같은 인터페이스를 가진 가상 GPIO. 출력 핀의 상태와 쓰기 횟수를 기록함"""
+
+    HIGH = 1
+    LOW = 0
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.mode = None
+        self.pin_modes = {}
+        self.pin_states = {}
+        self.write_count = 0
+        self._lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, initial=None):
+        with self._lock:
+            self.pin_modes[pin] = mode
+            if initial is not None:
+                self.pin_states[pin] = initial
+
+    def output(self, pin, state):
+        if pin not in self.pin_modes:
+            raise RuntimeError(f"핀 {pin}이 setup되지 않은 상태에서 output이 호출되었습니다!")
+        with self._lock:
+            self.pin_states[pin] = state
+            self.write_count += 1
+        self.environment.set_pin(pin, state)
+
+    def input(self, pin):
+        return self.pin_states.get(pin, self.LOW)
+
+    def cleanup(self, channels=None):
+        """RPi.GPIO처럼 channels(핀 번호 혹은 그 list)가 주어지면 그 핀들만, 아니면 모든 핀을 초기화함"""
+        with self._lock:
+            if channels is None:
+                self.pin_modes.clear()
+                self.pin_states.clear()
+                return
+            if isinstance(channels, int):
+                channels = [channels]
+            for pin in channels:
+                self.pin_modes.pop(pin, None)
+                self.pin_states.pop(pin, None)
+
+
+class SimulatedDHT:
+    """
+    Adafruit_DHT와 같은 인터페이스를 가진 가상 DHT 센서 모듈.
+    - latency(float) : 한번 읽는 데 걸리는 시간(초)
+    - failure_rate(float) : 한번 읽을 때 실패할 확률
+    - dead_pins(set) : 항상 실패하는 핀들
+    - retry_delay(float) : read_retry에서 재시도 사이 대기시간(초) - Adafruit_DHT 기본값과 같은 2초
+    모든 시간은 environment.time_scale 배로 줄거나 늘어남
+    """
+
+    DHT11 = 11
+    DHT22 = 22
+    AM2302 = 22
+
+    def __init__(self, environment, latency=0.25, failure_rate=0.1, dead_pins=(), retry_delay=2.0, noise=0.4):
+        self.environment = environment
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.dead_pins = set(dead_pins)
+        self.retry_delay = retry_delay
+        self.noise = noise
+        self.pin_failure_rates = {}
+        self.read_count = 0
+        self.fail_count = 0
+        self._lock = threading.Lock()
+
+    def set_failure_rate(self, pin, rate):
+        """특정 핀의 실패 확률만 따로 지정함"""
+        self.pin_failure_rates[pin] = rate
+
+    def read(self, sensor, pin):
+        """센서를 한번 읽어 (humidity, temperature)를 반환. 실패하면 (None, None)"""
+        _time.sleep(self.latency * self.environment.time_scale)
+        rate = 1.0 if pin in self.dead_pins else self.pin_failure_rates.get(pin, self.failure_rate)
+        with self._lock:
+            self.read_count += 1
+            failed = self.environment.random.random() < rate
+            if failed:
+                self.fail_count += 1
+        if failed:
+            return None, None
+        temperature, humidity, _ = self.environment.snapshot()
+        rng = self.environment.random
+        # DHT11은 정수 단위로만 값을 돌려줌
+        return float(round(humidity + rng.gauss(0, self.noise))), float(round(temperature + rng.gauss(0, self.noise)))
+
+    def read_retry(self, sensor, pin, retries=15, delay_seconds=None):
+        """Adafruit_DHT.read_retry처럼 성공할 때까지 최대 retries번 읽음"""
+        if delay_seconds is None:
+            delay_seconds = self.retry_delay
+        for i in range(retries):
+            humidity, temperature = self.read(sensor, pin)
+            if humidity is not None and temperature is not None:
+                return humidity, temperature
+            if i < retries - 1:
+                _time.sleep(delay_seconds * self.environment.time_scale)
+        return None, None
+
+
+class SimulatedSpiDev:
+    """
+    spidev.SpiDev와 같은 인터페이스를 가진 가상 MCP3008 10비트 ADC.
+    channel_values로 값(0~1023)을 지정한 채널은 그 값을, 나머지 채널은 수위센서 전압을 돌려줌 (여러 대의 스마트팜이 채널을 나눠 씀).
+    3바이트 단위로 여러 변환을 한 트랜잭션에 몰아서 보내도 각각 처리함.
+    """
+
+    VREF = 3.3
+
+    def __init__(self, environment, latency_per_byte=8e-6, noise=3.0, volts_per_cm=0.2):
+        self.environment = environment
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.latency_per_byte = latency_per_byte
+        self.noise = noise
+        self.volts_per_cm = volts_per_cm
+        self.channel_values = {}
+        self.transfer_count = 0
+        self.is_open = False
+
+    def open(self, bus, device):
+        self.bus = bus
+        self.device = device
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _convert(self, channel):
+        if channel in self.channel_values:
+            code = self.channel_values[channel]
+        else:
+            _, _, water_level = self.environment.snapshot()
+            code = water_level * self.volts_per_cm / self.VREF * 1024
+        code += self.environment.random.gauss(0, self.noise)
+        return int(min(1023, max(0, round(code))))
+
+    def xfer2(self, data):
+        if not self.is_open:
+            raise RuntimeError("SPI 장치가 열려있지 않습니다!")
+        self.transfer_count += 1
+        _time.sleep(len(data) * self.latency_per_byte * self.environment.time_scale)
+        result = []
+        for i in range(0, len(data) - len(data) % 3, 3):
+            start, command, _ = data[i : i + 3]
+            if start != 1 or not command & 0x80:
+                result.extend([0, 0, 0])
+                continue
+            code = self._convert((command >> 4) & 0x07)
+            result.extend([0, (code >> 8) & 0x03, code & 0xFF])
+        result.extend([0] * (len(data) % 3))
+        return result
+
+    xfer = xfer2
+
+
+class SimulatedCamera:
+    """
+    picamera.PiCamera와 같은 인터페이스를 가진 가상 카메라.
+    capture() 할때마다 시각이 찍힌 합성 JPEG 이미지를 만들어 줌.
+    """
+
+    def __init__(self, environment, resolution=(600, 600), latency=0.15):
+        self.environment = environment
+        self.resolution = resolution
+        self.framerate = 5
+        self.latency = latency
+        self.frame_count = 0
+        self.closed = False
+        self._recording = None
+
+    def _render_jpeg(self):
+        # 합성 이미지를 만들 때만 PIL이 필요하므로 여기서 import함
+        from PIL import Image, ImageDraw
+
+        width, height = self.resolution
+        shade = (self.frame_count * 7) % 120
+        # 배경은 흙색, 가운데 식물은 초록색이라 growth.py의 초록 비율 계산을 가상 하드웨어로도 확인할 수 있음
+        img = Image.new("RGB", (width, height), (110 + shade // 4, 80 + shade // 4, 55))
+        draw = ImageDraw.Draw(img)
+        # 화분 속 식물처럼 보이도록 초록색 원을 그림. 프레임마다 크기가 조금씩 바뀜
+        radius = width // 6 + (self.frame_count % 20)
+        cx, cy = width // 2, height // 2
+        draw.ellipse([cx - radius, cy - radius, cx + radius, cy + radius], fill=(40, 170, 60))
+        draw.text((10, 10), datetime.now().strftime("%Y.%m.%d %H:%M:%S"), fill=(255, 255, 255))
+        buffer = BytesIO()
+        img.save(buffer, format="jpeg")
+        return buffer.getvalue()
+
+    def capture(self, output, format="jpeg", use_video_port=False, **kwargs):
+        if self.closed:
+            raise RuntimeError("카메라가 닫혀있습니다!")
+        _time.sleep(self.latency * self.environment.time_scale)
+        data = self._render_jpeg()
+        self.frame_count += 1
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                f.write(data)
+        else:
+            output.write(data)
+
+    def start_recording(self, output, format="mjpeg", **kwargs):
+        """picamera처럼 framerate에 맞춰 사진을 한 장씩 output.write()로 계속 보냄"""
+        if self._recording is not None:
+            raise RuntimeError("카메라가 이미 녹화중입니다!")
+        stop = threading.Event()
+
+        def record():
+            period = 1.0 / self.framerate
+            next_time = _time.monotonic()
+            while not stop.is_set():
+                output.write(self._render_jpeg())
+                self.frame_count += 1
+                next_time = max(next_time + period, _time.monotonic())
+                stop.wait(next_time - _time.monotonic())
+            if hasattr(output, "flush"):
+                output.flush()
+
+        thread = threading.Thread(target=record, name="SimulatedCamera", daemon=True)
+        self._recording = (thread, stop)
+        thread.start()
+
+    def stop_recording(self):
+        if self._recording is None:
+            return
+        thread, stop = self._recording
+        stop.set()
+        thread.join()
+        self._recording = None
+
+    def close(self):
+        self.stop_recording()
+        self.closed = True
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, "") else float(value)
+
+
+def make_simulated_backend(
+    time_scale=None,
+    dht_latency=None,
+    dht_failure_rate=None,
+    dead_pins=None,
+    seed=None,
+):
+    """
+    가상 하드웨어 백엔드를 만듬. 인자가 주어지지 않으면 SMARTFARM_SIM_* 환경변수, 그것도 없으면 기본값을 씀.
+    - time_scale(float) : 모든 가상 지연시간에 곱하는 배율
+    - dht_latency(float) : DHT 센서 한번 읽는 시간(초)
+    - dht_failure_rate(float) : DHT 센서 읽기 실패 확률
+    - dead_pins(iterable) : 항상 실패하는 DHT 핀 번호들
+    - seed : 난수 시드 (벤치마크를 재현할 때 사용). 주어지지 않으면 SMARTFARM_SIM_SEED
+    """
+    if time_scale is None:
+        time_scale = _env_float("SMARTFARM_SIM_TIME_SCALE", 1.0)
+    if dht_latency is None:
+        dht_latency = _env_float("SMARTFARM_SIM_DHT_LATENCY", 0.25)
+    if dht_failure_rate is None:
+        dht_failure_rate = _env_float("SMARTFARM_SIM_DHT_FAIL_RATE", 0.1)
+    if dead_pins is None:
+        dead_pins_str = os.environ.get("SMARTFARM_SIM_DEAD_PINS", "")
+        dead_pins = [int(pin) for pin in dead_pins_str.split(",") if pin.strip()]
+    if seed is None and os.environ.get("SMARTFARM_SIM_SEED"):
+        seed = int(os.environ["SMARTFARM_SIM_SEED"])
+
+    environment = SimulatedEnvironment(time_scale=time_scale, seed=seed)
+    gpio = SimulatedGPIO(environment)
+    dht = SimulatedDHT(environment, latency=dht_latency, failure_rate=dht_failure_rate, dead_pins=dead_pins)
+    backend = DeviceBackend(
+        "sim",
+        gpio,
+        dht,
+        lambda: SimulatedSpiDev(environment),
+        lambda: SimulatedCamera(environment),
+    )
+    backend.environment = environment
+    return backend
+
+
+def load_backend(name=None):
+    """
+    이름에 맞는 DeviceBackend를 만들어 반환함.
+    - name(str) : "rpi" 혹은 "sim". None이면 환경변수 SMARTFARM_BACKEND, 그것도 없으면 "rpi"
+    """
+    if name is None:
+        name = os.environ.get("SMARTFARM_BACKEND", DEFAULT_BACKEND)
+    if name == "rpi":
+        return _load_rpi_backend()
+    elif name == "sim":
+        return make_simulated_backend()
+    else:
+        raise ValueError(f"알 수 없는 하드웨어 백엔드 {name}가 주어졌습니다! ('rpi' 혹은 'sim')")
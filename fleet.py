@@ -0,0 +1,149 @@
+"""
+여러 대의 스마트팜(랙)을 서버 하나로 함께 돌리기 위한 설정 모듈.
+
+스마트팜 목록은 JSON 설정 파일(환경변수 SMARTFARM_FLEET_CONFIG, 기본값 ./fleet.json)에 적음.
+설정 파일이 없으면 예전처럼 hardware.py의 기본 핀 배치를 쓰는 스마트팜 "farm" 한 대만 돌림.
+
+    {
+      "devices": [
+        {"id": "rack1"},
+        {"id": "rack2", "camera": false,
+         "pins": {"led_first_floor": 5, "led_second_floor": 22, "heater": 27, "pump": 17,
+                  "dhts": [23, 24, 25, 18], "adc_channel": 1, "extra_adc_channels": [2]},
+         "water_level_calibration": [[0.12, 0.0], [1.05, 5.0], [2.1, 10.0], [3.0, 15.0]]}
+      ]
+    }
+
+pins에 적지 않은 핀은 hardware.DEFAULT_PIN_MAP의 값을 씀. water_level_calibration은 수위센서 보정점들 [[전압 V, 수위 cm], ...]이며
+적지 않으면 hardware.WATER_LEVEL_CALIBRATION_POINTS를 씀. 스마트팜들은 라즈베리파이 한 대의 GPIO를 나눠 쓰므로
+같은 GPIO 핀이나 같은 ADC 채널을 두 대가 쓰면 FleetConfigError를 raise함. 카메라는 한 대만 쓸 수 있음.
+"""
+
+import json
+import os
+import re
+from collections import namedtuple
+
+import log
+from hardware import CAMERA_ENABLED, DEFAULT_PIN_MAP, PinMap, output_pins
+from ingest import DEFAULT_DEVICE_ID
+
+LOG = log.get_logger("fleet")
+
+DEFAULT_FLEET_CONFIG_PATH = "./fleet.json"
+
+# 스마트팜 이름은 socket.io 방 이름과 파일 경로에도 쓰이므로 글자를 제한함
+_DEVICE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+DeviceConfig = namedtuple("DeviceConfig", ["device_id", "pins", "camera", "water_level_calibration"])
+
+
+class FleetConfigError(ValueError):
+    """fleet 설정 파일의 내용이 올바르지 않을 때 raise되는 예외"""
+
+
+def _parse_pins(device_id, pins):
+    unknown = set(pins) - set(PinMap._fields)
+    if unknown:
+        raise FleetConfigError(f"{device_id}의 pins에 알 수 없는 항목이 있습니다 : {', '.join(sorted(unknown))}")
+    merged = DEFAULT_PIN_MAP._replace(**pins)
+    return merged._replace(dhts=tuple(merged.dhts), extra_adc_channels=tuple(merged.extra_adc_channels))
+
+
+def _parse_calibration(device_id, points):
+    if points is None:
+        return None
+    try:
+        points = [(float(volts), float(value)) for volts, value in points]
+    except (TypeError, ValueError):
+        raise FleetConfigError(f"{device_id}의 water_level_calibration은 [[전압, 수위], ...] 형식이어야 합니다!")
+    if len(points) < 2:
+        raise FleetConfigError(f"{device_id}의 water_level_calibration에는 점이 두 개 이상 있어야 합니다!")
+    return points
+
+
+def validate_fleet(devices):
+    """스마트팜 이름, GPIO 핀, ADC 채널이 겹치지 않는지, 카메라가 한 대만 켜져 있는지 확인함"""
+    if not devices:
+        raise FleetConfigError("스마트팜이 하나도 없습니다!")
+    seen_ids = set()
+    pin_owners = {}
+    adc_owners = {}
+    cameras = []
+    for device in devices:
+        if not _DEVICE_ID_PATTERN.match(device.device_id):
+            raise FleetConfigError(f"스마트팜 이름 {device.device_id!r}는 영문, 숫자, '-', '_'로만 지어야 합니다!")
+        if device.device_id in seen_ids:
+            raise FleetConfigError(f"스마트팜 이름 {device.device_id}가 두번 나옵니다!")
+        seen_ids.add(device.device_id)
+        pins = output_pins(device.pins) + list(device.pins.dhts)
+        if len(set(pins)) != len(pins):
+            raise FleetConfigError(f"{device.device_id}의 pins에 같은 GPIO 핀이 두번 나옵니다! ({pins})")
+        for pin in pins:
+            if pin in pin_owners:
+                raise FleetConfigError(f"GPIO {pin}번 핀을 {pin_owners[pin]}와 {device.device_id}가 같이 씁니다!")
+            pin_owners[pin] = device.device_id
+        for channel in (device.pins.adc_channel,) + tuple(device.pins.extra_adc_channels):
+            adc = (device.pins.spi_bus, device.pins.spi_device, channel)
+            if adc in adc_owners:
+                raise FleetConfigError(f"ADC 채널 {adc}를 {adc_owners[adc]}와 {device.device_id}가 같이 씁니다!")
+            adc_owners[adc] = device.device_id
+        if device.camera:
+            cameras.append(device.device_id)
+    if len(cameras) > 1:
+        raise FleetConfigError(f"카메라는 한 대만 쓸 수 있습니다! ({', '.join(cameras)})")
+
+
+def load_fleet_config(path=None):
+    """
+    fleet 설정 파일을 읽어 DeviceConfig list를 반환함. 첫번째 스마트팜이 예전 데이터와 설정을 이어받음.
+    - path(str) : 설정 파일 경로. None이면 환경변수 SMARTFARM_FLEET_CONFIG, 그것도 없으면 ./fleet.json
+    """
+    if path is None:
+        path = os.environ.get("SMARTFARM_FLEET_CONFIG", DEFAULT_FLEET_CONFIG_PATH)
+    if not os.path.exists(path):
+        LOG.info("default_fleet", "설정 파일이 없어 스마트팜 한 대만 돌립니다.", path=path, device=DEFAULT_DEVICE_ID)
+        return [DeviceConfig(DEFAULT_DEVICE_ID, DEFAULT_PIN_MAP, CAMERA_ENABLED, None)]
+
+    with open(path, encoding="utf-8") as f:
+        try:
+            config = json.load(f)
+        except json.JSONDecodeError as e:
+            raise FleetConfigError(f"{path}를 읽을 수 없습니다 : {e}")
+    devices = []
+    for entry in config.get("devices", []):
+        if "id" not in entry:
+            raise FleetConfigError(f"{path}에 id가 없는 스마트팜이 있습니다!")
+        device_id = str(entry["id"])
+        devices.append(
+            DeviceConfig(
+                device_id,
+                _parse_pins(device_id, entry.get("pins", {})),
+                bool(entry.get("camera", False)),
+                _parse_calibration(device_id, entry.get("water_level_calibration")),
+            )
+        )
+    validate_fleet(devices)
+    LOG.info("loaded", "설정 파일에서 스마트팜들을 읽었습니다.", path=path, devices=",".join(d.device_id for d in devices))
+    return devices
+
+
+class FleetDevice:
+    """
+    서버에서 돌아가는 스마트팜 한 대와 그 스마트팜에 딸린 것들을 묶어둔 객체.
+    - config(DeviceConfig) : 설정
+    - smartfarm(SmartFarmDevice) : 스마트팜
+    - reference_status(list) : settings.db의 설정값 [ref_temperature, ref_turn_on_time, ref_turn_off_time]
+    - recent_samples(SampleRingBuffer) : 최근 측정값 링 버퍼
+    - frame_broadcaster(FrameBroadcaster) : 카메라 화면 MJPEG 방송 (카메라가 없으면 None)
+    - image_archive(ImageArchive) : 사진 보관소 (카메라가 없으면 None)
+    """
+
+    def __init__(self, config, smartfarm, reference_status, recent_samples, frame_broadcaster=None, image_archive=None):
+        self.config = config
+        self.device_id = config.device_id
+        self.smartfarm = smartfarm
+        self.reference_status = reference_status
+        self.recent_samples = recent_samples
+        self.frame_broadcaster = frame_broadcaster
+        self.image_archive = image_archive
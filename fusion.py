@@ -0,0 +1,194 @@
+"""
+DHT 온습도센서 여러 개의 측정값을 하나의 온도/습도로 합치는(fusion) 모듈.
+
+예전에는 값을 돌려준 센서들의 평균을 그대로 썼기 때문에, DHT11 하나가 엉뚱한 값(예: 0도, 95%)을 한 번만 돌려줘도
+온실 전체 온도가 흔들려 히터가 켜졌다 꺼졌다 했음. DHTFusion은
+- 센서가 3개 이상 값을 돌려주면 센서들 사이의 중앙값과 MAD(중앙값 절대 편차)로, 그보다 적으면 각 센서의 최근 값들(rolling window)의
+  중앙값과 MAD로 벗어난 값(outlier)을 골라 버리고 나머지의 평균을 씀
+- 원하면 합친 값에 지수이동평균(EMA)을 한번 더 씌움
+- 센서마다 최근 window번의 측정에서 실패율, 버려진 비율, 합친 값과의 평균 차이(bias), 마지막 성공 후 지난 시간(staleness)을 모아둠
+모든 계산은 (센서 수, window, 2) 모양의 NumPy 배열에서 한꺼번에 함. 마지막 축은 (습도, 온도) 순서 (sampler.DHTReading과 같음).
+"""
+
+import threading
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+
+import log
+
+LOG = log.get_logger("fusion")
+
+HUMIDITY, TEMPERATURE = 0, 1
+
+# MAD를 정규분포의 표준편차와 같은 크기로 맞추는 상수
+MAD_SCALE = 1.4826
+
+
+def robust_outliers(values, center, mad, threshold, min_mad):
+    """
+    values가 center에서 threshold * MAD_SCALE * max(mad, min_mad)보다 멀리 떨어져 있으면 True인 bool 배열을 반환함.
+    nan인 값은 outlier가 아님(False)
+    """
+    with np.errstate(invalid="ignore"):
+        limit = threshold * MAD_SCALE * np.maximum(mad, min_mad)
+        return np.abs(values - center) > limit
+
+
+class DHTFusion:
+    """
+    DHT 센서들의 측정값을 합치고 센서마다의 건강 상태를 모으는 객체.
+    - pins(list[int]) : 센서 핀 번호들 (DHTSamplerPool과 같은 순서)
+    - window(int) : 센서마다 기억할 최근 측정 횟수
+    - threshold(float) : 중앙값에서 MAD의 몇 배 넘게 벗어나면 버릴지
+    - min_mad(tuple) : (습도, 온도) MAD의 최솟값. DHT11은 1 단위로만 값을 주기 때문에 센서들이 모두 같은 값을 주면 MAD가 0이 되어
+      1만 달라도 버려지는 것을 막음
+    - min_history(int) : 센서가 3개보다 적게 값을 돌려줬을 때 자기 최근 값들로 검사하려면 최소 몇 개의 값이 쌓여 있어야 하는지
+    - ema_alpha(float) : 합친 값에 씌울 지수이동평균의 새 값 비중 (0~1). None이면 씌우지 않음
+    """
+
+    def __init__(self, pins, window=30, threshold=3.5, min_mad=(1.0, 1.0), min_history=5, ema_alpha=None):
+        if ema_alpha is not None and not 0 < ema_alpha <= 1:
+            raise ValueError(f"ema_alpha는 0보다 크고 1 이하여야 합니다! ({ema_alpha})")
+        self.pins = list(pins)
+        self.window = window
+        self.threshold = threshold
+        self.min_mad = np.asarray(min_mad, dtype=np.float64)
+        self.min_history = min_history
+        self.ema_alpha = ema_alpha
+        self._lock = threading.Lock()
+
+        n = len(self.pins)
+        # 센서마다 받아들인 최근 값들 (없으면 nan) - 센서 수가 적을 때의 outlier 검사와 통계에 씀
+        self.history = np.full((n, window, 2), np.nan)
+        # 받아들인 센서 값 - 합친 값 (bias 계산용. 엉뚱한 값은 버려진 비율로 따로 보이므로 넣지 않음)
+        self.residuals = np.full((n, window, 2), np.nan)
+        # 최근 측정에서 센서가 새 값을 돌려줬는지 / 그 값이 버려졌는지 (아직 측정이 없으면 nan)
+        self.fresh_history = np.full((n, window), np.nan)
+        self.rejected_history = np.full((n, window), np.nan)
+        self.position = 0  # 다음에 쓸 window 칸
+        self.ages = np.full(n, np.nan)
+        self.ema = None
+
+        # 지표들
+        self.update_count = 0
+        self.rejected_count = np.zeros(n, dtype=np.int64)
+
+    def _window_stats(self):
+        """센서마다 자기 최근 값들의 (중앙값, MAD, 값 개수)"""
+        counts = np.sum(~np.isnan(self.history[:, :, TEMPERATURE]), axis=1)
+        with np.errstate(invalid="ignore"), _ignore_nan_warnings():
+            median = np.nanmedian(self.history, axis=1)
+            mad = np.nanmedian(np.abs(self.history - median[:, None, :]), axis=1)
+        return median, mad, counts
+
+    def update(self, readings, max_age):
+        """
+        sampler.DHTSamplerPool.collect()의 결과를 받아 합친 (습도, 온도)를 반환함. 쓸 수 있는 값이 없으면 (None, None)
+        - readings(list[DHTReading]) : pins와 같은 순서의 측정 결과
+        - max_age(float) : 이보다 오래된(초) 마지막 성공 값은 쓰지 않음
+        """
+        n = len(self.pins)
+        values = np.full((n, 2), np.nan)
+        fresh = np.zeros(n, dtype=bool)
+        ages = np.full(n, np.nan)
+        for i, reading in enumerate(readings):
+            if reading.age is not None:
+                ages[i] = reading.age
+            fresh[i] = reading.fresh
+            if reading.age is None or reading.age > max_age:
+                continue
+            values[i] = (reading.humidity, reading.temperature)
+
+        with self._lock:
+            valid = ~np.isnan(values[:, TEMPERATURE])
+            if valid.sum() >= 3:
+                # 센서들끼리 비교 - 한 센서만 엉뚱하면 나머지들의 중앙값에서 멀리 떨어짐
+                center = np.median(values[valid], axis=0)
+                mad = np.median(np.abs(values[valid] - center), axis=0)
+                outliers = robust_outliers(values, center, mad, self.threshold, self.min_mad)
+            else:
+                # 비교할 센서가 모자라면 각 센서의 최근 값들과 비교 (값이 충분히 쌓인 센서만)
+                median, mad, counts = self._window_stats()
+                outliers = robust_outliers(values, median, mad, self.threshold, self.min_mad)
+                outliers &= (counts >= self.min_history)[:, None]
+            rejected = valid & outliers.any(axis=1)
+            accepted = valid & ~rejected
+
+            fused = None
+            if accepted.any():
+                fused = values[accepted].mean(axis=0)
+                if self.ema_alpha is not None:
+                    self.ema = fused if self.ema is None else self.ema_alpha * fused + (1 - self.ema_alpha) * self.ema
+                    fused = self.ema
+
+            # 이번 측정을 window에 기록함. 새로 읽은 값만 넣음 (같은 마지막 성공 값이 여러 번 들어가지 않도록)
+            p = self.position
+            self.history[:, p] = np.nan
+            self.history[fresh & accepted, p] = values[fresh & accepted]
+            self.residuals[:, p] = np.nan
+            if fused is not None:
+                self.residuals[fresh & accepted, p] = values[fresh & accepted] - fused
+            self.fresh_history[:, p] = fresh
+            self.rejected_history[:, p] = np.where(fresh, rejected, np.nan)
+            self.position = (p + 1) % self.window
+            self.ages = ages
+            self.update_count += 1
+            self.rejected_count += rejected
+
+        for i in np.flatnonzero(rejected):
+            # 계속 틀어진 센서가 주기마다 로그를 남기지 않도록 센서마다 1분에 한 줄만 남김 (버린 횟수는 get_health()에 있음)
+            LOG.warning(
+                "rejected",
+                "벗어난 값을 버립니다.",
+                key=self.pins[i],
+                every=60,
+                pin=self.pins[i],
+                humidity=float(values[i, HUMIDITY]),
+                temperature=float(values[i, TEMPERATURE]),
+            )
+        if fused is None:
+            return None, None
+        return float(fused[HUMIDITY]), float(fused[TEMPERATURE])
+
+    def get_health(self) -> list:
+        """
+        센서마다의 건강 상태 dict list를 반환함.
+        - failure_rate : 최근 window번의 측정 중 새 값을 돌려주지 못한 비율
+        - rejected_rate : 새로 돌려준 값 중 outlier로 버려진 비율
+        - humidity_bias, temperature_bias : 합친 값과의 평균 차이 (계속 한쪽으로 크면 센서가 틀어진 것)
+        - staleness : 마지막으로 성공한 뒤 지난 시간(초). 한번도 성공하지 못했으면 None
+        """
+        with self._lock, _ignore_nan_warnings():
+            failure_rate = 1 - np.nanmean(self.fresh_history, axis=1)
+            rejected_rate = np.nanmean(self.rejected_history, axis=1)
+            bias = np.nanmean(self.residuals, axis=1)
+            ages = self.ages.copy()
+            rejected_count = self.rejected_count.copy()
+        health = []
+        for i, pin in enumerate(self.pins):
+            health.append(
+                {
+                    "pin": pin,
+                    "failure_rate": _to_float(failure_rate[i], 3),
+                    "rejected_rate": _to_float(rejected_rate[i], 3),
+                    "rejected": int(rejected_count[i]),
+                    "humidity_bias": _to_float(bias[i, HUMIDITY], 2),
+                    "temperature_bias": _to_float(bias[i, TEMPERATURE], 2),
+                    "staleness": _to_float(ages[i], 1),
+                }
+            )
+        return health
+
+
+def _to_float(value, digits):
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+@contextmanager
+def _ignore_nan_warnings():
+    """값이 모두 nan인 줄에 nanmedian/nanmean을 쓰면 나오는 RuntimeWarning을 숨김 (그 줄의 결과는 nan이면 됨)"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        yield
@@ -0,0 +1,415 @@
+"""
+사진 보관소(archive.py)의 카메라 사진으로 식물이 얼마나 자랐는지 재는 생장 분석 모듈.
+
+사진 한 장마다 다음 값들을 NumPy 배열 연산으로 한번에 계산해 datas.db의 growth_metrics 테이블에
+measurements와 같은 (device_id, timestamp_ms) 키의 시계열로 남김
+- green_coverage : 초록색 픽셀의 비율 (HSV로 바꾼 뒤 색상, 채도, 밝기가 GREEN_HUE, MIN_SATURATION, MIN_VALUE 안인 픽셀)
+- canopy_area : 잎이 덮은 넓이의 비율. 행마다 가장 왼쪽과 오른쪽 초록 픽셀 사이를 채운 넓이 (잎 사이 빈 곳 포함)
+- change : 바로 앞 사진과 비교해 초록/초록 아님이 바뀐 픽셀의 비율 (앞 사진이 없으면 None)
+- brightness : 평균 밝기 (0~1). 전등이 꺼진 밤 사진을 걸러낼 때 씀
+JPEG 디코딩과 계산은 ProcessPoolExecutor의 다른 프로세스에서 하므로 flask/socket.io 프로세스는 CPU를 빼앗기지 않음.
+분석 프로세스는 보관소 파일을 직접 읽기만 하므로 사진 bytes를 프로세스 사이로 복사하지 않음
+- 서버가 켜져 있을 때 : GrowthAnalyzer가 GROWTH_INTERVAL마다 마지막으로 분석한 사진 뒤에 새로 저장된 사진들만 분석함
+- 한 철치 사진을 한번에 분석하려면 : `python growth.py backfill` (모든 코어로 날짜마다 나눠 분석함. 서버가 켜져 있어도 됨)
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from functools import partial
+from io import BytesIO
+
+import numpy as np
+
+import log
+from archive import DAY_FORMAT, archive_days, iter_frames, read_index
+from ingest import connect_database
+
+LOG = log.get_logger("growth")
+
+# 서버가 새 사진을 분석하는 주기(초)와 분석에 쓰는 프로세스 수 (서버에서는 측정과 웹페이지에 코어를 남겨둠)
+GROWTH_INTERVAL = float(os.environ.get("SMARTFARM_GROWTH_INTERVAL", 300))
+GROWTH_WORKERS = int(os.environ.get("SMARTFARM_GROWTH_WORKERS", 1))
+# 분석 프로세스의 nice 값 (높을수록 다른 프로세스에 CPU를 양보함)
+WORKER_NICE = 10
+# 작업 하나가 분석할 최대 사진 수 - 밀린 사진이 많으면 여러 작업으로 나눠 차례로 분석함
+MAX_JOB_FRAMES = 500
+# 분석한 적이 없는 스마트팜이면 서버는 최근 이 기간의 사진부터 분석함 (그 전 사진은 backfill로)
+INITIAL_LOOKBACK = timedelta(days=1)
+
+# 이 크기 안에 들어가도록 줄여서 디코딩함 (JPEG draft 모드라 원본 크기로 디코딩하는 것보다 훨씬 빠름)
+ANALYSIS_SIZE = (300, 300)
+# 초록으로 볼 색상(hue, 도) 범위와 최소 채도, 최소 밝기 (0~1)
+GREEN_HUE = (70, 170)
+MIN_SATURATION = 0.25
+MIN_VALUE = 0.15
+
+GROWTH_COLUMNS = ("green_coverage", "canopy_area", "change", "brightness")
+
+CREATE_GROWTH_QUERY = f"""CREATE TABLE IF NOT EXISTS growth_metrics(
+                device_id TEXT NOT NULL,
+                timestamp_ms INTEGER NOT NULL,
+                {', '.join(f'{column} REAL' for column in GROWTH_COLUMNS)},
+                PRIMARY KEY (device_id, timestamp_ms)) WITHOUT ROWID;"""
+INSERT_GROWTH_QUERY = (
+    f"INSERT OR REPLACE INTO growth_metrics (device_id, timestamp_ms, {', '.join(GROWTH_COLUMNS)}) "
+    f"VALUES (?, ?, {', '.join('?' for _ in GROWTH_COLUMNS)});"
+)
+
+# PIL의 HSV는 색상, 채도, 밝기 모두 0~255이므로 임계값도 같은 단위로 바꿔 둠
+_HUE_RANGE = tuple(round(degree / 360 * 255) for degree in GREEN_HUE)
+_MIN_SATURATION = round(MIN_SATURATION * 255)
+_MIN_VALUE = round(MIN_VALUE * 255)
+
+
+def decode_hsv(jpeg, size=ANALYSIS_SIZE):
+    """JPEG bytes를 size 안에 들어가도록 줄여 디코딩하고 HSV uint8 배열 (높이, 너비, 3)로 반환함"""
+    from PIL import Image
+
+    image = Image.open(BytesIO(jpeg))
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    if image.width > size[0] or image.height > size[1]:
+        image.thumbnail(size)
+    return np.asarray(image.convert("HSV"))
+
+
+def frame_metrics(hsv, previous_mask=None):
+    """
+    HSV 사진 한 장의 생장 값들을 계산해 (GROWTH_COLUMNS 순서의 tuple, 초록 픽셀 mask)로 반환함.
+    previous_mask는 바로 앞 사진의 mask이며 크기가 다르거나 None이면 change는 None
+    """
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    mask = (hue >= _HUE_RANGE[0]) & (hue <= _HUE_RANGE[1]) & (saturation >= _MIN_SATURATION) & (value >= _MIN_VALUE)
+    width = mask.shape[1]
+
+    # 행마다 처음과 마지막 초록 픽셀의 위치 (초록 픽셀이 없는 행은 0)
+    has_green = mask.any(axis=1)
+    first = mask.argmax(axis=1)
+    last = width - 1 - mask[:, ::-1].argmax(axis=1)
+    canopy = int(np.where(has_green, last - first + 1, 0).sum())
+
+    change = None
+    if previous_mask is not None and previous_mask.shape == mask.shape:
+        change = np.count_nonzero(mask != previous_mask) / mask.size
+    values = (np.count_nonzero(mask) / mask.size, canopy / mask.size, change, float(value.mean()) / 255)
+    return values, mask
+
+
+def analyze_frames(root, start_ms=None, end_ms=None, previous_ms=None, limit=None):
+    """
+    분석 프로세스에서 도는 작업. root 사진 보관소의 [start_ms, end_ms] 사진들을 분석해
+    ([(timestamp_ms, green_coverage, canopy_area, change, brightness), ...], 디코딩하지 못한 사진 수, 마지막으로 읽은 사진 시각)을
+    반환함. 마지막으로 읽은 사진 시각은 읽은 사진이 없으면 None
+    - previous_ms(int) : 주면 이 시각의 사진을 첫 사진의 change를 계산하는 데만 씀 (이미 분석한 마지막 사진)
+    - limit(int) : 분석할 최대 사진 수
+    """
+    rows = []
+    failed = 0
+    last_ms = None
+    previous_mask = None
+    first_ms = start_ms if previous_ms is None else previous_ms
+    read_limit = None if limit is None else limit + (previous_ms is not None)
+    for timestamp_ms, jpeg in iter_frames(root, first_ms, end_ms, read_limit):
+        if start_ms is None or timestamp_ms >= start_ms:
+            last_ms = timestamp_ms
+        try:
+            values, mask = frame_metrics(decode_hsv(jpeg), previous_mask)
+        except Exception:
+            # 쓰다가 끊긴 사진 등 - 다음 사진의 change는 그 앞 사진과 비교함
+            failed += 1
+            continue
+        previous_mask = mask
+        if start_ms is not None and timestamp_ms < start_ms:
+            continue
+        rows.append((timestamp_ms, *values))
+    return rows, failed, last_ms
+
+
+def _init_worker():
+    """분석 프로세스가 켜질 때 한 번 부르는 함수. 측정과 웹페이지보다 CPU를 덜 받도록 우선순위를 낮춤"""
+    if hasattr(os, "nice"):
+        os.nice(WORKER_NICE)
+
+
+def make_pool(workers):
+    """
+    분석 프로세스 pool을 만듬. 서버 프로세스는 스레드가 많아 fork하면 다른 스레드가 잡고 있던 잠금까지 복사되므로
+    forkserver(없으면 spawn)로 새 프로세스를 띄우고, numpy와 이 모듈은 forkserver가 미리 import해 둠
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload(["numpy", "growth"])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker)
+
+
+def ensure_growth_table(con):
+    with con:
+        con.execute(CREATE_GROWTH_QUERY)
+
+
+def store_rows(con, device_id, rows):
+    """분석 결과들을 한 트랜잭션으로 growth_metrics에 저장함 (같은 사진을 다시 분석했으면 덮어씀)"""
+    with con:
+        con.executemany(INSERT_GROWTH_QUERY, [(device_id, *row) for row in rows])
+
+
+def last_analyzed_ms(con, device_id):
+    """device_id의 마지막으로 분석한 사진 시각 (epoch 밀리초). 없으면 None"""
+    return con.execute("SELECT max(timestamp_ms) FROM growth_metrics WHERE device_id = ?;", (device_id,)).fetchone()[0]
+
+
+def growth_query(start_ms=None, end_ms=None, device_id=None):
+    """
+    growth_metrics의 [start_ms, end_ms]를 시각 순서대로 읽는 (query, params, columns)를 만듬.
+    columns는 ("timestamp"(, "device_id"), GROWTH_COLUMNS...)이며 history.iter_rows()와 stream_json()/stream_csv()에 그대로 씀
+    (timestamp는 epoch 밀리초로 읽고 stream_json()/stream_csv()가 문자열로 바꿈)
+    """
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    if start_ms is not None:
+        conditions.append("timestamp_ms >= ?")
+        params.append(start_ms)
+    if end_ms is not None:
+        conditions.append("timestamp_ms <= ?")
+        params.append(end_ms)
+    columns = ["timestamp"] + (["device_id"] if device_id is None else []) + list(GROWTH_COLUMNS)
+    select = ["timestamp_ms"] + (["device_id"] if device_id is None else []) + list(GROWTH_COLUMNS)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"SELECT {', '.join(select)} FROM growth_metrics{where} ORDER BY timestamp_ms, device_id;"
+    return query, params, columns
+
+
+class GrowthAnalyzer:
+    """
+    서버가 켜져 있는 동안 새로 저장된 사진들을 분석 프로세스에 넘기고 결과를 growth_metrics에 저장하는 분석기.
+    poll()을 스케줄러가 GROWTH_INTERVAL마다 부르며, 스마트팜마다 작업은 하나씩만 돌림 (밀려 있으면 끝나자마자 다음 작업을 넘김)
+    - db_path(str) : 결과를 저장할 datas.db 경로
+    - archives(dict) : {스마트팜 이름: 사진 보관소 디렉토리}
+    - workers(int) : 분석 프로세스 수
+    - max_frames(int) : 작업 하나가 분석할 최대 사진 수
+    """
+
+    def __init__(self, db_path, archives, workers=GROWTH_WORKERS, max_frames=MAX_JOB_FRAMES):
+        self.db_path = db_path
+        self.archives = dict(archives)
+        self.workers = workers
+        self.max_frames = max_frames
+        self._pool = None
+        # 스케줄러 스레드(poll)와 pool의 관리 스레드(_done)가 함께 쓰는 아래 세 가지와 pool 교체를 보호함
+        self._lock = threading.Lock()
+        self._running = {}  # 스마트팜 이름 -> 돌고 있는 작업(Future)
+        self._last_ms = {}
+        self._stopped = False
+
+        # 지표들
+        self.analyzed_count = 0
+        self.failed_count = 0
+        self.job_count = 0
+        self.last_job_seconds = 0.0
+        self.latest = {}  # 스마트팜 이름 -> 마지막으로 분석한 사진의 값들 dict
+
+        con = connect_database(db_path)
+        try:
+            ensure_growth_table(con)
+            for device_id in self.archives:
+                self._last_ms[device_id] = last_analyzed_ms(con, device_id)
+        finally:
+            con.close()
+
+    def start(self):
+        self._pool = make_pool(self.workers)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            pool = self._pool
+        # 취소된 작업의 _done이 잠금을 잡으므로 잠금 밖에서 기다림
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def get_stats(self) -> dict:
+        now_ms = time.time() * 1000
+        with self._lock:
+            running = len(self._running)
+            last_analyzed = dict(self._last_ms)
+        return {
+            "analyzed": self.analyzed_count,
+            "failed": self.failed_count,
+            "jobs": self.job_count,
+            "running": running,
+            "last_job_seconds": self.last_job_seconds,
+            "lag_seconds": {
+                device_id: (now_ms - last_ms) / 1000 for device_id, last_ms in last_analyzed.items() if last_ms is not None
+            },
+            "latest": dict(self.latest),
+        }
+
+    def poll(self):
+        """스케줄러가 부르는 함수. 돌고 있는 작업이 없는 스마트팜마다 새로 저장된 사진들의 분석 작업을 넘기고 바로 반환함"""
+        for device_id in self.archives:
+            self._submit(device_id)
+
+    def _submit(self, device_id):
+        """device_id에 돌고 있는 작업이 없으면 마지막으로 분석한 사진 뒤부터의 작업을 넘김 (확인과 넘기기는 한 잠금 안에서 함)"""
+        with self._lock:
+            if self._stopped or self._pool is None or device_id in self._running:
+                return
+            future = self._submit_locked(device_id)
+            self._running[device_id] = future
+        # 이미 끝난 작업이면 add_done_callback이 이 스레드에서 바로 _done을 부르므로 잠금 밖에서 붙임
+        future.add_done_callback(partial(self._done, device_id, time.monotonic()))
+
+    def _submit_locked(self, device_id):
+        last_ms = self._last_ms[device_id]
+        if last_ms is None:
+            start_ms = int((datetime.now() - INITIAL_LOOKBACK).timestamp() * 1000)
+            LOG.info(
+                "initial",
+                "분석한 적이 없는 스마트팜이라 최근 사진부터 분석합니다. 그 전 사진은 backfill로 분석하세요.",
+                key=device_id,
+                every=INITIAL_LOOKBACK.total_seconds(),
+                device=device_id,
+            )
+            args = (self.archives[device_id], start_ms, None, None, self.max_frames)
+        else:
+            args = (self.archives[device_id], last_ms + 1, None, last_ms, self.max_frames)
+        try:
+            future = self._pool.submit(analyze_frames, *args)
+        except BrokenProcessPool:
+            # 분석 프로세스가 비정상 종료되면(메모리 부족 등) pool을 다시 만듬
+            LOG.warning("pool_restart", "분석 프로세스가 비정상 종료되어 다시 띄웁니다.", device=device_id)
+            self._pool.shutdown(wait=False)
+            self._pool = make_pool(self.workers)
+            future = self._pool.submit(analyze_frames, *args)
+        return future
+
+    def _done(self, device_id, started, future):
+        """작업이 끝나면 pool의 관리 스레드에서 불리는 함수. 결과를 저장하고, 더 밀려 있으면 다음 작업을 바로 넘김"""
+        try:
+            rows, failed, last_ms = future.result()
+        except Exception as e:
+            with self._lock:
+                self._running.pop(device_id, None)
+            if not self._stopped:
+                LOG.error("job_failed", "사진을 분석하는 중 오류가 발생했습니다!", every=60, device=device_id, error=e)
+            return
+        if rows:
+            con = connect_database(self.db_path, timeout=60.0)
+            try:
+                store_rows(con, device_id, rows)
+            finally:
+                con.close()
+            self.latest[device_id] = dict(zip(GROWTH_COLUMNS, rows[-1][1:]))
+        with self._lock:
+            # 디코딩하지 못한 사진도 다시 분석하지 않도록 마지막으로 읽은 사진까지 분석한 것으로 봄.
+            # 작업을 지우는 것과 같은 잠금 안에서 바꾸므로 poll()이 예전 시각으로 같은 작업을 넘기는 일이 없음
+            if last_ms is not None:
+                self._last_ms[device_id] = last_ms
+            self._running.pop(device_id, None)
+        self.analyzed_count += len(rows)
+        self.failed_count += failed
+        self.job_count += 1
+        self.last_job_seconds = time.monotonic() - started
+        LOG.debug("analyzed", "사진들을 분석했습니다.", device=device_id, frames=len(rows), failed=failed, seconds=round(self.last_job_seconds, 2))
+        if len(rows) + failed >= self.max_frames:
+            self._submit(device_id)
+
+
+def plan_backfill(con, root, device_id, first_day=None, last_day=None, force=False) -> list:
+    """
+    root 사진 보관소의 날짜마다 analyze_frames()에 넘길 (날짜, 사진 수, kwargs) list를 만듬.
+    force가 아니면 사진 수만큼 이미 분석한 날짜는 건너뜀. 앞 날짜의 마지막 사진을 previous_ms로 넘겨 change가 날짜 사이에서도 이어짐
+    """
+    jobs = []
+    previous_ms = None
+    for day in archive_days(root):
+        if last_day is not None and day > last_day:
+            break
+        records = read_index(root, day)
+        if not records:
+            continue
+        start_ms, end_ms = records[0][0], records[-1][0]
+        if first_day is None or day >= first_day:
+            done = con.execute(
+                "SELECT count(*) FROM growth_metrics WHERE device_id = ? AND timestamp_ms BETWEEN ? AND ?;",
+                (device_id, start_ms, end_ms),
+            ).fetchone()[0]
+            if force or done < len(records):
+                jobs.append((day, len(records), {"start_ms": start_ms, "end_ms": end_ms, "previous_ms": previous_ms}))
+        previous_ms = end_ms
+    return jobs
+
+
+def backfill(db_path, images_root, device_ids=None, first_day=None, last_day=None, workers=None, force=False) -> int:
+    """
+    images_root/<스마트팜>/ 사진 보관소들의 사진들을 날짜마다 작업으로 나눠 workers개의 프로세스로 분석하고 저장함.
+    분석한 사진 수를 반환함. 끝난 날짜부터 저장하므로 중간에 멈춰도 다시 실행하면 남은 날짜만 분석함
+    - workers(int) : 분석 프로세스 수. None이면 모든 코어
+    """
+    if device_ids is None:
+        device_ids = sorted(name for name in os.listdir(images_root) if os.path.isdir(os.path.join(images_root, name)))
+    con = connect_database(db_path, timeout=60.0)
+    try:
+        ensure_growth_table(con)
+        jobs = []
+        for device_id in device_ids:
+            root = os.path.join(images_root, device_id)
+            for day, frames, kwargs in plan_backfill(con, root, device_id, first_day, last_day, force):
+                jobs.append((device_id, day, frames, root, kwargs))
+        total_frames = sum(frames for _, _, frames, _, _ in jobs)
+        print(f"{len(jobs)}일치 사진 {total_frames}장을 분석합니다.", file=sys.stderr)
+
+        analyzed = 0
+        started = time.monotonic()
+        with make_pool(workers or os.cpu_count()) as pool:
+            # 사진이 많은 날짜부터 넘겨 마지막에 큰 작업 하나만 남는 일이 없게 함
+            futures = {
+                pool.submit(analyze_frames, root, **kwargs): (device_id, day)
+                for device_id, day, _, root, kwargs in sorted(jobs, key=lambda job: -job[2])
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                device_id, day = futures[future]
+                rows, failed, _ = future.result()
+                store_rows(con, device_id, rows)
+                analyzed += len(rows)
+                if failed:
+                    LOG.warning("decode_failed", "디코딩하지 못한 사진이 있습니다.", device=device_id, day=day, failed=failed)
+                elapsed = time.monotonic() - started
+                print(f"{done} / {len(jobs)}일 ({analyzed}장, {analyzed / max(elapsed, 1e-9):.0f}장/초)", file=sys.stderr)
+        return analyzed
+    finally:
+        con.close()
+
+
+def _parse_day(value):
+    if value is None:
+        return None
+    return datetime.strptime(value, DAY_FORMAT).strftime(DAY_FORMAT)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="사진 보관소의 사진들로 생장 값(초록 비율, 잎 넓이, 변화량)을 계산해 datas.db에 저장함")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="저장된 사진들을 모든 코어로 한번에 분석함 (이미 분석한 날짜는 건너뜀)")
+    backfill_parser.add_argument("--db", default="./datas.db", help="datas.db 경로 (기본값 ./datas.db)")
+    backfill_parser.add_argument("--images", default="./captured_images", help="사진 보관소들이 있는 디렉토리 (기본값 ./captured_images)")
+    backfill_parser.add_argument("--device", action="append", help="분석할 스마트팜 (여러 번 줄 수 있음). 없으면 모든 스마트팜")
+    backfill_parser.add_argument("--from", dest="first_day", type=_parse_day, help="시작 날짜 (YYYY-MM-DD)")
+    backfill_parser.add_argument("--to", dest="last_day", type=_parse_day, help="끝 날짜 (YYYY-MM-DD)")
+    backfill_parser.add_argument("--workers", type=int, default=None, help="분석 프로세스 수 (기본값 코어 수)")
+    backfill_parser.add_argument("--force", action="store_true", help="이미 분석한 날짜도 다시 분석함")
+    args = parser.parse_args()
+    count = backfill(args.db, args.images, args.device, args.first_day, args.last_day, args.workers, args.force)
+    log.shutdown()
+    print(f"사진 {count}장을 분석했습니다.")
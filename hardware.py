@@ -1,16 +1,20 @@
-import RPi.GPIO as GPIO
-
-# pip install Adafruit_DHT로 DHT 온습도센서 사용 모듈을 설치
-import Adafruit_DHT
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+import os
 import threading
-import spidev
-from time import sleep
-from datetime import datetime, time
-import picamera
-from PIL import Image
-from io import BytesIO
-import board
-import base64
+from drivers import load_backend
+from sampler import DHTSamplerPool
+from fusion import DHTFusion
+import log
+import metrics
+from adc import BurstADCReader, CalibrationTable, code_to_volts, volts_to_code
+
+# 하드웨어 드라이버 백엔드 - 환경변수 SMARTFARM_BACKEND로 실제 라즈베리파이("rpi")와 가상 하드웨어("sim") 중 고름
+# GPIO.HIGH/GPIO.LOW 같은 상수는 app.py에서도 쓰기 때문에 모듈 변수로 꺼내둠
+backend = load_backend()
+GPIO = backend.GPIO
+
+LOG = log.get_logger("hardware")
 
 # 핀 배치들을 변수로 저장해둠
 pin_led_first_floor = 26
@@ -18,6 +22,34 @@ pin_led_second_floor = 19
 pin_heater = 6
 pin_pump = 13
 pin_dhts = [21, 20, 16, 12]
+# 수위센서가 연결된 SPI 버스, 장치(CE) 번호와 MCP3008 채널
+spi_bus = 0
+spi_device = 0
+adc_water_level_channel = 0
+# 수위센서와 같은 burst로 함께 읽을 다른 MCP3008 채널들 (예: 조도센서). 읽은 값은 get_adc_volts(채널)로 얻음
+adc_extra_channels = ()
+
+# 스마트팜 한 대의 핀 배치. 라즈베리파이 한 대에 여러 대(랙)를 연결할 때는 스마트팜마다 다른 PinMap을 줌 (fleet.py 참고)
+PinMap = namedtuple(
+    "PinMap",
+    ["led_first_floor", "led_second_floor", "heater", "pump", "dhts", "spi_bus", "spi_device", "adc_channel", "extra_adc_channels"],
+)
+DEFAULT_PIN_MAP = PinMap(
+    pin_led_first_floor,
+    pin_led_second_floor,
+    pin_heater,
+    pin_pump,
+    tuple(pin_dhts),
+    spi_bus,
+    spi_device,
+    adc_water_level_channel,
+    tuple(adc_extra_channels),
+)
+
+
+def output_pins(pins):
+    """PinMap에서 출력(GPIO.OUT)으로 쓰는 핀들을 반환함"""
+    return [pins.led_first_floor, pins.led_second_floor, pins.heater, pins.pump]
 
 
 # 사용자 설정값이 주어지지 않았을 경우 사용할 기본값
@@ -25,12 +57,39 @@ DEFAULT_MIN_TEMP = 18
 DEFAULT_ON_TIME = time(hour=5)
 DEFAULT_OFF_TIME = time(hour=19)
 
+# DHT 온습도센서 측정 한 번에 기다리는 최대 시간(초)과, 측정에 실패한 센서의 마지막 값을 대신 써도 되는 최대 나이(초)
+DHT_READ_DEADLINE = 3.0
+DHT_MAX_VALUE_AGE = 90.0
+# 값을 돌려주지 않는 온습도센서를 로그에 남기는 최소 간격(초) - 고장난 센서가 주기마다 로그를 남기지 않도록
+DHT_FAILURE_LOG_INTERVAL = 60.0
+# 온습도센서 값 합치기 - 센서마다 기억할 최근 측정 횟수, 중앙값에서 MAD의 몇 배 넘게 벗어난 값을 버릴지,
+# 합친 값에 씌울 지수이동평균의 새 값 비중 (None이면 씌우지 않음)
+DHT_FUSION_WINDOW = 30
+DHT_FUSION_THRESHOLD = 3.5
+DHT_FUSION_EMA_ALPHA = None
+
+# 수위센서를 읽을 때 한 번의 SPI 트랜잭션으로 채널마다 변환할 횟수와, 그 값들을 하나로 줄이는 방법("median" 혹은 "trimmed_mean")
+WATER_LEVEL_OVERSAMPLE = 32
+WATER_LEVEL_REDUCE_METHOD = "median"
+# 수위센서 보정점들 (센서 전압 V, 수위 cm). 점들 사이는 선형 보간해 ADC 코드 1024개의 보정표를 미리 만들어 둠
+# 기본값은 전압을 그대로 두는 항등 보정이라 예전(adc_to_water_level)처럼 수위는 V로 저장됨. 저장된 측정값과 규칙(water_level < 2)이
+# 모두 V 기준이므로, 실측한 점들이 생기기 전까지는 바꾸지 말고 랙마다 fleet.json의 water_level_calibration으로 줄 것
+WATER_LEVEL_CALIBRATION_POINTS = [(0.0, 0.0), (3.3, 3.3)]
+
+GPIO_WRITES = metrics.counter("smartfarm_gpio_writes_total", "GPIO 출력 핀에 값을 쓴 횟수", ["device", "pin"])
+
+# 카메라 사용 여부 - 라즈베리파이 카메라가 고장나 있어 기본값은 꺼짐. 환경변수 SMARTFARM_CAMERA=1 로 켬
+CAMERA_ENABLED = os.environ.get("SMARTFARM_CAMERA", "0") == "1"
+# 카메라 사진을 담아둘 미리 할당된 버퍼의 개수와 크기(bytes)
+CAPTURE_BUFFER_COUNT = 6
+CAPTURE_BUFFER_SIZE = 512 * 1024
+
 
 # 스마트팜 하드웨어와 소통하는 클래스를 정의
 class SmartFarmDevice:
     """
     서버에서 스마트팜을 조작하기 위해 만든 스마트팜 제어 클래스
-    핀 값들은 이 객체에 self.(핀번호) 변수로 저장된게 아니라 hardware.py 상단에 pin_어쩌구로 정의된거 갖다 씀.
+    핀 값들은 self.pins(PinMap)에 저장됨. 주어지지 않으면 hardware.py 상단에 pin_어쩌구로 정의된 DEFAULT_PIN_MAP을 씀.
 
     measure_어쩌구()로 어쩌구 값(온습도나 수위)을 측정해 self.어쩌구에 그 측정값들을 저장하고
     get_어쩌구()로 스마트팜의 상태 self.어쩌구를 서버로 얻어올 수 있고
@@ -47,6 +106,11 @@ class SmartFarmDevice:
         user_set_min_temp=None,
         user_set_on_time: time = None,
         user_set_off_time: time = None,
+        device_backend=None,
+        pins: PinMap = None,
+        device_id="farm",
+        camera_enabled=None,
+        water_level_calibration=None,
     ):
         """
         클래스 초기화하며 서버에 저장된 마지막 사용자 설정상태를 인자로 받아 self.user_set_(변수)로 저장함.
@@ -54,7 +118,18 @@ class SmartFarmDevice:
         - user_set_min_temp(float): 사용자가 설정한 최저온도
         - user_set_on_time(time) : 사용자가 설정한 불 켜는 시각
         - user_set_off_time(time) : 사용자가 설정한 불 끄는 시각
+        - device_backend(DeviceBackend) : 사용할 하드웨어 드라이버 묶음. 주어지지 않으면 모듈의 backend를 씀
+        - pins(PinMap) : 이 스마트팜의 핀 배치. 주어지지 않으면 DEFAULT_PIN_MAP
+        - device_id(str) : 여러 대를 함께 돌릴 때 이 스마트팜을 가리키는 이름
+        - camera_enabled(bool) : 카메라 사용 여부. 주어지지 않으면 CAMERA_ENABLED
+        - water_level_calibration(list) : 수위센서 보정점들 [(전압 V, 수위 cm), ...]. 주어지지 않으면 WATER_LEVEL_CALIBRATION_POINTS
         """
+        # 하드웨어 드라이버 지정
+        self.device_id = device_id
+        self.pins = pins if pins is not None else DEFAULT_PIN_MAP
+        self.backend = device_backend if device_backend is not None else backend
+        self.gpio = self.backend.GPIO
+        self.backend.register_actuators(heater_pins=[self.pins.heater], pump_pins=[self.pins.pump])
         # 측정값들 변수 정의
         self.temperature = 15
         self.humidity = 50
@@ -65,30 +140,59 @@ class SmartFarmDevice:
         self.led_first_state = GPIO.HIGH
         self.led_second_state = GPIO.HIGH
         self.heater_state = GPIO.LOW
+        # DHT 온습도센서 측정용 스레드들 - 센서마다 하나씩 만들어 두고 계속 재사용함
+        self.dht_sampler = DHTSamplerPool(self.backend.DHT, self.pins.dhts, read_deadline=DHT_READ_DEADLINE)
+        self.dht_readings = []
+        self.dht_fusion = DHTFusion(
+            self.pins.dhts, window=DHT_FUSION_WINDOW, threshold=DHT_FUSION_THRESHOLD, ema_alpha=DHT_FUSION_EMA_ALPHA
+        )
+
         # spi 기본 설정
-        self.spi = spidev.SpiDev()
-        self.spi.open(0, 0)
+        self.spi = self.backend.spi_factory()
+        self.spi.open(self.pins.spi_bus, self.pins.spi_device)
         self.spi.max_speed_hz = 1000000
+        # 수위센서 채널과 다른 채널들을 한 번의 트랜잭션으로 oversampling해서 읽음
+        self.adc_reader = BurstADCReader(
+            self.spi,
+            [self.pins.adc_channel] + list(self.pins.extra_adc_channels),
+            samples=WATER_LEVEL_OVERSAMPLE,
+            method=WATER_LEVEL_REDUCE_METHOD,
+        )
+        self.water_level_calibration = CalibrationTable.from_volts(
+            water_level_calibration if water_level_calibration is not None else WATER_LEVEL_CALIBRATION_POINTS
+        )
+        self.adc_volts = {}  # 다른 채널들의 마지막 측정 전압 {채널: V}
 
         #  카메라 관련
-        # TODO: 라즈베리파이 카메라 고치면 주석 풀고 카메라 쓰이는 기능들 사용하기
-        # self.camera = picamera.PiCamera()
-        self.stream = BytesIO()
+        # TODO: 라즈베리파이 카메라 고치면 CAMERA_ENABLED를 켜고 카메라 쓰이는 기능들 사용하기
+        # 카메라가 켜져 있으면 video port에서 계속 MJPEG로 녹화하며 미리 만들어 둔 버퍼들에 사진을 담아둠.
+        # 카메라를 여는 데 몇 초가 걸리기도 하므로 (전원이 나갔다 켜질 때 히터 제어가 늦어지지 않도록) 처음 사진이 필요할 때 엶
+        if camera_enabled is None:
+            camera_enabled = CAMERA_ENABLED
+        self.camera_enabled = camera_enabled
+        self.camera = None
+        self.capture_engine = None
+        self._camera_lock = threading.Lock()
 
         # 사용자의 설정값을 지정함
         self.min_temp = user_set_min_temp
         self.on_time: time = user_set_on_time  # user_set_on_time은 app.py 에서 전달받은 설정값은 %H:%M (즉, 시:분) 형식의 datetime 객체임
         self.off_time: time = user_set_off_time
         if self.min_temp is None:
-            print(f"[hardware] : 최저 온도 설정값이 주어지지 않아 기본값 {DEFAULT_MIN_TEMP}로 설정합니다!")
+            LOG.warning("default_setting", "최저 온도 설정값이 주어지지 않아 기본값으로 설정합니다!", min_temp=DEFAULT_MIN_TEMP)
             self.min_temp = DEFAULT_MIN_TEMP
         if self.on_time is None:
-            print(f"[hardware] : 불을 켜는 시각이 주어지지 않아 기본값 {DEFAULT_ON_TIME}로 설정합니다!")
+            LOG.warning("default_setting", "불을 켜는 시각이 주어지지 않아 기본값으로 설정합니다!", on_time=DEFAULT_ON_TIME)
             self.on_time = DEFAULT_ON_TIME
         if self.off_time is None:
-            print(f"[hardware] : 불을 끄는 시각이 주어지지 않아 기본값 {DEFAULT_OFF_TIME}로 설정합니다!")
+            LOG.warning("default_setting", "불을 끄는 시각이 주어지지 않아 기본값으로 설정합니다!", off_time=DEFAULT_OFF_TIME)
             self.off_time = DEFAULT_OFF_TIME
 
+        # 측정값이나 설정값이 바뀔 때 알림을 받을 함수들 (control.ControlEngine 등)
+        self.listeners = []
+        # 출력 핀에 값을 쓸 때마다 알림을 받을 함수들 (actuators.ActuatorLog 등)
+        self.actuator_listeners = []
+
         # GPIO 초기설정
         self.setup_gpio()
 
@@ -110,13 +214,11 @@ class SmartFarmDevice:
         """GPIO 초기 설정을 진행"""
         # TEST : start_device 실제 작동 테스트
         # 라즈베리파이 핀맵 구성모드를 BCM으로 설정
-        GPIO.setmode(GPIO.BCM)
+        self.gpio.setmode(self.gpio.BCM)
 
         # 사용할 모든 핀들의 입출력 모드 설정
-        GPIO.setup(pin_led_first_floor, GPIO.OUT)
-        GPIO.setup(pin_led_second_floor, GPIO.OUT)
-        GPIO.setup(pin_heater, GPIO.OUT)
-        GPIO.setup(pin_pump, GPIO.OUT)
+        for pin in output_pins(self.pins):
+            self.gpio.setup(pin, self.gpio.OUT)
 
     def off_device(self):
         """펌프를 끄고 장비를 정지함"""
@@ -134,12 +236,21 @@ class SmartFarmDevice:
         self._heater_update()
         self._pump_update()
 
-        GPIO.cleanup()  # GPIO 초기화
+        self.gpio.cleanup(output_pins(self.pins))  # 이 스마트팜의 핀들만 초기화 (다른 스마트팜의 핀은 건드리지 않음)
+        self.dht_sampler.stop()  # 온습도센서 측정 스레드 정지
+        with self._camera_lock:
+            if self.capture_engine is not None:
+                self.capture_engine.stop()  # 카메라 녹화 정지
 
     def adjust(self):
         """
         측정된 센서값과 사용자 설정값을 비교하여 전등과 히터를 켜거나 끄는 함수.
         """
+        self.adjust_heater()
+        self.adjust_lights()
+
+    def adjust_heater(self):
+        """측정된 온도와 설정 최저 온도를 비교하여 히터를 켜거나 끄는 함수 (최저온도 ~ 최저온도+2도 사이는 그대로 둠)"""
         # 히터 조절하기 - Tested
         if self.temperature < self.min_temp and self.heater_state == GPIO.LOW:
             self.heater_state = GPIO.HIGH
@@ -148,9 +259,15 @@ class SmartFarmDevice:
             self.heater_state = GPIO.LOW
             self._heater_update()
 
+    def adjust_lights(self, now: time = None):
+        """
+        현재 시각과 설정된 켜는/끄는 시각을 비교하여 전등을 켜거나 끄는 함수.
+        - now(time) : 비교할 시각. 주어지지 않으면 현재 시각
+        """
         # datetime.now()로 오늘의 날짜와 시각을 담은 datetime 객체를 얻고 time()함수로 시간만을 표현하는 time 객체로 변환함.
         # self.on_time 과 self.off_time이 모두 time 객체이기 때문에 비교를 위해서 필요함.
-        now = datetime.now().time()
+        if now is None:
+            now = datetime.now().time()
 
         # 켜는시각이 끄는시각보다 앞서면 - Tested
         if self.on_time < self.off_time:
@@ -196,85 +313,113 @@ class SmartFarmDevice:
                     self._led_first_update()
                     self._led_second_update()
 
+    def next_light_transition(self, now: datetime = None):
+        """
+        now 이후에 전등을 켜거나 꺼야 하는 가장 가까운 시각을 datetime으로 반환하는 함수.
+        켜는 시각과 끄는 시각이 같아 전등을 조절하지 않는 경우에는 None을 반환함.
+        """
+        if self.on_time == self.off_time:
+            return None
+        if now is None:
+            now = datetime.now()
+        candidates = []
+        for day_offset in (0, 1):
+            day = (now + timedelta(days=day_offset)).date()
+            candidates.append(datetime.combine(day, self.on_time))
+            candidates.append(datetime.combine(day, self.off_time))
+        return min(candidate for candidate in candidates if candidate > now)
+
+    def add_listener(self, listener):
+        """
+        측정값이나 사용자 설정값이 바뀔 때마다 listener(reason)으로 호출될 함수를 등록함.
+        reason은 "measurement", "min_temp", "on_time", "off_time" 중 하나
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, reason):
+        for listener in self.listeners:
+            listener(reason)
+
+    def add_actuator_listener(self, listener):
+        """
+        액추에이터 출력 핀에 값을 쓸 때마다 listener(actuator, state)로 호출될 함수를 등록함.
+        actuator는 "led_first", "led_second", "heater", "pump" 중 하나, state는 1(켜짐) 혹은 0(꺼짐).
+        상태가 바뀌지 않아도 쓸 때마다 호출되므로 바뀐 것만 기록하는 것은 listener가 함
+        """
+        self.actuator_listeners.append(listener)
+
     def measure_temp_and_humidity(self) -> None:
         """
         온도 및 습도 측정해 self.temperature, self.humidity에 저장하는 함수.
+        센서마다 재사용되는 측정 스레드(sampler.DHTSamplerPool)에 측정을 요청하고 DHT_READ_DEADLINE초까지만 기다림.
+        이번에 읽지 못한 센서는 마지막으로 성공한 값이 DHT_MAX_VALUE_AGE초보다 최근이면 그 값을 대신 씀.
+        센서들의 값은 fusion.DHTFusion으로 벗어난 값(outlier)을 버리고 합침.
         """
-        print("[hardware.measure_temp_and_humidity() 실행됨]")
-        humidities = [0, 0, 0, 0]
-        temperatures = [0, 0, 0, 0]
-        humid_count = 0
-        temp_count = 0
-        sensor_type = Adafruit_DHT.DHT11
-
-        # 측정을 위한 Worker 스레드 클래스
-        class Worker(threading.Thread):
-            def __init__(self, pin):
-                super().__init__()
-                self.temp = None
-                self.humid = None
-                self.pin = pin
-
-            def run(self):
-                self.measure()
-
-            def measure(self):
-                self.humid, self.temp = Adafruit_DHT.read_retry(
-                    sensor_type, self.pin, retries=14
+        self.dht_readings = self.dht_sampler.collect()
+        for reading in self.dht_readings:
+            if not reading.fresh:
+                # 고장나거나 빠진 센서는 한 주기마다가 아니라 DHT_FAILURE_LOG_INTERVAL초에 한 줄만 남김
+                LOG.warning(
+                    "dht_failed",
+                    "온습도센서가 이번 측정에서 값을 돌려주지 않았습니다!",
+                    key=(self.device_id, reading.pin),
+                    every=DHT_FAILURE_LOG_INTERVAL,
+                    device=self.device_id,
+                    pin=reading.pin,
+                    failures=reading.failures,
+                    age=reading.age if reading.age is None else round(reading.age, 1),
                 )
-                print(
-                    f"    [worker({self.pin})] humid : {self.humid}, temp : {self.temp}"
-                )
-
-        # 측정용 스레드 만들고 동시에 실행하여 측정값을 얻음
-        threads = []
-        for i in range(4):
-            thread = Worker(pin_dhts[i])
-            thread.start()
-            threads.append(thread)
-
-        for thread in threads:
-            thread.join()  # 만든 스레드들의 종료시각이 일치하도록 join함
-
-        for i in range(4):
-            if threads[i].humid is not None:
-                humidities[i] = threads[i].humid
-                humid_count += 1
-            if threads[i].temp is not None:
-                temperatures[i] = threads[i].temp
-                temp_count += 1
-
-        # 측정값이 하나도 없으면
-        if humid_count == 0:
-            print(f"온습도센서로 측정한 습도값이 없습니다! - 이전에 저장된 습도값을 반환합니다 : {self.humidity}")
-        else:
-            self.humidity = sum(humidities) / humid_count
-            print(
-                f"    [hardware.measure_temp_and_humidity()] 측정된 습도값 : {self.humidity}"
+            LOG.debug(
+                "dht_reading",
+                "온습도센서 측정값",
+                device=self.device_id,
+                pin=reading.pin,
+                humidity=reading.humidity,
+                temperature=reading.temperature,
+                failures=reading.failures,
             )
-
-        if temp_count == 0:
-            print(f"온습도센서로 측정한 온도값이 없습니다! - 이전에 저장된 온도값을 반환합니다 : {self.temperature}")
-        else:
-            self.temperature = sum(temperatures) / temp_count
-            print(
-                f"    [hardware.measure_temp_and_humidity()] 측정된 온도값 : {self.temperature}"
+        humidity, temperature = self.dht_fusion.update(self.dht_readings, DHT_MAX_VALUE_AGE)
+
+        # 측정값이 하나도 없으면 이전에 저장된 값을 그대로 둠
+        if humidity is None or temperature is None:
+            LOG.warning(
+                "dht_no_value",
+                "온습도센서로 측정한 값이 없어 이전에 저장된 값을 그대로 씁니다!",
+                key=self.device_id,
+                every=DHT_FAILURE_LOG_INTERVAL,
+                device=self.device_id,
+                humidity=self.humidity,
+                temperature=self.temperature,
             )
+        if humidity is not None:
+            self.humidity = humidity
+        if temperature is not None:
+            self.temperature = temperature
+            LOG.debug("measured", "온습도 측정값", device=self.device_id, humidity=self.humidity, temperature=self.temperature)
+            self._notify("measurement")
 
     def measure_water_level(self) -> None:
-        """3층 물통 수위 측정해 self.water_level 값을 갱신하는 함수"""
-        print("[hardware.measure_water_level() 실행됨]")
-        adc = self.spi.xfer2([1, (8 + 0) << 4, 0])
-        adc_out = ((adc[1] & 3) << 8) + adc[2]
-        a_volt = 3.3 * adc_out / 1024
-        print(f"adc_out : {adc_out}")
-        self.water_level = self.adc_to_water_level(a_volt)
+        """
+        3층 물통 수위 측정해 self.water_level 값을 갱신하는 함수.
+        한 번의 SPI 트랜잭션으로 WATER_LEVEL_OVERSAMPLE번 변환한 값들의 중앙값(혹은 절사평균)을 보정표로 수위로 환산함.
+        같은 트랜잭션에서 읽은 다른 채널들의 전압은 self.adc_volts에 저장함
+        """
+        codes = self.adc_reader.read()
+        adc_out = codes.pop(self.pins.adc_channel)
+        self.water_level = self.water_level_calibration.lookup(adc_out)
+        LOG.debug(
+            "water_level",
+            "수위 측정값",
+            device=self.device_id,
+            adc_out=round(adc_out, 1),
+            spread=self.adc_reader.last_spread[self.pins.adc_channel],
+            water_level=round(self.water_level, 2),
+        )
+        self.adc_volts = {channel: code_to_volts(code) for channel, code in codes.items()}
 
     def adc_to_water_level(self, a_volt):
-        """수위센서에서 읽은 analog volt값을 수위 cm으로 환산하는 함수"""
-        # adc_value 리턴한건 그냥 데이터 반환이 필요해서 한거임
-        return a_volt
-        # TODO(정수) : 수위센서 adc -> cm 환산 함수 실험 및 실측을 통해 근사식 작성하기
+        """수위센서에서 읽은 analog volt값을 보정표로 수위 cm으로 환산하는 함수"""
+        return self.water_level_calibration.lookup(volts_to_code(a_volt))
 
     def set_pump_state(self, state):
         """
@@ -289,7 +434,6 @@ class SmartFarmDevice:
         except Exception as e:
             raise e
 
-        print(f"[set_pump_state] : 펌프 상태를 {state}로 설정합니다")
         self.pump_state = state
         self._pump_update()
 
@@ -307,7 +451,6 @@ class SmartFarmDevice:
             raise e
 
         self.led_first_state = state
-        print(f"[set_led_first_state] : 1층 LED 상태를 {self.led_first_state}로 설정합니다.")
         self._led_first_update()  # 실제 led 상태 업데이트
 
     def set_led_second_state(self, state: list):
@@ -324,7 +467,6 @@ class SmartFarmDevice:
             raise e
 
         self.led_second_state = state
-        print(f"[set_led_second_state] : 2층 LED 상태를 {self.led_second_state}로 설정합니다.")
         self._led_second_update()  # 실제 led 상태 업데이트
 
     def set_heater_state(self, state):
@@ -335,21 +477,23 @@ class SmartFarmDevice:
         except Exception as e:
             raise e
 
-        print(f"[set_heater_state] : 히터 상태를 {state}로 설정합니다")
         self.heater_state = state
         self._heater_update()
 
     def set_min_temp(self, _min_temp):
-        print(f"[hardware.set_min_temp] : 설정 최저 온도를 {_min_temp}로 설정합니다")
+        LOG.info("setting", "설정 최저 온도를 바꿉니다.", device=self.device_id, min_temp=_min_temp)
         self.min_temp = _min_temp
+        self._notify("min_temp")
 
     def set_on_time(self, _on_time: datetime):
-        print(f"[hardware.set_on_time] : 전등을 킬 시각을 {_on_time}로 설정합니다")
+        LOG.info("setting", "전등을 켤 시각을 바꿉니다.", device=self.device_id, on_time=_on_time)
         self.on_time = _on_time
+        self._notify("on_time")
 
     def set_off_time(self, _off_time: datetime):
-        print(f"[hardware.set_off_time] : 전등을 끌 시각을 {_off_time}로 설정합니다")
+        LOG.info("setting", "전등을 끌 시각을 바꿉니다.", device=self.device_id, off_time=_off_time)
         self.off_time = _off_time
+        self._notify("off_time")
 
     def get_temperature(self):
         return self.temperature
@@ -364,6 +508,14 @@ class SmartFarmDevice:
     def get_water_level(self) -> float:
         return self.water_level
 
+    def get_dht_health(self) -> list:
+        """온습도센서마다의 실패율, 버려진 비율, bias, staleness를 반환함 (fusion.DHTFusion.get_health 참고)"""
+        return self.dht_fusion.get_health()
+
+    def get_adc_volts(self, channel):
+        """수위센서와 함께 읽은 다른 ADC 채널의 마지막 측정 전압(V)을 반환함. 아직 읽지 않았으면 None"""
+        return self.adc_volts.get(channel)
+
     def get_led_first_state(self):
         """1층 LED 전원 상태를 얻어오는 함수 (GPIO.HIGH/GPIO.LOW)"""
         return self.led_first_state
@@ -376,44 +528,74 @@ class SmartFarmDevice:
         """히터의 상태를 반환하는 함수 (GPIO.HIGH 혹은 GPIO.LOW)"""
         return self.heater_state
 
+    def start_camera(self):
+        """카메라를 열고 녹화를 시작함 (이미 시작했으면 아무것도 안 함). 카메라가 꺼져있으면 None, 아니면 CaptureEngine을 반환함"""
+        if not self.camera_enabled:
+            return None
+        with self._camera_lock:
+            if self.capture_engine is None:
+                from capture import CaptureEngine, FrameBufferPool
+
+                LOG.info("start_camera", "카메라를 엽니다.", device=self.device_id)
+                self.camera = self.backend.camera_factory()
+                engine = CaptureEngine(self.camera, FrameBufferPool(CAPTURE_BUFFER_COUNT, CAPTURE_BUFFER_SIZE))
+                engine.start()
+                self.capture_engine = engine
+        return self.capture_engine
+
+    def get_frame(self):
+        """
+        가장 최근 사진을 capture.Frame으로 반환함 (복사 없음). 다 쓰면 release()해야 하며 with 문으로 쓸 수 있음.
+        카메라가 꺼져있거나 아직 사진이 없으면 None을 반환함. 처음 부르면 카메라를 엶
+        """
+        engine = self.start_camera()
+        if engine is None:
+            return None
+        return engine.latest()
+
     def get_image(self, save_to_file=False):
-        #        '''
-        #        사진을 찍어 byte로 반환함.
-        #        -save_to_file : True로 설정되면 f"./captured_images/{datetime.now().strftime('%Y.%m.%d_%H:%M:%S')}.jpeg"로 파일을 저장
-        print(f"[hardware.get_image({save_to_file}) 실행됨]")
-
-    #
-    #        photo_width = 600
-    #        photo_height = 600
-    #        self.camera.capture(self.stream, format='jpeg')
-    #        self.stream.seek(0)
-    #        encoded_image = self.stream.getvalue()
-    #        self.stream.seek(0)
-    #        if save_to_file == True :
-    #            with Image.open(self.stream) as img :
-    #                image_path = './captured_images/'
-    #                image_filename = f"{datetime.now().strftime('%Y.%m.%d_%H:%M:%S')}.jpeg"
-    #                img.save(image_path + image_filename)
-    #            self.stream.seek(0)
-    #
-    #        return encoded_image
+        """
+        사진을 찍어 byte로 반환함. 카메라가 꺼져있으면(CAMERA_ENABLED가 False) None을 반환함.
+        -save_to_file : True로 설정되면 f"./captured_images/{datetime.now().strftime('%Y.%m.%d_%H:%M:%S')}.jpeg"로 파일을 저장
+        """
+        frame = self.get_frame()
+        if frame is None:
+            return None
+
+        with frame:
+            if save_to_file == True :
+                from capture import save_frame
+
+                # 카메라가 이미 JPEG로 인코딩해 준 bytes를 다시 열지 않고 그대로 씀
+                image_filename = f"{datetime.fromtimestamp(frame.timestamp).strftime('%Y.%m.%d_%H:%M:%S')}.jpeg"
+                save_frame(frame, './captured_images/', image_filename)
+            # 여러 viewer가 나눠 쓸 수 있도록 bytes로 한 번만 복사함
+            return frame.tobytes()
+
+    def _gpio_output(self, name, pin, state):
+        self.gpio.output(pin, state)
+        GPIO_WRITES.labels(self.device_id, pin).inc()
+        LOG.info("gpio_write", "출력 핀의 상태를 바꿉니다.", device=self.device_id, output=name, pin=pin, state=state)
+        on = 1 if state == GPIO.HIGH else 0
+        for listener in self.actuator_listeners:
+            try:
+                listener(name, on)
+            except Exception as e:
+                # 기록에 실패했다고 장치 제어를 멈출 수는 없으므로 로그만 남김
+                LOG.error("actuator_listener_failed", "액추에이터 상태를 알리는 중 오류가 발생했습니다!", device=self.device_id, output=name, error=e)
 
     def _pump_update(self):
         """현재 self.pump_state에 맞게 펌프를 끄거나 켜는 함수"""
-        print(f"[_pump_update] : 펌프를 {self.pump_state}로 켭니다/끕니다.")
-        GPIO.output(pin_pump, self.pump_state)
+        self._gpio_output("pump", self.pins.pump, self.pump_state)
 
     def _heater_update(self):
-        print(f"[_heater_update] : 히터를 {self.heater_state}로 켭니다/끕니다.")
-        GPIO.output(pin_heater, self.heater_state)
+        self._gpio_output("heater", self.pins.heater, self.heater_state)
 
     def _led_first_update(self):
-        print(f"[_led_first_update] : 1층 LED를 {self.led_first_state}로 켭니다/끕니다.")
-        GPIO.output(pin_led_first_floor, self.led_first_state)
+        self._gpio_output("led_first", self.pins.led_first_floor, self.led_first_state)
 
     def _led_second_update(self):
-        print(f"[_led_second_update] : 2층 LED를 {self.led_second_state}로 켭니다/끕니다.")
-        GPIO.output(pin_led_second_floor, self.led_second_state)
+        self._gpio_output("led_second", self.pins.led_second_floor, self.led_second_state)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+"""
+measurements 테이블과 집계 테이블(rollups.py)에서 기간별 측정값을 읽어 JSON이나 CSV로 조금씩 흘려보내는(streaming) 모듈.
+
+/api/measurements 라우트가 사용함. 결과는 generator로 chunk_size줄씩 만들어지기 때문에
+몇 달치를 내보내도 서버가 한번에 들고 있는 메모리 양은 일정함.
+액추에이터 상태와 켜져있던 비율은 테이블에서 NULL로 읽고, fill_actuator_states()가 chunk마다 상태 변화 로그(actuators.py)로 채움.
+chunk의 줄마다 첫 열은 시각(epoch 밀리초 정수)이며, 시각 문자열로는 stream_json()/stream_csv()가 내보낼 때만 chunk마다 한번에 바꿈.
+"""
+
+import csv
+import json
+import sqlite3
+from datetime import datetime
+from io import StringIO
+
+import numpy as np
+
+from actuators import STATE_FIELDS
+from ringbuffer import ms_to_timestamps
+from rollups import ROLLUP_RESOLUTIONS, rollup_select_columns
+
+TIMESTAMP_FORMAT = "%Y.%m.%d %H:%M:%S"
+# 집계 테이블의 bucket(서버의 지역 시각 문자열)을 epoch 밀리초로 바꾸는 SQL 식 (ingest.TIMESTAMP_MS_SQL과 같은 방법)
+BUCKET_MS_SQL = "CAST(strftime('%s', replace(substr(bucket, 1, 10), '.', '-') || substr(bucket, 11), 'utc') AS INTEGER) * 1000"
+
+# raw measurements 테이블에서 고를 수 있는 열들 (상태 열들은 actuator_events에서 채움)
+RAW_FIELDS = (
+    "temperature",
+    "humidity",
+    "water_level",
+    "led_first_state",
+    "led_second_state",
+    "heater_state",
+    "pump_state",
+)
+DEFAULT_RAW_FIELDS = ("temperature", "humidity", "water_level")
+
+# 집계 테이블에서 고를 수 있는 열들 (열 이름 -> SQL 식). bucket은 timestamp로 내보냄
+ROLLUP_FIELDS = {name: expr for name, expr in rollup_select_columns() if name != "bucket"}
+# 집계 테이블의 켜져있던 비율 열 이름 -> 액추에이터 이름
+ON_FRACTION_FIELDS = {f"{actuator}_on_fraction": actuator for actuator in STATE_FIELDS.values()}
+
+# 요청 받을 수 있는 시각 문자열 형식들 - 차례대로 시도함
+_ACCEPTED_TIME_FORMATS = (
+    TIMESTAMP_FORMAT,
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%d",
+    "%Y.%m.%d",
+)
+
+
+class HistoryQueryError(ValueError):
+    """요청받은 기간, 열, 해상도가 올바르지 않을 때 raise되는 예외"""
+
+
+def parse_time(value):
+    """요청에서 받은 시각 문자열을 TIMESTAMP_FORMAT 형식의 문자열로 바꿈. 비어있으면 None"""
+    if value is None or value == "":
+        return None
+    for fmt in _ACCEPTED_TIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime(TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+    raise HistoryQueryError(f"시각 {value}를 해석할 수 없습니다! (예: 2023.08.08 07:11:09 혹은 2023-08-08T07:11:09)")
+
+
+def choose_resolution(resolution):
+    """
+    요청한 해상도에 맞는 데이터 원본을 고름.
+    - resolution(str) : "raw", "1m", "1h", "1d" 혹은 초 단위 숫자. 비어있으면 "raw"
+    숫자가 주어지면 구간 길이가 그 값 이하인 가장 굵은 집계 테이블을 고르고, 그런 테이블이 없으면 raw를 고름.
+    -> return "raw" 혹은 ROLLUP_RESOLUTIONS의 키
+    """
+    if resolution is None or resolution in ("", "raw"):
+        return "raw"
+    if resolution in ROLLUP_RESOLUTIONS:
+        return resolution
+    try:
+        seconds = float(resolution)
+    except ValueError:
+        raise HistoryQueryError(f"해상도 {resolution}는 허용되지 않습니다! ('raw', '1m', '1h', '1d' 혹은 초 단위 숫자)")
+    chosen = "raw"
+    chosen_seconds = 0
+    for name, (_, bucket_seconds, _) in ROLLUP_RESOLUTIONS.items():
+        if chosen_seconds < bucket_seconds <= seconds:
+            chosen, chosen_seconds = name, bucket_seconds
+    return chosen
+
+
+def build_query(start, end, fields, resolution, device_id=None):
+    """
+    기간과 열, 해상도에 맞는 SELECT 문과 인자를 만듬.
+    - start, end(str) : TIMESTAMP_FORMAT 형식의 시작(포함), 끝(포함) 시각. None이면 제한 없음
+    - fields(list[str]) : 고를 열 이름들. 비어있으면 기본 열들
+    - resolution(str) : choose_resolution()의 결과
+    - device_id(str) : 이 스마트팜의 측정값만 고름. None이면 모든 스마트팜의 측정값을 device_id 열과 함께 고름
+    -> return (query, params, column_names). 첫 열 "timestamp"는 epoch 밀리초로 읽음
+    """
+    if resolution == "raw":
+        # 시각 조건은 정수 키(timestamp_ms)로 비교하고, 내보낼 때만 문자열로 바꿈
+        table, time_column, time_expr = "measurements", "timestamp_ms", "timestamp_ms"
+        start, end = _to_ms(start), _to_ms(end, 999)
+        fields = list(fields) or list(DEFAULT_RAW_FIELDS)
+        unknown = [field for field in fields if field not in RAW_FIELDS]
+        exprs = [f"NULL AS {field}" if field in STATE_FIELDS else field for field in fields]
+    else:
+        table, time_column = ROLLUP_RESOLUTIONS[resolution][0], "bucket"
+        time_expr = BUCKET_MS_SQL
+        fields = list(fields) or list(DEFAULT_RAW_FIELDS)
+        unknown = [field for field in fields if field not in ROLLUP_FIELDS]
+        exprs = [ROLLUP_FIELDS.get(field) for field in fields]
+    if unknown:
+        raise HistoryQueryError(f"해상도 {resolution}에서 고를 수 없는 열이 주어졌습니다 : {', '.join(unknown)}")
+
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    if start is not None:
+        conditions.append(f"{time_column} >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{time_column} <= ?")
+        params.append(end)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    if device_id is not None:
+        query = f"SELECT {time_expr}, {', '.join(exprs)} FROM {table}{where} ORDER BY {time_column};"
+        return query, params, ["timestamp"] + fields
+    query = f"SELECT {time_expr}, device_id, {', '.join(exprs)} FROM {table}{where} ORDER BY {time_column}, device_id;"
+    return query, params, ["timestamp", "device_id"] + fields
+
+
+def _to_ms(timestamp, extra_ms=0):
+    """TIMESTAMP_FORMAT 문자열을 epoch 밀리초로 바꿈. 끝 시각은 그 초 안의 측정값도 들어가도록 extra_ms를 더함"""
+    if timestamp is None:
+        return None
+    return int(datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp() * 1000) + extra_ms
+
+
+def iter_rows(db_path, query, params, chunk_size=500):
+    """query 결과를 chunk_size줄씩 읽어 한 chunk(list)씩 내보내는 generator. 다 읽으면 커넥션을 닫음"""
+    con = sqlite3.connect(db_path, check_same_thread=False)
+    try:
+        cur = con.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        con.close()
+
+
+def fill_actuator_states(chunks, columns, actuator_log, resolution, device_id=None):
+    """
+    iter_rows()의 chunk들에서 비어있는(None) 액추에이터 상태 열을 상태 변화 로그로 채워 내보내는 generator.
+    - raw : 그 시각의 상태 ('ON', 'OFF', 기록이 없으면 None)
+    - 집계 : 구간 [bucket, bucket + 구간 길이) 동안 켜져있던 시간의 비율 (기록이 없는 시간은 꺼진 것으로 셈)
+    - columns : build_query()가 돌려준 열 이름들. device_id 열이 없으면 모두 device_id 스마트팜의 줄임
+    """
+    if resolution == "raw":
+        targets = {i: column for i, column in enumerate(columns) if column in STATE_FIELDS}
+    else:
+        targets = {i: column for i, column in enumerate(columns) if column in ON_FRACTION_FIELDS}
+        bucket_ms = ROLLUP_RESOLUTIONS[resolution][1] * 1000
+    if not targets:
+        yield from chunks
+        return
+    device_index = columns.index("device_id") if "device_id" in columns else None
+    for rows in chunks:
+        rows = [list(row) for row in rows]
+        groups = {}
+        for row in rows:
+            groups.setdefault(device_id if device_index is None else row[device_index], []).append(row)
+        for device, group in groups.items():
+            times = np.array([row[0] for row in group], dtype=np.int64)
+            if resolution == "raw":
+                states = actuator_log.states_at(device, times)
+                for i, column in targets.items():
+                    for row, state in zip(group, states[column].tolist()):
+                        if row[i] is None and state >= 0:
+                            row[i] = "ON" if state == 1 else "OFF"
+            else:
+                start_ms, end_ms = int(times.min()), int(times.max()) + bucket_ms
+                for i, column in targets.items():
+                    timeline = actuator_log.timeline(device, ON_FRACTION_FIELDS[column], start_ms, end_ms)
+                    duty = timeline.duty_cycle(times, times + bucket_ms)
+                    for row, value in zip(group, duty.tolist()):
+                        if row[i] is None:
+                            row[i] = round(value, 4)
+        yield [tuple(row) for row in rows]
+
+
+def format_rows(rows):
+    """chunk의 첫 열(epoch 밀리초)을 TIMESTAMP_FORMAT 문자열로 한번에 바꾼 줄(tuple)들을 반환함"""
+    timestamps = ms_to_timestamps([row[0] for row in rows])
+    return [(timestamp, *row[1:]) for timestamp, row in zip(timestamps, rows)]
+
+
+def stream_json(chunks, columns):
+    """row chunk들을 JSON 배열 문자열 조각으로 바꿔 내보내는 generator"""
+    yield "["
+    first = True
+    for rows in chunks:
+        rows = format_rows(rows)
+        parts = [json.dumps(dict(zip(columns, row)), ensure_ascii=False) for row in rows]
+        if first:
+            yield ",".join(parts)
+            first = False
+        else:
+            yield "," + ",".join(parts)
+    yield "]\n"
+
+
+def stream_csv(chunks, columns):
+    """row chunk들을 CSV 문자열 조각으로 바꿔 내보내는 generator (첫 줄은 열 이름)"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(format_rows(rows))
+        yield buffer.getvalue()
@@ -0,0 +1,408 @@
+"""
+측정값을 datas.db에 모아서 저장하는 write-behind 저장 단계.
+
+측정 루프는 MeasurementWriter.submit()으로 측정값 한 줄을 큐에 넣기만 하고 바로 돌아가며,
+전용 writer 스레드가 하나의 오래 유지되는 WAL 모드 커넥션으로 여러 줄을 executemany로 한번에 씀.
+액추에이터 상태 변화(actuators.py)도 submit_actuator_event()로 같은 큐에 넣어 측정값과 같은 트랜잭션으로 저장함.
+배치는 batch_size만큼 모이거나 가장 오래된 줄이 max_delay초 동안 기다렸을 때 저장됨.
+큐가 가득 차면 put_timeout초까지만 기다리고 그 줄은 버리며, 그 횟수를 get_stats()로 확인할 수 있음.
+datas.db가 잠겨 있어(database is locked) 저장하지 못한 배치는 버리지 않고 들고 있다가 LOCKED_RETRY_DELAY초마다 다시 저장함.
+
+datas.db의 형식은 schema_version 테이블에 기록함 (SCHEMA_VERSION). 예전 형식의 measurements 테이블은
+ensure_measurements_table()이 새 테이블로 바꿔 단 뒤, 예전 줄들은 migrate.py가 조금씩 옮김.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import log
+import metrics
+from actuators import INSERT_ACTUATOR_EVENT_QUERY, ensure_actuator_events_table
+from rollups import ROLLUP_RESOLUTIONS, apply_rollups, create_rollup_tables
+
+LOG = log.get_logger("ingest")
+
+# 측정값 한 줄의 열 순서. submit()에 넘기는 tuple도 이 순서를 따라야 함
+# device_id는 여러 대의 스마트팜(fleet.py)을 구분하는 이름으로, 앞쪽 열들의 위치가 바뀌지 않도록 맨 뒤에 둠
+# 액추에이터 상태는 바뀔 때만 actuator_events 테이블(actuators.py)에 따로 기록함
+MEASUREMENT_COLUMNS = (
+    "timestamp_ms",
+    "temperature",
+    "humidity",
+    "water_level",
+    "device_id",
+)
+# 예전 measurements 테이블에 줄마다 있던 액추에이터 상태 열들
+LEGACY_STATE_COLUMNS = ("led_first_state", "led_second_state", "heater_state", "pump_state")
+
+# device_id 열이 없던 예전 datas.db의 측정값들에 붙일 스마트팜 이름
+DEFAULT_DEVICE_ID = "farm"
+
+# datas.db 형식의 버전
+# 1 : timestamp가 "%Y.%m.%d %H:%M:%S" 문자열인 measurements (schema_version 테이블이 없음)
+# 2 : timestamp_ms(epoch 밀리초 INTEGER)가 키인 WITHOUT ROWID measurements
+SCHEMA_VERSION = 2
+# 옮기는 중인 예전 measurements 테이블 이름 (migrate.py가 다 옮기면 지움)
+LEGACY_MEASUREMENTS_TABLE = "measurements_v1"
+
+# 같은 초에 들어온 두 측정값이 키가 겹치지 않도록 밀리초까지 키로 씀.
+# WITHOUT ROWID라 줄들이 (device_id, timestamp_ms) 순서로 B-tree에 바로 저장되므로 rowid와 따로 된 키 인덱스가 없고,
+# 한 스마트팜의 기간 조회는 키를 찾아 이어 읽기만 함. 값 열들은 STRICT 대신 CHECK로 REAL(혹은 NULL)만 받음
+CREATE_MEASUREMENTS_QUERY = """CREATE TABLE measurements(
+                device_id TEXT NOT NULL,
+                timestamp_ms INTEGER NOT NULL CHECK (typeof(timestamp_ms) = 'integer'),
+                temperature REAL CHECK (typeof(temperature) IN ('real', 'null')),
+                humidity REAL CHECK (typeof(humidity) IN ('real', 'null')),
+                water_level REAL CHECK (typeof(water_level) IN ('real', 'null')),
+                PRIMARY KEY (device_id, timestamp_ms)) WITHOUT ROWID;"""
+
+CREATE_SCHEMA_VERSION_QUERY = """CREATE TABLE IF NOT EXISTS schema_version(
+                version INTEGER PRIMARY KEY,
+                applied_at TEXT NOT NULL);"""
+
+INSERT_MEASUREMENT_QUERY = (
+    f"INSERT OR REPLACE INTO measurements ({', '.join(MEASUREMENT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in MEASUREMENT_COLUMNS)});"
+)
+
+SQLITE_INSERT_SECONDS = metrics.histogram(
+    "smartfarm_sqlite_insert_seconds", "측정값 한 배치를 INSERT하고 집계 테이블을 갱신하는 데 걸린 시간 (commit 제외)"
+)
+SQLITE_COMMIT_SECONDS = metrics.histogram("smartfarm_sqlite_commit_seconds", "측정값 한 배치를 commit하는 데 걸린 시간")
+
+# datas.db가 잠겨 저장하지 못한 배치를 버리지 않고 들고 있다가 다시 저장해보기까지 기다리는 시간(초)
+LOCKED_RETRY_DELAY = 1.0
+
+# writer 스레드에게 보내는 제어용 표시
+_FLUSH = object()
+_STOP = object()
+
+# 예전 timestamp 문자열("%Y.%m.%d %H:%M:%S", 서버의 지역 시각)을 epoch 밀리초로 바꾸는 SQL 식 (ringbuffer.timestamp_to_ms와 같은 값)
+TIMESTAMP_MS_SQL = "CAST(strftime('%s', replace(substr(timestamp, 1, 10), '.', '-') || substr(timestamp, 11), 'utc') AS INTEGER) * 1000"
+
+
+class _ActuatorEvent(tuple):
+    """저장 큐 안에서 측정값과 구분하기 위한 액추에이터 상태 변화 한 줄 (device_id, actuator, timestamp_ms, state)"""
+
+
+class SchemaVersionError(RuntimeError):
+    """datas.db가 이 서버가 아는 것보다 새 형식일 때 raise되는 예외"""
+
+
+def connect_database(db_path, check_same_thread=True, timeout=5.0):
+    """
+    WAL 모드로 설정된 sqlite 커넥션을 만들어 반환함.
+    WAL + synchronous=NORMAL 이면 commit마다 fsync하지 않아 SD카드에 쓰는 횟수가 크게 줄어듬.
+    새로 만드는 datas.db는 auto_vacuum=INCREMENTAL로 만들어 retention.py가 지운 공간을 조금씩 돌려줄 수 있게 함
+    (이미 있는 DB에서는 아무 효과가 없음).
+    - timeout(float) : 다른 커넥션이 쓰는 중일 때 기다리는 최대 시간(초)
+    """
+    con = sqlite3.connect(db_path, check_same_thread=check_same_thread, timeout=timeout)
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    return con
+
+
+def table_columns(con, table):
+    return [row[1] for row in con.execute(f"PRAGMA table_info({table});")]
+
+
+def schema_version(con) -> int:
+    """datas.db의 형식 버전. 아무 테이블도 없으면 0, schema_version 테이블 없이 measurements만 있으면 1"""
+    if table_columns(con, "schema_version"):
+        version = con.execute("SELECT max(version) FROM schema_version;").fetchone()[0]
+        if version is not None:
+            return version
+    return 1 if table_columns(con, "measurements") else 0
+
+
+def _set_schema_version(con, version):
+    con.execute(CREATE_SCHEMA_VERSION_QUERY)
+    con.execute(
+        "INSERT OR REPLACE INTO schema_version (version, applied_at) VALUES (?, ?);",
+        (version, datetime.now().strftime("%Y.%m.%d %H:%M:%S")),
+    )
+
+
+def ensure_measurements_table(con, default_device_id=DEFAULT_DEVICE_ID) -> bool:
+    """
+    datas.db를 SCHEMA_VERSION 형식으로 맞춤. 예전 줄들을 아직 옮기는 중이면(migrate.py) True를 반환함.
+    - 테이블이 없으면 만듬
+    - 예전 형식(1)이면 한 트랜잭션 안에서 measurements를 LEGACY_MEASUREMENTS_TABLE로 이름을 바꾸고 새 measurements를 만듬.
+      예전 줄들은 서버가 새 측정값을 저장하는 동안 migrate.MeasurementMigration이 조금씩 옮기며,
+      줄마다 있던 액추에이터 상태 열들도 그때 상태가 바뀐 줄만 골라 actuator_events로 옮김
+    - datas.db가 이 서버보다 새 형식이면 SchemaVersionError를 raise함 (모르는 형식에 쓰지 않도록)
+    """
+    ensure_actuator_events_table(con)
+    version = schema_version(con)
+    if version > SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"datas.db의 형식(버전 {version})이 이 서버가 아는 형식(버전 {SCHEMA_VERSION})보다 새 것입니다! 서버를 업데이트해주세요"
+        )
+    if version == 0:
+        LOG.info("create_table", "datas.db에 measurements 테이블이 존재하지 않아 만듭니다!")
+        with con:
+            con.execute(CREATE_MEASUREMENTS_QUERY)
+            _set_schema_version(con, SCHEMA_VERSION)
+    elif version == 1:
+        _begin_migration(con, default_device_id)
+    return bool(table_columns(con, LEGACY_MEASUREMENTS_TABLE))
+
+
+def _begin_migration(con, default_device_id):
+    columns = table_columns(con, "measurements")
+    has_device = "device_id" in columns
+    has_states = any(column in columns for column in LEGACY_STATE_COLUMNS)
+    LOG.info(
+        "migrate_table",
+        "measurements 테이블을 새 형식으로 바꿉니다. 예전 측정값은 조금씩 옮깁니다.",
+        version=SCHEMA_VERSION,
+        add_device_id=not has_device,
+        move_states=has_states,
+        default_device_id=default_device_id,
+    )
+    # 집계 테이블이 없거나 device_id가 없는 예전 것이면 새로 만들고, 옮기는 줄들을 집계에 더함 (있으면 이미 들어 있음)
+    rebuild_rollups = any("device_id" not in table_columns(con, table) for table, _, _ in ROLLUP_RESOLUTIONS.values())
+    with con:
+        con.execute(f"ALTER TABLE measurements RENAME TO {LEGACY_MEASUREMENTS_TABLE};")
+        con.execute(CREATE_MEASUREMENTS_QUERY)
+        # 어디까지 옮겼는지 (예전 테이블의 rowid). 옮기는 트랜잭션마다 같이 갱신하므로 중간에 꺼져도 이어서 옮김
+        con.execute(
+            "CREATE TABLE measurements_migration(last_rowid INTEGER NOT NULL, copied INTEGER NOT NULL, "
+            "total INTEGER NOT NULL, device_id TEXT, states INTEGER NOT NULL, rollups INTEGER NOT NULL);"
+        )
+        total = con.execute(f"SELECT count(*) FROM {LEGACY_MEASUREMENTS_TABLE};").fetchone()[0]
+        con.execute(
+            "INSERT INTO measurements_migration VALUES (0, 0, ?, ?, ?, ?);",
+            (total, None if has_device else default_device_id, int(has_states), int(rebuild_rollups)),
+        )
+        _set_schema_version(con, SCHEMA_VERSION)
+    if rebuild_rollups:
+        create_rollup_tables(con)
+
+
+def list_devices(con) -> list:
+    """measurements에 측정값이 있는 스마트팜 이름들. 키 순서로 다음 이름을 찾아가며 건너뛰므로 줄 수가 많아도 빠름"""
+    return [
+        row[0]
+        for row in con.execute(
+            "WITH RECURSIVE devices(device_id) AS ("
+            "SELECT min(device_id) FROM measurements UNION ALL "
+            "SELECT (SELECT min(device_id) FROM measurements WHERE device_id > devices.device_id) FROM devices "
+            "WHERE devices.device_id IS NOT NULL) "
+            "SELECT device_id FROM devices WHERE device_id IS NOT NULL;"
+        )
+    ]
+
+
+class MeasurementWriter:
+    """
+    측정값을 모아서 한번에 저장하는 write-behind 저장기.
+    - db_path(str) : 저장할 sqlite DB 파일 경로
+    - batch_size(int) : 한번에 저장할 최대 줄 수
+    - max_delay(float) : 큐에 들어온 줄이 저장되기까지 기다릴 수 있는 최대 시간(초)
+    - queue_size(int) : 저장을 기다리는 줄을 담아둘 큐의 최대 크기
+    - put_timeout(float) : 큐가 가득 찼을 때 submit()이 기다리는 최대 시간(초). 0이면 기다리지 않고 바로 버림
+    - rollups(bool) : True면 저장할 때 같은 트랜잭션 안에서 1분/1시간/1일 집계 테이블(rollups.py)도 갱신함
+    - raw(bool) : False면 raw 측정값은 measurements에 넣지 않고 집계와 액추에이터 상태 변화만 저장함
+      (raw 측정값을 segment 파일(segments.py)에 따로 저장할 때)
+    """
+
+    def __init__(self, db_path, batch_size=64, max_delay=30.0, queue_size=1024, put_timeout=0.0, rollups=True, raw=True):
+        self.db_path = db_path
+        self.rollups = rollups
+        self.raw = raw
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        # back-pressure 지표들
+        self._stats_lock = threading.Lock()
+        self.submitted_count = 0
+        self.written_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+        self.retried_count = 0
+        self.batch_count = 0
+        self.max_queue_depth = 0
+        self.last_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.total_blocked_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="MeasurementWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, row) -> bool:
+        """
+        측정값 한 줄(MEASUREMENT_COLUMNS 순서의 tuple)을 저장 큐에 넣음.
+        큐가 가득 차 put_timeout 안에 넣지 못하면 그 줄을 버리고 False를 반환함.
+        """
+        start = time.monotonic()
+        try:
+            if self.put_timeout > 0:
+                self.queue.put(row, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(row)
+            accepted = True
+        except queue.Full:
+            accepted = False
+        blocked = time.monotonic() - start
+
+        with self._stats_lock:
+            self.total_blocked_seconds += blocked
+            if accepted:
+                self.submitted_count += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+            else:
+                self.dropped_count += 1
+        if not accepted:
+            LOG.warning("dropped", "저장 큐가 가득 차 측정값을 버립니다!", every=60, timestamp=row[0], dropped=self.dropped_count)
+        return accepted
+
+    def submit_actuator_event(self, event) -> bool:
+        """
+        액추에이터 상태 변화 한 줄 (device_id, actuator, timestamp_ms, state)을 저장 큐에 넣음.
+        측정값과 같은 큐와 배치로 저장되며, 큐가 가득 차 있으면 submit()처럼 버리고 False를 반환함
+        """
+        return self.submit(_ActuatorEvent(event))
+
+    def flush(self, timeout=None):
+        """지금까지 submit된 줄들을 바로 저장하고, 저장이 끝날 때까지 기다림"""
+        self.queue.put(_FLUSH, timeout=timeout)
+        self.queue.join()
+
+    def close(self):
+        """남은 줄들을 모두 저장하고 writer 스레드를 종료함"""
+        if not self._thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self._thread.join()
+
+    def get_stats(self) -> dict:
+        """back-pressure 지표들을 dict로 반환함"""
+        with self._stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "max_queue_depth": self.max_queue_depth,
+                "submitted": self.submitted_count,
+                "written": self.written_count,
+                "dropped": self.dropped_count,
+                "failed": self.failed_count,
+                "retried": self.retried_count,
+                "batches": self.batch_count,
+                "last_batch_size": self.last_batch_size,
+                "last_flush_seconds": self.last_flush_seconds,
+                "total_flush_seconds": self.total_flush_seconds,
+                "total_blocked_seconds": self.total_blocked_seconds,
+            }
+
+    def _write_batch(self, con, rows):
+        """모아둔 줄들을 (집계 테이블 갱신과 액추에이터 상태 변화까지 포함해) 한 트랜잭션으로 저장함"""
+        events = [row for row in rows if isinstance(row, _ActuatorEvent)]
+        if events:
+            rows = [row for row in rows if not isinstance(row, _ActuatorEvent)]
+        # INSERT와 commit에 걸린 시간을 따로 재기 위해 with con 대신 직접 commit함
+        try:
+            with SQLITE_INSERT_SECONDS.time():
+                if self.raw:
+                    con.executemany(INSERT_MEASUREMENT_QUERY, rows)
+                if events:
+                    con.executemany(INSERT_ACTUATOR_EVENT_QUERY, events)
+                if self.rollups and rows:
+                    apply_rollups(con, rows)
+            with SQLITE_COMMIT_SECONDS.time():
+                con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+    def _flush_rows(self, con, rows, retry=True) -> bool:
+        """
+        줄들을 저장함. datas.db가 잠겨 있어(database is locked) 실패했고 retry면 실패로 세지 않고 False를 반환함
+        (부르는 쪽이 줄들을 들고 있다가 다시 저장함). 그 외에는 저장했거나 실패로 센 뒤 True를 반환함
+        """
+        start = time.monotonic()
+        try:
+            self._write_batch(con, rows)
+            failed = False
+        except sqlite3.Error as e:
+            if retry and _is_locked(e):
+                LOG.warning("write_locked", "datas.db가 잠겨 있어 측정값을 들고 있다가 다시 저장합니다.", every=60, rows=len(rows), error=e)
+                with self._stats_lock:
+                    self.retried_count += 1
+                return False
+            LOG.error("write_failed", "측정값 저장에 실패했습니다!", every=60, rows=len(rows), error=e)
+            failed = True
+        elapsed = time.monotonic() - start
+        with self._stats_lock:
+            if failed:
+                self.failed_count += len(rows)
+            else:
+                self.written_count += len(rows)
+            self.batch_count += 1
+            self.last_batch_size = len(rows)
+            self.last_flush_seconds = elapsed
+            self.total_flush_seconds += elapsed
+        return True
+
+    def _run(self):
+        """writer 스레드용 함수. 큐에서 줄들을 꺼내 batch_size나 max_delay 기준으로 모아서 저장함"""
+        # sqlite 커넥션은 만든 스레드에서만 쓸 수 있으므로 writer 스레드 안에서 만듬
+        # 정리(retention.py)가 지우는 동안 잠금을 기다릴 수 있도록 timeout을 넉넉히 줌 (저장은 측정 루프를 막지 않음)
+        con = connect_database(self.db_path, timeout=60.0)
+        if self.rollups:
+            create_rollup_tables(con)
+        stopping = False
+        pending = []  # 잠겨서 저장하지 못하고 들고 있는 줄들
+        taken = 0  # 꺼냈지만 아직 task_done을 부르지 않은 항목 수
+        while not stopping:
+            rows, pending = pending, []
+            try:
+                # 들고 있는 줄들이 있으면 새 줄을 오래 기다리지 않고 다시 저장해봄
+                item = self.queue.get(timeout=LOCKED_RETRY_DELAY) if rows else self.queue.get()
+                taken += 1
+            except queue.Empty:
+                item = _FLUSH
+            if item is _STOP:
+                stopping = True
+            elif item is not _FLUSH:
+                rows.append(item)
+                deadline = time.monotonic() + self.max_delay
+                # 첫 줄이 들어온 뒤 batch_size만큼 모이거나 max_delay가 지날 때까지 더 모음
+                while len(rows) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    taken += 1
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    if item is _FLUSH:
+                        break
+                    rows.append(item)
+
+            # 끄는 중이면 더 기다리지 않고 마지막으로 한 번만 저장해봄
+            if rows and not self._flush_rows(con, rows, retry=not stopping):
+                pending = rows
+                continue
+            # 꺼낸 항목 수만큼 task_done을 호출해야 flush()의 queue.join()이 풀림 (들고 있는 줄들을 저장할 때까지 미룸)
+            for _ in range(taken):
+                self.queue.task_done()
+            taken = 0
+        con.close()
+
+
+def _is_locked(error) -> bool:
+    """다른 커넥션(정리, 옮기기 등)이 datas.db를 잠가 timeout까지 기다려도 쓰지 못한 오류인지"""
+    return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
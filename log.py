@@ -0,0 +1,245 @@
+"""
+print 대신 쓰는 구조화된(structured) 로그 모듈.
+
+지금까지는 GPIO에 쓸 때마다, DHT 센서 결과마다, 측정 루프를 돌 때마다 print로 stdout(라즈베리파이에서는 journald -> SD카드)에
+바로 썼기 때문에, 측정과 제어가 출력이 끝나기를 기다렸고 고장난 센서 하나가 한 주기에 네 줄씩 SD카드에 남겼음. 이 모듈은
+- 로그 한 줄을 (시각, 수준, 이름, 사건(event), 메시지, 필드 dict)로 만들어 큐에 넣기만 하고, 실제 문자열 만들기와 쓰기는
+  백그라운드 스레드가 모아서 한 번에 함 (큐가 가득 차면 기다리지 않고 버림)
+- 같은 key의 로그는 every초에 한 줄만 쓰고, 그 사이에 반복된 횟수는 다음 줄에 붙임 (예: 고장난 센서는 1분에 한 줄)
+- 수준(level)이 SMARTFARM_LOG_LEVEL보다 낮은 로그는 큐에 넣지도 않음
+을 제공함.
+
+    LOG = log.get_logger("hardware")
+    LOG.info("gpio_write", "히터를 켭니다/끕니다.", device="farm", pin=27, state=1)
+    LOG.warning("dht_failed", "온습도센서가 값을 돌려주지 않습니다!", key=pin, every=60, pin=pin)
+
+메시지는 f-string 대신 고정된 문자열로 쓰고 바뀌는 값은 필드로 넘김 (버려지는 로그는 문자열을 만들지 않도록).
+환경변수
+- SMARTFARM_LOG_LEVEL : DEBUG, INFO(기본값), WARNING, ERROR
+- SMARTFARM_LOG_FORMAT : text(기본값) 혹은 json (한 줄에 JSON 객체 하나)
+- SMARTFARM_LOG_FILE : 주면 stdout 대신 이 파일 끝에 이어 씀
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+import metrics
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+LOG_LEVEL = {name: level for level, name in LEVEL_NAMES.items()}.get(
+    os.environ.get("SMARTFARM_LOG_LEVEL", "INFO").upper(), INFO
+)
+LOG_FORMAT = os.environ.get("SMARTFARM_LOG_FORMAT", "text")
+LOG_FILE = os.environ.get("SMARTFARM_LOG_FILE")
+
+# 큐에 쌓아둘 수 있는 최대 로그 수 - 넘으면 측정 루프를 막지 않고 버림
+QUEUE_SIZE = 10000
+# 백그라운드 스레드가 모아 쓰는 최대 간격(초)과 한 번에 쓰는 최대 줄 수
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 500
+# every를 쓰는 key를 이만큼 넘게 기억하면 오래된 것들을 잊음
+MAX_RATE_KEYS = 4096
+
+LOG_RECORDS = metrics.counter("smartfarm_log_records_total", "큐에 넣은 로그 수", ["level"])
+LOG_SUPPRESSED = metrics.counter("smartfarm_log_suppressed_total", "every 안에 반복되어 쓰지 않은 로그 수")
+LOG_DROPPED = metrics.counter("smartfarm_log_dropped_total", "큐가 가득 차 버린 로그 수")
+_RECORD_COUNTERS = {level: LOG_RECORDS.labels(name) for level, name in LEVEL_NAMES.items()}
+
+
+class LogWriter:
+    """
+    큐에 들어온 로그들을 백그라운드 스레드에서 모아 문자열로 만들어 쓰는 객체.
+    - stream : 쓸 곳 (write, flush가 있는 객체)
+    - fmt(str) : "text" 혹은 "json"
+    """
+
+    def __init__(self, stream, fmt="text", queue_size=QUEUE_SIZE):
+        self.stream = stream
+        self.fmt = fmt
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        # 지표들
+        self.written_count = 0
+        self.dropped_count = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=2.0):
+        """남은 로그를 모두 쓰고 스레드를 멈춤"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, record):
+        """로그 하나를 큐에 넣음. 큐가 가득 차 있으면 기다리지 않고 버림"""
+        if self._thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+            LOG_DROPPED.inc()
+
+    def _run(self):
+        while not (self._stopped.is_set() and self.queue.empty()):
+            try:
+                records = [self.queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(records)
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception as e:
+                lines.append(f"[log.LogWriter] : 로그를 만드는 중 오류가 발생했습니다! : {e}")
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            # 로그를 쓸 수 없다고 측정을 멈출 수는 없으므로 버림
+            return
+        self.written_count += len(lines)
+
+    def format(self, record) -> str:
+        created, level, name, event, message, fields, suppressed = record
+        if self.fmt == "json":
+            entry = {
+                "time": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+                "level": LEVEL_NAMES[level],
+                "logger": name,
+                "event": event,
+                "message": message,
+            }
+            entry.update(fields)
+            if suppressed:
+                entry["suppressed"] = suppressed
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{datetime.fromtimestamp(created).strftime('%Y.%m.%d %H:%M:%S')} {LEVEL_NAMES[level]} [{name}.{event}] : {message}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if suppressed:
+            line += f" (그 사이 {suppressed}번 더 반복됨)"
+        return line
+
+
+class RateLimiter:
+    """key마다 마지막으로 쓴 시각과 그 뒤로 쓰지 않은 횟수를 기억해, every초에 한 번만 통과시키는 객체"""
+
+    def __init__(self, max_keys=MAX_RATE_KEYS):
+        self.max_keys = max_keys
+        self._entries = {}  # key -> [마지막으로 통과한 시각, 그 뒤로 막은 횟수]
+        self._lock = threading.Lock()
+
+    def allow(self, key, every, now):
+        """통과하면 그 사이 막은 횟수(0 이상)를, 막으면 None을 반환함"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < every:
+                entry[1] += 1
+                return None
+            suppressed = 0 if entry is None else entry[1]
+            if entry is None and len(self._entries) >= self.max_keys:
+                self._forget(now, every)
+            self._entries[key] = [now, 0]
+            return suppressed
+
+    def _forget(self, now, every):
+        stale = [key for key, (last, _) in self._entries.items() if now - last >= every]
+        for key in stale or list(self._entries)[: self.max_keys // 2]:
+            del self._entries[key]
+
+
+class Logger:
+    """
+    이름(보통 모듈 이름) 하나의 로그를 남기는 객체. get_logger()로 얻음.
+    debug/info/warning/error(event, message, key=None, every=None, **fields)
+    - event(str) : 로그의 종류 (예: "gpio_write"). 이름과 함께 줄 앞에 [이름.event]로 붙음
+    - message(str) : 사람이 읽을 메시지 (고정된 문자열)
+    - key : every를 줄 때 같은 로그로 칠 기준 (예: 센서 핀). (이름, event, key)가 같으면 같은 로그임
+    - every(float) : 같은 로그를 몇 초에 한 번만 쓸지. None이면 매번 씀
+    - fields : 함께 남길 값들
+    """
+
+    def __init__(self, name, writer, limiter):
+        self.name = name
+        self.writer = writer
+        self.limiter = limiter
+
+    def log(self, level, event, message, key=None, every=None, **fields):
+        if level < LOG_LEVEL:
+            return
+        now = time.time()
+        suppressed = 0
+        if every is not None:
+            suppressed = self.limiter.allow((self.name, event, key), every, now)
+            if suppressed is None:
+                LOG_SUPPRESSED.inc()
+                return
+        _RECORD_COUNTERS[level].inc()
+        self.writer.submit((now, level, self.name, event, message, fields, suppressed))
+
+    def debug(self, event, message, **kwargs):
+        self.log(DEBUG, event, message, **kwargs)
+
+    def info(self, event, message, **kwargs):
+        self.log(INFO, event, message, **kwargs)
+
+    def warning(self, event, message, **kwargs):
+        self.log(WARNING, event, message, **kwargs)
+
+    def error(self, event, message, **kwargs):
+        self.log(ERROR, event, message, **kwargs)
+
+    def enabled(self, level) -> bool:
+        """level의 로그가 쓰이는지 (필드 값을 만드는 비용이 클 때 미리 확인하는 용도)"""
+        return level >= LOG_LEVEL
+
+
+def _open_stream():
+    if LOG_FILE:
+        return open(LOG_FILE, "a", encoding="utf-8", buffering=1 << 16)
+    return sys.stdout
+
+
+# 프로그램 전체가 같이 쓰는 writer와 rate limiter
+WRITER = LogWriter(_open_stream(), LOG_FORMAT)
+RATE_LIMITER = RateLimiter()
+_loggers = {}
+
+
+def get_logger(name) -> Logger:
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers.setdefault(name, Logger(name, WRITER, RATE_LIMITER))
+    return logger
+
+
+def shutdown():
+    """남은 로그를 모두 씀 (프로그램이 끝날 때 자동으로 불림)"""
+    WRITER.stop()
+
+
+atexit.register(shutdown)
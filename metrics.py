@@ -0,0 +1,273 @@
+"""
+측정 루프, 저장, 발행 같은 백그라운드 작업들의 지표(metric)를 모아 Prometheus 텍스트 형식으로 내보내는 모듈.
+
+지금까지는 print 출력만 보고 30초 측정 주기 안에 무엇이 오래 걸리는지 짐작했음. 이 모듈은
+- Counter : 계속 늘어나기만 하는 횟수 (예: GPIO에 쓴 횟수, 주기를 넘긴(overrun) 횟수)
+- Gauge : 올라가고 내려가는 현재 값 (예: 저장 큐 길이)
+- Histogram : 미리 정한 구간(bucket)마다의 개수로 모은 걸린 시간 분포 (예: DHT 한 번 읽는 시간)
+을 제공하고, 모든 지표는 모듈 전역 REGISTRY에 등록되어 app.py의 '/metrics'에서 한꺼번에 내보내짐.
+
+측정 루프(hot path)에서 지표를 기록하는 비용은 잠금(lock) 한 번과 덧셈 몇 번뿐이며, 라벨이 있는 지표는
+labels()로 얻은 자식 지표를 미리 들고 있다가 쓰면 dict 찾기도 하지 않음. 문자열 만들기는 '/metrics'를 읽을 때만 함.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+# 걸린 시간(초) Histogram의 기본 구간. DHT(수 초)부터 SPI 한 번(수 밀리초)까지 담을 수 있게 잡음
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class _Timer:
+    """with 블록이 걸린 시간을 Histogram에 기록하는 context manager"""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Counter:
+    """계속 늘어나기만 하는 값"""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """올라가고 내려가는 현재 값"""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """
+    구간(bucket)마다의 개수, 전체 합, 전체 개수를 모으는 값 분포.
+    - buckets(tuple) : 구간의 상한들 (오름차순). +Inf 구간은 자동으로 붙음
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """with metric.time(): ... 로 블록이 걸린 시간(초)을 기록함"""
+        return _Timer(self)
+
+    def _samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            yield name + "_bucket", labels + (("le", _format_value(float(bound))),), cumulative
+        yield name + "_sum", labels, total
+        yield name + "_count", labels, count
+
+
+class MetricFamily:
+    """
+    같은 이름의 지표들의 묶음. 라벨이 없으면 묶음 자체를 지표처럼 쓰고 (inc, set, observe, time),
+    라벨이 있으면 labels(값들)로 라벨 값마다의 자식 지표를 얻어 씀.
+    """
+
+    def __init__(self, name, documentation, kind, labelnames=(), **options):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._options = options
+        self._children = {}
+        self._lock = threading.Lock()
+        self._default = None if self.labelnames else self._new_child()
+
+    def _new_child(self):
+        if self.kind == "counter":
+            return Counter()
+        elif self.kind == "gauge":
+            return Gauge()
+        return Histogram(**self._options)
+
+    def labels(self, *values, **kwargs):
+        """라벨 값들에 해당하는 자식 지표를 반환함 (없으면 만듬). 측정 루프에서는 한 번 얻어서 들고 있다가 쓰는 것이 좋음"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"지표 {self.name}의 라벨은 {self.labelnames}입니다!")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def __getattr__(self, attribute):
+        # 라벨이 없는 지표는 inc/set/observe/time을 바로 부를 수 있게 함
+        default = self.__dict__.get("_default")
+        if default is None:
+            raise AttributeError(attribute)
+        return getattr(default, attribute)
+
+    def collect(self):
+        """(이름, 라벨 tuple, 값) 들을 내보냄"""
+        if self._default is not None:
+            yield from self._default._samples(self.name, ())
+            return
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            yield from child._samples(self.name, tuple(zip(self.labelnames, key)))
+
+
+class MetricsRegistry:
+    """지표 묶음들과, '/metrics'를 읽을 때마다 값을 모아오는 수집 함수(collector)들을 들고 있는 객체"""
+
+    def __init__(self):
+        self._families = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, name, documentation, kind, labelnames, **options):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = MetricFamily(name, documentation, kind, labelnames, **options)
+                self._families[name] = family
+            elif family.kind != kind or family.labelnames != tuple(labelnames):
+                raise ValueError(f"지표 {name}이 다른 종류나 라벨로 이미 등록되어 있습니다!")
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Counter 묶음을 등록하고 반환함. 같은 이름으로 다시 부르면 이미 등록된 묶음을 반환함.
+        Prometheus 관례에 따라 이름은 _total로 끝나게 지음
+        """
+        return self._register(name, documentation, "counter", labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Gauge 묶음을 등록하고 반환함"""
+        return self._register(name, documentation, "gauge", labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Histogram 묶음을 등록하고 반환함. 시간을 잴 때는 이름을 _seconds로 끝나게 지음"""
+        return self._register(name, documentation, "histogram", labelnames, buckets=buckets)
+
+    def add_collector(self, collect):
+        """
+        '/metrics'를 읽을 때마다 불리는 수집 함수를 등록함. 다른 객체의 get_stats() 값처럼 따로 기록하지 않는 값을 내보낼 때 씀.
+        collect()는 (이름, 종류('gauge' 혹은 'counter'), 설명, [(라벨 dict, 값), ...]) 들을 내보내야 함
+        """
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        """등록된 모든 지표를 Prometheus 텍스트 형식 문자열로 만듬"""
+        lines = []
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for name, labels, value in family.collect():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for collect in self._collectors:
+            try:
+                for name, kind, documentation, samples in collect():
+                    lines.append(f"# HELP {name} {documentation}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in samples:
+                        if value is None:
+                            continue
+                        lines.append(f"{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}")
+            except Exception as e:
+                # log.py가 이 모듈을 import하므로 여기서 import함
+                import log
+
+                log.get_logger("metrics").error("collect_failed", "지표를 모으는 중 오류가 발생했습니다!", every=60, error=e)
+        return "\n".join(lines) + "\n"
+
+
+# 프로그램 전체가 같이 쓰는 registry
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
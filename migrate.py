@@ -0,0 +1,185 @@
+"""
+예전 형식(버전 1)의 datas.db measurements 줄들을 새 형식(ingest.SCHEMA_VERSION)으로 조금씩 옮기는 도구.
+
+ingest.ensure_measurements_table()이 예전 measurements를 ingest.LEGACY_MEASUREMENTS_TABLE로 이름만 바꾸고 새 테이블을 만들어 두면,
+- 서버가 켜져 있을 때는 MeasurementMigration 스레드가 CHUNK_ROWS줄씩 옮기고 (서버는 그 동안에도 새 측정값을 저장함)
+- 서버를 끈 채로 한번에 옮기려면 `python migrate.py [datas.db 경로]`를 실행함.
+  이때 auto_vacuum이 INCREMENTAL이 아닌 예전 datas.db는 전체 VACUUM으로 바꿔, retention.py가 지운 공간을 조금씩 돌려줄 수 있게 함
+한 덩어리(chunk)를 옮기는 것과 어디까지 옮겼는지(measurements_migration 테이블)의 갱신은 한 트랜잭션이므로
+중간에 꺼져도 다음에 켜질 때 이어서 옮김. 다 옮기면 예전 테이블을 지우고, 생긴 빈 공간은 retention.py가 조금씩 돌려줌.
+옮기는 동안 /api/measurements에는 아직 옮기지 않은 예전 측정값이 보이지 않음.
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import log
+from actuators import transitions_query
+from ingest import (
+    DEFAULT_DEVICE_ID,
+    INSERT_MEASUREMENT_QUERY,
+    LEGACY_MEASUREMENTS_TABLE,
+    TIMESTAMP_MS_SQL,
+    connect_database,
+    ensure_measurements_table,
+    table_columns,
+)
+from rollups import apply_rollups
+
+LOG = log.get_logger("migrate")
+
+# 한 트랜잭션으로 옮길 줄 수와, 서버가 켜져 있을 때 덩어리 사이에 쉴 시간(초) - 측정값 저장을 오래 막지 않도록
+CHUNK_ROWS = 5000
+STEP_PAUSE = 0.2
+
+INSERT_IGNORE_QUERY = INSERT_MEASUREMENT_QUERY.replace("INSERT OR REPLACE", "INSERT OR IGNORE")
+
+
+def migration_progress(con):
+    """(옮긴 줄 수, 전체 줄 수). 옮기는 중이 아니면 None"""
+    if not table_columns(con, "measurements_migration"):
+        return None
+    return con.execute("SELECT copied, total FROM measurements_migration;").fetchone()
+
+
+def copy_chunk(con, chunk_rows=CHUNK_ROWS) -> int:
+    """
+    예전 테이블에서 아직 옮기지 않은 줄을 rowid 순서로 chunk_rows줄까지 옮김. 읽은 줄 수를 반환함.
+    예전 상태 열이 있으면 그 줄들의 상태 변화를 actuator_events에, 집계를 새로 만들었으면 그 줄들을 집계 테이블에 함께 넣음.
+    더 옮길 줄이 없으면 예전 테이블과 진행 테이블을 지우고 0을 반환함
+    """
+    if not table_columns(con, LEGACY_MEASUREMENTS_TABLE):
+        return 0
+    last_rowid, default_device_id, states, rollups = con.execute(
+        "SELECT last_rowid, device_id, states, rollups FROM measurements_migration;"
+    ).fetchone()
+    device_expr = "device_id" if default_device_id is None else "?"
+    device_params = () if default_device_id is None else (default_device_id,)
+    with con:
+        upper, count = con.execute(
+            f"SELECT max(rowid), count(*) FROM (SELECT rowid FROM {LEGACY_MEASUREMENTS_TABLE} "
+            "WHERE rowid > ? ORDER BY rowid LIMIT ?);",
+            (last_rowid, chunk_rows),
+        ).fetchone()
+        if count == 0:
+            con.execute(f"DROP TABLE {LEGACY_MEASUREMENTS_TABLE};")
+            con.execute("DROP TABLE measurements_migration;")
+            LOG.info("migrated", "예전 측정값을 모두 새 형식으로 옮겼습니다.")
+            return 0
+        rows = con.execute(
+            f"SELECT {TIMESTAMP_MS_SQL}, CAST(temperature AS REAL), CAST(humidity AS REAL), CAST(water_level AS REAL), "
+            f"{device_expr} FROM {LEGACY_MEASUREMENTS_TABLE} WHERE rowid > ? AND rowid <= ?;",
+            (*device_params, last_rowid, upper),
+        ).fetchall()
+        # 같은 (스마트팜, 시각)이 이미 있으면 새 형식으로 저장된 값을 그대로 둠
+        con.executemany(INSERT_IGNORE_QUERY, rows)
+        if rollups:
+            apply_rollups(con, rows)
+        if states:
+            for query in transitions_query(LEGACY_MEASUREMENTS_TABLE, device_expr, TIMESTAMP_MS_SQL, "rowid > ? AND rowid <= ?"):
+                con.execute(query, (*device_params, last_rowid, upper))
+        con.execute("UPDATE measurements_migration SET last_rowid = ?, copied = copied + ?;", (upper, count))
+    return count
+
+
+class MeasurementMigration:
+    """
+    서버가 켜져 있는 동안 예전 측정값을 조금씩 옮기는 백그라운드 스레드.
+    - db_path(str) : datas.db 경로
+    - chunk_rows(int) : 한 트랜잭션으로 옮길 줄 수
+    """
+
+    def __init__(self, db_path, chunk_rows=CHUNK_ROWS):
+        self.db_path = db_path
+        self.chunk_rows = chunk_rows
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # 지표들
+        self.copied_count = 0
+        self.total_count = None
+        self.done = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="MeasurementMigration", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_stats(self) -> dict:
+        return {"copied": self.copied_count, "total": self.total_count, "done": self.done}
+
+    def _run(self):
+        # 측정값 저장과 잠금이 겹치면 기다릴 수 있게 함
+        con = connect_database(self.db_path, timeout=60.0)
+        try:
+            progress = migration_progress(con)
+            if progress is not None:
+                self.copied_count, self.total_count = progress
+                LOG.info("resume", "예전 측정값을 새 형식으로 옮깁니다.", copied=self.copied_count, total=self.total_count)
+            while not self._stopped.is_set():
+                copied = copy_chunk(con, self.chunk_rows)
+                if copied == 0:
+                    self.done = True
+                    break
+                self.copied_count += copied
+                LOG.debug("chunk", "예전 측정값을 옮겼습니다.", copied=self.copied_count, total=self.total_count)
+                time.sleep(STEP_PAUSE)
+        except Exception as e:
+            LOG.error("failed", "예전 측정값을 옮기는 중 오류가 발생했습니다! 다음에 켜질 때 이어서 옮깁니다.", error=e)
+        finally:
+            con.close()
+
+
+def enable_incremental_vacuum(con) -> bool:
+    """
+    auto_vacuum이 INCREMENTAL이 아닌 예전 datas.db를 전체 VACUUM으로 바꿈. 바꿨으면 True를 반환함.
+    파일 전체를 다시 쓰는 동안 datas.db를 잠그므로 서버를 끈 채로만 부름
+    """
+    if con.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+        return False
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    con.execute("VACUUM;")
+    return True
+
+
+def migrate(db_path, default_device_id=DEFAULT_DEVICE_ID, chunk_rows=CHUNK_ROWS) -> int:
+    """datas.db를 새 형식으로 바꾸고 예전 측정값을 모두 옮긴 뒤 incremental vacuum을 켬 (서버를 끈 채로 실행). 옮긴 줄 수를 반환함"""
+    con = connect_database(db_path, timeout=60.0)
+    try:
+        ensure_measurements_table(con, default_device_id)
+        total = 0
+        chunks = 0
+        while True:
+            copied = copy_chunk(con, chunk_rows)
+            if copied == 0:
+                break
+            total += copied
+            chunks += 1
+            if chunks % 20 == 0:
+                progress = migration_progress(con)
+                print(f"{progress[0]} / {progress[1]}", file=sys.stderr)
+        if con.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            print("incremental vacuum을 쓸 수 있게 datas.db 전체를 VACUUM합니다. 파일이 크면 오래 걸립니다.", file=sys.stderr)
+            enable_incremental_vacuum(con)
+        return total
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="datas.db를 새 형식으로 옮기고 incremental vacuum을 켬 (서버를 끈 채로. 중간에 멈춰도 다시 실행하면 이어서 옮김)"
+    )
+    parser.add_argument("db_path", nargs="?", default="./datas.db", help="datas.db 경로 (기본값 ./datas.db)")
+    parser.add_argument("--device", default=DEFAULT_DEVICE_ID, help="device_id 열이 없던 예전 측정값에 붙일 스마트팜 이름")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="한 트랜잭션으로 옮길 줄 수")
+    args = parser.parse_args()
+    copied = migrate(args.db_path, args.device, args.chunk_rows)
+    log.shutdown()
+    print(f"{copied}줄을 옮겼습니다.")
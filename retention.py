@@ -0,0 +1,434 @@
+"""
+datas.db가 끝없이 커지지 않도록 오래된 측정값을 정리하는 보관(retention) 모듈.
+
+30초마다 한 줄씩 쌓이는 measurements 테이블을 그대로 두면 라즈베리파이의 page cache에 다 들어가지 않을 만큼 커져
+최근 측정값을 읽을 때도 SD카드를 읽게 됨. RetentionManager는 RETENTION_INTERVAL마다 백그라운드 스레드에서
+1. raw 측정값 중 RAW_RETENTION_DAYS일보다 오래된 줄을 달마다 하나씩인 압축 열(column) 파일
+   (ARCHIVE_DIR/measurements-YYYY-MM.npz)로 옮기고 datas.db에서 지움.
+   집계 테이블(rollups.py)은 저장할 때 이미 갱신되어 있으므로 지워도 1분/1시간/1일 평균은 그대로 남음
+2. 1분 집계 테이블도 ROLLUP_RETENTION_DAYS일보다 오래된 구간은 지움 (1시간, 1일 집계는 계속 둠)
+   raw 측정값을 segment 파일(segments.py)에 저장하고 있으면, 마지막 측정값까지 오래된 segment도 같은 열 파일로 옮기고 지움
+3. 지워서 생긴 빈 페이지를 incremental vacuum으로 VACUUM_STEP_PAGES씩 조금씩 돌려줘 파일 크기를 줄임
+을 함. 지우기는 DELETE_CHUNK_ROWS줄씩 나눠 해서 MeasurementWriter의 저장을 오래 막지 않음.
+
+열 파일은 np.savez_compressed로 만든 npz 파일이며 열마다 배열 하나씩 들어 있음
+- devices : 스마트팜 이름들 (정렬됨), device : 줄마다 devices에서의 번호 (uint16)
+- timestamp : epoch 밀리초 (int64)
+- temperature, humidity, water_level : float64 (값이 없으면 nan)
+- led_first_state, led_second_state, heater_state, pump_state : int8 (1 'ON', 0 'OFF', -1 값 없음)
+  액추에이터 상태가 measurements에 함께 저장되던 때 만든 파일에만 있음. 지금은 상태 변화 로그(actuators.py)에 따로 남음
+옮긴 측정값은 iter_archived_rows()로 /api/measurements에서 datas.db의 측정값과 이어서 읽을 수 있음.
+"""
+
+import glob
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import log
+import metrics
+from ingest import connect_database, list_devices
+from ringbuffer import TIMESTAMP_FORMAT, timestamp_to_ms
+from rollups import ROLLUP_RESOLUTIONS
+
+LOG = log.get_logger("retention")
+
+# raw 측정값을 datas.db에 남겨둘 기간(일)과 1분 집계를 남겨둘 기간(일)
+RAW_RETENTION_DAYS = float(os.environ.get("SMARTFARM_RAW_RETENTION_DAYS", 90))
+ROLLUP_RETENTION_DAYS = {"1m": float(os.environ.get("SMARTFARM_1M_RETENTION_DAYS", 365))}
+# 정리를 하는 주기(초)와, 서버가 켜진 뒤 첫 정리까지 기다리는 시간(초)
+RETENTION_INTERVAL = float(os.environ.get("SMARTFARM_RETENTION_INTERVAL", 6 * 3600))
+RETENTION_START_DELAY = 60.0
+
+ARCHIVE_DIR = "./measurement_archive"
+
+# 한 트랜잭션에서 지울 최대 줄 수와, incremental vacuum 한 번에 돌려줄 페이지 수. 사이사이 PAUSE초씩 쉼
+DELETE_CHUNK_ROWS = 5000
+VACUUM_STEP_PAGES = 256
+STEP_PAUSE = 0.2
+
+VALUE_COLUMNS = ("temperature", "humidity", "water_level")
+STATE_COLUMNS = ("led_first_state", "led_second_state", "heater_state", "pump_state")
+_STATE_NAMES = {1: "ON", 0: "OFF"}
+
+ARCHIVED_ROWS = metrics.counter("smartfarm_retention_archived_rows_total", "열 파일로 옮기고 datas.db에서 지운 raw 측정값 줄 수")
+PRUNED_ROWS = metrics.counter("smartfarm_retention_pruned_rows_total", "보관 기간이 지나 지운 집계 줄 수", ["table"])
+RUN_SECONDS = metrics.histogram("smartfarm_retention_run_seconds", "정리 한 번에 걸린 시간")
+
+
+def archive_path(archive_dir, month):
+    """month("YYYY-MM")의 열 파일 경로"""
+    return os.path.join(archive_dir, f"measurements-{month}.npz")
+
+
+def rows_to_columns(rows):
+    """
+    (device_id, timestamp_ms, temperature, humidity, water_level) 줄들을 열 파일에 넣을 배열 dict로 바꿈
+    """
+    devices = sorted({row[0] for row in rows})
+    device_codes = {device_id: i for i, device_id in enumerate(devices)}
+    columns = {
+        "devices": np.array(devices, dtype=str),
+        "device": np.array([device_codes[row[0]] for row in rows], dtype=np.uint16),
+        "timestamp": np.array([row[1] for row in rows], dtype=np.int64),
+    }
+    for i, name in enumerate(VALUE_COLUMNS, start=2):
+        columns[name] = np.array([np.nan if row[i] is None else row[i] for row in rows], dtype=np.float64)
+    return columns
+
+
+def load_columns(path):
+    """열 파일을 읽어 배열 dict로 반환함"""
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def merge_columns(old, new):
+    """
+    같은 달의 두 열 dict를 합쳐 (시각, 스마트팜) 순으로 정렬한 dict를 반환함.
+    같은 (스마트팜, 시각)이 두 번 있으면 new의 값을 씀 (지우기 전에 꺼졌다가 다시 옮기는 경우)
+    한쪽에만 있는 상태 열(예전 파일)은 다른 쪽을 -1(값 없음)로 채워 합침
+
+    스마트팜 번호는 합친 devices에서의 번호로 바뀜 ("farm"은 old에서 0번이었다가 1번이 됨)
+    >>> old = rows_to_columns([("farm", 1000, 20.0, None, 3.0), ("farm", 2000, 21.0, None, 3.0)])
+    >>> new = rows_to_columns([("annex", 1000, 18.0, None, 2.0), ("farm", 2000, 22.0, None, 3.0)])
+    >>> merged = merge_columns(old, new)
+    >>> merged["devices"].tolist(), merged["device"].tolist(), merged["timestamp"].tolist(), merged["temperature"].tolist()
+    (['annex', 'farm'], [0, 1, 1], [1000, 1000, 2000], [18.0, 20.0, 22.0])
+    """
+    for name in STATE_COLUMNS:
+        if (name in old) != (name in new):
+            missing = new if name in old else old
+            missing[name] = np.full(len(missing["timestamp"]), -1, dtype=np.int8)
+    devices = sorted(set(old["devices"].tolist()) | set(new["devices"].tolist()))
+    remap = {name: i for i, name in enumerate(devices)}
+    parts = []
+    for columns in (new, old):
+        codes = np.array([remap[name] for name in columns["devices"].tolist()], dtype=np.uint16)
+        part = dict(columns)
+        part["device"] = codes[columns["device"]]
+        parts.append(part)
+    merged = {name: np.concatenate([part[name] for part in parts]) for name in parts[0] if name != "devices"}
+    # np.unique는 처음 나온 것을 남기므로 new를 앞에 두고 중복을 버림
+    keys = merged["timestamp"] * len(devices) + merged["device"]
+    _, first = np.unique(keys, return_index=True)
+    merged = {name: values[first] for name, values in merged.items()}
+    merged["devices"] = np.array(devices, dtype=str)
+    return merged
+
+
+def write_columns(path, columns):
+    """열 dict를 압축 npz로 씀. 다 쓴 임시 파일을 os.replace로 바꿔 넣기 때문에 중간에 꺼져도 예전 파일이 남음"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _archive_months(archive_dir, start, end):
+    """[start, end] (TIMESTAMP_FORMAT 문자열, None이면 제한 없음) 기간과 겹치는 열 파일들을 달 순서로 반환함"""
+    paths = sorted(glob.glob(os.path.join(archive_dir, "measurements-*.npz")))
+    first = None if start is None else start[:7].replace(".", "-")
+    last = None if end is None else end[:7].replace(".", "-")
+    selected = []
+    for path in paths:
+        month = os.path.basename(path)[len("measurements-") : -len(".npz")]
+        if (first is None or month >= first) and (last is None or month <= last):
+            selected.append(path)
+    return selected
+
+
+def iter_archived_rows(archive_dir, columns, start=None, end=None, device_id=None, chunk_size=500):
+    """
+    열 파일들에 옮겨둔 raw 측정값을 history.iter_rows()와 같은 모양의 chunk(list)로 내보내는 generator.
+    - columns(list[str]) : history.build_query()가 돌려준 열 이름들 ("timestamp"(, "device_id"), 열들...)
+    - start, end(str) : TIMESTAMP_FORMAT 형식의 시작(포함), 끝(포함) 시각. None이면 제한 없음
+    - device_id(str) : 이 스마트팜의 측정값만. None이면 모든 스마트팜 (columns에 device_id가 있어야 함)
+    상태 열이 없는 파일의 액추에이터 상태는 None으로 내보냄 (history.fill_actuator_states()가 채움)
+    """
+    fields = [column for column in columns if column not in ("timestamp", "device_id")]
+    start_ms = None if start is None else timestamp_to_ms(start)
+    end_ms = None if end is None else timestamp_to_ms(end) + 999
+    for path in _archive_months(archive_dir, start, end):
+        data = load_columns(path)
+        devices = data["devices"].tolist()
+        mask = np.ones(len(data["timestamp"]), dtype=bool)
+        if start_ms is not None:
+            mask &= data["timestamp"] >= start_ms
+        if end_ms is not None:
+            mask &= data["timestamp"] <= end_ms
+        if device_id is not None:
+            if device_id not in devices:
+                continue
+            mask &= data["device"] == devices.index(device_id)
+        selected = np.flatnonzero(mask)
+        for offset in range(0, len(selected), chunk_size):
+            index = selected[offset : offset + chunk_size]
+            output = [data["timestamp"][index].tolist()]
+            if device_id is None:
+                output.append([devices[code] for code in data["device"][index].tolist()])
+            for field in fields:
+                if field in STATE_COLUMNS:
+                    if field not in data:
+                        output.append([None] * len(index))
+                        continue
+                    output.append([_STATE_NAMES.get(code) for code in data[field][index].tolist()])
+                else:
+                    output.append([None if np.isnan(value) else value for value in data[field][index].tolist()])
+            yield list(zip(*output))
+
+
+def _months(first_ms, upper_ms):
+    """first_ms(epoch 밀리초)가 든 달부터 upper_ms 전까지를 달마다 ("YYYY-MM", 시작, 끝) (서버의 지역 시각 기준, 끝은 빼고)로 나눔"""
+    month_start = datetime.fromtimestamp(first_ms // 1000).replace(day=1, hour=0, minute=0, second=0)
+    while month_start.timestamp() * 1000 < upper_ms:
+        month_end = (month_start + timedelta(days=32)).replace(day=1)
+        yield month_start.strftime("%Y-%m"), int(month_start.timestamp() * 1000), min(int(month_end.timestamp() * 1000), upper_ms)
+        month_start = month_end
+
+
+class RetentionManager:
+    """
+    datas.db의 오래된 측정값을 열 파일로 옮기고 지운 뒤 빈 공간을 돌려주는 백그라운드 스레드.
+    - db_path(str) : datas.db 경로
+    - archive_dir(str) : 열 파일들을 둘 폴더
+    - raw_retention_days(float) : raw 측정값을 datas.db에 남겨둘 기간(일)
+    - rollup_retention_days(dict) : 집계 해상도 -> 남겨둘 기간(일). 없는 해상도는 지우지 않음
+    - interval(float) : 정리 주기(초)
+    - segment_log(segments.SegmentLog) : raw 측정값을 segment 파일에 저장하고 있으면 그 저장소. None이면 datas.db만 정리함
+    """
+
+    def __init__(
+        self,
+        db_path,
+        archive_dir=ARCHIVE_DIR,
+        raw_retention_days=RAW_RETENTION_DAYS,
+        rollup_retention_days=None,
+        interval=RETENTION_INTERVAL,
+        segment_log=None,
+    ):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.raw_retention_days = raw_retention_days
+        self.rollup_retention_days = ROLLUP_RETENTION_DAYS if rollup_retention_days is None else rollup_retention_days
+        self.interval = interval
+        self.segment_log = segment_log
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # 지표들
+        self.run_count = 0
+        self.archived_count = 0
+        self.pruned_count = 0
+        self.vacuumed_pages = 0
+        self.last_run_seconds = None
+        self.freelist_pages = None
+
+    def start(self, delay=RETENTION_START_DELAY):
+        self._thread = threading.Thread(target=self._run, args=(delay,), name="RetentionManager", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_stats(self) -> dict:
+        archive_files = glob.glob(os.path.join(self.archive_dir, "measurements-*.npz"))
+        return {
+            "runs": self.run_count,
+            "archived": self.archived_count,
+            "pruned": self.pruned_count,
+            "vacuumed_pages": self.vacuumed_pages,
+            "freelist_pages": self.freelist_pages,
+            "last_run_seconds": self.last_run_seconds,
+            "db_bytes": os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0,
+            "archive_files": len(archive_files),
+            "archive_bytes": sum(os.path.getsize(path) for path in archive_files),
+        }
+
+    def _run(self, delay):
+        """정리 스레드용 함수. 서버가 켜지고 delay초 뒤부터 interval마다 run_once()를 부름"""
+        if self._stopped.wait(delay):
+            return
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                LOG.error("run_failed", "오래된 측정값을 정리하는 중 오류가 발생했습니다!", error=e)
+            if self._stopped.wait(self.interval):
+                return
+
+    def run_once(self, now=None):
+        """
+        정리를 한 번 함 (열 파일로 옮기기 -> 집계 지우기 -> 빈 공간 돌려주기).
+        - now(datetime) : 기준 시각. 주어지지 않으면 현재 시각
+        """
+        if now is None:
+            now = datetime.now()
+        start = time.monotonic()
+        # 정리는 MeasurementWriter와 다른 커넥션으로 하므로 저장과 잠금이 겹치면 오래 기다릴 수 있게 함
+        con = connect_database(self.db_path, timeout=60.0)
+        try:
+            cutoff = int((now - timedelta(days=self.raw_retention_days)).timestamp() * 1000)
+            archived = self.archive_expired(con, cutoff)
+            if self.segment_log is not None:
+                archived += self.archive_segments(cutoff)
+            pruned = self.prune_rollups(con, now)
+            vacuumed = self.vacuum(con)
+        finally:
+            con.close()
+        elapsed = time.monotonic() - start
+        RUN_SECONDS.observe(elapsed)
+        self.run_count += 1
+        self.last_run_seconds = elapsed
+        if archived or pruned or vacuumed:
+            LOG.info(
+                "run",
+                "오래된 측정값을 정리했습니다.",
+                archived=archived,
+                pruned=pruned,
+                vacuumed_pages=vacuumed,
+                seconds=round(elapsed, 2),
+            )
+
+    def archive_expired(self, con, cutoff) -> int:
+        """
+        cutoff(epoch 밀리초)보다 오래된 raw 측정값을 스마트팜마다, 달마다 열 파일로 옮기고 datas.db에서 지움. 옮긴 줄 수를 반환함.
+        measurements의 키가 (device_id, timestamp_ms)이므로 스마트팜을 정해서 읽고 지워야 키를 찾아 이어 읽기만 함
+        """
+        total = 0
+        for device_id in list_devices(con):
+            oldest = con.execute("SELECT min(timestamp_ms) FROM measurements WHERE device_id = ?;", (device_id,)).fetchone()[0]
+            for month, lower, upper in _months(oldest, cutoff):
+                if self._stopped.is_set():
+                    break
+                total += self._archive_range(con, device_id, month, lower, upper)
+        return total
+
+    def archive_segments(self, cutoff) -> int:
+        """
+        마지막 측정값이 cutoff(epoch 밀리초)보다 오래된 segment 파일들을 달마다 열 파일로 옮기고 지움. 옮긴 줄 수를 반환함.
+        segment 안은 시각 순서이므로 달의 경계는 이진 탐색으로 찾음
+        """
+        total = 0
+        for device_id in self.segment_log.devices():
+            for segment in self.segment_log.expired(device_id, cutoff):
+                if self._stopped.is_set():
+                    return total
+                self._archive_segment(device_id, segment)
+                # 열 파일에 다 쓴 다음에 지우므로, 그 사이에 꺼지면 다음 정리 때 같은 segment를 다시 옮김 (merge_columns가 중복을 버림)
+                self.segment_log.remove(device_id, segment)
+                ARCHIVED_ROWS.inc(segment.count)
+                self.archived_count += segment.count
+                total += segment.count
+                LOG.info("archived_segment", "오래된 segment를 열 파일로 옮겼습니다.", device=device_id, rows=segment.count, path=segment.path)
+        return total
+
+    def _archive_range(self, con, device_id, month, lower, upper) -> int:
+        """한 스마트팜의 [lower, upper) 측정값을 month("YYYY-MM")의 열 파일로 옮기고 지움"""
+        condition = "device_id = ? AND timestamp_ms >= ? AND timestamp_ms < ?"
+        params = (device_id, lower, upper)
+        rows = con.execute(
+            "SELECT device_id, timestamp_ms, temperature, humidity, water_level "
+            f"FROM measurements WHERE {condition} ORDER BY timestamp_ms;",
+            params,
+        ).fetchall()
+        if not rows:
+            return 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = archive_path(self.archive_dir, month)
+        columns = rows_to_columns(rows)
+        if os.path.exists(path):
+            columns = merge_columns(load_columns(path), columns)
+        # 파일에 다 쓴 다음에 지우므로, 그 사이에 꺼지면 다음 정리 때 같은 줄을 다시 옮김 (merge_columns가 중복을 버림)
+        write_columns(path, columns)
+        deleted = self._delete_chunked(con, "measurements", condition, params, key="timestamp_ms")
+        ARCHIVED_ROWS.inc(deleted)
+        self.archived_count += deleted
+        LOG.info("archived", "오래된 측정값을 열 파일로 옮겼습니다.", device=device_id, month=month, rows=deleted, path=path)
+        return deleted
+
+    def _archive_segment(self, device_id, segment):
+        """segment 하나의 레코드들을 달마다 열 파일에 합쳐 씀"""
+        records = segment.view()
+        timestamps = records["timestamp_ms"]
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for month, lower, upper in _months(segment.first_ms, segment.last_ms + 1):
+            part = records[np.searchsorted(timestamps, lower) : np.searchsorted(timestamps, upper)]
+            if not len(part):
+                continue
+            path = archive_path(self.archive_dir, month)
+            columns = {
+                "devices": np.array([device_id], dtype=str),
+                "device": np.zeros(len(part), dtype=np.uint16),
+                "timestamp": part["timestamp_ms"].copy(),
+            }
+            for name in VALUE_COLUMNS:
+                columns[name] = part[name].copy()
+            if os.path.exists(path):
+                columns = merge_columns(load_columns(path), columns)
+            write_columns(path, columns)
+
+    def prune_rollups(self, con, now) -> int:
+        """보관 기간이 지난 집계 구간을 지움. 지운 줄 수를 반환함"""
+        total = 0
+        for resolution, days in self.rollup_retention_days.items():
+            table = ROLLUP_RESOLUTIONS[resolution][0]
+            cutoff = (now - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+            deleted = self._delete_chunked(con, table, "bucket < ?", (cutoff,))
+            PRUNED_ROWS.labels(table).inc(deleted)
+            total += deleted
+        self.pruned_count += total
+        return total
+
+    def _delete_chunked(self, con, table, condition, params, key="rowid") -> int:
+        """
+        condition에 맞는 줄들을 DELETE_CHUNK_ROWS줄씩 나눈 트랜잭션으로 지움.
+        - key : condition 안에서 줄을 하나로 정하는 열 (rowid가 없는 WITHOUT ROWID 테이블은 키 열을 줌)
+        """
+        total = 0
+        query = f"DELETE FROM {table} WHERE {condition} AND {key} IN (SELECT {key} FROM {table} WHERE {condition} LIMIT ?);"
+        while not self._stopped.is_set():
+            with con:
+                deleted = con.execute(query, (*params, *params, DELETE_CHUNK_ROWS)).rowcount
+            total += deleted
+            if deleted < DELETE_CHUNK_ROWS:
+                break
+            time.sleep(STEP_PAUSE)
+        return total
+
+    def vacuum(self, con) -> int:
+        """
+        빈 페이지들을 VACUUM_STEP_PAGES씩 파일에서 돌려줌. 돌려준 페이지 수를 반환함.
+        auto_vacuum이 INCREMENTAL이 아닌 예전 datas.db는 건너뜀. 바꾸는 전체 VACUUM은 파일 전체를 다시 쓰는 동안
+        datas.db를 잠가 측정값 저장을 막으므로, 서버를 끈 채로 migrate.py가 함
+        """
+        if con.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            LOG.warning(
+                "vacuum_skipped",
+                "예전 datas.db라 지운 공간을 돌려줄 수 없습니다. 서버를 끈 채로 `python migrate.py`를 한 번 실행하세요.",
+                every=24 * 3600,
+            )
+            self.freelist_pages = con.execute("PRAGMA freelist_count;").fetchone()[0]
+            return 0
+        total = 0
+        while not self._stopped.is_set():
+            free = con.execute("PRAGMA freelist_count;").fetchone()[0]
+            if free == 0:
+                break
+            # execute()로 부르면 sqlite3_step을 한 번만 불러 한 페이지만 돌려주므로 끝까지 실행하는 executescript()를 씀
+            con.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+            total += free - con.execute("PRAGMA freelist_count;").fetchone()[0]
+            time.sleep(STEP_PAUSE)
+        if total:
+            # 옮겨진 페이지들이 WAL 파일에 남아 있으므로 datas.db에 반영하고 WAL 파일도 비움
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+        self.freelist_pages = con.execute("PRAGMA freelist_count;").fetchone()[0]
+        self.vacuumed_pages += total
+        return total
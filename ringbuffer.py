@@ -0,0 +1,175 @@
+"""
+최근 측정값들을 메모리에 들고 있는 고정 크기 NumPy 링 버퍼.
+
+/stats, /control 같은 페이지는 최근 몇 개의 측정값만 필요하기 때문에 매번 sqlite를 열어 테이블 전체를 정렬하는 대신
+이 버퍼에서 바로 읽음. 측정 루프(FlaskAppWrapper.record_measurement)가 값을 넣고, 서버가 켜질 때 저장소(storage.py)의 최근 값들로 채워 둠.
+- 시각 : int64 (epoch 밀리초)
+- 센서값 : float32 (온도, 습도, 수위)
+- 액추에이터 상태 : uint8 비트마스크 (STATE_BITS 참고)
+"""
+
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import log
+
+LOG = log.get_logger("ringbuffer")
+
+TIMESTAMP_FORMAT = "%Y.%m.%d %H:%M:%S"
+
+CHANNELS = ("temperature", "humidity", "water_level")
+# 액추에이터 이름 -> 비트마스크에서의 비트 값
+STATE_BITS = {
+    "led_first_state": 1 << 0,
+    "led_second_state": 1 << 1,
+    "heater_state": 1 << 2,
+    "pump_state": 1 << 3,
+}
+
+
+def timestamp_to_ms(timestamp_str):
+    """"%Y.%m.%d %H:%M:%S" 형식의 시각 문자열을 epoch 밀리초로 바꿈"""
+    return int(datetime.strptime(timestamp_str, TIMESTAMP_FORMAT).timestamp() * 1000)
+
+
+def ms_to_timestamp(ms):
+    """epoch 밀리초를 "%Y.%m.%d %H:%M:%S" 형식의 시각 문자열로 바꿈"""
+    return datetime.fromtimestamp(ms / 1000).strftime(TIMESTAMP_FORMAT)
+
+
+def ms_to_timestamps(ms):
+    """
+    epoch 밀리초 배열을 "%Y.%m.%d %H:%M:%S" 형식의 시각 문자열 list로 바꿈 (ms_to_timestamp()와 같은 값).
+    배열이 일주일 안이고 처음과 끝의 지역 시간대(UTC와의 차이)가 같으면 (서머타임이 바뀌지 않았으면) NumPy datetime64로 한번에 바꿈
+    """
+    seconds = np.asarray(ms, dtype=np.int64) // 1000
+    if not len(seconds):
+        return []
+    offset = time.localtime(int(seconds[0])).tm_gmtoff
+    if seconds[-1] - seconds[0] > 7 * 86400 or time.localtime(int(seconds[-1])).tm_gmtoff != offset:
+        return [ms_to_timestamp(value) for value in np.asarray(ms).tolist()]
+    iso = np.datetime_as_string((seconds + offset).astype("datetime64[s]")).tolist()
+    return [f"{s[:4]}.{s[5:7]}.{s[8:10]} {s[11:]}" for s in iso]
+
+
+def encode_states(states):
+    """{'led_first_state': 'ON', ...} 형태의 상태 dict를 비트마스크로 바꿈"""
+    mask = 0
+    for name, bit in STATE_BITS.items():
+        if states.get(name) == "ON":
+            mask |= bit
+    return mask
+
+
+def encode_state_arrays(states):
+    """{'led_first_state': int8[] (1 켜짐, 0 꺼짐, -1 모름), ...} 형태의 상태 배열 dict를 비트마스크 배열로 바꿈"""
+    masks = None
+    for name, bit in STATE_BITS.items():
+        values = np.asarray(states[name])
+        if masks is None:
+            masks = np.zeros(len(values), dtype=np.uint8)
+        masks |= np.where(values == 1, bit, 0).astype(np.uint8)
+    return masks
+
+
+def decode_states(mask):
+    """비트마스크를 {'led_first_state': 'ON'/'OFF', ...} 형태의 dict로 바꿈"""
+    return {name: "ON" if int(mask) & bit else "OFF" for name, bit in STATE_BITS.items()}
+
+
+class SampleRingBuffer:
+    """
+    최근 capacity개의 측정값을 담는 링 버퍼. 가득 차면 가장 오래된 값부터 덮어씀.
+    - capacity(int) : 담아둘 측정값 개수
+    """
+
+    def __init__(self, capacity=2880):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((capacity, len(CHANNELS)), dtype=np.float32)
+        self.states = np.zeros(capacity, dtype=np.uint8)
+        self.count = 0  # 지금까지 넣은 전체 개수 (다음에 쓸 칸 = count % capacity)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp_ms, temperature, humidity, water_level, state_mask):
+        """측정값 하나를 넣음"""
+        with self._lock:
+            i = self.count % self.capacity
+            self.timestamps[i] = timestamp_ms
+            self.values[i] = (temperature, humidity, water_level)
+            self.states[i] = state_mask
+            self.count += 1
+
+    def append_row(self, row, states=None):
+        """
+        ingest.MEASUREMENT_COLUMNS 순서의 tuple (timestamp_ms, 온도, 습도, 수위, ...)을 넣음
+        - states(dict) : 그 시각의 액추에이터 상태 {'led_first_state': 'ON', ...}. None이면 모두 꺼진 것으로 넣음
+        """
+        # 저장된 값이 NULL이면 nan으로 넣음
+        temperature, humidity, water_level = (np.nan if value is None else value for value in row[1:4])
+        self.append(row[0], temperature, humidity, water_level, encode_states(states or {}))
+
+    def latest(self, n):
+        """
+        가장 최근 n개(혹은 그보다 적게 들어있으면 전부)를 오래된 것부터 순서대로 반환함.
+        -> return (timestamps int64[n], values float32[n, 3], states uint8[n]) (fancy indexing이라 모두 복사본임)
+        """
+        with self._lock:
+            n = min(n, len(self))
+            end = self.count % self.capacity
+            index = (np.arange(end - n, end)) % self.capacity
+            return self.timestamps[index], self.values[index], self.states[index]
+
+    def warm(self, timestamps, values, state_lookup=None, source="datas.db", device_id=None):
+        """
+        오래된 것부터 순서대로인 측정값들로 버퍼를 채움. 서버가 켜질 때 한번 호출함
+        - timestamps : 시각 배열 (epoch 밀리초), values : (온도, 습도, 수위) 배열 [n, 3] (값이 없으면 nan)
+        - state_lookup : 시각 배열(epoch 밀리초)을 받아 그 시각들의 상태 배열 dict를 돌려주는 함수
+          (예: partial(actuator_log.states_at, device_id)). None이면 상태는 모두 꺼진 것으로 넣음
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if state_lookup is None or not len(timestamps):
+            masks = np.zeros(len(timestamps), dtype=np.uint8)
+        else:
+            masks = encode_state_arrays(state_lookup(timestamps))
+        for timestamp_ms, (temperature, humidity, water_level), mask in zip(
+            timestamps.tolist(), np.asarray(values, dtype=np.float64).tolist(), masks.tolist()
+        ):
+            self.append(timestamp_ms, temperature, humidity, water_level, mask)
+        LOG.info("warm", "최근 측정값을 불러왔습니다.", source=source, device=device_id, rows=len(timestamps))
+
+    def warm_from_db(self, db_path, n=None, device_id=None, state_lookup=None):
+        """
+        datas.db의 최근 n개(기본값 capacity개) 측정값으로 버퍼를 채움 (warm() 참고)
+        - device_id(str) : 이 스마트팜의 측정값만 불러옴. None이면 스마트팜을 가리지 않음
+        """
+        timestamps, values = load_latest(db_path, self.capacity if n is None else n, device_id)
+        self.warm(timestamps, values, state_lookup, device_id=device_id)
+
+
+def load_latest(db_path, n, device_id=None):
+    """
+    datas.db measurements의 최근 n개 측정값을 오래된 것부터 순서대로 읽음
+    -> return (timestamps int64[n], values float64[n, 3]) (값이 없으면 nan)
+    """
+    where, params = ("", (n,)) if device_id is None else (" WHERE device_id = ?", (device_id, n))
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute(
+            "SELECT timestamp_ms, temperature, humidity, water_level "
+            f"FROM measurements{where} ORDER BY timestamp_ms DESC LIMIT ?;",
+            params,
+        ).fetchall()
+    finally:
+        con.close()
+    rows.reverse()
+    timestamps = np.array([row[0] for row in rows], dtype=np.int64)
+    values = np.array([row[1:4] for row in rows], dtype=np.float64).reshape(len(rows), len(CHANNELS))
+    return timestamps, values
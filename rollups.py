@@ -0,0 +1,150 @@
+"""
+measurements 테이블의 1분 / 1시간 / 1일 단위 집계 테이블(rollup)을 관리하는 모듈.
+
+MeasurementWriter가 측정값을 저장할 때 같은 트랜잭션 안에서 apply_rollups()를 불러
+각 집계 테이블의 해당 구간(bucket) 한 줄을 UPSERT로 갱신함. 따라서 집계는 측정값이 들어올 때마다 조금씩 갱신되고,
+따로 전체를 다시 계산하는 배치 작업은 필요 없음.
+
+집계 테이블 한 줄의 구조 (스마트팜(device_id)마다 따로 집계함)
+- device_id : 스마트팜 이름
+- bucket : 구간 시작 시각 (서버의 지역 시각 "%Y.%m.%d %H:%M:%S" 형식 문자열)
+- sample_count : 구간에 들어온 측정값 개수
+- (temperature/humidity/water_level)_min, _max, _sum : 센서값의 최소, 최대, 합 (평균 = _sum / sample_count)
+
+액추에이터가 켜져 있던 비율은 측정값 개수로 세지 않고 상태 변화 로그(actuators.py)에서 시간으로 계산함.
+예전에 만든 집계 테이블에 남아있는 (led_first/led_second/heater/pump)_on 열은 더 이상 갱신하지 않음
+"""
+
+from datetime import datetime
+
+import log
+
+LOG = log.get_logger("rollups")
+
+
+def _bucket_function(fmt):
+    return lambda timestamp_ms: datetime.fromtimestamp(timestamp_ms // 1000).strftime(fmt)
+
+
+# 해상도 이름 -> (테이블 이름, 구간 길이(초), measurements.timestamp_ms를 구간 시작 시각 문자열로 바꾸는 함수)
+ROLLUP_RESOLUTIONS = {
+    "1m": ("measurements_1m", 60, _bucket_function("%Y.%m.%d %H:%M:00")),
+    "1h": ("measurements_1h", 3600, _bucket_function("%Y.%m.%d %H:00:00")),
+    "1d": ("measurements_1d", 86400, _bucket_function("%Y.%m.%d 00:00:00")),
+}
+
+VALUE_CHANNELS = ("temperature", "humidity", "water_level")
+STATE_CHANNELS = ("led_first", "led_second", "heater", "pump")
+
+_ROLLUP_COLUMNS = ["device_id", "bucket", "sample_count"] + [
+    f"{ch}_{agg}" for ch in VALUE_CHANNELS for agg in ("min", "max", "sum")
+]
+
+
+def _create_table_query(table):
+    value_columns = ",\n".join(f"{ch}_{agg} REAL" for ch in VALUE_CHANNELS for agg in ("min", "max", "sum"))
+    return f"""CREATE TABLE IF NOT EXISTS {table}(
+                device_id TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                sample_count INTEGER NOT NULL,
+                {value_columns},
+                PRIMARY KEY (device_id, bucket));"""
+
+
+def _upsert_query(table):
+    updates = ["sample_count = sample_count + excluded.sample_count"]
+    for ch in VALUE_CHANNELS:
+        # 한쪽이 NULL이면 sqlite의 min()/max()가 NULL을 돌려주므로 coalesce로 감쌈
+        updates.append(f"{ch}_min = min(coalesce({ch}_min, excluded.{ch}_min), coalesce(excluded.{ch}_min, {ch}_min))")
+        updates.append(f"{ch}_max = max(coalesce({ch}_max, excluded.{ch}_max), coalesce(excluded.{ch}_max, {ch}_max))")
+        updates.append(f"{ch}_sum = coalesce({ch}_sum, 0) + coalesce(excluded.{ch}_sum, 0)")
+    return (
+        f"INSERT INTO {table} ({', '.join(_ROLLUP_COLUMNS)}) "
+        f"VALUES ({', '.join('?' for _ in _ROLLUP_COLUMNS)}) "
+        f"ON CONFLICT(device_id, bucket) DO UPDATE SET {', '.join(updates)};"
+    )
+
+
+def _backfill_query(table, bucket_expr):
+    value_aggs = ", ".join(
+        f"min({ch}), max({ch}), sum({ch})" for ch in VALUE_CHANNELS
+    )
+    return (
+        f"INSERT INTO {table} ({', '.join(_ROLLUP_COLUMNS)}) "
+        f"SELECT device_id, {bucket_expr} AS bucket, count(*), {value_aggs} "
+        f"FROM measurements GROUP BY device_id, bucket;"
+    )
+
+
+# 이미 저장되어 있는 raw 측정값으로 집계 테이블을 처음 채울 때 쓰는 구간 계산식 (ROLLUP_RESOLUTIONS의 함수와 같은 동작)
+_BUCKET_SQL = {
+    "1m": "strftime('%Y.%m.%d %H:%M:00', timestamp_ms / 1000, 'unixepoch', 'localtime')",
+    "1h": "strftime('%Y.%m.%d %H:00:00', timestamp_ms / 1000, 'unixepoch', 'localtime')",
+    "1d": "strftime('%Y.%m.%d 00:00:00', timestamp_ms / 1000, 'unixepoch', 'localtime')",
+}
+
+_UPSERT_QUERIES = {resolution: _upsert_query(table) for resolution, (table, _, _) in ROLLUP_RESOLUTIONS.items()}
+
+
+def create_rollup_tables(con):
+    """
+    집계 테이블들이 없으면 만듬. 새로 만든 테이블은 measurements에 이미 있던 측정값으로 한번 채움.
+    device_id 열이 없는 예전 집계 테이블은 raw 측정값으로 다시 만들 수 있으므로 지우고 새로 만듬.
+    - con : datas.db sqlite 커넥션
+    """
+    with con:
+        for resolution, (table, _, _) in ROLLUP_RESOLUTIONS.items():
+            columns = [row[1] for row in con.execute(f"PRAGMA table_info({table});")]
+            if "device_id" in columns:
+                continue
+            if columns:
+                LOG.info("recreate_table", "집계 테이블에 device_id 열이 없어 다시 만듭니다.", table=table)
+                con.execute(f"DROP TABLE {table};")
+            LOG.info("create_table", "집계 테이블을 만들고 기존 측정값으로 채웁니다.", table=table)
+            con.execute(_create_table_query(table))
+            con.execute(_backfill_query(table, _BUCKET_SQL[resolution]))
+
+
+def _aggregate(rows, bucket_of):
+    """rows를 구간별로 묶어 집계 테이블에 넣을 값 list를 만듬"""
+    buckets = {}
+    for row in rows:
+        timestamp_ms, temperature, humidity, water_level, device_id = row
+        key = (device_id, bucket_of(timestamp_ms))
+        agg = buckets.get(key)
+        if agg is None:
+            # [sample_count, (min, max, sum) * 3]
+            agg = buckets[key] = [0, None, None, None, None, None, None, None, None, None]
+        agg[0] += 1
+        for i, value in enumerate((temperature, humidity, water_level)):
+            if value is None:
+                continue
+            base = 1 + i * 3
+            agg[base] = value if agg[base] is None else min(agg[base], value)
+            agg[base + 1] = value if agg[base + 1] is None else max(agg[base + 1], value)
+            agg[base + 2] = value if agg[base + 2] is None else agg[base + 2] + value
+    return [(*key, *agg) for key, agg in buckets.items()]
+
+
+def apply_rollups(con, rows):
+    """
+    새로 저장되는 측정값들 rows를 각 해상도의 집계 테이블에 더함. 호출하는 쪽의 트랜잭션 안에서 실행해야 함.
+    - rows : ingest.MEASUREMENT_COLUMNS 순서의 tuple들
+    """
+    for resolution, (_, _, bucket_of) in ROLLUP_RESOLUTIONS.items():
+        con.executemany(_UPSERT_QUERIES[resolution], _aggregate(rows, bucket_of))
+
+
+def rollup_select_columns():
+    """
+    집계 테이블에서 구간별 평균, 최소, 최대, 켜져있던 비율을 읽을 때 쓸 SELECT 식들을
+    (열 이름, SQL 식) list로 반환함. 켜져있던 비율은 NULL로 읽고 history.fill_actuator_states()가 채움
+    """
+    columns = [("bucket", "bucket"), ("sample_count", "sample_count")]
+    for ch in VALUE_CHANNELS:
+        columns.append((ch, f"{ch}_sum / sample_count"))
+        columns.append((f"{ch}_min", f"{ch}_min"))
+        columns.append((f"{ch}_max", f"{ch}_max"))
+    for ch in STATE_CHANNELS:
+        columns.append((f"{ch}_on_fraction", "NULL"))
+    return columns
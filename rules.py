@@ -0,0 +1,570 @@
+"""
+측정값이 들어올 때마다 규칙(rule)들을 검사해 경보(alert)를 내는 스트리밍 규칙 엔진.
+
+히터와 전등 조절(control.py) 말고는 측정값을 보고 반응하는 것이 없어, 물통이 거의 비었거나 습도가 너무 높거나
+히터를 켰는데도 온도가 계속 떨어지는 것을 아무도 알아채지 못했음. RuleEngine은
+- 규칙 파일(환경변수 SMARTFARM_RULES_CONFIG, 기본값 ./rules.json. 없으면 DEFAULT_RULES)의 조건 문자열들을 켜질 때 한 번만
+  해석(compile)해 함수로 만들어 두고
+- 측정 루프가 submit()으로 넘긴 측정값을 큐에 넣기만 하면, 규칙 스레드가 꺼내 스마트팜마다의 sliding window
+  (최근 N분의 min/max/mean/slope)를 갱신하고 그 측정값을 쓰는 규칙들만 다시 검사함.
+  window 갱신은 누적 합과 단조(monotonic) deque로 하므로 window 안의 측정값 수와 관계없이 측정값 하나에 O(1)(분할 상환)임
+- 조건이 for초 동안 계속 맞으면 경보를 내고(firing), 맞지 않게 되면 풀음(resolved). 경보는 datas.db의 alerts 테이블에 남기고
+  socket.io 'alert' 이벤트로 '<device_id>/alerts' 방에 보냄
+을 함. 큐가 가득 차면 측정 루프를 막지 않고 그 측정값을 버림.
+
+규칙 파일 (rules.example.json 참고)
+
+    {
+      "rules": [
+        {"name": "water_low", "when": ["water_level < 2"], "for": 10, "severity": "critical",
+         "message": "물통의 물이 거의 없습니다!"},
+        {"name": "heater_not_warming", "when": ["heater_state == 1", "slope(temperature, 15m) < -0.05"], "for": 300,
+         "devices": ["rack1"]}
+      ]
+    }
+
+when의 조건들은 모두 맞아야 하며(AND), 조건 하나는
+- "<측정값> <비교> <숫자>" : 가장 최근 값 (예: "humidity > 85", "heater_state == 1" - 상태는 켜짐 1, 꺼짐 0)
+- "<min|max|mean|slope>(<측정값>, <길이><s|m|h>) <비교> <숫자>" : 최근 길이 동안의 최솟값, 최댓값, 평균, 기울기(1분당 변화량)
+  window에 길이의 절반(MIN_WINDOW_COVERAGE)보다 짧은 기간의 측정값만 있으면 (켜진 직후) 그 조건은 맞지 않은 것으로 봄
+비교는 <, <=, >, >=, ==, != 중 하나. 측정값은 telemetry.FIELDS 중 하나 (temperature, humidity, water_level, ..._state)
+"""
+
+import json
+import operator
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+import log
+import metrics
+from ingest import connect_database
+from telemetry import FIELDS
+
+LOG = log.get_logger("rules")
+
+DEFAULT_RULES_CONFIG_PATH = "./rules.json"
+
+# 규칙 파일이 없을 때 쓰는 규칙들
+DEFAULT_RULES = [
+    {"name": "water_low", "when": ["water_level < 2"], "for": 10, "severity": "critical", "message": "물통의 물이 거의 없습니다!"},
+    {"name": "humidity_high", "when": ["mean(humidity, 10m) > 85"], "severity": "warning", "message": "습도가 너무 높습니다!"},
+    {
+        "name": "heater_not_warming",
+        "when": ["heater_state == 1", "slope(temperature, 15m) < -0.05"],
+        "for": 300,
+        "severity": "warning",
+        "message": "히터가 켜져 있는데도 온도가 계속 떨어집니다!",
+    },
+]
+
+SEVERITIES = ("info", "warning", "critical")
+ALERT_EVENT = "alert"
+
+# window에 길이의 이 비율보다 긴 기간의 측정값이 있어야 window 조건을 검사함
+MIN_WINDOW_COVERAGE = 0.5
+# window의 시각 기준점을 다시 잡는 주기 (window 길이의 배수). 누적 합의 반올림 오차가 쌓이지 않도록 이때 합을 새로 계산함
+REBASE_WINDOWS = 64
+# 규칙 스레드에 넘길 측정값을 쌓아둘 수 있는 최대 수
+QUEUE_SIZE = 4096
+
+RULE_SAMPLES = metrics.counter("smartfarm_rule_samples_total", "규칙 엔진이 검사한 측정값 수")
+RULE_EVAL_SECONDS = metrics.histogram("smartfarm_rule_eval_seconds", "측정값 하나로 window를 갱신하고 규칙들을 검사하는 데 걸린 시간")
+ALERTS_FIRED = metrics.counter("smartfarm_alerts_fired_total", "낸 경보 수", ["severity"])
+
+CREATE_ALERTS_QUERY = """CREATE TABLE IF NOT EXISTS alerts(
+                id INTEGER PRIMARY KEY,
+                device_id TEXT NOT NULL,
+                rule TEXT NOT NULL,
+                severity TEXT NOT NULL,
+                message TEXT NOT NULL,
+                started_ms INTEGER NOT NULL,
+                resolved_ms INTEGER,
+                detail TEXT);"""
+CREATE_ALERTS_INDEX_QUERY = "CREATE INDEX IF NOT EXISTS alerts_device_started ON alerts(device_id, started_ms);"
+
+_OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq, "!=": operator.ne}
+_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600}
+_CONDITION_PATTERN = re.compile(
+    r"^\s*(?:(?P<agg>min|max|mean|slope)\(\s*(?P<wmetric>\w+)\s*,\s*(?P<length>\d+(?:\.\d+)?)(?P<unit>[smh])\s*\)|(?P<metric>\w+))"
+    r"\s*(?P<op><=|>=|==|!=|<|>)\s*(?P<value>-?\d+(?:\.\d+)?)\s*$"
+)
+_STATE_VALUES = {"ON": 1, "OFF": 0}
+
+Rule = namedtuple("Rule", ["name", "conditions", "hold_seconds", "severity", "message", "devices", "metrics"])
+
+
+class RuleConfigError(ValueError):
+    """규칙 파일이나 조건 문자열이 올바르지 않을 때 raise되는 예외"""
+
+
+class Condition:
+    """
+    조건 문자열 하나를 해석한 것. evaluate(state)로 스마트팜 한 대의 지금 상태(DeviceState)에서 맞는지 검사함
+    - agg(str) : None(가장 최근 값), "min", "max", "mean", "slope"
+    - window(float) : window 길이(초). agg가 None이면 None
+    """
+
+    def __init__(self, text):
+        match = _CONDITION_PATTERN.match(text)
+        if match is None:
+            raise RuleConfigError(f"조건 {text!r}를 해석할 수 없습니다! (예: 'water_level < 2', 'slope(temperature, 15m) < -0.05')")
+        self.text = text.strip()
+        self.agg = match.group("agg")
+        self.metric = match.group("wmetric") or match.group("metric")
+        self.window = None if self.agg is None else float(match.group("length")) * _UNIT_SECONDS[match.group("unit")]
+        self.compare = _OPERATORS[match.group("op")]
+        self.threshold = float(match.group("value"))
+        if self.metric not in FIELDS:
+            raise RuleConfigError(f"조건 {text!r}의 측정값 {self.metric}를 알 수 없습니다! ({', '.join(FIELDS)} 중 하나)")
+        if self.window is not None and self.window <= 0:
+            raise RuleConfigError(f"조건 {text!r}의 window 길이는 0보다 커야 합니다!")
+
+    def value(self, state):
+        if self.agg is None:
+            return state.last.get(self.metric)
+        return state.windows[(self.metric, self.window)].aggregate(self.agg)
+
+    def evaluate(self, state):
+        value = self.value(state)
+        return value is not None and self.compare(value, self.threshold)
+
+
+def compile_rule(entry, device_ids=None) -> Rule:
+    """규칙 파일의 규칙 하나(dict)를 Rule로 만듬. device_ids를 주면 devices에 없는 스마트팜이 있는지 확인함"""
+    name = entry.get("name")
+    if not name:
+        raise RuleConfigError("name이 없는 규칙이 있습니다!")
+    when = entry.get("when")
+    if isinstance(when, str):
+        when = [when]
+    if not when:
+        raise RuleConfigError(f"규칙 {name}에 조건(when)이 없습니다!")
+    severity = entry.get("severity", "warning")
+    if severity not in SEVERITIES:
+        raise RuleConfigError(f"규칙 {name}의 severity {severity}는 허용되지 않습니다! ({', '.join(SEVERITIES)} 중 하나)")
+    devices = entry.get("devices")
+    if devices is not None:
+        devices = frozenset(str(device_id) for device_id in devices)
+        unknown = devices - set(device_ids) if device_ids is not None else set()
+        if unknown:
+            raise RuleConfigError(f"규칙 {name}의 devices에 없는 스마트팜이 있습니다 : {', '.join(sorted(unknown))}")
+    conditions = tuple(Condition(text) for text in when)
+    return Rule(
+        name=str(name),
+        conditions=conditions,
+        hold_seconds=float(entry.get("for", 0)),
+        severity=severity,
+        message=str(entry.get("message", name)),
+        devices=devices,
+        metrics=frozenset(condition.metric for condition in conditions),
+    )
+
+
+def load_rules(path=None, device_ids=None) -> list:
+    """
+    규칙 파일을 읽어 Rule list를 반환함. 파일이 없으면 DEFAULT_RULES를 씀
+    - path(str) : 규칙 파일 경로. None이면 환경변수 SMARTFARM_RULES_CONFIG, 그것도 없으면 ./rules.json
+    - device_ids(list[str]) : 돌리는 스마트팜들 (규칙의 devices 확인용)
+    """
+    if path is None:
+        path = os.environ.get("SMARTFARM_RULES_CONFIG", DEFAULT_RULES_CONFIG_PATH)
+    if not os.path.exists(path):
+        entries = DEFAULT_RULES
+    else:
+        with open(path, encoding="utf-8") as f:
+            try:
+                entries = json.load(f).get("rules", [])
+            except json.JSONDecodeError as e:
+                raise RuleConfigError(f"{path}를 읽을 수 없습니다 : {e}")
+    rules = [compile_rule(entry, device_ids) for entry in entries]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise RuleConfigError(f"규칙 이름이 겹칩니다! ({', '.join(names)})")
+    LOG.info("loaded", "규칙들을 읽었습니다.", path=path if entries is not DEFAULT_RULES else "(기본 규칙)", rules=",".join(names))
+    return rules
+
+
+class SlidingWindow:
+    """
+    최근 seconds초 동안의 (시각, 값)들의 최솟값, 최댓값, 평균, 기울기를 값 하나를 넣을 때마다 O(1)(분할 상환)로 갱신하는 window.
+    - 평균, 기울기 : 시각과 값의 누적 합 (n, Σt, Σv, Σtt, Σtv)에 넣고 빼기만 함 (t는 base로부터의 초)
+    - 최솟값, 최댓값 : 값이 단조 증가/감소하는 deque의 맨 앞
+
+    90초에는 30초 이후의 세 값만 window에 남음 (30초에 22, 60초에 21, 90초에 25 -> 1분당 3씩 오름)
+    >>> window = SlidingWindow(60)
+    >>> for t, v in [(0, 20.0), (30, 22.0), (60, 21.0), (90, 25.0)]:
+    ...     window.add(t, v)
+    >>> [round(window.aggregate(agg), 6) for agg in ("min", "max", "mean", "slope")]
+    [21.0, 25.0, 22.666667, 3.0]
+    """
+
+    __slots__ = ("seconds", "samples", "mins", "maxs", "base", "n", "st", "sv", "stt", "stv")
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()
+        self.mins = deque()
+        self.maxs = deque()
+        self.base = None
+        self.n = 0
+        self.st = self.sv = self.stt = self.stv = 0.0
+
+    def add(self, t, v):
+        """t(초)에 측정한 값 v를 넣고 window 밖으로 나간 값들을 뺌. t는 이전에 넣은 값보다 작으면 안 됨"""
+        if self.base is None or t - self.base > self.seconds * REBASE_WINDOWS:
+            self._rebase(t)
+        self.samples.append((t, v))
+        x = t - self.base
+        self.n += 1
+        self.st += x
+        self.sv += v
+        self.stt += x * x
+        self.stv += x * v
+        while self.mins and self.mins[-1][1] >= v:
+            self.mins.pop()
+        self.mins.append((t, v))
+        while self.maxs and self.maxs[-1][1] <= v:
+            self.maxs.pop()
+        self.maxs.append((t, v))
+
+        cutoff = t - self.seconds
+        while self.samples[0][0] < cutoff:
+            old_t, old_v = self.samples.popleft()
+            x = old_t - self.base
+            self.n -= 1
+            self.st -= x
+            self.sv -= old_v
+            self.stt -= x * x
+            self.stv -= x * old_v
+        while self.mins[0][0] < cutoff:
+            self.mins.popleft()
+        while self.maxs[0][0] < cutoff:
+            self.maxs.popleft()
+
+    def _rebase(self, t):
+        """기준점을 t로 옮기고 누적 합을 window 안의 값들로 새로 계산함 (REBASE_WINDOWS번의 window마다 한 번)"""
+        self.base = t
+        self.n = len(self.samples)
+        self.st = self.sv = self.stt = self.stv = 0.0
+        for old_t, old_v in self.samples:
+            x = old_t - t
+            self.st += x
+            self.sv += old_v
+            self.stt += x * x
+            self.stv += x * old_v
+
+    def covered(self):
+        """window 길이의 MIN_WINDOW_COVERAGE보다 긴 기간의 값들이 들어있는지"""
+        return self.n >= 2 and self.samples[-1][0] - self.samples[0][0] >= self.seconds * MIN_WINDOW_COVERAGE
+
+    def aggregate(self, agg):
+        """agg("min", "max", "mean", "slope")의 지금 값. window가 덜 찼으면 None. slope는 1분당 변화량"""
+        if not self.covered():
+            return None
+        if agg == "min":
+            return self.mins[0][1]
+        if agg == "max":
+            return self.maxs[0][1]
+        if agg == "mean":
+            return self.sv / self.n
+        denominator = self.n * self.stt - self.st * self.st
+        if denominator <= 0:
+            return None
+        return (self.n * self.stv - self.st * self.sv) / denominator * 60
+
+
+class DeviceState:
+    """스마트팜 한 대의 가장 최근 값들, window들, 규칙마다의 경보 상태"""
+
+    def __init__(self, windows):
+        self.last = {}
+        self.last_ms = None
+        self.windows = {key: SlidingWindow(key[1]) for key in windows}
+        self.windows_by_metric = {}
+        for key, window in self.windows.items():
+            self.windows_by_metric.setdefault(key[0], []).append(window)
+        self.pending_since = {}  # 규칙 이름 -> 조건이 맞기 시작한 시각(epoch 밀리초)
+        self.firing = {}  # 규칙 이름 -> 경보 dict
+
+    def update(self, timestamp_ms, values):
+        """측정값들로 최근 값과 window들을 갱신하고, 시각이 뒤로 가지 않았으면 True를 반환함"""
+        if self.last_ms is not None and timestamp_ms < self.last_ms:
+            return False
+        self.last_ms = timestamp_ms
+        t = timestamp_ms / 1000
+        for metric, value in values.items():
+            self.last[metric] = value
+            for window in self.windows_by_metric.get(metric, ()):
+                window.add(t, value)
+        return True
+
+
+class RuleEngine:
+    """
+    측정값을 받아 규칙들을 검사하고 경보를 내는 백그라운드 스레드.
+    - rules(list[Rule]) : load_rules()의 결과
+    - db_path(str) : 경보를 남길 datas.db 경로
+    - socketio(flask_socketio.SocketIO) : 경보를 보낼 socket.io 서버. None이면 보내지 않음
+    - queue_size(int) : 검사를 기다리는 측정값을 담아둘 큐의 최대 크기
+    """
+
+    def __init__(self, rules, db_path, socketio=None, queue_size=QUEUE_SIZE):
+        self.rules = list(rules)
+        self.db_path = db_path
+        self.socketio = socketio
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._states = {}
+
+        # 측정값 이름 -> 그 측정값을 쓰는 규칙들, 스마트팜마다 필요한 window들 (켤 때 한 번 계산함)
+        self.rules_by_metric = {}
+        for rule in self.rules:
+            for metric in rule.metrics:
+                self.rules_by_metric.setdefault(metric, []).append(rule)
+        self.windows = {
+            (condition.metric, condition.window) for rule in self.rules for condition in rule.conditions if condition.window
+        }
+
+        # 지표들
+        self.submitted_count = 0
+        self.processed_count = 0
+        self.dropped_count = 0
+        self.fired_count = 0
+        self.resolved_count = 0
+
+        con = connect_database(db_path)
+        try:
+            with con:
+                con.execute(CREATE_ALERTS_QUERY)
+                con.execute(CREATE_ALERTS_INDEX_QUERY)
+            self._load_open_alerts(con)
+        finally:
+            con.close()
+
+    def _state(self, device_id):
+        state = self._states.get(device_id)
+        if state is None:
+            state = self._states[device_id] = DeviceState(self.windows)
+        return state
+
+    def _load_open_alerts(self, con):
+        """지난번에 켜져 있을 때 풀리지 않은 경보들을 이어받음. 지금은 없는 규칙의 경보는 풀음"""
+        rules = {rule.name: rule for rule in self.rules}
+        now_ms = int(time.time() * 1000)
+        rows = con.execute(
+            "SELECT id, device_id, rule, severity, message, started_ms, detail FROM alerts WHERE resolved_ms IS NULL;"
+        ).fetchall()
+        with con:
+            for alert_id, device_id, name, severity, message, started_ms, detail in rows:
+                if name not in rules:
+                    con.execute("UPDATE alerts SET resolved_ms = ? WHERE id = ?;", (now_ms, alert_id))
+                    continue
+                self._state(device_id).firing[name] = {
+                    "id": alert_id,
+                    "device": device_id,
+                    "rule": name,
+                    "severity": severity,
+                    "message": message,
+                    "started": started_ms,
+                    "detail": json.loads(detail) if detail else {},
+                }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="RuleEngine", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+    def submit(self, device_id, values, timestamp_ms=None) -> bool:
+        """
+        스마트팜 한 대의 측정값들을 검사 큐에 넣음. 큐가 가득 차 있으면 기다리지 않고 버리고 False를 반환함
+        - values(dict) : {측정값 이름: 값}. 규칙에 쓰이지 않는 이름은 무시함. 상태는 'ON'/'OFF' 혹은 1/0
+        - timestamp_ms(int) : 측정 시각 (epoch 밀리초). None이면 지금
+        """
+        sample = {}
+        for metric, value in values.items():
+            if metric not in self.rules_by_metric:
+                continue
+            value = _STATE_VALUES.get(value, value)
+            # 값이 없거나 nan이면 넣지 않음
+            if value is None or value != value:
+                continue
+            sample[metric] = float(value)
+        if not sample:
+            return True
+        try:
+            self.queue.put_nowait((device_id, int(time.time() * 1000) if timestamp_ms is None else timestamp_ms, sample))
+        except queue.Full:
+            self.dropped_count += 1
+            LOG.warning("dropped", "규칙 검사 큐가 가득 차 측정값을 버립니다!", every=60, device=device_id, dropped=self.dropped_count)
+            return False
+        self.submitted_count += 1
+        return True
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            firing = [alert for state in self._states.values() for alert in state.firing.values()]
+        return {
+            "queue_depth": self.queue.qsize(),
+            "submitted": self.submitted_count,
+            "processed": self.processed_count,
+            "dropped": self.dropped_count,
+            "fired": self.fired_count,
+            "resolved": self.resolved_count,
+            "firing": firing,
+        }
+
+    def active_alerts(self, device_id=None) -> list:
+        """지금 풀리지 않은 경보들 (device_id를 주면 그 스마트팜의 것만)"""
+        with self._lock:
+            return [
+                dict(alert)
+                for state_device, state in self._states.items()
+                if device_id is None or state_device == device_id
+                for alert in state.firing.values()
+            ]
+
+    def _run(self):
+        """규칙 스레드용 함수. 큐에서 측정값을 꺼내 검사하고 경보를 내거나 풀음"""
+        # 경보는 드물게 나므로 저장기(ingest.py)를 거치지 않고 이 스레드의 커넥션으로 바로 씀
+        con = connect_database(self.db_path, timeout=60.0)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                try:
+                    with RULE_EVAL_SECONDS.time():
+                        self.process(con, *item)
+                except Exception as e:
+                    LOG.error("process_failed", "규칙을 검사하는 중 오류가 발생했습니다!", every=60, device=item[0], error=e)
+        finally:
+            con.close()
+
+    def process(self, con, device_id, timestamp_ms, sample):
+        """측정값 하나로 window들을 갱신하고 그 측정값을 쓰는 규칙들을 검사함"""
+        state = self._state(device_id)
+        if not state.update(timestamp_ms, sample):
+            return
+        self.processed_count += 1
+        RULE_SAMPLES.inc()
+        checked = set()
+        for metric in sample:
+            for rule in self.rules_by_metric[metric]:
+                if rule.name in checked or (rule.devices is not None and device_id not in rule.devices):
+                    continue
+                checked.add(rule.name)
+                self._check(con, device_id, state, rule, timestamp_ms)
+
+    def _check(self, con, device_id, state, rule, timestamp_ms):
+        matched = all(condition.evaluate(state) for condition in rule.conditions)
+        if not matched:
+            state.pending_since.pop(rule.name, None)
+            if rule.name in state.firing:
+                self._resolve(con, state, rule, timestamp_ms)
+            return
+        if rule.name in state.firing:
+            return
+        since = state.pending_since.setdefault(rule.name, timestamp_ms)
+        if timestamp_ms - since >= rule.hold_seconds * 1000:
+            self._fire(con, device_id, state, rule, since)
+
+    def _fire(self, con, device_id, state, rule, started_ms):
+        detail = {condition.text: round(condition.value(state), 4) for condition in rule.conditions}
+        with con:
+            alert_id = con.execute(
+                "INSERT INTO alerts (device_id, rule, severity, message, started_ms, detail) VALUES (?, ?, ?, ?, ?, ?);",
+                (device_id, rule.name, rule.severity, rule.message, started_ms, json.dumps(detail, ensure_ascii=False)),
+            ).lastrowid
+        alert = {
+            "id": alert_id,
+            "device": device_id,
+            "rule": rule.name,
+            "severity": rule.severity,
+            "message": rule.message,
+            "started": started_ms,
+            "detail": detail,
+        }
+        with self._lock:
+            state.firing[rule.name] = alert
+        state.pending_since.pop(rule.name, None)
+        self.fired_count += 1
+        ALERTS_FIRED.labels(rule.severity).inc()
+        LOG.warning("fired", "경보를 냅니다!", device=device_id, rule=rule.name, severity=rule.severity, **detail)
+        self._emit(device_id, dict(alert, state="firing"))
+
+    def _resolve(self, con, state, rule, timestamp_ms):
+        with self._lock:
+            alert = state.firing.pop(rule.name)
+        with con:
+            con.execute("UPDATE alerts SET resolved_ms = ? WHERE id = ?;", (timestamp_ms, alert["id"]))
+        self.resolved_count += 1
+        LOG.info("resolved", "경보가 풀렸습니다.", device=alert["device"], rule=rule.name)
+        self._emit(alert["device"], dict(alert, state="resolved", resolved=timestamp_ms))
+
+    def _emit(self, device_id, payload):
+        if self.socketio is None:
+            return
+        try:
+            self.socketio.emit(ALERT_EVENT, payload, to=alert_room(device_id))
+        except Exception as e:
+            LOG.error("emit_failed", "경보를 보내는 중 오류가 발생했습니다!", every=60, device=device_id, error=e)
+
+
+def alert_room(device_id):
+    """스마트팜 한 대의 경보를 받는 socket.io 방 이름"""
+    return f"{device_id}/alerts"
+
+
+def query_alerts(db_path, device_id=None, active=False, start_ms=None, end_ms=None, limit=100) -> list:
+    """
+    alerts 테이블의 경보들을 최근 것부터 반환함
+    - device_id(str) : 이 스마트팜의 경보만. None이면 모든 스마트팜
+    - active(bool) : True면 풀리지 않은 경보만
+    - start_ms, end_ms(int) : 경보가 시작된 시각의 범위 (epoch 밀리초, 끝 포함). None이면 제한 없음
+    """
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    if active:
+        conditions.append("resolved_ms IS NULL")
+    if start_ms is not None:
+        conditions.append("started_ms >= ?")
+        params.append(start_ms)
+    if end_ms is not None:
+        conditions.append("started_ms <= ?")
+        params.append(end_ms)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute(
+            "SELECT id, device_id, rule, severity, message, started_ms, resolved_ms, detail "
+            f"FROM alerts{where} ORDER BY started_ms DESC LIMIT ?;",
+            (*params, limit),
+        ).fetchall()
+    finally:
+        con.close()
+    return [
+        {
+            "id": alert_id,
+            "device": device,
+            "rule": rule,
+            "severity": severity,
+            "message": message,
+            "started": started_ms,
+            "resolved": resolved_ms,
+            "detail": json.loads(detail) if detail else {},
+        }
+        for alert_id, device, rule, severity, message, started_ms, resolved_ms, detail in rows
+    ]
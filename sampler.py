@@ -0,0 +1,177 @@
+"""
+DHT 온습도센서들을 읽는 오래 유지되는(persistent) 샘플러.
+
+센서 핀마다 스레드를 하나씩 만들어 두고 계속 재사용하며, 측정 요청이 오면 각 스레드가 자기 센서를 읽음.
+- 한 번의 측정은 read_deadline초 안에 끝나고, 그 안에 읽지 못한 센서는 마지막으로 성공한 값(last-good)과 그 값의 나이를 돌려줌
+- 계속 실패하는 센서는 실패할수록 다음 시도까지 기다리는 시간을 두 배씩 늘림(exponential back-off)
+그래서 센서 하나가 고장나도 측정 한 번에 걸리는 시간은 일정하고, 다른 센서들의 측정을 붙잡지 않음.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+
+DHT_READ_SECONDS = metrics.histogram("smartfarm_dht_read_seconds", "DHT 센서 한 번의 측정(재시도 포함)에 걸린 시간", ["pin"])
+DHT_READ_RETRIES = metrics.counter("smartfarm_dht_read_retries_total", "DHT 측정 안에서 다시 읽은 횟수", ["pin"])
+DHT_READ_FAILURES = metrics.counter("smartfarm_dht_read_failures_total", "마감 시간 안에 읽지 못한 DHT 측정 횟수", ["pin"])
+
+# collect()가 돌려주는 센서 하나의 측정 결과
+# - pin : 센서 핀 번호
+# - humidity, temperature : 마지막으로 성공한 측정값 (한번도 성공하지 못했으면 None)
+# - age : 그 측정값의 나이(초). 한번도 성공하지 못했으면 None
+# - fresh : 이번 collect()에서 새로 읽은 값이면 True
+# - failures : 연속으로 실패한 측정 횟수
+DHTReading = namedtuple("DHTReading", ["pin", "humidity", "temperature", "age", "fresh", "failures"])
+
+
+class DHTSensorWorker(threading.Thread):
+    """센서 핀 하나를 맡아 요청이 올 때마다 읽는 스레드"""
+
+    def __init__(self, pool, pin):
+        super().__init__(name=f"DHTSensorWorker({pin})", daemon=True)
+        self.pool = pool
+        self.pin = pin
+        self.humidity = None
+        self.temperature = None
+        self.last_good_time = None
+        self.consecutive_failures = 0
+        self.next_allowed_time = 0.0
+        self.generation = 0  # 측정을 한번 끝낼 때마다 1씩 늘어남
+        self.busy = False
+        self.last_read_seconds = 0.0
+        self.read_attempts = 0
+        self._request = threading.Event()
+        self._stopped = False
+        self._read_seconds = DHT_READ_SECONDS.labels(pin)
+        self._retries = DHT_READ_RETRIES.labels(pin)
+        self._failures = DHT_READ_FAILURES.labels(pin)
+
+    def request(self):
+        self.busy = True
+        self._request.set()
+
+    def stop(self):
+        self._stopped = True
+        self._request.set()
+
+    def run(self):
+        while True:
+            self._request.wait()
+            self._request.clear()
+            if self._stopped:
+                return
+            self._sample()
+
+    def _sample(self):
+        """read_deadline 안에서 성공할 때까지 센서를 읽고, 결과와 back-off 상태를 갱신함"""
+        pool = self.pool
+        start = time.monotonic()
+        humidity = temperature = None
+        attempts = 0
+        while True:
+            attempts += 1
+            humidity, temperature = pool.dht.read(pool.sensor_type, self.pin)
+            if humidity is not None and temperature is not None:
+                break
+            # 다음 시도를 해도 마감 시간 안에 끝나지 않으면 포기함
+            if time.monotonic() - start + pool.retry_delay >= pool.read_deadline:
+                break
+            time.sleep(pool.retry_delay)
+        now = time.monotonic()
+        succeeded = humidity is not None and temperature is not None
+        self._read_seconds.observe(now - start)
+        if attempts > 1:
+            self._retries.inc(attempts - 1)
+        if not succeeded:
+            self._failures.inc()
+
+        with pool.condition:
+            self.read_attempts += attempts
+            self.last_read_seconds = now - start
+            if succeeded:
+                self.humidity = humidity
+                self.temperature = temperature
+                self.last_good_time = now
+                self.consecutive_failures = 0
+                self.next_allowed_time = 0.0
+            else:
+                self.consecutive_failures += 1
+                backoff = min(pool.base_backoff * 2 ** (self.consecutive_failures - 1), pool.max_backoff)
+                self.next_allowed_time = now + backoff
+            self.generation += 1
+            self.busy = False
+            pool.condition.notify_all()
+
+
+class DHTSamplerPool:
+    """
+    DHT 센서 핀마다 DHTSensorWorker를 하나씩 두고 재사용하는 샘플러.
+    - dht : Adafruit_DHT와 같은 인터페이스를 가진 드라이버 (read, DHT11)
+    - pins(list[int]) : 센서 핀 번호들
+    - sensor_type : 센서 종류. None이면 dht.DHT11
+    - read_deadline(float) : 측정 한 번에 쓸 수 있는 최대 시간(초)
+    - retry_delay(float) : 같은 측정 안에서 재시도 사이의 대기시간(초)
+    - base_backoff(float) : 처음 실패했을 때 다음 시도까지 쉬는 시간(초). 연속 실패마다 두 배가 됨
+    - max_backoff(float) : back-off 시간의 최댓값(초)
+    """
+
+    def __init__(
+        self,
+        dht,
+        pins,
+        sensor_type=None,
+        read_deadline=3.0,
+        retry_delay=1.0,
+        base_backoff=15.0,
+        max_backoff=600.0,
+    ):
+        self.dht = dht
+        self.sensor_type = sensor_type if sensor_type is not None else dht.DHT11
+        self.read_deadline = read_deadline
+        self.retry_delay = retry_delay
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.workers = [DHTSensorWorker(self, pin) for pin in pins]
+        for worker in self.workers:
+            worker.start()
+
+    def collect(self):
+        """
+        back-off 중이 아닌 센서들에게 측정을 요청하고 read_deadline까지만 기다린 뒤,
+        센서마다 마지막으로 성공한 값을 DHTReading list로 반환함.
+        """
+        now = time.monotonic()
+        requested = {}
+        with self.condition:
+            for worker in self.workers:
+                # 이전 측정이 아직 안 끝났거나(센서가 멈춤) back-off 중이면 이번에는 요청하지 않음
+                if worker.busy or now < worker.next_allowed_time:
+                    continue
+                requested[worker] = worker.generation
+                worker.request()
+
+            # 요청한 센서들이 모두 끝나거나 마감 시간이 될 때까지 기다림
+            deadline = now + self.read_deadline
+            while any(worker.generation == gen for worker, gen in requested.items()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            now = time.monotonic()
+            readings = []
+            for worker in self.workers:
+                fresh = worker in requested and worker.generation != requested[worker] and worker.consecutive_failures == 0
+                age = None if worker.last_good_time is None else now - worker.last_good_time
+                readings.append(
+                    DHTReading(worker.pin, worker.humidity, worker.temperature, age, fresh, worker.consecutive_failures)
+                )
+        return readings
+
+    def stop(self):
+        """모든 센서 스레드를 멈춤 (진행중인 측정은 끝난 뒤 멈춤)"""
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,174 @@
+"""
+센서마다 다른 주기로 측정하는 다중 주기(multi-rate) 측정 스케줄러.
+
+add_source()로 측정원(DHT 센서 묶음, SPI 수위센서, 카메라 등)을 주기, 허용 지연(jitter budget), 결과 처리 함수와 함께 등록하면
+start()가 측정원마다 백그라운드 작업을 하나씩 띄워 각자의 주기로 측정하고, 측정이 끝나는 즉시 결과 처리 함수를 불러 결과를 내보냄.
+측정 시각은 "시작 시각 + n * 주기"의 절대 시각으로 잡기 때문에 오래 돌아도 주기가 밀리지(drift) 않으며,
+예정보다 늦게 시작한 정도(lateness)와 측정이 주기보다 오래 걸린 횟수(overrun)를 측정원마다 기록함.
+"""
+
+import threading
+import time
+
+import log
+import metrics
+
+LOG = log.get_logger("scheduler")
+
+LOOP_DURATION_SECONDS = metrics.histogram("smartfarm_loop_duration_seconds", "측정원 한 번의 측정과 결과 처리에 걸린 시간", ["source"])
+LOOP_LATENESS_SECONDS = metrics.histogram("smartfarm_loop_lateness_seconds", "측정이 예정 시각보다 늦게 시작한 정도", ["source"])
+LOOP_OVERRUNS = metrics.counter("smartfarm_loop_overruns_total", "측정이 주기보다 오래 걸린 횟수", ["source"])
+LOOP_SKIPPED = metrics.counter("smartfarm_loop_skipped_total", "앞 측정이 밀려 건너뛴 측정 횟수", ["source"])
+LOOP_ERRORS = metrics.counter("smartfarm_loop_errors_total", "측정 중 오류가 난 횟수", ["source"])
+
+
+class ScheduledSource:
+    """
+    스케줄러에 등록된 측정원 하나.
+    - name(str) : 측정원 이름
+    - acquire : 인자 없이 호출하면 측정을 하고 결과를 반환하는 함수
+    - interval(float) : 측정 주기(초)
+    - jitter_budget(float) : 예정 시각보다 이만큼(초) 넘게 늦게 시작하면 늦은 것(late)으로 셈
+    - on_result : 측정이 끝나면 on_result(결과)로 호출되는 함수. None이면 호출하지 않음
+    """
+
+    def __init__(self, name, acquire, interval, jitter_budget, on_result):
+        self.name = name
+        self.acquire = acquire
+        self.interval = interval
+        self.jitter_budget = jitter_budget
+        self.on_result = on_result
+
+        # 지표들
+        self.runs = 0
+        self.errors = 0
+        self.late_count = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.duration_metric = LOOP_DURATION_SECONDS.labels(name)
+        self.lateness_metric = LOOP_LATENESS_SECONDS.labels(name)
+        self.overrun_metric = LOOP_OVERRUNS.labels(name)
+        self.skipped_metric = LOOP_SKIPPED.labels(name)
+        self.error_metric = LOOP_ERRORS.labels(name)
+
+    def get_stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "jitter_budget": self.jitter_budget,
+            "runs": self.runs,
+            "errors": self.errors,
+            "late": self.late_count,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "last_lateness": self.last_lateness,
+            "max_lateness": self.max_lateness,
+            "mean_lateness": self.total_lateness / self.runs if self.runs else 0.0,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration,
+        }
+
+
+class AcquisitionScheduler:
+    """
+    측정원마다 자기 주기로 측정하고 결과를 바로 내보내는 스케줄러.
+    - spawn : 함수를 백그라운드 작업으로 실행하는 함수 (예: socketio.start_background_task). None이면 데몬 스레드를 씀
+    - sleep : 기다리는 함수 (예: socketio.sleep). None이면 time.sleep을 씀
+    """
+
+    def __init__(self, spawn=None, sleep=None):
+        self.spawn = spawn if spawn is not None else self._spawn_thread
+        self.sleep = sleep if sleep is not None else time.sleep
+        self.sources = {}
+        self.running = False
+
+    @staticmethod
+    def _spawn_thread(target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def add_source(self, name, acquire, interval, jitter_budget=None, on_result=None):
+        """
+        측정원을 등록함. 이미 start()한 뒤에 등록하면 바로 그 측정원의 작업을 띄움.
+        jitter_budget이 주어지지 않으면 주기의 10%로 함.
+        """
+        if name in self.sources:
+            raise ValueError(f"측정원 {name}이 이미 등록되어 있습니다!")
+        if interval <= 0:
+            raise ValueError(f"측정원 {name}의 주기는 0보다 커야 합니다! ({interval})")
+        if jitter_budget is None:
+            jitter_budget = interval * 0.1
+        source = ScheduledSource(name, acquire, interval, jitter_budget, on_result)
+        self.sources[name] = source
+        if self.running:
+            self.spawn(self._run_source, source)
+        return source
+
+    def start(self):
+        """등록된 모든 측정원의 백그라운드 작업을 띄움"""
+        if self.running:
+            return
+        self.running = True
+        for source in list(self.sources.values()):
+            self.spawn(self._run_source, source)
+
+    def stop(self):
+        """모든 측정원의 작업이 다음 측정 전에 멈추도록 함"""
+        self.running = False
+
+    def get_stats(self) -> dict:
+        """측정원별 지표들을 {이름: 지표 dict} 형태로 반환함"""
+        return {name: source.get_stats() for name, source in self.sources.items()}
+
+    def _run_source(self, source):
+        """측정원 하나를 주기적으로 측정하는 백그라운드 작업용 함수"""
+        next_time = time.monotonic()
+        while self.running:
+            started = time.monotonic()
+            lateness = max(0.0, started - next_time)
+            source.last_lateness = lateness
+            source.max_lateness = max(source.max_lateness, lateness)
+            source.total_lateness += lateness
+            source.lateness_metric.observe(lateness)
+            if lateness > source.jitter_budget:
+                source.late_count += 1
+
+            try:
+                result = source.acquire()
+                if source.on_result is not None:
+                    source.on_result(result)
+            except Exception as e:
+                source.errors += 1
+                source.error_metric.inc()
+                LOG.error("acquire_failed", "측정 중 오류가 발생했습니다!", key=source.name, every=60, source=source.name, error=e)
+            finished = time.monotonic()
+            source.runs += 1
+            source.last_duration = finished - started
+            source.max_duration = max(source.max_duration, source.last_duration)
+            source.duration_metric.observe(source.last_duration)
+
+            # 다음 측정 시각은 절대 시각으로 잡아 주기가 밀리지 않게 함
+            next_time += source.interval
+            if finished > next_time:
+                # 측정이 주기보다 오래 걸렸으면 다음 측정은 바로 시작하고, 통째로 지나가버린 측정 시각들은 건너뜀
+                source.overruns += 1
+                source.overrun_metric.inc()
+                missed = int((finished - next_time) // source.interval)
+                if missed > 0:
+                    source.skipped += missed
+                    source.skipped_metric.inc(missed)
+                    next_time += missed * source.interval
+                    LOG.warning(
+                        "skipped",
+                        "측정이 주기보다 오래 걸려 측정을 건너뜁니다.",
+                        key=source.name,
+                        every=60,
+                        source=source.name,
+                        missed=missed,
+                    )
+            self.sleep(max(0.0, next_time - time.monotonic()))
@@ -0,0 +1,349 @@
+"""
+측정값을 미리 크기를 잡아둔 memory-mapped segment 파일에 고정 폭(fixed-width) binary 레코드로 이어 쓰는 저장소.
+
+SD카드 위의 sqlite는 측정값 한 줄마다 B-tree를 찾아 페이지를 고치고 WAL에 쓰기 때문에, 수위처럼 1초보다 자주 재는 값이나
+랙이 여러 대인 스마트팜에서는 저장이 병목이 됨. SegmentLog는
+- 스마트팜마다 SEGMENT_DIR/<device_id>/ 폴더에 SEGMENT_RECORDS개짜리 segment 파일을 미리 만들어(ftruncate) mmap해 두고
+- 측정값 하나를 RECORD_DTYPE 레코드 하나로 다음 칸에 복사(memcpy)하고 헤더의 개수만 고침 (쓰기는 커널이 나중에 모아서 함)
+- INDEX_STRIDE개마다 첫 레코드의 시각을 segment 안의 sparse 시각 색인에 적어, 기간 조회는 색인에서 구간을 찾은 뒤
+  그 구간 안에서만 이진 탐색함
+- 읽을 때는 파일을 그대로 NumPy structured array로 보아(np.frombuffer) 조각(view)을 돌려줌 - 파싱도 복사도 없음
+을 함. segment가 가득 차면 flush하고 새 segment를 만듬. 서버를 다시 켜면 마지막 segment만 쓰기로 열고 나머지는 읽기 전용으로 염.
+
+segment 파일 하나의 구조 (모두 little-endian)
+- 헤더 HEADER_SIZE 바이트 : magic, 형식 버전, 레코드 크기, 레코드 칸 수(capacity), 색인 간격(stride), 쓴 레코드 수(count)
+- sparse 시각 색인 : int64 [capacity / stride] (레코드 stride개마다 첫 레코드의 timestamp_ms)
+- 레코드들 : RECORD_DTYPE [capacity]
+count는 레코드를 다 쓴 뒤에 고치므로 중간에 꺼져도 count까지의 레코드는 온전함. 커널이 헤더 페이지만 먼저 내려 써서
+count가 레코드보다 앞서 있으면 다음에 열 때 끝의 빈(시각이 0인) 레코드들을 버림.
+"""
+
+import glob
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+import log
+
+LOG = log.get_logger("segments")
+
+SEGMENT_DIR = "./telemetry_segments"
+# segment 하나의 레코드 칸 수 (32바이트 x 65536 = 2MB. 30초 주기면 약 22일치, 1초 주기면 약 18시간치)
+SEGMENT_RECORDS = int(os.environ.get("SMARTFARM_SEGMENT_RECORDS", 1 << 16))
+# sparse 시각 색인의 간격 (레코드 수)
+INDEX_STRIDE = 256
+
+# 레코드 하나의 구조. 값은 sqlite의 REAL과 같은 float64로 두어 어느 저장소에서 읽어도 같은 값이 나옴 (값이 없으면 nan)
+RECORD_DTYPE = np.dtype(
+    [
+        ("timestamp_ms", "<i8"),
+        ("temperature", "<f8"),
+        ("humidity", "<f8"),
+        ("water_level", "<f8"),
+    ]
+)
+VALUE_FIELDS = ("temperature", "humidity", "water_level")
+
+MAGIC = b"SFSEGMNT"
+FORMAT_VERSION = 1
+HEADER_SIZE = 64
+# magic, 형식 버전, 레코드 크기, capacity, stride
+_HEADER = struct.Struct("<8sIIQI")
+_COUNT = struct.Struct("<Q")
+_COUNT_OFFSET = 32
+
+
+class SegmentFormatError(ValueError):
+    """segment 파일의 헤더가 이 모듈이 아는 형식이 아닐 때 raise되는 예외"""
+
+
+def _records_offset(capacity, stride):
+    """레코드들이 시작하는 위치. 색인 뒤를 64바이트 단위로 맞춤"""
+    index_bytes = -(-capacity // stride) * 8
+    return HEADER_SIZE + -(-index_bytes // 64) * 64
+
+
+def _in_order(views) -> list:
+    """
+    view들을 첫 시각 순서로 놓고, 시계가 뒤로 가 시각 범위가 겹치는 view들만 이어 붙여 시각 순서로 정렬함 (이때만 복사함).
+    겹치지 않는 view는 그대로 둠
+    """
+    groups = []
+    group_last_ms = None
+    for view in sorted(views, key=lambda view: int(view["timestamp_ms"][0])):
+        if groups and view["timestamp_ms"][0] < group_last_ms:
+            groups[-1].append(view)
+            group_last_ms = max(group_last_ms, int(view["timestamp_ms"][-1]))
+        else:
+            groups.append([view])
+            group_last_ms = int(view["timestamp_ms"][-1])
+    ordered = []
+    for group in groups:
+        if len(group) == 1:
+            ordered.append(group[0])
+        else:
+            records = np.concatenate(group)
+            ordered.append(records[np.argsort(records["timestamp_ms"], kind="stable")])
+    return ordered
+
+
+class Segment:
+    """
+    segment 파일 하나를 mmap해서 들고 있는 객체. SegmentLog가 만들고 씀.
+    - path(str) : segment 파일 경로
+    - writable(bool) : True면 이어 쓸 수 있게 열고, False면 읽기 전용으로 염 (읽기 전용 배열을 돌려줌)
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        with open(path, "r+b" if writable else "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, version, record_size, self.capacity, self.stride = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD_DTYPE.itemsize:
+            self.mm.close()
+            raise SegmentFormatError(f"{path}는 알 수 없는 segment 파일입니다! (magic={magic}, version={version})")
+        offset = _records_offset(self.capacity, self.stride)
+        self.index = np.frombuffer(self.mm, dtype="<i8", count=-(-self.capacity // self.stride), offset=HEADER_SIZE)
+        self.records = np.frombuffer(self.mm, dtype=RECORD_DTYPE, count=self.capacity, offset=offset)
+        self.timestamps = self.records["timestamp_ms"]
+        self.count = min(_COUNT.unpack_from(self.mm, _COUNT_OFFSET)[0], self.capacity)
+        # count만 먼저 디스크에 내려간 채 꺼졌으면 끝의 비어있는 레코드들을 버림
+        while self.count > 0 and self.timestamps[self.count - 1] == 0:
+            self.count -= 1
+
+    @classmethod
+    def create(cls, path, capacity=SEGMENT_RECORDS, stride=INDEX_STRIDE):
+        """레코드 capacity칸을 미리 잡아둔 빈 segment 파일을 만들고 이어 쓸 수 있게 열어 반환함"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD_DTYPE.itemsize, capacity, stride))
+            # 파일 크기만 잡아둠 (sparse 파일이라 쓴 만큼만 SD카드를 씀)
+            f.truncate(_records_offset(capacity, stride) + capacity * RECORD_DTYPE.itemsize)
+        os.replace(tmp_path, path)
+        return cls(path, writable=True)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    @property
+    def first_ms(self):
+        return int(self.timestamps[0]) if self.count else None
+
+    @property
+    def last_ms(self):
+        return int(self.timestamps[self.count - 1]) if self.count else None
+
+    def append(self, timestamp_ms, temperature, humidity, water_level):
+        """레코드 하나를 다음 칸에 쓰고 count를 고침. timestamp_ms는 last_ms보다 작으면 안 되며, 가득 찬지는 부르는 쪽이 확인함"""
+        i = self.count
+        self.records[i] = (timestamp_ms, temperature, humidity, water_level)
+        if i % self.stride == 0:
+            self.index[i // self.stride] = timestamp_ms
+        self.count = i + 1
+        _COUNT.pack_into(self.mm, _COUNT_OFFSET, self.count)
+
+    def _bound(self, index, timestamps, count, timestamp_ms, side):
+        """[0, count)의 레코드 중 시각이 timestamp_ms 이상("left")/초과("right")인 첫 위치. 색인으로 구간을 찾은 뒤 그 안에서만 찾음"""
+        blocks = index[: -(-count // self.stride)]
+        block = max(int(np.searchsorted(blocks, timestamp_ms, side)) - 1, 0)
+        lower = block * self.stride
+        upper = min(lower + self.stride, count)
+        return lower + int(np.searchsorted(timestamps[lower:upper], timestamp_ms, side))
+
+    def view(self, start_ms=None, end_ms=None, count=None):
+        """
+        [start_ms, end_ms] (epoch 밀리초, 끝 포함. None이면 제한 없음) 안의 레코드들을 복사 없이 structured array view로 반환함
+        - count(int) : 이만큼 쓴 것으로 보고 찾음 (SegmentLog가 잠금 안에서 읽어둔 값). None이면 지금 count
+        """
+        # 정리(retention.py)가 그 사이에 지운 segment면 빈 배열을 돌려줌
+        records, index, timestamps = self.records, self.index, self.timestamps
+        if records is None:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        if count is None:
+            count = self.count
+        if count == 0:
+            return records[:0]
+        if (start_ms is not None and timestamps[count - 1] < start_ms) or (end_ms is not None and timestamps[0] > end_ms):
+            return records[:0]
+        lower = 0 if start_ms is None else self._bound(index, timestamps, count, start_ms, "left")
+        upper = count if end_ms is None else self._bound(index, timestamps, count, end_ms, "right")
+        return records[lower:max(lower, upper)]
+
+    def flush(self):
+        if self.writable:
+            self.mm.flush()
+
+    def close(self):
+        """mmap을 닫음. 아직 누가 이 segment의 view를 들고 있으면 닫지 않고 그 view가 없어질 때 함께 풀리게 둠"""
+        self.flush()
+        self.index = self.records = self.timestamps = None
+        try:
+            self.mm.close()
+        except BufferError:
+            LOG.debug("close_deferred", "읽는 중인 segment라 mmap을 나중에 닫습니다.", path=self.path)
+
+
+class SegmentLog:
+    """
+    스마트팜마다 segment 파일들을 시각 순서로 들고 있는 저장소.
+    - root(str) : segment 파일들을 둘 폴더 (스마트팜마다 하위 폴더를 만듬)
+    - capacity(int) : 새로 만드는 segment의 레코드 칸 수
+    - stride(int) : 새로 만드는 segment의 색인 간격
+    """
+
+    def __init__(self, root=SEGMENT_DIR, capacity=SEGMENT_RECORDS, stride=INDEX_STRIDE):
+        self.root = root
+        self.capacity = capacity
+        self.stride = stride
+        self._lock = threading.Lock()
+        self._segments = {}  # device_id -> [Segment] (첫 시각 순서)
+        self._writable = {}  # device_id -> 이어 쓰는 Segment (시계가 뒤로 가면 목록의 마지막이 아닐 수 있음)
+
+        # 지표들
+        self.appended_count = 0
+        self.sealed_count = 0
+
+        for directory in sorted(glob.glob(os.path.join(root, "*", ""))):
+            device_id = os.path.basename(os.path.dirname(directory))
+            paths = sorted(glob.glob(os.path.join(directory, "*.seg")))
+            segments = []
+            for i, path in enumerate(paths):
+                try:
+                    segments.append(Segment(path, writable=i == len(paths) - 1))
+                except (OSError, SegmentFormatError) as e:
+                    LOG.error("open_failed", "segment 파일을 열 수 없어 건너뜁니다!", path=path, error=e)
+            # 파일 이름이 첫 시각이므로 이름 순서가 곧 첫 시각 순서임
+            self._segments[device_id] = [segment for segment in segments if segment.count or segment.writable]
+            if segments and segments[-1].writable:
+                self._writable[device_id] = segments[-1]
+        if self._segments:
+            LOG.info(
+                "opened",
+                "segment 파일들을 열었습니다.",
+                devices=len(self._segments),
+                segments=sum(len(segments) for segments in self._segments.values()),
+            )
+
+    def devices(self) -> list:
+        with self._lock:
+            return sorted(device_id for device_id, segments in self._segments.items() if segments)
+
+    def append(self, device_id, timestamp_ms, temperature, humidity, water_level):
+        """
+        측정값 하나를 그 스마트팜의 마지막 segment에 이어 씀 (값이 None이면 nan).
+        segment가 가득 찼거나 시계가 뒤로 가서 시각이 마지막 레코드보다 이르면 새 segment를 만들어 씀
+        """
+        temperature, humidity, water_level = (np.nan if value is None else value for value in (temperature, humidity, water_level))
+        with self._lock:
+            segments = self._segments.setdefault(device_id, [])
+            segment = self._writable.get(device_id)
+            if segment is None or segment.full or (segment.count and timestamp_ms < segment.last_ms):
+                segment = self._new_segment(device_id, timestamp_ms)
+                segment.append(timestamp_ms, temperature, humidity, water_level)
+                # 시계가 뒤로 가 새 segment의 첫 시각이 앞 segment들보다 이를 수 있으므로 목록 전체를 첫 시각 순서로 다시 정렬함
+                # (이어 쓰던 segment는 비어 있으면 바꾸지 않으므로 여기서는 모든 segment에 레코드가 있음)
+                segments.sort(key=lambda segment: segment.first_ms)
+            else:
+                segment.append(timestamp_ms, temperature, humidity, water_level)
+            self.appended_count += 1
+
+    def append_row(self, row):
+        """ingest.MEASUREMENT_COLUMNS 순서의 tuple (timestamp_ms, 온도, 습도, 수위, device_id)을 이어 씀"""
+        self.append(row[4], row[0], row[1], row[2], row[3])
+
+    def _new_segment(self, device_id, timestamp_ms):
+        previous = self._writable.get(device_id)
+        if previous is not None:
+            # 더 쓰지 않을 segment는 디스크에 내려 씀
+            previous.flush()
+            self.sealed_count += 1
+        directory = os.path.join(self.root, device_id)
+        os.makedirs(directory, exist_ok=True)
+        # 시계가 뒤로 가 같은 첫 시각의 파일이 이미 있으면 이름 뒤에 번호를 붙임
+        path = os.path.join(directory, f"{timestamp_ms:016d}.seg")
+        suffix = 0
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(directory, f"{timestamp_ms:016d}-{suffix}.seg")
+        segment = Segment.create(path, self.capacity, self.stride)
+        self._segments[device_id].append(segment)
+        self._writable[device_id] = segment
+        LOG.debug("new_segment", "새 segment 파일을 만들었습니다.", device=device_id, path=segment.path)
+        return segment
+
+    def _snapshot(self, device_id):
+        """그 스마트팜의 (segment, 지금까지 쓴 개수)들. 잠금 밖에서 읽는 동안 이어 쓰는 레코드는 보지 않음"""
+        with self._lock:
+            return [(segment, segment.count) for segment in self._segments.get(device_id, ())]
+
+    def read(self, device_id, start_ms=None, end_ms=None) -> list:
+        """
+        [start_ms, end_ms] (epoch 밀리초, 끝 포함. None이면 제한 없음) 안의 레코드들을 segment마다 하나씩인
+        RECORD_DTYPE structured array view들의 list로 시각 순서대로 반환함 (복사 없음. 빈 view는 뺌).
+        시계가 뒤로 가 시각 범위가 겹치는 segment들의 레코드는 하나로 합쳐 정렬한 배열로 돌려줌
+        """
+        views = (segment.view(start_ms, end_ms, count) for segment, count in self._snapshot(device_id))
+        return _in_order([view for view in views if len(view)])
+
+    def latest(self, device_id, n) -> list:
+        """그 스마트팜의 시각이 가장 늦은 n개(혹은 그보다 적게 있으면 전부) 레코드를 시각 순서대로 view들의 list로 반환함"""
+        if n <= 0:
+            return []
+        # segment마다 마지막 n개 안에 전체의 마지막 n개가 모두 들어 있음
+        views = _in_order([segment.view(count=count)[-n:] for segment, count in self._snapshot(device_id) if count])
+        latest = []
+        for view in reversed(views):
+            if n <= 0:
+                break
+            latest.append(view[-n:])
+            n -= len(latest[-1])
+        latest.reverse()
+        return latest
+
+    def expired(self, device_id, cutoff_ms) -> list:
+        """마지막 레코드가 cutoff_ms보다 이른, 더 쓰지 않는 segment들 (이어 쓰는 segment는 빼고)"""
+        with self._lock:
+            writable = self._writable.get(device_id)
+            return [
+                segment
+                for segment in self._segments.get(device_id, [])
+                if segment is not writable and segment.count and segment.last_ms < cutoff_ms
+            ]
+
+    def remove(self, device_id, segment):
+        """segment 하나를 목록에서 빼고 파일을 지움 (retention.py가 열 파일로 옮긴 뒤 부름)"""
+        with self._lock:
+            self._segments[device_id].remove(segment)
+        segment.close()
+        os.remove(segment.path)
+
+    def flush(self):
+        """이어 쓰는 중인 segment들을 디스크에 내려 씀 (msync)"""
+        with self._lock:
+            for segment in self._writable.values():
+                segment.flush()
+
+    def close(self):
+        with self._lock:
+            for segments in self._segments.values():
+                for segment in segments:
+                    segment.close()
+            self._segments = {}
+            self._writable = {}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            segments = [segment for device_segments in self._segments.values() for segment in device_segments]
+            return {
+                "devices": len(self._segments),
+                "segments": len(segments),
+                "records": sum(segment.count for segment in segments),
+                "bytes": sum(len(segment.mm) for segment in segments),
+                "appended": self.appended_count,
+                "sealed": self.sealed_count,
+            }
@@ -0,0 +1,93 @@
+"""
+스마트팜마다의 사용자 설정값(최저 온도, 불 켜는/끄는 시각)을 settings.db에 저장하는 모듈.
+
+settings 테이블은 스마트팜(device_id)마다 한 줄씩 가지며, 예전처럼 한 줄만 있던 settings 테이블은
+처음 켜질 때 첫번째 스마트팜의 설정으로 옮김.
+"""
+
+import sqlite3
+
+import log
+from hardware import DEFAULT_MIN_TEMP, DEFAULT_OFF_TIME, DEFAULT_ON_TIME
+
+LOG = log.get_logger("settings")
+
+CREATE_SETTINGS_QUERY = """CREATE TABLE settings(
+                device_id TEXT PRIMARY KEY,
+                ref_temperature REAL,
+                ref_turn_on_time TEXT,
+                ref_turn_off_time TEXT);"""
+
+
+class SettingsStore:
+    """
+    settings.db의 스마트팜별 설정값을 읽고 쓰는 객체. 호출한 스레드마다 커넥션을 새로 열어 씀.
+    - db_path(str) : settings.db 경로
+    """
+
+    def __init__(self, db_path="./settings.db"):
+        self.db_path = db_path
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def ensure(self, device_ids):
+        """
+        settings 테이블이 없거나 예전 형식(device_id 열이 없음)이면 만들고, 설정이 없는 스마트팜에는 기본값을 넣음.
+        예전 형식의 설정 한 줄은 device_ids의 첫번째 스마트팜의 설정이 됨
+        """
+        con = self._connect()
+        try:
+            with con:
+                columns = [row[1] for row in con.execute("PRAGMA table_info(settings);")]
+                legacy = None
+                if columns and "device_id" not in columns:
+                    LOG.info("migrate_table", "예전 settings 테이블의 설정을 옮깁니다.", device=device_ids[0])
+                    legacy = con.execute("SELECT ref_temperature, ref_turn_on_time, ref_turn_off_time FROM settings;").fetchone()
+                    con.execute("DROP TABLE settings;")
+                    columns = []
+                if not columns:
+                    if legacy is None:
+                        LOG.info("create_table", "settings.db에 settings 테이블이 존재하지 않아 만듭니다!")
+                    con.execute(CREATE_SETTINGS_QUERY)
+                if legacy is not None:
+                    con.execute("INSERT INTO settings VALUES (?, ?, ?, ?);", (device_ids[0], *legacy))
+                for device_id in device_ids:
+                    con.execute(
+                        "INSERT OR IGNORE INTO settings VALUES (?, ?, ?, ?);",
+                        (device_id, DEFAULT_MIN_TEMP, DEFAULT_ON_TIME.strftime("%H:%M"), DEFAULT_OFF_TIME.strftime("%H:%M")),
+                    )
+        finally:
+            con.close()
+
+    def load(self, device_id):
+        """스마트팜의 설정값을 [ref_temperature, ref_turn_on_time, ref_turn_off_time] list로 반환함 (시각은 '%H:%M' 문자열)"""
+        con = self._connect()
+        try:
+            row = con.execute(
+                "SELECT ref_temperature, ref_turn_on_time, ref_turn_off_time FROM settings WHERE device_id = ?;", (device_id,)
+            ).fetchone()
+        finally:
+            con.close()
+        if row is None:
+            raise KeyError(f"{device_id}의 설정이 settings.db에 없습니다!")
+        return list(row)
+
+    def set_min_temp(self, device_id, temp):
+        con = self._connect()
+        try:
+            with con:
+                con.execute("UPDATE settings SET ref_temperature = ? WHERE device_id = ?;", (round(temp, 1), device_id))
+        finally:
+            con.close()
+
+    def set_time_period(self, device_id, on_time_str, off_time_str):
+        con = self._connect()
+        try:
+            with con:
+                con.execute(
+                    "UPDATE settings SET ref_turn_on_time = ?, ref_turn_off_time = ? WHERE device_id = ?;",
+                    (on_time_str, off_time_str, device_id),
+                )
+        finally:
+            con.close()
@@ -0,0 +1,166 @@
+"""
+raw 측정값을 어디에 저장하고 어디서 읽을지 고르는 저장소(storage backend) 모듈.
+
+환경변수 SMARTFARM_STORAGE로 고름
+- sqlite(기본값) : datas.db의 measurements 테이블 (SqliteStorage)
+- segments : SEGMENT_DIR의 memory-mapped segment 파일들 (SegmentStorage, segments.py).
+  측정값 하나를 저장하는 비용이 레코드 하나의 복사뿐이라 수위처럼 자주 재는 값이나 랙이 많은 스마트팜에 알맞음
+어느 쪽이든 1분/1시간/1일 집계(rollups.py)와 액추에이터 상태 변화(actuators.py)는 MeasurementWriter가 datas.db에 저장하며,
+두 저장소는 같은 메서드를 가짐
+- append(row) : ingest.MEASUREMENT_COLUMNS 순서의 측정값 한 줄을 저장함
+- iter_raw(columns, start, end, device_id) : 기간의 raw 측정값을 history.iter_rows()와 같은 모양의 chunk로 내보냄
+- latest(device_id, n) : 최근 n개 측정값 (timestamps, values) (링 버퍼를 채울 때)
+- flush(), close(), get_stats()
+"""
+
+import os
+
+import numpy as np
+
+import history
+from ingest import MeasurementWriter
+from ringbuffer import CHANNELS, load_latest, timestamp_to_ms
+from segments import SEGMENT_DIR, VALUE_FIELDS, SegmentLog
+
+STORAGE_BACKEND = os.environ.get("SMARTFARM_STORAGE", "sqlite")
+STORAGE_BACKENDS = ("sqlite", "segments")
+
+
+def open_storage(backend, db_path, max_delay=30.0):
+    """
+    backend("sqlite" 혹은 "segments")의 저장소를 만들어 반환함. 저장소의 writer(MeasurementWriter)는 집계와
+    액추에이터 상태 변화도 저장하므로 actuators.ActuatorLog에도 넘겨 씀
+    - max_delay(float) : writer가 모아서 저장하기까지 기다리는 최대 시간(초)
+    """
+    if backend == "sqlite":
+        return SqliteStorage(db_path, MeasurementWriter(db_path, max_delay=max_delay))
+    if backend == "segments":
+        return SegmentStorage(db_path, MeasurementWriter(db_path, max_delay=max_delay, raw=False), SegmentLog(SEGMENT_DIR))
+    raise ValueError(f"저장소 {backend}는 허용되지 않습니다! ({', '.join(STORAGE_BACKENDS)} 중 하나)")
+
+
+class SqliteStorage:
+    """
+    raw 측정값을 datas.db의 measurements 테이블에 저장하는 기본 저장소.
+    - db_path(str) : datas.db 경로
+    - writer(MeasurementWriter) : 측정값을 모아서 저장하는 저장기
+    """
+
+    backend = "sqlite"
+    segment_log = None
+
+    def __init__(self, db_path, writer):
+        self.db_path = db_path
+        self.writer = writer
+
+    def append(self, row) -> bool:
+        return self.writer.submit(row)
+
+    def iter_raw(self, columns, start=None, end=None, device_id=None, chunk_size=500):
+        """
+        measurements의 [start, end] raw 측정값을 chunk(list)로 내보내는 generator.
+        - columns(list[str]) : history.build_query()가 돌려준 열 이름들 ("timestamp"(, "device_id"), 열들...)
+        """
+        fields = [column for column in columns if column not in ("timestamp", "device_id")]
+        query, params, _ = history.build_query(start, end, fields, "raw", device_id)
+        return history.iter_rows(self.db_path, query, params, chunk_size)
+
+    def latest(self, device_id, n):
+        """-> return (timestamps int64[n], values float64[n, 3]) (오래된 것부터)"""
+        return load_latest(self.db_path, n, device_id)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+    def get_stats(self) -> dict:
+        return {"backend": self.backend}
+
+
+class SegmentStorage(SqliteStorage):
+    """
+    raw 측정값을 segment 파일(segments.SegmentLog)에 저장하는 저장소. 집계와 액추에이터 상태 변화는
+    writer(raw=False)가 datas.db에 저장함.
+    sqlite 저장소를 쓰다가 바꾼 경우 measurements에 남아 있는 예전 raw 측정값도 segment 파일의 측정값 앞에 이어서 읽음
+    - segment_log(SegmentLog) : segment 파일들
+    """
+
+    backend = "segments"
+
+    def __init__(self, db_path, writer, segment_log):
+        super().__init__(db_path, writer)
+        self.segment_log = segment_log
+
+    def append(self, row) -> bool:
+        # 레코드 하나를 mmap에 복사하고, 집계는 writer가 모아서 갱신함
+        self.segment_log.append_row(row)
+        return self.writer.submit(row)
+
+    def iter_raw(self, columns, start=None, end=None, device_id=None, chunk_size=500):
+        """
+        measurements에 남은 예전 측정값, segment 파일의 측정값 순서로 [start, end] raw 측정값을 chunk(list)로 내보내는 generator.
+        segment는 view로 읽어 chunk마다 필요한 만큼만 파이썬 값으로 바꿈. 상태 열은 None으로 내보냄 (history.fill_actuator_states()가 채움)
+        """
+        yield from super().iter_raw(columns, start, end, device_id, chunk_size)
+        fields = [column for column in columns if column not in ("timestamp", "device_id")]
+        start_ms = None if start is None else timestamp_to_ms(start)
+        end_ms = None if end is None else timestamp_to_ms(end) + 999
+        if device_id is not None:
+            for view in self.segment_log.read(device_id, start_ms, end_ms):
+                for offset in range(0, len(view), chunk_size):
+                    yield self._rows(view[offset : offset + chunk_size], fields)
+            return
+        # 모든 스마트팜이면 스마트팜마다의 view들을 이어 붙여 (시각, 스마트팜) 순서로 정렬함 (이때만 복사함)
+        devices = self.segment_log.devices()
+        parts = [(code, view) for code, device in enumerate(devices) for view in self.segment_log.read(device, start_ms, end_ms)]
+        if not parts:
+            return
+        records = np.concatenate([view for _, view in parts])
+        codes = np.concatenate([np.full(len(view), code, dtype=np.uint16) for code, view in parts])
+        order = np.lexsort((codes, records["timestamp_ms"]))
+        for offset in range(0, len(order), chunk_size):
+            index = order[offset : offset + chunk_size]
+            yield self._rows(records[index], fields, [devices[code] for code in codes[index].tolist()])
+
+    @staticmethod
+    def _rows(records, fields, device_ids=None):
+        """레코드들을 history.iter_rows()와 같은 모양의 줄(tuple)들로 바꿈 (시각은 epoch 밀리초 그대로). nan은 None으로 내보냄"""
+        output = [records["timestamp_ms"].tolist()]
+        if device_ids is not None:
+            output.append(device_ids)
+        for field in fields:
+            if field in VALUE_FIELDS:
+                output.append([None if value != value else value for value in records[field].tolist()])
+            else:
+                output.append([None] * len(records))
+        return list(zip(*output))
+
+    def latest(self, device_id, n):
+        """segment 파일의 최근 n개. 모자라면 measurements에 남은 예전 측정값으로 앞을 채움"""
+        views = self.segment_log.latest(device_id, n)
+        count = sum(len(view) for view in views)
+        timestamps = [view["timestamp_ms"] for view in views]
+        values = [np.column_stack([view[name] for name in CHANNELS]) for view in views]
+        if count < n:
+            old_timestamps, old_values = super().latest(device_id, n - count)
+            if views:
+                keep = old_timestamps < views[0]["timestamp_ms"][0]
+                old_timestamps, old_values = old_timestamps[keep], old_values[keep]
+            timestamps.insert(0, old_timestamps)
+            values.insert(0, old_values)
+        return np.concatenate(timestamps), np.concatenate(values).reshape(-1, len(CHANNELS))
+
+    def flush(self):
+        super().flush()
+        self.segment_log.flush()
+
+    def close(self):
+        super().close()
+        self.segment_log.close()
+
+    def get_stats(self) -> dict:
+        stats = self.segment_log.get_stats()
+        stats["backend"] = self.backend
+        return stats
@@ -0,0 +1,128 @@
+"""
+카메라 화면을 여러 사용자에게 MJPEG(multipart/x-mixed-replace)로 보내는 모듈.
+
+사진은 캡처 스레드 하나만 찍고, 보는 사람(viewer)마다 작은 큐를 하나씩 두어 같은 JPEG bytes를 나눠줌.
+- 큐가 가득 찬 느린 사용자는 오래된 사진을 버리고 가장 최신 사진만 받음
+- 보는 사람이 한 명도 없으면 캡처를 멈춤
+base64로 socket.io에 실어 보내던 예전 방식보다 보내는 양이 약 33% 적고, 아무도 안 볼 때는 CPU와 Wi-Fi를 쓰지 않음.
+"""
+
+import queue
+import threading
+import time
+
+import log
+
+LOG = log.get_logger("streaming")
+
+BOUNDARY = "frame"
+
+
+class FrameBroadcaster:
+    """
+    사진 한 장을 찍어 모든 viewer의 큐에 나눠주는 캡처 스레드.
+    - capture : 인자 없이 호출하면 JPEG bytes(혹은 카메라가 없으면 None)를 반환하는 함수
+    - interval(float) : 사진을 찍는 주기(초)
+    - viewer_queue_size(int) : viewer마다 쌓아둘 수 있는 사진 수. 넘치면 오래된 사진을 버림
+    """
+
+    def __init__(self, capture, interval, viewer_queue_size=2):
+        self.capture = capture
+        self.interval = interval
+        self.viewer_queue_size = viewer_queue_size
+        self.viewers = set()
+        self._lock = threading.Lock()
+        self._has_viewers = threading.Event()
+        self._thread = None
+
+        # 지표들
+        self.captured_count = 0
+        self.dropped_count = 0
+        self.last_capture_seconds = 0.0
+
+    def subscribe(self):
+        """새 viewer의 큐를 만들어 등록하고 반환함. 캡처 스레드가 없으면 띄움"""
+        viewer = queue.Queue(maxsize=self.viewer_queue_size)
+        with self._lock:
+            self.viewers.add(viewer)
+            self._has_viewers.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="FrameBroadcaster", daemon=True)
+                self._thread.start()
+        LOG.info("subscribe", "viewer가 접속했습니다.", viewers=len(self.viewers))
+        return viewer
+
+    def unsubscribe(self, viewer):
+        """viewer의 큐를 등록 해제함. 남은 viewer가 없으면 캡처를 멈춤"""
+        with self._lock:
+            self.viewers.discard(viewer)
+            if not self.viewers:
+                self._has_viewers.clear()
+        LOG.info("unsubscribe", "viewer가 나갔습니다.", viewers=len(self.viewers))
+
+    def get_stats(self) -> dict:
+        return {
+            "viewers": len(self.viewers),
+            "captured": self.captured_count,
+            "dropped": self.dropped_count,
+            "last_capture_seconds": self.last_capture_seconds,
+        }
+
+    def _publish(self, frame):
+        with self._lock:
+            viewers = list(self.viewers)
+        for viewer in viewers:
+            try:
+                viewer.put_nowait(frame)
+            except queue.Full:
+                # 느린 viewer는 가장 오래된 사진을 버리고 최신 사진을 넣음
+                try:
+                    viewer.get_nowait()
+                    self.dropped_count += 1
+                except queue.Empty:
+                    pass
+                try:
+                    viewer.put_nowait(frame)
+                except queue.Full:
+                    self.dropped_count += 1
+
+    def _run(self):
+        """캡처 스레드용 함수. viewer가 있을 때만 interval마다 사진을 찍어 나눠줌"""
+        next_time = time.monotonic()
+        while True:
+            if not self._has_viewers.is_set():
+                self._has_viewers.wait()
+                next_time = time.monotonic()
+            start = time.monotonic()
+            try:
+                frame = self.capture()
+            except Exception as e:
+                LOG.error("capture_failed", "사진을 찍는 중 오류가 발생했습니다!", every=60, error=e)
+                frame = None
+            self.last_capture_seconds = time.monotonic() - start
+            if frame is not None:
+                self.captured_count += 1
+                self._publish(frame)
+            next_time = max(next_time + self.interval, time.monotonic())
+            time.sleep(max(0.0, next_time - time.monotonic()))
+
+    def mjpeg_stream(self, timeout=None):
+        """
+        viewer로 등록한 뒤 그 큐에서 사진을 꺼내 multipart/x-mixed-replace 형식의 조각으로 내보내는 generator.
+        사용자가 연결을 끊어 generator가 닫히면 viewer를 등록 해제함.
+        - timeout(float) : 이 시간(초) 동안 사진이 안 오면 스트림을 끝냄. None이면 계속 기다림
+        """
+        # 응답이 실제로 시작될 때 등록해야, 시작도 못하고 닫힌 응답이 viewer로 남지 않음
+        viewer = self.subscribe()
+        try:
+            while True:
+                try:
+                    frame = viewer.get(timeout=timeout)
+                except queue.Empty:
+                    return
+                # 사진 bytes를 헤더와 이어 붙이면 사진 크기만큼 복사가 생기므로 따로 내보냄
+                yield f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode()
+                yield frame
+                yield b"\r\n"
+        finally:
+            self.unsubscribe(viewer)
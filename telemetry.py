@@ -0,0 +1,260 @@
+"""
+측정값을 구독(subscribe)한 socket.io 사용자들에게만, 바뀐 값만 골라 보내는 텔레메트리 발행기.
+
+예전에는 측정할 때마다 ON/OFF 문자열 4개와 시각 문자열까지 들어있는 dict 전체를 접속한 모든 사용자에게 보냈음.
+이제는 사용자가 "telemetry_subscribe"로 (장치, 채널, 인코딩)을 골라 그 방(room)에 들어가고, 발행기는
+- 방에 아무도 없으면 메시지를 만들지도 않고
+- 지난번에 보낸 값과 달라진 필드만 보내며 (keyframe_interval번마다 한번은 모든 필드를 보내는 keyframe)
+- 방 하나에 한번만 emit하기 때문에 같은 방의 사용자가 30명이어도 직렬화(JSON 혹은 binary)는 한번만 함
+방 이름은 "장치/채널/인코딩" (예: "farm/environment/json").
+
+메시지 ("telemetry" 이벤트)
+- json : {"d": 장치, "c": 채널, "s": 순번, "t": 측정시각(epoch 밀리초), "k": keyframe이면 1, "v": {필드: 값}}
+- binary : {"r": 방 이름, "b": bytes}. bytes는 BINARY_HEADER(flags, 순번, 측정시각, 필드 수) 뒤에 필드마다 BINARY_FIELD(필드 번호, float32 값)
+액추에이터 상태는 "ON"/"OFF" 대신 1/0으로 보냄. 순번이 건너뛰면 사용자는 "telemetry_resync"로 keyframe을 다시 받을 수 있음.
+"""
+
+import math
+import struct
+import threading
+import time
+
+import metrics
+
+# binary 인코딩에서 쓰는 필드 번호 (순서를 바꾸면 안 됨)
+FIELDS = (
+    "temperature",
+    "humidity",
+    "water_level",
+    "led_first_state",
+    "led_second_state",
+    "heater_state",
+    "pump_state",
+)
+FIELD_IDS = {name: i for i, name in enumerate(FIELDS)}
+
+ENCODINGS = ("json", "binary")
+BINARY_HEADER = struct.Struct("<BIqB")  # flags(bit 0 : keyframe), 순번, 측정시각(epoch 밀리초), 필드 수
+BINARY_FIELD = struct.Struct("<Bf")  # 필드 번호, 값
+
+EVENT = "telemetry"
+
+SOCKET_EMIT_SECONDS = metrics.histogram("smartfarm_socket_emit_seconds", "telemetry 메시지 한 번을 emit하는 데 걸린 시간", ["encoding"])
+
+
+def room_name(device_id, channel, encoding):
+    return f"{device_id}/{channel}/{encoding}"
+
+
+def encode_binary(seq, timestamp_ms, values, keyframe):
+    """값 dict를 binary 메시지 bytes로 만듬. None 값은 nan으로 보냄"""
+    parts = [BINARY_HEADER.pack(1 if keyframe else 0, seq, timestamp_ms, len(values))]
+    for name, value in values.items():
+        parts.append(BINARY_FIELD.pack(FIELD_IDS[name], math.nan if value is None else value))
+    return b"".join(parts)
+
+
+class TelemetryChannel:
+    """
+    장치 하나의 채널 하나 (예: 'farm'의 'environment'). 마지막으로 보낸 값을 들고 있다가 달라진 필드만 골라냄.
+    - fields(tuple) : 이 채널의 필드들 (FIELDS 중에서)
+    - precision(int) : 값을 이 소수 자리까지 반올림한 뒤 비교함 (센서 잡음 때문에 매번 값이 바뀐 것으로 보지 않도록)
+    - send_empty(bool) : 달라진 필드가 없어도 (측정이 있었다는 것을 알리기 위해) 빈 메시지를 보낼지
+    """
+
+    def __init__(self, device_id, name, fields, precision=1, send_empty=False):
+        for field in fields:
+            if field not in FIELD_IDS:
+                raise ValueError(f"알 수 없는 필드 {field}입니다! ({FIELDS} 중 하나)")
+        self.device_id = device_id
+        self.name = name
+        self.fields = tuple(fields)
+        self.precision = precision
+        self.send_empty = send_empty
+        self.seq = 0
+        self.timestamp_ms = 0
+        self.state = {}  # 마지막으로 보낸 값들
+        self.since_keyframe = None  # 마지막 keyframe 이후 보낸 메시지 수 (None이면 아직 keyframe을 안 보냄)
+
+    def normalize(self, values):
+        out = {}
+        for field in self.fields:
+            if field not in values:
+                continue
+            value = values[field]
+            if value == "ON":
+                value = 1
+            elif value == "OFF":
+                value = 0
+            elif isinstance(value, float):
+                value = None if math.isnan(value) else round(value, self.precision)
+            out[field] = value
+        return out
+
+    def keyframe(self):
+        """지금 들고 있는 모든 값으로 keyframe 메시지(json용 dict)를 만듬"""
+        return {"d": self.device_id, "c": self.name, "s": self.seq, "t": self.timestamp_ms, "k": 1, "v": dict(self.state)}
+
+
+class TelemetryPublisher:
+    """
+    채널별로 바뀐 값만 구독한 방에 보내는 발행기.
+    - socketio(flask_socketio.SocketIO) : emit할 socket.io 서버
+    - keyframe_interval(int) : 이 횟수마다 한번은 모든 필드를 보냄
+    """
+
+    def __init__(self, socketio, keyframe_interval=30):
+        self.socketio = socketio
+        self.keyframe_interval = keyframe_interval
+        self.channels = {}
+        self._lock = threading.Lock()
+        self._room_members = {}  # 방 이름 -> 구독자 sid 집합
+        self._sid_rooms = {}  # sid -> 들어가 있는 방 이름 집합
+
+        # 지표들
+        self.published_count = 0
+        self.keyframe_count = 0
+        self.emit_count = 0
+        self.skipped_no_subscribers = 0
+        self.skipped_unchanged = 0
+
+    def add_channel(self, device_id, name, fields, precision=1, send_empty=False):
+        channel = TelemetryChannel(device_id, name, fields, precision, send_empty)
+        self.channels[(device_id, name)] = channel
+        return channel
+
+    def _get_channel(self, device_id, name):
+        channel = self.channels.get((device_id, name))
+        if channel is None:
+            raise ValueError(f"등록되지 않은 채널입니다! ({device_id}/{name})")
+        return channel
+
+    def _rooms_with_members(self, channel):
+        """구독자가 한 명 이상 있는 이 채널의 방들을 (인코딩, 방 이름)으로 반환함"""
+        rooms = []
+        with self._lock:
+            for encoding in ENCODINGS:
+                room = room_name(channel.device_id, channel.name, encoding)
+                if self._room_members.get(room):
+                    rooms.append((encoding, room))
+        return rooms
+
+    def publish(self, device_id, name, values, timestamp=None):
+        """
+        채널의 새 값들을 받아 달라진 필드만 구독한 방들에 emit함. 새 값은 구독자가 없어도 기억해 둠 (새로 구독하면 keyframe으로 보냄)
+        - values(dict) : {필드: 값}. 상태는 'ON'/'OFF' 혹은 GPIO 값 그대로 줘도 됨
+        - timestamp(float) : 측정 시각 (time.time() 형식). None이면 지금
+        """
+        channel = self._get_channel(device_id, name)
+        values = channel.normalize(values)
+        with self._lock:
+            changed = {field: value for field, value in values.items() if channel.state.get(field, ()) != value}
+            channel.state.update(values)
+            channel.timestamp_ms = int((time.time() if timestamp is None else timestamp) * 1000)
+            keyframe = channel.since_keyframe is None or channel.since_keyframe + 1 >= self.keyframe_interval
+            if not keyframe and not changed and not channel.send_empty:
+                self.skipped_unchanged += 1
+                return
+            channel.seq += 1
+            channel.since_keyframe = 0 if keyframe else channel.since_keyframe + 1
+            payload_values = dict(channel.state) if keyframe else changed
+            seq, timestamp_ms = channel.seq, channel.timestamp_ms
+        self.published_count += 1
+        if keyframe:
+            self.keyframe_count += 1
+
+        rooms = self._rooms_with_members(channel)
+        if not rooms:
+            self.skipped_no_subscribers += 1
+            return
+        for encoding, room in rooms:
+            if encoding == "binary":
+                payload = {"r": room, "b": encode_binary(seq, timestamp_ms, payload_values, keyframe)}
+            else:
+                payload = {"d": device_id, "c": name, "s": seq, "t": timestamp_ms, "v": payload_values}
+                if keyframe:
+                    payload["k"] = 1
+            # 방 하나에 한번 emit하면 socket.io가 패킷을 한번만 인코딩해서 방 안의 모든 사용자에게 보냄
+            with SOCKET_EMIT_SECONDS.labels(encoding).time():
+                self.socketio.emit(EVENT, payload, to=room)
+            self.emit_count += 1
+
+    def _send_keyframe(self, sid, channel, encoding):
+        with self._lock:
+            message = channel.keyframe()
+        if encoding == "binary":
+            room = room_name(channel.device_id, channel.name, encoding)
+            payload = {"r": room, "b": encode_binary(message["s"], message["t"], message["v"], True)}
+        else:
+            payload = message
+        self.socketio.emit(EVENT, payload, to=sid)
+
+    def subscribe(self, sid, device_id, channels, encoding="json"):
+        """
+        sid 사용자를 장치의 채널들 방에 넣고 각 채널의 현재 keyframe을 바로 보냄 (다음 keyframe까지 기다리지 않도록).
+        flask_socketio의 이벤트 핸들러 안(request context)에서 불러야 함
+        """
+        from flask_socketio import join_room
+
+        if encoding not in ENCODINGS:
+            raise ValueError(f"인코딩 {encoding}는 허용되지 않습니다! ({ENCODINGS} 중 하나)")
+        targets = [self._get_channel(device_id, name) for name in channels]
+        for channel in targets:
+            room = room_name(device_id, channel.name, encoding)
+            join_room(room, sid=sid)
+            with self._lock:
+                self._room_members.setdefault(room, set()).add(sid)
+                self._sid_rooms.setdefault(sid, set()).add(room)
+            if channel.since_keyframe is not None:
+                self._send_keyframe(sid, channel, encoding)
+
+    def unsubscribe(self, sid, device_id=None, channels=None):
+        """sid 사용자를 방에서 뺌. device_id가 없으면 모든 방에서, channels가 없으면 그 장치의 모든 채널 방에서 뺌"""
+        from flask_socketio import leave_room
+
+        with self._lock:
+            rooms = set(self._sid_rooms.get(sid, ()))
+        for room in rooms:
+            room_device, room_channel, _ = room.split("/")
+            if device_id is not None and room_device != device_id:
+                continue
+            if channels is not None and room_channel not in channels:
+                continue
+            leave_room(room, sid=sid)
+            self._forget(sid, room)
+
+    def disconnect(self, sid):
+        """연결이 끊긴 sid를 구독자 목록에서 지움 (socket.io는 끊긴 사용자를 방에서 알아서 뺌)"""
+        with self._lock:
+            rooms = self._sid_rooms.pop(sid, set())
+            for room in rooms:
+                members = self._room_members.get(room)
+                if members is not None:
+                    members.discard(sid)
+
+    def _forget(self, sid, room):
+        with self._lock:
+            self._room_members.get(room, set()).discard(sid)
+            self._sid_rooms.get(sid, set()).discard(room)
+
+    def resync(self, sid):
+        """sid 사용자가 구독한 모든 채널의 keyframe을 다시 보냄 (순번이 건너뛰었을 때 사용자가 요청함)"""
+        with self._lock:
+            rooms = list(self._sid_rooms.get(sid, ()))
+        for room in rooms:
+            device_id, name, encoding = room.split("/")
+            channel = self.channels.get((device_id, name))
+            if channel is not None and channel.since_keyframe is not None:
+                self._send_keyframe(sid, channel, encoding)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            subscribers = {room: len(members) for room, members in self._room_members.items() if members}
+        return {
+            "published": self.published_count,
+            "keyframes": self.keyframe_count,
+            "emits": self.emit_count,
+            "skipped_no_subscribers": self.skipped_no_subscribers,
+            "skipped_unchanged": self.skipped_unchanged,
+            "subscribers": subscribers,
+        }
@@ -0,0 +1,193 @@
+"""
+까다로운 알고리즘들을 단순한(brute force) 계산과 비교하는 테스트 모음. docstring의 짧은 예제(doctest)도 함께 확인함.
+
+    SMARTFARM_BACKEND=sim python -m pytest -q
+"""
+
+import doctest
+import os
+import random
+import sqlite3
+from collections import Counter
+from datetime import datetime, timedelta
+
+os.environ.setdefault("SMARTFARM_BACKEND", "sim")
+
+import numpy as np
+import pytest
+
+import actuators
+import ingest
+import migrate
+import retention
+import rules
+import segments
+
+DOCTEST_MODULES = [actuators, retention, rules]
+
+
+@pytest.mark.parametrize("module", DOCTEST_MODULES, ids=lambda module: module.__name__)
+def test_docstring_examples(module):
+    assert doctest.testmod(module).failed == 0
+
+
+def test_merge_columns_matches_brute_force():
+    """중복이 많은 임의의 줄들로 new, old 순서로 처음 나온 값만 남고 스마트팜 번호가 바뀌는지 한 줄씩 비교함"""
+    rng = random.Random(2023)
+
+    def random_rows(devices, n):
+        return [(rng.choice(devices), rng.randrange(50) * 1000, rng.random(), None, None) for _ in range(n)]
+
+    old_rows, new_rows = random_rows(["b", "c"], 300), random_rows(["a", "b"], 300)
+    merged = retention.merge_columns(retention.rows_to_columns(old_rows), retention.rows_to_columns(new_rows))
+
+    expected = {}
+    for device_id, timestamp_ms, temperature, _, _ in new_rows + old_rows:
+        expected.setdefault((timestamp_ms, device_id), temperature)
+    devices = merged["devices"].tolist()
+    actual = zip(merged["timestamp"].tolist(), merged["device"].tolist(), merged["temperature"].tolist())
+    assert [(timestamp_ms, devices[code], temperature) for timestamp_ms, code, temperature in actual] == sorted(
+        (timestamp_ms, device_id, temperature) for (timestamp_ms, device_id), temperature in expected.items()
+    )
+
+
+def test_duty_cycle_matches_brute_force():
+    """임의의 로그와 구간들에서 1밀리초마다의 상태를 모두 더한 값과 비교함 (같은 상태가 이어서 기록된 경우 포함)"""
+    rng = random.Random(2023)
+    times = sorted(rng.sample(range(1, 300), 20))
+    states = [rng.randint(0, 1) for _ in times]
+    # 첫 기록보다 앞선 시각은 꺼져 있던 것으로 셈
+    on = [0] * 320
+    for time, state in zip(times, states):
+        on[time:] = [state] * (320 - time)
+    windows = [sorted(rng.sample(range(320), 2)) for _ in range(500)]
+    starts, ends = zip(*windows)
+    expected = [sum(on[start:end]) / (end - start) for start, end in windows]
+    assert np.allclose(actuators.ActuatorTimeline(times, states).duty_cycle(starts, ends), expected)
+
+
+def test_migration_matches_brute_force():
+    """
+    예전 형식(버전 1)의 임의의 측정값들을 7줄씩 옮긴 뒤, 줄마다 하나씩 따라가며 계산한 값과 비교함
+    (덩어리 경계를 넘어서도 상태가 바뀐 줄만 기록되어야 함)
+    """
+    rng = random.Random(2023)
+    con = sqlite3.connect(":memory:")
+    con.execute(
+        "CREATE TABLE measurements(timestamp TEXT PRIMARY KEY, temperature REAL, humidity REAL, water_level REAL, "
+        "led_first_state TEXT, led_second_state TEXT, heater_state TEXT, pump_state TEXT);"
+    )
+    when, rows = datetime(2023, 5, 1, 23, 0), []
+    for _ in range(100):
+        when += timedelta(seconds=rng.randint(1, 90))
+        states = [rng.choice(["ON", "OFF", "OFF", None]) for _ in actuators.ACTUATORS]
+        rows.append((when.strftime("%Y.%m.%d %H:%M:%S"), rng.uniform(10, 30), None, 3.0, *states))
+    con.executemany("INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows)
+
+    assert ingest.ensure_measurements_table(con)
+    while migrate.copy_chunk(con, chunk_rows=7):
+        pass
+    assert ingest.table_columns(con, ingest.LEGACY_MEASUREMENTS_TABLE) == []
+    assert migrate.migration_progress(con) is None
+
+    timestamps = [int(datetime.strptime(row[0], "%Y.%m.%d %H:%M:%S").timestamp() * 1000) for row in rows]
+    assert con.execute("SELECT device_id, timestamp_ms, temperature FROM measurements ORDER BY timestamp_ms;").fetchall() == [
+        (ingest.DEFAULT_DEVICE_ID, timestamp_ms, row[1]) for timestamp_ms, row in zip(timestamps, rows)
+    ]
+
+    events = []
+    for i, actuator in enumerate(actuators.ACTUATORS):
+        previous = None
+        for timestamp_ms, row in zip(timestamps, rows):
+            if row[4 + i] is not None and row[4 + i] != previous:
+                events.append((actuator, timestamp_ms, int(row[4 + i] == "ON")))
+                previous = row[4 + i]
+    assert con.execute(
+        "SELECT actuator, timestamp_ms, state FROM actuator_events ORDER BY actuator, timestamp_ms;"
+    ).fetchall() == sorted(events)
+
+    hours = Counter(row[0][:13] + ":00:00" for row in rows)
+    assert dict(con.execute("SELECT bucket, sample_count FROM measurements_1h;").fetchall()) == hours
+
+
+def test_segment_bound_matches_searchsorted(tmp_path):
+    """같은 시각이 여러 번 있는 레코드들로 색인 구간 경계 근처의 count들에서 np.searchsorted와 비교함"""
+    rng = random.Random(2023)
+    segment = segments.Segment.create(str(tmp_path / "bound.seg"), capacity=1000, stride=16)
+    timestamps = sorted(rng.choices(range(1, 500), k=700))
+    for timestamp_ms in timestamps:
+        segment.append(timestamp_ms, 0.0, 0.0, 0.0)
+    try:
+        for count in (1, 15, 16, 17, 32, 33, 700):
+            for timestamp_ms in range(502):
+                for side in ("left", "right"):
+                    assert segment._bound(segment.index, segment.timestamps, count, timestamp_ms, side) == np.searchsorted(
+                        timestamps[:count], timestamp_ms, side
+                    )
+    finally:
+        segment.close()
+
+
+def segment_timestamps(views):
+    return [timestamp_ms for view in views for timestamp_ms in view["timestamp_ms"].tolist()]
+
+
+def test_segment_log_merges_overlapping_segments(tmp_path):
+    """1000000을 쓴 뒤 시계가 5로 돌아가 [10, 1000000]과 [5, 20, 2000000] segment가 겹치는 경우"""
+    segment_log = segments.SegmentLog(str(tmp_path), capacity=3, stride=1)
+    try:
+        for timestamp_ms in (10, 1000000, 5, 20, 2000000, 3000000):
+            segment_log.append("farm", timestamp_ms, None, None, None)
+        assert [view["timestamp_ms"].tolist() for view in segment_log.read("farm")] == [[5, 10, 20, 1000000, 2000000], [3000000]]
+        assert [view["timestamp_ms"].tolist() for view in segment_log.latest("farm", 4)] == [[20, 1000000, 2000000], [3000000]]
+    finally:
+        segment_log.close()
+
+
+def test_segment_log_matches_sorted(tmp_path):
+    """시계가 가끔 뒤로 가는 임의의 측정값들로 여러 기간의 read()와 latest()를 정렬한 값과 비교함"""
+    rng = random.Random(2023)
+    segment_log = segments.SegmentLog(str(tmp_path), capacity=7, stride=2)
+    try:
+        timestamps, timestamp_ms = [], 1
+        for _ in range(2000):
+            timestamp_ms = max(timestamp_ms + (rng.choice([1, 3, 10]) if rng.random() > 0.02 else -rng.randint(0, 500)), 1)
+            timestamps.append(timestamp_ms)
+            segment_log.append("rack", timestamp_ms, None, None, None)
+        for start_ms, end_ms in [(None, None), (None, 300), (100, 900), (1000, None), (5000, 6000)]:
+            assert segment_timestamps(segment_log.read("rack", start_ms, end_ms)) == sorted(
+                t for t in timestamps if (start_ms is None or t >= start_ms) and (end_ms is None or t <= end_ms)
+            )
+        for n in (1, 5, 50, 2000):
+            assert segment_timestamps(segment_log.latest("rack", n)) == sorted(timestamps)[len(timestamps) - n :]
+    finally:
+        segment_log.close()
+
+
+def test_sliding_window_matches_brute_force():
+    """
+    epoch 초 시각의 임의의 측정값들(가끔 window보다 긴 공백 포함)을 넣으며 매번 window 안의 값들로 직접 계산한 값과 비교함.
+    기준점을 여러 번 다시 잡을 만큼 넣음
+    """
+    rng = random.Random(2023)
+    window, samples, t = rules.SlidingWindow(600), [], 1.68e9
+
+    def brute_force(agg):
+        inside = [(s, v) for s, v in samples if s >= t - 600]
+        if len(inside) < 2 or inside[-1][0] - inside[0][0] < 600 * rules.MIN_WINDOW_COVERAGE:
+            return None
+        times, values = np.array(inside).T
+        if agg == "slope":
+            return np.polyfit(times - times[0], values, 1)[0] * 60
+        return {"min": min, "max": max, "mean": np.mean}[agg](values)
+
+    for _ in range(5000):
+        t += rng.uniform(1, 30) + (1000 if rng.random() < 0.01 else 0)
+        samples = samples[-700:] + [(t, rng.gauss(20, 5))]
+        window.add(*samples[-1])
+        for agg in ("min", "max", "mean", "slope"):
+            expected = brute_force(agg)
+            if expected is None:
+                assert window.aggregate(agg) is None
+            else:
+                assert window.aggregate(agg) == pytest.approx(expected, rel=1e-6, abs=1e-6)